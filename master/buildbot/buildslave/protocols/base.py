@@ -94,6 +94,9 @@ class FileWriterImpl(object):
     def remote_write(self, data):
         raise NotImplementedError
 
+    def remote_cached(self, digests):
+        raise NotImplementedError
+
     def remote_utime(self, accessed_modified):
         raise NotImplementedError
 
@@ -15,6 +15,8 @@
 
 from __future__ import absolute_import
 
+from distutils.version import LooseVersion
+
 from buildbot.buildslave.protocols import base
 from twisted.internet import defer
 from twisted.internet import reactor
@@ -204,6 +206,11 @@ class Connection(base.Connection, pb.Avatar):
         slavebuilder = self.builders.get(builderName)
         remoteCommand = RemoteCommand(remoteCommand)
         args = self.createArgsProxies(args)
+        # slaves from 2.19 on can send their updates in batches, compressed
+        commands = (self.info or {}).get('slave_commands') or {}
+        version = commands.get(commandName)
+        if version and LooseVersion(version) >= LooseVersion("2.19"):
+            args['batchUpdates'] = True
         return slavebuilder.callRemote('startCommand',
                                        remoteCommand, commandId, commandName, args
                                        )
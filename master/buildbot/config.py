@@ -88,6 +88,7 @@ class MasterConfig(util.ComparableMixin):
         self.collapseRequests = None
         self.codebaseGenerator = None
         self.prioritizeBuilders = None
+        self.buildStartConcurrency = 1
         self.multiMaster = False
         self.manhole = None
         self.protocols = {}
@@ -126,8 +127,8 @@ class MasterConfig(util.ComparableMixin):
         self.services = {}
 
     _known_config_keys = set([
-        "buildbotURL", "buildCacheSize", "builders", "buildHorizon", "caches",
-        "change_source", "codebaseGenerator", "changeCacheSize", "changeHorizon",
+        "buildbotURL", "buildCacheSize", "builders", "buildHorizon",
+        "buildStartConcurrency", "caches", "change_source", "codebaseGenerator", "changeCacheSize", "changeHorizon",
         'db', "db_poll_interval", "db_url", "eventHorizon",
         "logCompressionLimit", "logCompressionMethod", "logEncoding",
         "logHorizon", "logMaxSize", "logMaxTailSize", "manhole",
@@ -297,8 +298,17 @@ class MasterConfig(util.ComparableMixin):
 
         if 'logCompressionMethod' in config_dict:
             logCompressionMethod = config_dict.get('logCompressionMethod')
-            if logCompressionMethod not in ('bz2', 'gz'):
-                error("c['logCompressionMethod'] must be 'bz2' or 'gz'")
+            if logCompressionMethod not in ('raw', 'bz2', 'gz', 'lz4'):
+                error("c['logCompressionMethod'] must be 'raw', 'bz2', 'gz' "
+                      "or 'lz4'")
+            if logCompressionMethod == 'lz4':
+                try:
+                    import lz4.block
+                    [lz4.block]
+                except ImportError:
+                    error("To set c['logCompressionMethod'] to 'lz4' you "
+                          "must install the lz4 library, version 0.9 or "
+                          "later ('pip install lz4')")
             self.logCompressionMethod = logCompressionMethod
 
         copy_int_param('logMaxSize')
@@ -331,6 +341,14 @@ class MasterConfig(util.ComparableMixin):
         else:
             self.prioritizeBuilders = prioritizeBuilders
 
+        if 'buildStartConcurrency' in config_dict:
+            buildStartConcurrency = config_dict['buildStartConcurrency']
+            if (not isinstance(buildStartConcurrency, int)
+                    or buildStartConcurrency < 1):
+                error("c['buildStartConcurrency'] must be a positive integer")
+            else:
+                self.buildStartConcurrency = buildStartConcurrency
+
         protocols = config_dict.get('protocols', {})
         if isinstance(protocols, dict):
             for proto, options in protocols.iteritems():
@@ -395,7 +413,13 @@ class MasterConfig(util.ComparableMixin):
 
         if 'db' in config_dict:
             db = config_dict['db']
-            if set(db.keys()) - set(['db_url', 'db_poll_interval']) and throwErrors:
+            if set(db.keys()) - set(['db_url', 'db_poll_interval',
+                                     'log_flush_interval',
+                                     'log_flush_size', 'pool_size',
+                                     'pool_max_size', 'read_db_url',
+                                     'read_lag', 'build_horizon',
+                                     'log_horizon', 'buildset_max_age',
+                                     'prune_batch_size']) and throwErrors:
                 error("unrecognized keys in c['db']")
             config_dict = db
 
@@ -412,6 +436,31 @@ class MasterConfig(util.ComparableMixin):
     def load_db(self, filename, config_dict):
         self.db = dict(db_url=self.getDbUrlFromConfig(config_dict))
 
+        db = config_dict.get('db', {})
+        for key in ('log_flush_interval', 'log_flush_size', 'read_lag',
+                    'buildset_max_age'):
+            if key in db:
+                if not isinstance(db[key], (int, long, float)) or db[key] < 0:
+                    error("c['db']['%s'] must be a non-negative number" % key)
+                else:
+                    self.db[key] = db[key]
+        for key in ('pool_size', 'pool_max_size', 'build_horizon',
+                    'log_horizon', 'prune_batch_size'):
+            if key in db:
+                if not isinstance(db[key], int) or db[key] < 1:
+                    error("c['db']['%s'] must be a positive integer" % key)
+                else:
+                    self.db[key] = db[key]
+        if ('pool_size' in self.db and 'pool_max_size' in self.db
+                and self.db['pool_max_size'] < self.db['pool_size']):
+            error("c['db']['pool_max_size'] must not be less than "
+                  "c['db']['pool_size']")
+        if 'read_db_url' in db:
+            if not isinstance(db['read_db_url'], basestring):
+                error("c['db']['read_db_url'] must be a string")
+            else:
+                self.db['read_db_url'] = db['read_db_url']
+
     def load_mq(self, filename, config_dict):
         from buildbot.mq import connector  # avoid circular imports
         if 'mq' in config_dict:
@@ -429,6 +478,9 @@ class MasterConfig(util.ComparableMixin):
             error("unrecognized keys in c['mq']: %s"
                   % (', '.join(unk),))
 
+        if typ == 'tcp' and not self.mq.get('broker'):
+            error("c['mq']['broker'] is required for mq type 'tcp'")
+
     def load_metrics(self, filename, config_dict):
         # we don't try to validate metrics keys
         if 'metrics' in config_dict:
@@ -151,6 +151,17 @@ class ListResult(UserList.UserList):
         self.total = total
         self.limit = limit
 
+    @classmethod
+    def fromDbResult(cls, dbResult, values):
+        """
+        Return C{values}, converted from the DB API result C{dbResult}, with
+        the pagination attributes of C{dbResult} if it has any.
+        """
+        if isinstance(dbResult, cls):
+            return cls(values, offset=dbResult.offset, total=dbResult.total,
+                       limit=dbResult.limit)
+        return values
+
     def __repr__(self):
         return "ListResult(%r, offset=%r, total=%r, limit=%r)" % \
             (self.data, self.offset, self.total, self.limit)
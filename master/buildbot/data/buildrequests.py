@@ -71,6 +71,13 @@ class BuildRequestsEndpoint(Db2DataMixin, base.Endpoint):
         /builders/n:builderid/buildrequests
     """
     rootLinkName = 'buildrequests'
+    fieldMapping = {
+        'buildrequestid': 'buildrequests.id',
+        'buildsetid': 'buildrequests.buildsetid',
+        'builderid': 'buildrequests.builderid',
+        'priority': 'buildrequests.priority',
+        'results': 'buildrequests.results',
+    }
 
     @defer.inlineCallbacks
     def get(self, resultSpec, kwargs):
@@ -86,20 +93,22 @@ class BuildRequestsEndpoint(Db2DataMixin, base.Endpoint):
             claimed = resultSpec.popBooleanFilter('claimed')
 
         bsid = resultSpec.popOneFilter('buildsetid', 'eq')
+        resultSpec.fieldMapping = self.fieldMapping
         buildrequests = yield self.master.db.buildrequests.getBuildRequests(
             builderid=builderid,
             complete=complete,
             claimed=claimed,
-            bsid=bsid)
-        defer.returnValue(
-            [(yield self.db2data(br)) for br in buildrequests])
+            bsid=bsid,
+            resultSpec=resultSpec)
+        defer.returnValue(base.ListResult.fromDbResult(
+            buildrequests, [(yield self.db2data(br)) for br in buildrequests]))
 
     def startConsuming(self, callback, options, kwargs):
         return self.master.mq.startConsuming(callback,
                                              ('buildrequests', None, None, None, None))
 
 
-class BuildRequest(base.ResourceType):
+class BuildRequest(Db2DataMixin, base.ResourceType):
 
     name = "buildrequest"
     plural = "buildrequests"
@@ -128,10 +137,15 @@ class BuildRequest(base.ResourceType):
 
     @defer.inlineCallbacks
     def generateEvent(self, brids, event):
+        # get all of the buildrequests in a single query, and munge them for
+        # the notifications
+        brdicts = yield self.master.db.buildrequests.getBuildRequests(
+            brids=brids)
+        brdicts = dict((brd['buildrequestid'], brd) for brd in brdicts)
         for _id in brids:
-            # get the build and munge the result for the notification
-            br = yield self.master.data.get(('buildrequests', str(_id)))
-            self.produceEvent(br, event)
+            if _id in brdicts:
+                br = yield self.db2data(brdicts[_id])
+                self.produceEvent(br, event)
 
     @defer.inlineCallbacks
     def callDbBuildRequests(self, brids, db_callable, event, **kw):
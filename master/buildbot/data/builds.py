@@ -77,18 +77,30 @@ class BuildsEndpoint(Db2DataMixin, base.Endpoint):
         /buildrequests/n:buildrequestid/builds
     """
     rootLinkName = 'builds'
+    fieldMapping = {
+        'buildid': 'builds.id',
+        'number': 'builds.number',
+        'builderid': 'builds.builderid',
+        'buildrequestid': 'builds.buildrequestid',
+        'buildslaveid': 'builds.buildslaveid',
+        'masterid': 'builds.masterid',
+        'state_string': 'builds.state_string',
+        'results': 'builds.results',
+    }
 
     @defer.inlineCallbacks
     def get(self, resultSpec, kwargs):
         # following returns None if no filter
         # true or false, if there is a complete filter
         complete = resultSpec.popBooleanFilter("complete")
+        resultSpec.fieldMapping = self.fieldMapping
         builds = yield self.master.db.builds.getBuilds(
             builderid=kwargs.get('builderid'),
             buildrequestid=kwargs.get('buildrequestid'),
-            complete=complete)
-        defer.returnValue(
-            [(yield self.db2data(dbdict)) for dbdict in builds])
+            complete=complete,
+            resultSpec=resultSpec)
+        defer.returnValue(base.ListResult.fromDbResult(
+            builds, [(yield self.db2data(dbdict)) for dbdict in builds]))
 
     def startConsuming(self, callback, options, kwargs):
         builderid = kwargs.get('builderid')
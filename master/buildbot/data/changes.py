@@ -69,6 +69,7 @@ class ChangesEndpoint(FixerMixin, base.Endpoint):
     def get(self, resultSpec, kwargs):
         buildid = kwargs.get('buildid')
         ssid = kwargs.get('ssid')
+        order = tuple(resultSpec.order or ())
         if buildid is not None:
             changes = yield self.master.db.changes.getChangesForBuild(buildid)
         elif ssid is not None:
@@ -77,6 +78,23 @@ class ChangesEndpoint(FixerMixin, base.Endpoint):
                 changes = [change]
             else:
                 changes = []
+        elif (resultSpec.limit is not None and resultSpec.offset is None
+              and not resultSpec.filters and order in ((), ('changeid',),
+                                                       ('-changeid',))):
+            # the first or last few changes, as the web UI asks for, can be
+            # fetched without loading every change
+            limit = resultSpec.limit
+            if order == ('-changeid',):
+                changes = yield self.master.db.changes.getRecentChanges(limit)
+                changes.reverse()
+            else:
+                changes = yield self.master.db.changes.getChanges(limit=limit)
+            total = yield self.master.db.changes.getChangesCount()
+            resultSpec.removePagination()
+            resultSpec.removeOrder()
+            changes = [(yield self._fixChange(ch)) for ch in changes]
+            defer.returnValue(base.ListResult(changes, offset=0, total=total,
+                                              limit=limit))
         else:
             changes = yield self.master.db.changes.getChanges()
 
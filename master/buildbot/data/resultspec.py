@@ -13,7 +13,13 @@
 #
 # Copyright Buildbot Team Members
 
+import heapq
+import operator
+import sqlalchemy as sa
+
 from buildbot.data import base
+from buildbot.db import NULL
+from sqlalchemy.sql import util as sql_util
 
 
 class Filter(object):
@@ -34,21 +40,96 @@ class Filter(object):
         'ne': lambda d, v: d not in v,
     }
 
+    # the operators above, as functions testing a single item
+    singular_predicates = {
+        'eq': lambda f, v: lambda d: d[f] == v,
+        'ne': lambda f, v: lambda d: d[f] != v,
+        'lt': lambda f, v: lambda d: d[f] < v,
+        'le': lambda f, v: lambda d: d[f] <= v,
+        'gt': lambda f, v: lambda d: d[f] > v,
+        'ge': lambda f, v: lambda d: d[f] >= v,
+    }
+
+    plural_predicates = {
+        'eq': lambda f, v: lambda d: d[f] in v,
+        'ne': lambda f, v: lambda d: d[f] not in v,
+    }
+
+    # SQL equivalents of the operators above, applied to a column
+    singular_operators_sql = {
+        'eq': lambda c, v: c == v[0],
+        'ne': lambda c, v: c != v[0],
+        'lt': lambda c, v: c < v[0],
+        'le': lambda c, v: c <= v[0],
+        'gt': lambda c, v: c > v[0],
+        'ge': lambda c, v: c >= v[0],
+    }
+
+    plural_operators_sql = {
+        'eq': lambda c, v: c.in_(v),
+        'ne': lambda c, v: sa.not_(c.in_(v)),
+    }
+
     def __init__(self, field, op, values):
         self.field = field
         self.op = op
         self.values = values
 
+    def _predicate(self):
+        v = self.values
+        if len(v) == 1:
+            return self.singular_predicates[self.op](self.field, v[0])
+        return self.plural_predicates[self.op](self.field, set(v))
+
     def _apply(self, data):
-        fld = self.field
+        pred = self._predicate()
+        return (d for d in data if pred(d))
+
+    def _sqlClause(self, column):
+        # return a clause selecting the same rows as _apply, or None if this
+        # operator has no SQL equivalent
         v = self.values
         if len(v) == 1:
-            ops = self.singular_operators
+            ops, sql_ops = self.singular_operators, self.singular_operators_sql
+            sql_v = v
+            if v[0] is None and self.op not in ('eq', 'ne'):
+                return None
         else:
-            ops = self.plural_operators
+            ops, sql_ops = self.plural_operators, self.plural_operators_sql
+            # NULL never matches IN, so handle None separately, below
+            sql_v = [x for x in v if x is not None]
+            if not sql_v:
+                return None
             v = set(v)
-        f = ops[self.op]
-        return (d for d in data if f(d[fld], v))
+        if self.op not in sql_ops:
+            return None
+        clause = sql_ops[self.op](column, sql_v)
+        # SQL comparisons with NULL are never true, while Python compares
+        # None like any other value
+        if column.nullable and ops[self.op](None, v):
+            clause = sa.or_(clause, column == NULL)
+        return clause
+
+
+def _allOf(preds):
+    # combine predicates into one, testing them in order
+    if len(preds) == 1:
+        return preds[0]
+    first, rest = preds[0], _allOf(preds[1:])
+    return lambda d: first(d) and rest(d)
+
+
+def _sortKeys(data, fields):
+    # return the sort key of each item.  None sorts before anything else, as
+    # in nonecmp, but some types (e.g., datetime) can't be compared with
+    # None, so if there are any, they are sorted explicitly
+    getters = [operator.itemgetter(f) for f in fields]
+    if not any(None in map(g, data) for g in getters):
+        return map(operator.itemgetter(*fields), data)
+    if len(fields) == 1:
+        fld = fields[0]
+        return [(d[fld] is not None, d[fld]) for d in data]
+    return [[(d[f] is not None, d[f]) for f in fields] for d in data]
 
 
 def nonecmp(a, b):
@@ -65,7 +146,8 @@ def nonecmp(a, b):
 
 class ResultSpec(object):
 
-    __slots__ = ['filters', 'fields', 'order', 'limit', 'offset']
+    __slots__ = ['filters', 'fields', 'order', 'limit', 'offset',
+                 'fieldMapping']
 
     def __init__(self, filters=None, fields=None, order=None,
                  limit=None, offset=None):
@@ -74,6 +156,9 @@ class ResultSpec(object):
         self.order = order
         self.limit = limit
         self.offset = offset
+        # maps field names to 'table.column' names; set by endpoints whose
+        # db queries can apply this result spec (see applyToSQLQuery)
+        self.fieldMapping = {}
 
     def __repr__(self):
         return "ResultSpec(**" + repr(dict(filters=self.filters, fields=self.fields, order=self.order,
@@ -116,6 +201,127 @@ class ResultSpec(object):
         del self.fields[i]
         return True
 
+    def _sqlColumn(self, query, field):
+        if field not in self.fieldMapping:
+            return None
+        table, column = self.fieldMapping[field].split('.')
+        for from_ in query.froms:
+            for tbl in sql_util.find_tables(from_):
+                if tbl.name == table:
+                    return tbl.c[column]
+
+    def applyToSQLQuery(self, query):
+        """
+        Apply as much of this result spec as possible to the SQLAlchemy select
+        C{query}, removing the parts that were applied.  Filters are applied
+        when their field is in C{fieldMapping} and their operator has a SQL
+        equivalent; ordering once all filters are applied, and pagination
+        once ordering is applied, too.  Anything left is applied in Python by
+        L{apply}, as usual.
+
+        Returns the new query, and a query for the total number of results if
+        pagination was applied, or None otherwise.
+        """
+        remaining = []
+        for f in self.filters:
+            column = self._sqlColumn(query, f.field)
+            clause = f._sqlClause(column) if column is not None else None
+            if clause is None:
+                remaining.append(f)
+            else:
+                query = query.where(clause)
+        self.filters = remaining
+        if self.filters:
+            return query, None
+
+        if self.order:
+            order_by = []
+            for k in self.order:
+                desc = k[0] == '-'
+                column = self._sqlColumn(query, k[1:] if desc else k)
+                if column is None:
+                    return query, None
+                # sort None before anything else, as nonecmp does
+                if column.nullable:
+                    order_by.append(sa.desc(column != NULL) if desc
+                                    else column != NULL)
+                order_by.append(sa.desc(column) if desc else column)
+            query = query.order_by(*order_by)
+            self.order = None
+
+        if self.offset is None and self.limit is None:
+            return query, None
+        count_query = sa.select([sa.func.count()]).select_from(
+            query.alias('results'))
+        if self.offset is not None:
+            query = query.offset(self.offset)
+        if self.limit is not None:
+            query = query.limit(self.limit)
+        self.removePagination()
+        return query, count_query
+
+    def thd_execute(self, conn, query, dictFromRow):
+        """
+        Apply this result spec to C{query} with L{applyToSQLQuery}, then
+        execute it on C{conn}, returning a list of the results of
+        C{dictFromRow} for each row.  If pagination was applied, the list is a
+        L{base.ListResult} giving the offset, limit and total.
+
+        The DB thread pool may call this again if the query fails, so the
+        result spec is applied to a copy, and the parts applied in SQL are
+        only removed from this result spec once the query has succeeded.
+        """
+        spec = ResultSpec(filters=list(self.filters), fields=self.fields,
+                          order=self.order, limit=self.limit,
+                          offset=self.offset)
+        spec.fieldMapping = self.fieldMapping
+        query, count_query = spec.applyToSQLQuery(query)
+        res = conn.execute(query)
+        rv = [dictFromRow(row) for row in res.fetchall()]
+        if count_query is not None:
+            total = conn.execute(count_query).scalar()
+            rv = base.ListResult(rv, offset=self.offset, total=total,
+                                 limit=self.limit)
+        self.filters, self.order = spec.filters, spec.order
+        self.limit, self.offset = spec.limit, spec.offset
+        return rv
+
+    @staticmethod
+    def _sort(data, order, end):
+        # group consecutive fields sorted in the same direction, as each group
+        # can be sorted with a single key
+        groups = []
+        for k in order:
+            reverse = k[0] == '-'
+            if reverse:
+                k = k[1:]
+            if groups and groups[-1][1] == reverse:
+                groups[-1][0].append(k)
+            else:
+                groups.append(([k], reverse))
+
+        # sort the indexes of the items rather than the items, so that each
+        # key is computed only once
+        if len(groups) == 1:
+            fields, reverse = groups[0]
+            keys = _sortKeys(data, fields)
+            # when only the first few items are wanted, don't sort them all;
+            # like sorted, nsmallest and nlargest are stable
+            if end is not None and end < len(data) // 10:
+                select = heapq.nlargest if reverse else heapq.nsmallest
+                indexes = select(end, xrange(len(data)), key=keys.__getitem__)
+            else:
+                indexes = sorted(xrange(len(data)), key=keys.__getitem__,
+                                 reverse=reverse)
+        else:
+            # sort on each group in turn, least significant first, relying on
+            # the stability of the sort
+            indexes = range(len(data))
+            for fields, reverse in reversed(groups):
+                keys = _sortKeys(data, fields)
+                indexes.sort(key=keys.__getitem__, reverse=reverse)
+        return [data[i] for i in indexes]
+
     def apply(self, data):
         if data is None:
             return data
@@ -141,51 +347,51 @@ class ResultSpec(object):
 
             # item collection
             if isinstance(data, base.ListResult):
-                # if pagination was applied, then fields, etc. must be empty
-                assert not fields and not order and not filters, \
-                    "endpoint must apply fields, order, and filters if it performs pagination"
+                # if pagination was applied, then order, etc. must be empty
+                assert not order and not filters, \
+                    "endpoint must apply order and filters if it performs pagination"
                 offset, total = data.offset, data.total
                 limit = data.limit
             else:
                 offset, total = None, None
                 limit = None
 
+            # fields are only applied to the items that are returned, but
+            # filtering or ordering on an excluded field is still an error
             if fields:
-                data = (applyFields(d) for d in data)
-
-            # link the filters together and then flatten to list
-            for f in self.filters:
-                data = f._apply(data)
-            data = list(data)
+                used = set(f.field for f in filters)
+                used.update(k.lstrip('-') for k in order or [])
+                if used - fields:
+                    raise KeyError(sorted(used - fields)[0])
+
+            if filters:
+                pred = _allOf([f._predicate() for f in filters])
+                data = [d for d in data if pred(d)]
+            else:
+                data = list(data)
 
             if total is None:
                 total = len(data)
 
-            # precompute the ordering functions and sort
-            if self.order:
-                order = [(lambda a, b, k=k[1:]: nonecmp(b[k], a[k]))
-                         if k[0] == '-' else
-                         (lambda a, b, k=k: nonecmp(a[k], b[k]))
-                         for k in self.order]
-
-                def cmpFunc(a, b):
-                    for f in order:
-                        c = f(a, b)
-                        if c:
-                            return c
-                    return 0
-                data.sort(cmp=cmpFunc)
-
-            # finally, slice out the limit/offset
+            end = None
             if self.offset is not None or self.limit is not None:
                 if offset is not None or limit is not None:
                     raise AssertionError("endpoint must clear offset/limit")
-                end = (self.offset or 0) + self.limit \
-                    if self.limit is not None else None
+                if self.limit is not None:
+                    end = (self.offset or 0) + self.limit
+
+            if order:
+                data = self._sort(data, order, end)
+
+            # finally, slice out the limit/offset
+            if self.offset is not None or self.limit is not None:
                 data = data[self.offset:end]
                 offset = self.offset
                 limit = self.limit
 
+            if fields:
+                data = [applyFields(d) for d in data]
+
             rv = base.ListResult(data)
             rv.offset, rv.total = offset, total
             rv.limit = limit
@@ -14,6 +14,7 @@
 # Copyright Buildbot Team Members
 
 import hashlib
+import itertools
 import sqlalchemy as sa
 
 
@@ -31,6 +32,10 @@ class DBConnectorComponent(object):
         self.db = connector
         self.master = connector.master
 
+        # statements built by self.statement, and their compiled forms
+        self._statements = {}
+        self._compiledCache = {}
+
         # set up caches
         for method in dir(self.__class__):
             o = getattr(self, method)
@@ -60,6 +65,56 @@ class DBConnectorComponent(object):
                 "value for column %s is greater than max of %d characters: %s"
                 % (col, col.type.length, value))
 
+    def doBatch(self, iterable, batch_n=500):
+        """
+        Split C{iterable} into lists of at most C{batch_n} items, so that each
+        can be used in a single statement (e.g., as the values of an C{IN}
+        clause).  The default is well below the smallest limit on the number
+        of parameters to a statement, sqlite's 999.
+        """
+        iterator = iter(iterable)
+        while True:
+            batch = list(itertools.islice(iterator, batch_n))
+            if not batch:
+                return
+            yield batch
+
+    def thdDeleteIn(self, conn, column, ids):
+        """
+        Delete the rows whose C{column} is in C{ids}, in batches, returning
+        the number of rows deleted.
+        """
+        rows = 0
+        for batch in self.doBatch(ids):
+            res = conn.execute(column.table.delete(column.in_(batch)))
+            rows += res.rowcount
+        return rows
+
+    def statement(self, name, build):
+        """
+        Return this component's statement called C{name}, calling C{build} to
+        construct it the first time.  Values that change from one call to
+        the next must be C{sa.bindparam}s, supplied when the statement is
+        executed with L{thdExecute}, so that it need only be compiled once.
+        """
+        try:
+            return self._statements[name]
+        except KeyError:
+            stmt = self._statements[name] = build()
+            return stmt
+
+    def thdExecute(self, conn, statement, *multiparams, **params):
+        """
+        Execute a statement from L{statement} on C{conn}, compiling it only if
+        it has not been executed with the same dialect and parameter names
+        before.
+        """
+        # thd* methods are sometimes given an engine rather than a connection
+        # (see buildbot.db.dbconfig); that just compiles the statement afresh
+        if isinstance(conn, sa.engine.Connection):
+            conn = conn.execution_options(compiled_cache=self._compiledCache)
+        return conn.execute(statement, *multiparams, **params)
+
     def findSomethingId(self, tbl, whereclause, insert_values,
                         _race_hook=None):
         """Find (using C{whereclause}) or add (using C{insert_values) a row to
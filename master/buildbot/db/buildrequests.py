@@ -13,7 +13,6 @@
 #
 # Copyright Buildbot Team Members
 
-import itertools
 import sqlalchemy as sa
 
 from buildbot.db import NULL
@@ -64,9 +63,10 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
     def getBuildRequest(self, brid):
         def thd(conn):
             reqs_tbl = self.db.model.buildrequests
-            q = self._saSelectQuery()
-            q = q.where(reqs_tbl.c.id == brid)
-            res = conn.execute(q)
+            q = self.statement('getBuildRequest', lambda:
+                               self._saSelectQuery().where(
+                                   reqs_tbl.c.id == sa.bindparam('b_id')))
+            res = self.thdExecute(conn, q, b_id=brid)
             row = res.fetchone()
             rv = None
             if row:
@@ -76,8 +76,21 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
         return self.db.pool.do(thd)
 
     def getBuildRequests(self, builderid=None, complete=None, claimed=None,
-                         bsid=None, branch=None, repository=None):
-        def thd(conn):
+                         bsid=None, branch=None, repository=None,
+                         resultSpec=None, brids=None):
+        # the statement depends only on which filters are given, so there is
+        # one to build and compile for each combination of them
+        params = dict(b_claimed=claimed, b_builderid=builderid,
+                      b_bsid=bsid, b_branch=branch, b_repository=repository)
+        params = dict((k, v) for k, v in params.iteritems() if v is not None)
+        if isinstance(claimed, bool):
+            del params['b_claimed']
+        key = ('getBuildRequests', claimed if isinstance(claimed, bool)
+               else 'master' if claimed is not None else None,
+               None if complete is None else bool(complete),
+               tuple(sorted(params)))
+
+        def build():
             reqs_tbl = self.db.model.buildrequests
             claims_tbl = self.db.model.buildrequest_claims
             sstamps_tbl = self.db.model.sourcestamps
@@ -93,26 +106,61 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
                             (claims_tbl.c.claimed_at != NULL))
                 else:
                     q = q.where(
-                        (claims_tbl.c.masterid == claimed))
+                        (claims_tbl.c.masterid == sa.bindparam('b_claimed')))
             if builderid is not None:
-                q = q.where(reqs_tbl.c.builderid == builderid)
+                q = q.where(reqs_tbl.c.builderid ==
+                            sa.bindparam('b_builderid'))
             if complete is not None:
                 if complete:
                     q = q.where(reqs_tbl.c.complete != 0)
                 else:
                     q = q.where(reqs_tbl.c.complete == 0)
             if bsid is not None:
-                q = q.where(reqs_tbl.c.buildsetid == bsid)
+                q = q.where(reqs_tbl.c.buildsetid == sa.bindparam('b_bsid'))
 
             if branch is not None:
-                q = q.where(sstamps_tbl.c.branch == branch)
+                q = q.where(sstamps_tbl.c.branch == sa.bindparam('b_branch'))
             if repository is not None:
-                q = q.where(sstamps_tbl.c.repository == repository)
+                q = q.where(sstamps_tbl.c.repository ==
+                            sa.bindparam('b_repository'))
+            return q
 
-            res = conn.execute(q)
+        def thd(conn):
+            reqs_tbl = self.db.model.buildrequests
+            q = self.statement(key, build)
+
+            def dictFromRow(row):
+                return self._brdictFromRow(row, self.db.master.masterid)
+            if brids is not None:
+                rv = []
+                q = q.params(params)
+                for batch in self.doBatch(brids):
+                    res = conn.execute(q.where(reqs_tbl.c.id.in_(batch)))
+                    rv.extend(dictFromRow(row) for row in res.fetchall())
+                return rv
+            if resultSpec is not None:
+                return resultSpec.thd_execute(conn, q.params(params),
+                                              dictFromRow)
+            res = self.thdExecute(conn, q, **params)
+
+            return [dictFromRow(row) for row in res.fetchall()]
+        return self.db.pool.do(thd)
 
-            return [self._brdictFromRow(row, self.db.master.masterid)
-                    for row in res.fetchall()]
+    def getOldestUnclaimedRequestTimes(self):
+        def thd(conn):
+            reqs_tbl = self.db.model.buildrequests
+            claims_tbl = self.db.model.buildrequest_claims
+            from_clause = reqs_tbl.outerjoin(
+                claims_tbl, reqs_tbl.c.id == claims_tbl.c.brid)
+            q = sa.select([reqs_tbl.c.builderid,
+                           sa.func.min(reqs_tbl.c.submitted_at)],
+                          from_obj=[from_clause])
+            q = q.where((claims_tbl.c.claimed_at == NULL) &
+                        (reqs_tbl.c.complete == 0))
+            q = q.group_by(reqs_tbl.c.builderid)
+            res = conn.execute(q)
+            return dict((builderid, epoch2datetime(submitted_at))
+                        for builderid, submitted_at in res.fetchall())
         return self.db.pool.do(thd)
 
     def claimBuildRequests(self, brids, claimed_at=None, _reactor=reactor):
@@ -126,8 +174,8 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
             tbl = self.db.model.buildrequest_claims
 
             try:
-                q = tbl.insert()
-                conn.execute(q, [
+                q = self.statement('claimBuildRequests', tbl.insert)
+                self.thdExecute(conn, q, [
                     dict(brid=id, masterid=self.db.master.masterid,
                          claimed_at=claimed_at)
                     for id in brids])
@@ -145,15 +193,7 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
             tbl = self.db.model.buildrequest_claims
             claimed_at = _reactor.seconds()
 
-            # we'll need to batch the brids into groups of 100, so that the
-            # parameter lists supported by the DBAPI aren't exhausted
-            iterator = iter(brids)
-
-            while True:
-                batch = list(itertools.islice(iterator, 100))
-                if not batch:
-                    break  # success!
-
+            for batch in self.doBatch(brids):
                 q = tbl.update(tbl.c.brid.in_(batch)
                                & (tbl.c.masterid == self.db.master.masterid))
                 res = conn.execute(q, claimed_at=claimed_at)
@@ -172,15 +212,7 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
             transaction = conn.begin()
             claims_tbl = self.db.model.buildrequest_claims
 
-            # we'll need to batch the brids into groups of 100, so that the
-            # parameter lists supported by the DBAPI aren't exhausted
-            iterator = iter(brids)
-
-            while True:
-                batch = list(itertools.islice(iterator, 100))
-                if not batch:
-                    break  # success!
-
+            for batch in self.doBatch(brids):
                 try:
                     q = claims_tbl.delete(
                         (claims_tbl.c.brid.in_(batch))
@@ -210,15 +242,7 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
 
             reqs_tbl = self.db.model.buildrequests
 
-            # we'll need to batch the brids into groups of 100, so that the
-            # parameter lists supported by the DBAPI aren't exhausted
-            iterator = iter(brids)
-
-            while True:
-                batch = list(itertools.islice(iterator, 100))
-                if not batch:
-                    break  # success!
-
+            for batch in self.doBatch(brids):
                 q = reqs_tbl.update()
                 q = q.where(reqs_tbl.c.id.in_(batch))
                 q = q.where(reqs_tbl.c.complete != 1)
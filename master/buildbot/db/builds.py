@@ -27,10 +27,11 @@ from twisted.internet import reactor
 class BuildsConnectorComponent(base.DBConnectorComponent):
     # Documentation is in developer/db.rst
 
-    def _getBuild(self, whereclause):
+    def _getBuild(self, name, whereclause, params):
         def thd(conn):
-            q = self.db.model.builds.select(whereclause=whereclause)
-            res = conn.execute(q)
+            q = self.statement(name, lambda: self.db.model.builds.select(
+                whereclause=whereclause))
+            res = self.thdExecute(conn, q, **params)
             row = res.fetchone()
 
             rv = None
@@ -38,15 +39,20 @@ class BuildsConnectorComponent(base.DBConnectorComponent):
                 rv = self._builddictFromRow(row)
             res.close()
             return rv
-        return self.db.pool.do(thd)
+        return self.db.pool.doRead(thd)
 
     def getBuild(self, buildid):
-        return self._getBuild(self.db.model.builds.c.id == buildid)
+        return self._getBuild(
+            'getBuild',
+            self.db.model.builds.c.id == sa.bindparam('b_id'),
+            dict(b_id=buildid))
 
     def getBuildByNumber(self, builderid, number):
         return self._getBuild(
-            (self.db.model.builds.c.builderid == builderid)
-            & (self.db.model.builds.c.number == number))
+            'getBuildByNumber',
+            (self.db.model.builds.c.builderid == sa.bindparam('b_builderid'))
+            & (self.db.model.builds.c.number == sa.bindparam('b_number')),
+            dict(b_builderid=builderid, b_number=number))
 
     def _getRecentBuilds(self, whereclause, offset=0, limit=1):
         def thd(conn):
@@ -61,7 +67,7 @@ class BuildsConnectorComponent(base.DBConnectorComponent):
             return list([self._builddictFromRow(row)
                          for row in res.fetchall()])
 
-        return self.db.pool.do(thd)
+        return self.db.pool.doRead(thd)
 
     @defer.inlineCallbacks
     def getPrevSuccessfulBuild(self, builderid, number, ssBuild):
@@ -93,7 +99,8 @@ class BuildsConnectorComponent(base.DBConnectorComponent):
 
         defer.returnValue(rv)
 
-    def getBuilds(self, builderid=None, buildrequestid=None, complete=None):
+    def getBuilds(self, builderid=None, buildrequestid=None, complete=None,
+                  resultSpec=None):
         def thd(conn):
             tbl = self.db.model.builds
             q = tbl.select()
@@ -106,9 +113,11 @@ class BuildsConnectorComponent(base.DBConnectorComponent):
                     q = q.where(tbl.c.complete_at != NULL)
                 else:
                     q = q.where(tbl.c.complete_at == NULL)
+            if resultSpec is not None:
+                return resultSpec.thd_execute(conn, q, self._builddictFromRow)
             res = conn.execute(q)
             return [self._builddictFromRow(row) for row in res.fetchall()]
-        return self.db.pool.do(thd)
+        return self.db.pool.doRead(thd)
 
     def addBuild(self, builderid, buildrequestid, buildslaveid, masterid,
                  state_string, _reactor=reactor, _race_hook=None):
@@ -117,8 +126,10 @@ class BuildsConnectorComponent(base.DBConnectorComponent):
         def thd(conn):
             tbl = self.db.model.builds
             # get the highest current number
-            r = conn.execute(sa.select([sa.func.max(tbl.c.number)],
-                                       whereclause=(tbl.c.builderid == builderid)))
+            q = self.statement('getMaxBuildNumber', lambda: sa.select(
+                [sa.func.max(tbl.c.number)],
+                whereclause=(tbl.c.builderid == sa.bindparam('b_builderid'))))
+            r = self.thdExecute(conn, q, b_builderid=builderid)
             number = r.scalar()
             new_number = 1 if number is None else number + 1
 
@@ -128,12 +139,13 @@ class BuildsConnectorComponent(base.DBConnectorComponent):
                     _race_hook(conn)
 
                 try:
-                    r = conn.execute(self.db.model.builds.insert(),
-                                     dict(number=new_number, builderid=builderid,
-                                          buildrequestid=buildrequestid,
-                                          buildslaveid=buildslaveid, masterid=masterid,
-                                          started_at=started_at, complete_at=None,
-                                          state_string=state_string))
+                    r = self.thdExecute(
+                        conn, self.statement('addBuild', tbl.insert),
+                        dict(number=new_number, builderid=builderid,
+                             buildrequestid=buildrequestid,
+                             buildslaveid=buildslaveid, masterid=masterid,
+                             started_at=started_at, complete_at=None,
+                             state_string=state_string))
                 except (sa.exc.IntegrityError, sa.exc.ProgrammingError):
                     new_number += 1
                     continue
@@ -142,21 +154,24 @@ class BuildsConnectorComponent(base.DBConnectorComponent):
 
     def setBuildStateString(self, buildid, state_string):
         def thd(conn):
-            tbl = self.db.model.builds
-
-            q = tbl.update(whereclause=(tbl.c.id == buildid))
-            conn.execute(q, state_string=state_string)
+            self.thdExecute(conn, self._updateBuildStatement(),
+                            b_id=buildid, state_string=state_string)
         return self.db.pool.do(thd)
 
     def finishBuild(self, buildid, results, _reactor=reactor):
         def thd(conn):
-            tbl = self.db.model.builds
-            q = tbl.update(whereclause=(tbl.c.id == buildid))
-            conn.execute(q,
-                         complete_at=_reactor.seconds(),
-                         results=results)
+            self.thdExecute(conn, self._updateBuildStatement(),
+                            b_id=buildid,
+                            complete_at=_reactor.seconds(),
+                            results=results)
         return self.db.pool.do(thd)
 
+    def _updateBuildStatement(self):
+        # the columns to set are given when this is executed
+        tbl = self.db.model.builds
+        return self.statement('updateBuild', lambda: tbl.update(
+            whereclause=(tbl.c.id == sa.bindparam('b_id'))))
+
     def getBuildProperties(self, bid):
         def thd(conn):
             bp_tbl = self.db.model.build_properties
@@ -168,7 +183,7 @@ class BuildsConnectorComponent(base.DBConnectorComponent):
                 prop = (json.loads(row.value), row.source)
                 props.append((row.name, prop))
             return dict(props)
-        return self.db.pool.do(thd)
+        return self.db.pool.doRead(thd)
 
     def setBuildProperty(self, bid, name, value, source):
         """ A kind of create_or_update, that's between one or two queries per
@@ -193,6 +208,79 @@ class BuildsConnectorComponent(base.DBConnectorComponent):
                              dict(value=value_js, source=source))
         return self.db.pool.do(thd)
 
+    @defer.inlineCallbacks
+    def pruneBuilds(self, buildHorizon, batch_n=500):
+        """
+        Called periodically by DBConnector, this method deletes all but the
+        latest C{buildHorizon} finished builds of each builder, along with
+        their properties, steps and logs, C{batch_n} builds at a time.
+        """
+        rows = dict.fromkeys(['builds', 'build_properties', 'steps', 'logs',
+                              'logchunks'], 0)
+        size = {'logchunks': 0}
+        if not buildHorizon:
+            defer.returnValue(dict(rows=rows, bytes=size))
+
+        def thdGetBuilderIds(conn):
+            tbl = self.db.model.builds
+            q = sa.select([tbl.c.builderid]).distinct()
+            return [row.builderid for row in conn.execute(q)]
+
+        def thd(conn, builderid):
+            model = self.db.model
+            tbl = model.builds
+            q = sa.select([tbl.c.id],
+                          whereclause=((tbl.c.builderid == builderid)
+                                       & (tbl.c.complete_at != NULL)),
+                          order_by=[sa.desc(tbl.c.number)],
+                          offset=buildHorizon, limit=batch_n)
+            buildids = [row.id for row in conn.execute(q)]
+            if not buildids:
+                return None
+
+            # delete everything belonging to these builds, in dependency
+            # order
+            transaction = conn.begin()
+            stepids = []
+            for batch in self.doBatch(buildids):
+                q = sa.select([model.steps.c.id],
+                              whereclause=model.steps.c.buildid.in_(batch))
+                stepids.extend(row.id for row in conn.execute(q))
+            logids = []
+            for batch in self.doBatch(stepids):
+                q = sa.select([model.logs.c.id],
+                              whereclause=model.logs.c.stepid.in_(batch))
+                logids.extend(row.id for row in conn.execute(q))
+            chunks, chunk_bytes = self.db.logs.thdDeleteLogChunks(conn,
+                                                                 logids)
+            deleted = dict(logchunks=chunks)
+            deleted['logs'] = self.thdDeleteIn(conn, model.logs.c.id, logids)
+            deleted['steps'] = self.thdDeleteIn(conn, model.steps.c.id,
+                                                stepids)
+            deleted['build_properties'] = self.thdDeleteIn(
+                conn, model.build_properties.c.buildid, buildids)
+            for batch in self.doBatch(buildids):
+                q = model.buildsets.update(
+                    whereclause=model.buildsets.c.parent_buildid.in_(batch))
+                conn.execute(q, parent_buildid=None)
+            deleted['builds'] = self.thdDeleteIn(conn, tbl.c.id, buildids)
+            transaction.commit()
+            return deleted, chunk_bytes
+
+        builderids = yield self.db.pool.do(thdGetBuilderIds)
+        for builderid in builderids:
+            # each batch is a separate call, so that other queries can run in
+            # between
+            while True:
+                res = yield self.db.pool.do(thd, builderid)
+                if res is None:
+                    break
+                deleted, chunk_bytes = res
+                for table, count in deleted.iteritems():
+                    rows[table] += count
+                size['logchunks'] += chunk_bytes
+        defer.returnValue(dict(rows=rows, bytes=size))
+
     def _builddictFromRow(self, row):
         def mkdt(epoch):
             if epoch:
@@ -97,22 +97,24 @@ class BuildsetsConnectorComponent(base.DBConnectorComponent):
                              [dict(buildsetid=bsid, sourcestampid=ssid)
                               for ssid in sourcestampids])
 
-            # and finish with a build request for each builder.  Note that
-            # sqlalchemy and the Python DBAPI do not provide a way to recover
-            # inserted IDs from a multi-row insert, so this is done one row at
-            # a time.
+            # and finish with a build request for each builder, inserted with
+            # a single executemany call.  Sqlalchemy and the Python DBAPI do
+            # not provide a way to recover inserted IDs from a multi-row
+            # insert, but this buildset was created in this transaction, so
+            # its build requests are exactly the ones just inserted.
             brids = {}
             br_tbl = self.db.model.buildrequests
-            ins = br_tbl.insert()
-            for builderid in builderids:
-                r = conn.execute(ins,
-                                 dict(buildsetid=bsid, builderid=builderid, priority=0,
-                                      claimed_at=0, claimed_by_name=None,
-                                      claimed_by_incarnation=None, complete=0, results=-1,
-                                      submitted_at=submitted_at, complete_at=None,
-                                      waited_for=1 if waited_for else 0))
-
-                brids[builderid] = r.inserted_primary_key[0]
+            if builderids:
+                conn.execute(br_tbl.insert(), [
+                    dict(buildsetid=bsid, builderid=builderid, priority=0,
+                         complete=0, results=-1, submitted_at=submitted_at,
+                         complete_at=None, waited_for=1 if waited_for else 0)
+                    for builderid in builderids])
+                q = sa.select([br_tbl.c.id, br_tbl.c.builderid],
+                              whereclause=(br_tbl.c.buildsetid == bsid),
+                              order_by=[br_tbl.c.id])
+                for brid, builderid in conn.execute(q):
+                    brids[builderid] = brid
 
             transaction.commit()
 
@@ -218,6 +220,69 @@ class BuildsetsConnectorComponent(base.DBConnectorComponent):
             return BsProps(l)
         return self.db.pool.do(thd)
 
+    @defer.inlineCallbacks
+    def pruneBuildsets(self, maxAge, batch_n=500, _reactor=reactor):
+        """
+        Called periodically by DBConnector, this method deletes buildsets
+        that completed more than C{maxAge} seconds ago, along with their
+        properties and build requests, C{batch_n} buildsets at a time.
+        Buildsets are kept as long as any of their build requests has a
+        build.
+        """
+        tables = ['buildsets', 'buildset_properties', 'buildset_sourcestamps',
+                  'buildrequests', 'buildrequest_claims']
+        rows = dict.fromkeys(tables, 0)
+        if maxAge is None:
+            defer.returnValue(dict(rows=rows, bytes={}))
+        older_than = _reactor.seconds() - maxAge
+
+        def thd(conn):
+            model = self.db.model
+            bs_tbl = model.buildsets
+            reqs_tbl = model.buildrequests
+            builds_tbl = model.builds
+            has_builds = sa.exists(
+                [builds_tbl.c.id],
+                (builds_tbl.c.buildrequestid == reqs_tbl.c.id)
+                & (reqs_tbl.c.buildsetid == bs_tbl.c.id))
+            q = sa.select([bs_tbl.c.id],
+                          whereclause=((bs_tbl.c.complete != 0)
+                                       & (bs_tbl.c.complete_at < older_than)
+                                       & ~has_builds),
+                          limit=batch_n)
+            bsids = [row.id for row in conn.execute(q)]
+            if not bsids:
+                return None
+
+            transaction = conn.begin()
+            brids = []
+            for batch in self.doBatch(bsids):
+                q = sa.select([reqs_tbl.c.id],
+                              whereclause=reqs_tbl.c.buildsetid.in_(batch))
+                brids.extend(row.id for row in conn.execute(q))
+            deleted = {}
+            deleted['buildrequest_claims'] = self.thdDeleteIn(
+                conn, model.buildrequest_claims.c.brid, brids)
+            deleted['buildrequests'] = self.thdDeleteIn(
+                conn, reqs_tbl.c.id, brids)
+            deleted['buildset_properties'] = self.thdDeleteIn(
+                conn, model.buildset_properties.c.buildsetid, bsids)
+            deleted['buildset_sourcestamps'] = self.thdDeleteIn(
+                conn, model.buildset_sourcestamps.c.buildsetid, bsids)
+            deleted['buildsets'] = self.thdDeleteIn(conn, bs_tbl.c.id, bsids)
+            transaction.commit()
+            return deleted
+
+        # each batch is a separate call, so that other queries can run in
+        # between
+        while True:
+            deleted = yield self.db.pool.do(thd)
+            if deleted is None:
+                break
+            for table, count in deleted.iteritems():
+                rows[table] += count
+        defer.returnValue(dict(rows=rows, bytes={}))
+
     def _thd_row2dict(self, conn, row):
         # get sourcestamps
         tbl = self.db.model.buildset_sourcestamps
@@ -48,6 +48,8 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
             parent_id = conn.scalar(q)
             return [parent_id] if parent_id else []
 
+        # not doRead: addChange uses this to link the new change to its
+        # parent, so it must see the latest changes
         return self.db.pool.do(thd)
 
     @defer.inlineCallbacks
@@ -162,7 +164,7 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
             # and fetch the ancillary data (files, properties)
             return self._chdict_from_change_row_thd(conn, row)
 
-        return self.db.pool.do(thd)
+        return self.db.pool.doRead(thd)
 
     @defer.inlineCallbacks
     def getChangesForBuild(self, buildid):
@@ -212,7 +214,7 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
                 return None
             # and fetch the ancillary data (files, properties)
             return self._chdict_from_change_row_thd(conn, row)
-        d = self.db.pool.do(thd)
+        d = self.db.pool.doRead(thd)
         return d
 
     def getChangeUids(self, changeid):
@@ -225,47 +227,69 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
             rows = res.fetchall()
             row_uids = [row.uid for row in rows]
             return row_uids
-        d = self.db.pool.do(thd)
+        d = self.db.pool.doRead(thd)
         return d
 
-    def getRecentChanges(self, count):
+    def getRecentChanges(self, count, before=None):
         def thd(conn):
             # get the changeids from the 'changes' table
             changes_tbl = self.db.model.changes
             q = sa.select([changes_tbl.c.changeid],
                           order_by=[sa.desc(changes_tbl.c.changeid)],
                           limit=count)
+            if before is not None:
+                q = q.where(changes_tbl.c.changeid < before)
             rp = conn.execute(q)
             changeids = [row.changeid for row in rp]
             rp.close()
             return list(reversed(changeids))
-        d = self.db.pool.do(thd)
-
-        # then turn those into changes, using the cache
-        @d.addCallback
-        def get_changes(changeids):
-            return defer.gatherResults([self.getChange(changeid)
-                                        for changeid in changeids])
+        d = self.db.pool.doRead(thd)
+        d.addCallback(self._getChangesById)
         return d
 
-    def getChanges(self):
+    def getChanges(self, after=None, limit=None):
         def thd(conn):
             # get the changeids from the 'changes' table
             changes_tbl = self.db.model.changes
-            q = sa.select([changes_tbl.c.changeid])
+            q = sa.select([changes_tbl.c.changeid],
+                          order_by=[changes_tbl.c.changeid],
+                          limit=limit)
+            if after is not None:
+                q = q.where(changes_tbl.c.changeid > after)
             rp = conn.execute(q)
             changeids = [row.changeid for row in rp]
             rp.close()
             return list(changeids)
-        d = self.db.pool.do(thd)
-
-        # then turn those into changes, using the cache
-        @d.addCallback
-        def get_changes(changeids):
-            return defer.gatherResults([self.getChange(changeid)
-                                        for changeid in changeids])
+        d = self.db.pool.doRead(thd)
+        d.addCallback(self._getChangesById)
         return d
 
+    @defer.inlineCallbacks
+    def _getChangesById(self, changeids):
+        # turn changeids into chdicts, in the same order, taking what we can
+        # from the getChange cache and fetching the rest in one go, rather
+        # than with a few queries for each change
+        cache = self.getChange.cache
+        chdicts = dict((changeid, cache.peek(changeid))
+                       for changeid in changeids)
+        missing = [changeid for changeid in changeids
+                   if chdicts[changeid] is None]
+
+        def thd(conn):
+            changes_tbl = self.db.model.changes
+            rows = []
+            for batch in self.doBatch(missing):
+                q = changes_tbl.select(
+                    whereclause=changes_tbl.c.changeid.in_(batch))
+                rows.extend(conn.execute(q).fetchall())
+            return self._thdChdictsFromRows(conn, rows)
+        if missing:
+            for chdict in (yield self.db.pool.doRead(thd)):
+                cache.put(chdict['changeid'], chdict)
+                chdicts[chdict['changeid']] = chdict
+        defer.returnValue([chdicts[changeid] for changeid in changeids
+                           if chdicts[changeid] is not None])
+
     def getChangesCount(self):
         def thd(conn):
             changes_tbl = self.db.model.changes
@@ -276,7 +300,7 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
                 r = row[0]
             rp.close()
             return int(r)
-        d = self.db.pool.do(thd)
+        d = self.db.pool.doRead(thd)
         return d
 
     def getLatestChangeid(self):
@@ -286,7 +310,7 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
                           order_by=sa.desc(changes_tbl.c.changeid),
                           limit=1)
             return conn.scalar(q)
-        d = self.db.pool.do(thd)
+        d = self.db.pool.doRead(thd)
         return d
 
     # utility methods
@@ -328,36 +352,49 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
     def _chdict_from_change_row_thd(self, conn, ch_row):
         # This method must be run in a db.pool thread, and returns a chdict
         # given a row from the 'changes' table
+        return self._thdChdictsFromRows(conn, [ch_row])[0]
+
+    def _thdChdictsFromRows(self, conn, ch_rows):
+        # This method must be run in a db.pool thread, and returns a list of
+        # chdicts given rows from the 'changes' table, fetching the files and
+        # properties for all of them with a few IN queries
         change_files_tbl = self.db.model.change_files
         change_properties_tbl = self.db.model.change_properties
 
-        if ch_row.parent_changeids:
-            parent_changeids = [ch_row.parent_changeids]
-        else:
-            parent_changeids = []
-
-        chdict = ChDict(
-            changeid=ch_row.changeid,
-            parent_changeids=parent_changeids,
-            author=ch_row.author,
-            files=[],  # see below
-            comments=ch_row.comments,
-            revision=ch_row.revision,
-            when_timestamp=epoch2datetime(ch_row.when_timestamp),
-            branch=ch_row.branch,
-            category=ch_row.category,
-            revlink=ch_row.revlink,
-            properties={},  # see below
-            repository=ch_row.repository,
-            codebase=ch_row.codebase,
-            project=ch_row.project,
-            sourcestampid=int(ch_row.sourcestampid))
-
-        query = change_files_tbl.select(
-            whereclause=(change_files_tbl.c.changeid == ch_row.changeid))
-        rows = conn.execute(query)
-        for r in rows:
-            chdict['files'].append(r.filename)
+        chdicts = []
+        by_changeid = {}
+        for ch_row in ch_rows:
+            if ch_row.parent_changeids:
+                parent_changeids = [ch_row.parent_changeids]
+            else:
+                parent_changeids = []
+
+            chdict = ChDict(
+                changeid=ch_row.changeid,
+                parent_changeids=parent_changeids,
+                author=ch_row.author,
+                files=[],  # see below
+                comments=ch_row.comments,
+                revision=ch_row.revision,
+                when_timestamp=epoch2datetime(ch_row.when_timestamp),
+                branch=ch_row.branch,
+                category=ch_row.category,
+                revlink=ch_row.revlink,
+                properties={},  # see below
+                repository=ch_row.repository,
+                codebase=ch_row.codebase,
+                project=ch_row.project,
+                sourcestampid=int(ch_row.sourcestampid))
+            chdicts.append(chdict)
+            by_changeid[ch_row.changeid] = chdict
+
+        changeids = list(by_changeid)
+        for batch in self.doBatch(changeids):
+            query = change_files_tbl.select(
+                whereclause=change_files_tbl.c.changeid.in_(batch))
+            rows = conn.execute(query)
+            for r in rows:
+                by_changeid[r.changeid]['files'].append(r.filename)
 
         # and properties must be given without a source, so strip that, but
         # be flexible in case users have used a development version where the
@@ -371,14 +408,16 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
                 v, s = vs, "Change"
             return v, s
 
-        query = change_properties_tbl.select(
-            whereclause=(change_properties_tbl.c.changeid == ch_row.changeid))
-        rows = conn.execute(query)
-        for r in rows:
-            try:
-                v, s = split_vs(json.loads(r.property_value))
-                chdict['properties'][r.property_name] = (v, s)
-            except ValueError:
-                pass
-
-        return chdict
+        for batch in self.doBatch(changeids):
+            query = change_properties_tbl.select(
+                whereclause=change_properties_tbl.c.changeid.in_(batch))
+            rows = conn.execute(query)
+            for r in rows:
+                try:
+                    v, s = split_vs(json.loads(r.property_value))
+                    by_changeid[r.changeid]['properties'][
+                        r.property_name] = (v, s)
+                except ValueError:
+                    pass
+
+        return chdicts
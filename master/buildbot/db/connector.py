@@ -35,6 +35,7 @@ from buildbot.db import state
 from buildbot.db import steps
 from buildbot.db import tags
 from buildbot.db import users
+from buildbot.process import metrics
 from buildbot.util import service
 from twisted.application import internet
 from twisted.internet import defer
@@ -64,6 +65,9 @@ class DBConnector(service.ReconfigurableServiceMixin, service.AsyncMultiService)
     # periodic cleanup actions on this schedule.
     CLEANUP_PERIOD = 3600
 
+    # default for c['db']['prune_batch_size']
+    PRUNE_BATCH_SIZE = 500
+
     def __init__(self, master, basedir):
         service.AsyncMultiService.__init__(self)
         self.setName('db')
@@ -76,6 +80,7 @@ class DBConnector(service.ReconfigurableServiceMixin, service.AsyncMultiService)
 
         # set up components
         self._engine = None  # set up in reconfigService
+        self._read_engine = None  # set up in setup, if configured
         self.pool = None  # set up in reconfigService
         self.model = model.Model(self)
         self.changes = changes.ChangesConnectorComponent(self)
@@ -107,7 +112,21 @@ class DBConnector(service.ReconfigurableServiceMixin, service.AsyncMultiService)
         # set up the engine and pool
         self._engine = enginestrategy.create_engine(db_url,
                                                     basedir=self.basedir)
-        self.pool = pool.DBThreadPool(self._engine, verbose=verbose)
+        db_cfg = self.master.config.db
+        self.pool = pool.DBThreadPool(self._engine, verbose=verbose,
+                                      pool_size=db_cfg.get('pool_size'),
+                                      pool_max_size=db_cfg.get('pool_max_size'))
+
+        # and, if configured, a separate engine and pool for reads
+        read_db_url = db_cfg.get('read_db_url')
+        if read_db_url:
+            log.msg("Reading from database with URL %r"
+                    % util.stripUrlPassword(read_db_url))
+            self._read_engine = enginestrategy.create_engine(
+                read_db_url, basedir=self.basedir)
+            read_pool = pool.DBThreadPool(self._read_engine, verbose=verbose,
+                                          name='DBReadThreadPool')
+            self.pool.setReadPool(read_pool, db_cfg.get('read_lag', 1))
 
         # make sure the db is up to date, unless specifically asked not to
         if check_version:
@@ -124,13 +143,30 @@ class DBConnector(service.ReconfigurableServiceMixin, service.AsyncMultiService)
 
         return d
 
+    @defer.inlineCallbacks
+    def stopService(self):
+        # appends may still be queued, waiting to be written behind
+        try:
+            yield self.logs.flushPendingAppends()
+        except Exception:
+            log.err(None, 'while flushing pending log appends')
+        yield service.AsyncMultiService.stopService(self)
+
     def reconfigServiceWithBuildbotConfig(self, new_config):
         # double-check -- the master ensures this in config checks
         assert self.configured_url == new_config.db['db_url']
 
+        # the pool size and read lag can change without restarting the master
+        if self.pool:
+            self.pool.setPoolSize(new_config.db.get('pool_size'),
+                                  new_config.db.get('pool_max_size'))
+            if self.pool.read_pool:
+                self.pool.read_lag = new_config.db.get('read_lag', 1)
+
         return service.ReconfigurableServiceMixin.reconfigServiceWithBuildbotConfig(self,
                                                                                     new_config)
 
+    @defer.inlineCallbacks
     def _doCleanup(self):
         """
         Perform any periodic database cleanup tasks.
@@ -143,4 +179,37 @@ class DBConnector(service.ReconfigurableServiceMixin, service.AsyncMultiService)
 
         d = self.changes.pruneChanges(self.master.config.changeHorizon)
         d.addErrback(log.err, 'while pruning changes')
-        return d
+        yield d
+
+        # nothing is deleted unless the retention keys of c['db'] ask for it;
+        # prune builds before buildsets, so that buildsets whose builds are
+        # pruned can go in the same pass
+        db_cfg = self.master.config.db
+        batch_n = db_cfg.get('prune_batch_size', self.PRUNE_BATCH_SIZE)
+        for what, prune, key in [
+                ('builds', self.builds.pruneBuilds, 'build_horizon'),
+                ('logs', self.logs.pruneLogs, 'log_horizon'),
+                ('buildsets', self.buildsets.pruneBuildsets,
+                 'buildset_max_age')]:
+            horizon = db_cfg.get(key)
+            if horizon is None:
+                continue
+            try:
+                pruned = yield prune(horizon, batch_n=batch_n)
+            except Exception:
+                log.err(None, 'while pruning %s' % (what,))
+            else:
+                self._reportPruned(pruned)
+
+    def _reportPruned(self, pruned):
+        # report the results of a prune* method as metrics, and in the log
+        deleted = []
+        for table, rows in sorted(pruned['rows'].iteritems()):
+            if rows:
+                metrics.MetricCountEvent.log('DBJanitor.rows.' + table, rows)
+                deleted.append('%d %s' % (rows, table))
+        for table, size in pruned['bytes'].iteritems():
+            if size:
+                metrics.MetricCountEvent.log('DBJanitor.bytes.' + table, size)
+        if deleted:
+            log.msg('pruned %s' % (', '.join(deleted),))
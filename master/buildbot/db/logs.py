@@ -13,12 +13,70 @@
 #
 # Copyright Buildbot Team Members
 
+import bz2
 import sqlalchemy as sa
+import threading
+import zlib
 
+from buildbot.db import NULL
 from buildbot.db import base
+from collections import deque
 from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.python import failure
 from twisted.python import log
 
+try:
+    import lz4.block
+    assert lz4.block
+except ImportError:
+    lz4 = None
+
+
+# lz4.block stores the uncompressed size in a 4-byte header, which is the
+# same format as the lz4.dumps of older lz4 releases
+def _lz4_dumps(data):
+    return lz4.block.compress(data)
+
+
+def _lz4_loads(data):
+    return lz4.block.decompress(data)
+
+
+class DecompressedChunkCache(object):
+
+    """
+    A small FIFO cache of decompressed log chunk contents, keyed by
+    C{(logid, first_line, last_line)}.  This is accessed from DB threads, so
+    it is protected by a lock.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.queue = deque()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            try:
+                rv = self.cache[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return rv
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.cache:
+                return
+            self.cache[key] = value
+            self.queue.append(key)
+            while len(self.queue) > self.max_size:
+                del self.cache[self.queue.popleft()]
+
 
 class LogsConnectorComponent(base.DBConnectorComponent):
 
@@ -26,10 +84,46 @@ class LogsConnectorComponent(base.DBConnectorComponent):
     # for MySQL appears to be max_packet_size (default 1M).
     MAX_CHUNK_SIZE = 65536
 
-    def _getLog(self, whereclause):
+    # values for the 'compressed' column of the logchunks table, and the
+    # corresponding (compress, decompress) functions, indexed by the names
+    # used in c['logCompressionMethod']
+    COMPRESSION_MODE = {
+        'raw': (0, None, None),
+        'gz': (1, zlib.compress, zlib.decompress),
+        'bz2': (2, bz2.compress, bz2.decompress),
+        'lz4': (3, _lz4_dumps, _lz4_loads),
+    }
+    COMPRESSION_BYID = dict((id, (name, dumps, loads))
+                            for name, (id, dumps, loads)
+                            in COMPRESSION_MODE.iteritems())
+
+    # number of decompressed chunks to keep in memory; each is at most
+    # MAX_CHUNK_SIZE bytes
+    DECOMPRESSED_CACHE_SIZE = 32
+
+    # defaults for c['db']['log_flush_interval'] and
+    # c['db']['log_flush_size']; see appendLog
+    LOG_FLUSH_INTERVAL = 0
+    LOG_FLUSH_SIZE = 1024 * 1024
+
+    _reactor = reactor  # for tests
+
+    def __init__(self, connector):
+        base.DBConnectorComponent.__init__(self, connector)
+        self.decompressedChunks = DecompressedChunkCache(
+            self.DECOMPRESSED_CACHE_SIZE)
+        self._numLines = {}
+        self._pendingAppends = []
+        self._pendingAppendBytes = 0
+        self._pendingAppendWaiters = []
+        self._appendFlushTimer = None
+        # while a flush is running, the list of its waiters
+        self._appendFlushRunning = None
+
+    def _getLog(self, name, build, params):
         def thd(conn):
-            q = self.db.model.logs.select(whereclause=whereclause)
-            res = conn.execute(q)
+            q = self.statement(name, build)
+            res = self.thdExecute(conn, q, **params)
             row = res.fetchone()
 
             rv = None
@@ -37,14 +131,23 @@ class LogsConnectorComponent(base.DBConnectorComponent):
                 rv = self._logdictFromRow(row)
             res.close()
             return rv
-        return self.db.pool.do(thd)
+        return self.db.pool.doRead(thd)
 
     def getLog(self, logid):
-        return self._getLog(self.db.model.logs.c.id == logid)
+        tbl = self.db.model.logs
+        return self._getLog(
+            'getLog',
+            lambda: tbl.select(whereclause=(tbl.c.id == sa.bindparam('b_id'))),
+            dict(b_id=logid))
 
     def getLogBySlug(self, stepid, slug):
         tbl = self.db.model.logs
-        return self._getLog((tbl.c.slug == slug) & (tbl.c.stepid == stepid))
+        return self._getLog(
+            'getLogBySlug',
+            lambda: tbl.select(
+                whereclause=((tbl.c.slug == sa.bindparam('b_slug'))
+                             & (tbl.c.stepid == sa.bindparam('b_stepid')))),
+            dict(b_slug=slug, b_stepid=stepid))
 
     def getLogs(self, stepid):
         def thd(conn):
@@ -54,37 +157,42 @@ class LogsConnectorComponent(base.DBConnectorComponent):
             q = q.order_by(tbl.c.id)
             res = conn.execute(q)
             return [self._logdictFromRow(row) for row in res.fetchall()]
-        return self.db.pool.do(thd)
+        return self.db.pool.doRead(thd)
 
     def getLogLines(self, logid, first_line, last_line):
         def thd(conn):
             # get a set of chunks that completely cover the requested range
             tbl = self.db.model.logchunks
-            q = sa.select([tbl.c.first_line, tbl.c.last_line,
-                           tbl.c.content, tbl.c.compressed])
-            q = q.where(tbl.c.logid == logid)
-            q = q.where(tbl.c.first_line <= last_line)
-            q = q.where(tbl.c.last_line >= first_line)
-            q = q.order_by(tbl.c.first_line)
+
+            def build():
+                q = sa.select([tbl.c.first_line, tbl.c.last_line,
+                               tbl.c.content, tbl.c.compressed])
+                q = q.where(tbl.c.logid == sa.bindparam('b_logid'))
+                q = q.where(tbl.c.first_line <= sa.bindparam('b_last_line'))
+                q = q.where(tbl.c.last_line >= sa.bindparam('b_first_line'))
+                return q.order_by(tbl.c.first_line)
+            q = self.statement('getLogLines', build)
             rv = []
-            for row in conn.execute(q):
-                assert not row.compressed, "compressed rows not supported yet"
-                content = row.content.decode('utf-8')
+            for row in self.thdExecute(conn, q, b_logid=logid,
+                                       b_first_line=first_line,
+                                       b_last_line=last_line):
+                # Trim the chunk to the requested lines before decoding it.
+                # No character but u'\n' maps to b'\n' in UTF-8, so it is
+                # safe to split the encoded content, and the splitting is
+                # done in C rather than one line at a time.  This is a small
+                # part of the cost of a read (see
+                # contrib/loglines_benchmark.py), so no index of the offsets
+                # of the lines in each chunk is stored.
+                content = self._thdChunkContent(logid, row)
                 if row.first_line < first_line:
-                    idx = -1
                     count = first_line - row.first_line
-                    for _ in xrange(count):
-                        idx = content.index('\n', idx + 1)
-                    content = content[idx + 1:]
+                    content = content.split('\n', count)[-1]
                 if row.last_line > last_line:
-                    idx = len(content) + 1
                     count = row.last_line - last_line
-                    for _ in xrange(count):
-                        idx = content.rindex('\n', 0, idx)
-                    content = content[:idx]
-                rv.append(content)
+                    content = content.rsplit('\n', count)[0]
+                rv.append(content.decode('utf-8'))
             return u'\n'.join(rv) + u'\n' if rv else u''
-        return self.db.pool.do(thd)
+        return self.db.pool.doRead(thd)
 
     def addLog(self, stepid, name, slug, type):
         assert type in 'tsh', "Log type must be one of t, s, or h"
@@ -104,36 +212,148 @@ class LogsConnectorComponent(base.DBConnectorComponent):
         # check for trailing newline and strip it for storage -- chunks omit
         # the trailing newline
         assert content[-1] == u'\n'
-        content = content[:-1]
+        d = defer.Deferred()
+        self._pendingAppends.append((logid, content[:-1], d))
+        self._pendingAppendBytes += len(content)
+        self._scheduleAppendFlush()
+        return d
 
-        def thd(conn):
-            q = sa.select([self.db.model.logs.c.num_lines])
-            q = q.where(self.db.model.logs.c.id == logid)
-            res = conn.execute(q)
-            row = res.fetchone()
-            res.close()
-            if not row:
-                return  # ignore a missing log
+    # Appends are written behind: they are queued and then written, for all
+    # logs at once, in a single transaction.  A flush happens after
+    # c['db']['log_flush_interval'] seconds, or as soon as
+    # c['db']['log_flush_size'] bytes are pending, or right away when
+    # something waits for them (finishLog, or the connector stopping).  Only
+    # one flush runs at a time, so appends arriving while a flush is running
+    # are coalesced into the next one.  Each log's line count is kept in
+    # memory, as this is the only master writing to it.
 
-            # Break the content up into chunks.  This takes advantage of the
-            # fact that no character but u'\n' maps to b'\n' in UTF-8.
+    def _scheduleAppendFlush(self):
+        if self._appendFlushRunning is not None or not self._pendingAppends:
+            return  # rescheduled when the running flush completes
+        db_cfg = self.master.config.db
+        flush_size = db_cfg.get('log_flush_size', self.LOG_FLUSH_SIZE)
+        # someone waiting for these appends should not wait for the timer
+        if (self._pendingAppendWaiters
+                or self._pendingAppendBytes >= flush_size):
+            self._flushAppends()
+        elif not self._appendFlushTimer:
+            interval = db_cfg.get('log_flush_interval',
+                                  self.LOG_FLUSH_INTERVAL)
+            self._appendFlushTimer = self._reactor.callLater(
+                interval, self._flushAppends)
 
-            first_line = chunk_first_line = row[0]
-            remaining = content.encode('utf-8')
-            while remaining:
-                chunk, remaining = self._splitBigChunk(remaining, logid)
+    @defer.inlineCallbacks
+    def _flushAppends(self):
+        if self._appendFlushTimer:
+            if self._appendFlushTimer.active():
+                self._appendFlushTimer.cancel()
+            self._appendFlushTimer = None
+        appends, self._pendingAppends = self._pendingAppends, []
+        waiters, self._pendingAppendWaiters = self._pendingAppendWaiters, []
+        self._pendingAppendBytes = 0
+        self._appendFlushRunning = waiters
+
+        logids = set(logid for logid, _, _ in appends)
+        num_lines = dict((logid, self._numLines[logid])
+                         for logid in logids if logid in self._numLines)
+        try:
+            results, num_lines = yield self.db.pool.do(
+                self._thdAppendLogs,
+                [(logid, content) for logid, content, _ in appends],
+                num_lines)
+        except Exception:
+            f = failure.Failure()
+            # the line counts may no longer be trustworthy
+            for logid in logids:
+                self._numLines.pop(logid, None)
+            for _, _, d in appends:
+                d.errback(f)
+        else:
+            self._numLines.update(num_lines)
+            for (_, _, d), res in zip(appends, results):
+                d.callback(res)
 
+        self._appendFlushRunning = None
+        for d in waiters:
+            d.callback(None)
+        self._scheduleAppendFlush()
+
+    def flushPendingAppends(self):
+        # write any queued appends now; the connector calls this when it
+        # stops, so that no log lines are lost at shutdown
+        return self._waitForAppends()
+
+    def _waitForAppends(self):
+        # return a Deferred that fires when all appends queued so far have
+        # been written, starting a flush right away if necessary
+        if self._pendingAppends:
+            d = defer.Deferred()
+            self._pendingAppendWaiters.append(d)
+            if self._appendFlushRunning is None:
+                self._flushAppends()
+            return d
+        elif self._appendFlushRunning is not None:
+            d = defer.Deferred()
+            self._appendFlushRunning.append(d)
+            return d
+        return defer.succeed(None)
+
+    def _thdAppendLogs(self, conn, appends, num_lines):
+        tbl = self.db.model.logs
+
+        # fetch the current line counts for any logs we have not seen
+        unknown = set(logid for logid, _ in appends) - set(num_lines)
+        if unknown:
+            q = sa.select([tbl.c.id, tbl.c.num_lines])
+            q = q.where(tbl.c.id.in_(unknown))
+            for row in conn.execute(q).fetchall():
+                num_lines[row.id] = row.num_lines
+
+        # assign line numbers to each append, and coalesce the content of
+        # the appends to each log
+        results = []
+        logids = []
+        contents = {}
+        for logid, content in appends:
+            if logid not in num_lines:
+                results.append(None)  # ignore a missing log
+                continue
+            first_line = num_lines[logid]
+            last_line = first_line + content.count(u'\n')
+            num_lines[logid] = last_line + 1
+            results.append((first_line, last_line))
+            if logid not in contents:
+                logids.append(logid)
+                contents[logid] = (first_line, [])
+            contents[logid][1].append(content)
+
+        # Break the content up into chunks.  This takes advantage of the
+        # fact that no character but u'\n' maps to b'\n' in UTF-8.
+        rows = []
+        for logid in logids:
+            chunk_first_line, content = contents[logid]
+            remaining = u'\n'.join(content).encode('utf-8')
+            while remaining is not None:
+                chunk, remaining = self._splitBigChunk(remaining, logid)
                 last_line = chunk_first_line + chunk.count('\n')
-                conn.execute(self.db.model.logchunks.insert(),
-                             dict(logid=logid, first_line=chunk_first_line,
-                                  last_line=last_line, content=chunk,
-                                  compressed=0))
+                rows.append(dict(logid=logid, first_line=chunk_first_line,
+                                 last_line=last_line, content=chunk,
+                                 compressed=0))
                 chunk_first_line = last_line + 1
 
-            conn.execute(self.db.model.logs.update(whereclause=(self.db.model.logs.c.id == logid)),
-                         num_lines=last_line + 1)
-            return (first_line, last_line)
-        return self.db.pool.do(thd)
+        if rows:
+            transaction = conn.begin()
+            q = self.statement('appendLogChunks',
+                               self.db.model.logchunks.insert)
+            self.thdExecute(conn, q, rows)
+            q = self.statement('setLogNumLines', lambda: tbl.update(
+                whereclause=(tbl.c.id == sa.bindparam('b_id'))).values(
+                    num_lines=sa.bindparam('b_num_lines')))
+            self.thdExecute(conn, q,
+                            [dict(b_id=logid, b_num_lines=num_lines[logid])
+                             for logid in logids])
+            transaction.commit()
+        return results, num_lines
 
     def _splitBigChunk(self, content, logid):
         """
@@ -167,16 +387,176 @@ class LogsConnectorComponent(base.DBConnectorComponent):
         else:
             return truncline, content[i + 1:]
 
+    @defer.inlineCallbacks
     def finishLog(self, logid):
         def thd(conn):
             tbl = self.db.model.logs
-            q = tbl.update(whereclause=(tbl.c.id == logid))
-            conn.execute(q, complete=1)
-        return self.db.pool.do(thd)
+            q = self.statement('finishLog', lambda: tbl.update(
+                whereclause=(tbl.c.id == sa.bindparam('b_id'))))
+            self.thdExecute(conn, q, b_id=logid, complete=1)
+        # make sure every line appended so far is written first
+        yield self._waitForAppends()
+        yield self.db.pool.do(thd)
+        self._numLines.pop(logid, None)
+
+    def _thdChunkContent(self, logid, row):
+        # return the uncompressed content of the given logchunks row,
+        # consulting the cache of decompressed chunks for compressed rows
+        if not row.compressed:
+            return row.content
+        key = (logid, row.first_line, row.last_line)
+        content = self.decompressedChunks.get(key)
+        if content is None:
+            loads = self.COMPRESSION_BYID[row.compressed][2]
+            content = loads(row.content)
+            self.decompressedChunks.put(key, content)
+        return content
+
+    def _thdCompressChunk(self, chunk, method):
+        # compress CHUNK with the given method, returning (content,
+        # compressed); the chunk is left uncompressed if that is not smaller
+        id, dumps, _ = self.COMPRESSION_MODE[method]
+        if dumps is not None:
+            compressed_chunk = dumps(chunk)
+            if len(compressed_chunk) < len(chunk):
+                return compressed_chunk, id
+        return chunk, 0
 
     def compressLog(self, logid):
-        # TODO: compression not supported yet
-        return defer.succeed(None)
+        method = self.master.config.logCompressionMethod
+
+        def thd(conn):
+            tbl = self.db.model.logchunks
+            q = sa.select([tbl.c.first_line, tbl.c.last_line,
+                           sa.func.length(tbl.c.content).label('length'),
+                           tbl.c.compressed])
+            q = q.where(tbl.c.logid == logid)
+            q = q.order_by(tbl.c.first_line)
+
+            # Gather runs of consecutive uncompressed chunks into groups that
+            # will fit in a single chunk once joined by newlines.  Chunks that
+            # are already compressed are left alone.
+            groups = []
+            group = None
+            for row in conn.execute(q).fetchall():
+                if row.compressed:
+                    group = None
+                    continue
+                length = row.length or 0
+                if group and group[2] + 1 + length <= self.MAX_CHUNK_SIZE:
+                    group[1] = row.last_line
+                    group[2] += 1 + length
+                    group[3] += 1
+                else:
+                    group = [row.first_line, row.last_line, length, 1]
+                    groups.append(group)
+
+            saved = 0
+            for first_line, last_line, length, numchunks in groups:
+                q = sa.select([tbl.c.content])
+                q = q.where(tbl.c.logid == logid)
+                q = q.where(tbl.c.first_line >= first_line)
+                q = q.where(tbl.c.last_line <= last_line)
+                q = q.order_by(tbl.c.first_line)
+                contents = [row.content for row in conn.execute(q)]
+                old_size = sum(len(c) for c in contents)
+                chunk, compressed = self._thdCompressChunk(
+                    '\n'.join(contents), method)
+                if numchunks == 1 and not compressed:
+                    continue  # nothing to gain from rewriting this chunk
+
+                # replace the group in a transaction, so that readers never
+                # see the lines missing
+                transaction = conn.begin()
+                d = tbl.delete()
+                d = d.where(tbl.c.logid == logid)
+                d = d.where(tbl.c.first_line >= first_line)
+                d = d.where(tbl.c.last_line <= last_line)
+                conn.execute(d)
+                conn.execute(tbl.insert(),
+                             dict(logid=logid, first_line=first_line,
+                                  last_line=last_line, content=chunk,
+                                  compressed=compressed))
+                transaction.commit()
+                saved += old_size - len(chunk)
+            return saved
+        return self.db.pool.do(thd)
+
+    def thdDeleteLogChunks(self, conn, logids):
+        # delete the content of the given logs, returning the number of
+        # chunks deleted and their total size in bytes
+        tbl = self.db.model.logchunks
+        size = 0
+        for batch in self.doBatch(logids):
+            q = sa.select([sa.func.sum(sa.func.length(tbl.c.content))],
+                          whereclause=tbl.c.logid.in_(batch))
+            size += conn.scalar(q) or 0
+        return self.thdDeleteIn(conn, tbl.c.logid, logids), size
+
+    @defer.inlineCallbacks
+    def pruneLogs(self, logHorizon, batch_n=500):
+        """
+        Called periodically by DBConnector, this method deletes the content
+        of the logs of all but the latest C{logHorizon} finished builds of
+        each builder, C{batch_n} logs at a time.  The logs themselves remain,
+        with no lines.
+        """
+        rows = {'logchunks': 0}
+        size = {'logchunks': 0}
+        if not logHorizon:
+            defer.returnValue(dict(rows=rows, bytes=size))
+
+        def thdGetBuilderIds(conn):
+            tbl = self.db.model.builds
+            q = sa.select([tbl.c.builderid]).distinct()
+            return [row.builderid for row in conn.execute(q)]
+
+        def thd(conn, builderid):
+            logs_tbl = self.db.model.logs
+            steps_tbl = self.db.model.steps
+            builds_tbl = self.db.model.builds
+            finished = ((builds_tbl.c.builderid == builderid)
+                        & (builds_tbl.c.complete_at != NULL))
+            # the latest build whose logs are emptied
+            q = sa.select([builds_tbl.c.number], whereclause=finished,
+                          order_by=[sa.desc(builds_tbl.c.number)],
+                          offset=logHorizon, limit=1)
+            number = conn.scalar(q)
+            if number is None:
+                return None
+            q = sa.select([logs_tbl.c.id],
+                          from_obj=[logs_tbl.join(
+                              steps_tbl, logs_tbl.c.stepid == steps_tbl.c.id
+                          ).join(
+                              builds_tbl,
+                              steps_tbl.c.buildid == builds_tbl.c.id)],
+                          whereclause=(finished
+                                       & (builds_tbl.c.number <= number)
+                                       & (logs_tbl.c.num_lines > 0)),
+                          limit=batch_n)
+            logids = [row.id for row in conn.execute(q)]
+            if not logids:
+                return None
+
+            transaction = conn.begin()
+            res = self.thdDeleteLogChunks(conn, logids)
+            for batch in self.doBatch(logids):
+                q = logs_tbl.update(whereclause=logs_tbl.c.id.in_(batch))
+                conn.execute(q, num_lines=0)
+            transaction.commit()
+            return res
+
+        builderids = yield self.db.pool.do(thdGetBuilderIds)
+        for builderid in builderids:
+            # each batch is a separate call, so that other queries can run in
+            # between
+            while True:
+                res = yield self.db.pool.do(thd, builderid)
+                if res is None:
+                    break
+                rows['logchunks'] += res[0]
+                size['logchunks'] += res[1]
+        defer.returnValue(dict(rows=rows, bytes=size))
 
     def _logdictFromRow(self, row):
         rv = dict(row)
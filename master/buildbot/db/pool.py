@@ -17,11 +17,15 @@ import inspect
 import os
 import shutil
 import sqlalchemy as sa
+import sys
 import tempfile
+import threading
 import time
 import traceback
 
 from buildbot.process import metrics
+from collections import defaultdict
+from sqlalchemy.sql import util as sql_util
 from twisted.internet import reactor
 from twisted.internet import threads
 from twisted.python import log
@@ -83,10 +87,62 @@ def timed_do_fn(f):
     return wrap
 
 
+def _callerName(frame, _names={}):
+    # name a pool callable after the connector method that submitted it, e.g.,
+    # "buildrequests.getBuildRequests"; the callables themselves are usually
+    # all called "thd"
+    code = frame.f_code
+    try:
+        return _names[code]
+    except KeyError:
+        module = frame.f_globals.get('__name__', '?').rsplit('.', 1)[-1]
+        name = _names[code] = '%s.%s' % (module, code.co_name)
+        return name
+
+
+class _CallStats(object):
+    # timing information for a single call to a pool callable; the times are
+    # filled in by the thread running the callable
+
+    __slots__ = ('name', 'queued', 'started', 'finished', 'retries', 'rows',
+                 'wrote')
+
+    def __init__(self, name):
+        self.name = name
+        self.queued = time.time()
+        self.started = self.finished = None
+        self.retries = 0
+        self.rows = None
+        # names of the tables written, if a read pool is set
+        self.wrote = None
+
+
+class _ReadFenced(Exception):
+    # raised in a read pool thread when a query reads a table this master
+    # wrote too recently for the read database to have caught up
+
+    pass
+
+
+# stands for every table, for writes whose tables cannot be determined
+_ALL_TABLES = '*'
+
+
 class DBThreadPool(threadpool.ThreadPool):
 
     running = False
 
+    # an adaptive pool (with pool_max_size > pool_size) grows by one thread
+    # whenever a callable has waited more than GROW_WAIT seconds for a thread,
+    # and shrinks by one thread after SHRINK_AFTER seconds with no such waits
+    GROW_WAIT = 0.1
+    SHRINK_AFTER = 60
+
+    # statistics about each callable are gathered in the pool, and logged as
+    # metrics at most once every STATS_INTERVAL seconds, since logging them
+    # for every call would take longer than many of the calls do
+    STATS_INTERVAL = 10
+
     # Some versions of SQLite incorrectly cache metadata about which tables are
     # and are not present on a per-connection basis.  This cache can be flushed
     # by querying the sqlite_master table.  We currently assume all versions of
@@ -95,7 +151,8 @@ class DBThreadPool(threadpool.ThreadPool):
     # in bug #1810.
     __broken_sqlite = None
 
-    def __init__(self, engine, verbose=False):
+    def __init__(self, engine, verbose=False, pool_size=None,
+                 pool_max_size=None, name='DBThreadPool'):
         # verbose is used by upgrade scripts, and if it is set we should print
         # messages about versions and other warnings
         log_msg = log.msg
@@ -104,20 +161,19 @@ class DBThreadPool(threadpool.ThreadPool):
                 print m
             log_msg = _log_msg
 
-        pool_size = 5
-
-        # If the engine has an C{optimal_thread_pool_size} attribute, then the
-        # maxthreads of the thread pool will be set to that value.  This is
-        # most useful for SQLite in-memory connections, where exactly one
-        # connection (and thus thread) should be used.
-        if hasattr(engine, 'optimal_thread_pool_size'):
-            pool_size = engine.optimal_thread_pool_size
-
         threadpool.ThreadPool.__init__(self,
                                        minthreads=1,
-                                       maxthreads=pool_size,
-                                       name='DBThreadPool')
+                                       maxthreads=1,
+                                       name=name)
         self.engine = engine
+        self.setPoolSize(pool_size, pool_max_size)
+        self._histograms = defaultdict(metrics.Histogram)
+        self._retries = defaultdict(int)
+        self._statsFlushed = time.time()
+        self.read_pool = None
+        # time each table was last written, if a read pool is set
+        self._lastWrite = {}
+        self._local = threading.local()
         if engine.dialect.name == 'sqlite':
             vers = self.get_sqlite_version()
             if vers < (3, 7):
@@ -140,6 +196,84 @@ class DBThreadPool(threadpool.ThreadPool):
         if debug:
             self.do = timed_do_fn(self.do)
             self.do_with_engine = timed_do_fn(self.do_with_engine)
+            self.doRead = timed_do_fn(self.doRead)
+
+    def setPoolSize(self, pool_size=None, pool_max_size=None):
+        """
+        Set the number of threads in the pool to C{pool_size}, or, if
+        C{pool_max_size} is larger, make the pool adaptive, using between
+        C{pool_size} and C{pool_max_size} threads.  Neither can exceed the
+        number of connections the engine allows.
+        """
+        # If the engine has an C{optimal_thread_pool_size} attribute, then
+        # the pool will not be larger than that value.  This is most useful
+        # for SQLite in-memory connections, where exactly one connection (and
+        # thus thread) should be used.
+        limit = getattr(self.engine, 'optimal_thread_pool_size', None)
+        if pool_size is None:
+            pool_size = limit or 5
+        if pool_max_size is None or pool_max_size < pool_size:
+            pool_max_size = pool_size
+        if limit:
+            pool_size = min(pool_size, limit)
+            pool_max_size = min(pool_max_size, limit)
+
+        self.pool_size = pool_size
+        self.pool_max_size = pool_max_size
+        self._lastSaturated = time.time()
+        self._setThreads(pool_size)
+
+    def _setThreads(self, count):
+        self.adjustPoolsize(maxthreads=count)
+        metrics.MetricCountEvent.log(self.name + '.threads', count,
+                                     absolute=True)
+
+    def _adapt(self, wait, now):
+        if wait > self.GROW_WAIT:
+            self._lastSaturated = now
+            if self.max < self.pool_max_size:
+                self._setThreads(self.max + 1)
+        elif now - self._lastSaturated > self.SHRINK_AFTER:
+            # shrink by at most one thread per SHRINK_AFTER seconds
+            self._lastSaturated = now
+            if self.max > self.pool_size:
+                self._setThreads(self.max - 1)
+
+    def _recordStats(self, res, stats):
+        # gather the timings of a completed call, and adapt the pool size to
+        # them
+        now = time.time()
+        name = stats.name
+        prefix = self.name
+        started = stats.started or now
+        wait = started - stats.queued
+        histograms = self._histograms
+        histograms[prefix + '.queueWait.' + name].add(wait)
+        histograms[prefix + '.execute.' + name].add(
+            (stats.finished or now) - started)
+        if stats.rows is not None:
+            histograms[prefix + '.rows.' + name].add(stats.rows)
+        if stats.retries:
+            self._retries[prefix + '.retries.' + name] += stats.retries
+        if stats.wrote:
+            for table in stats.wrote:
+                self._lastWrite[table] = now
+        if self.pool_max_size > self.pool_size:
+            self._adapt(wait, now)
+        if now - self._statsFlushed >= self.STATS_INTERVAL:
+            self.flushStats()
+        return res
+
+    def flushStats(self):
+        """Log the statistics gathered since the last flush as metrics."""
+        histograms, self._histograms = self._histograms, defaultdict(
+            metrics.Histogram)
+        retries, self._retries = self._retries, defaultdict(int)
+        self._statsFlushed = time.time()
+        for name, histogram in histograms.iteritems():
+            metrics.MetricHistogramEvent.log(name, histogram)
+        for name, count in retries.iteritems():
+            metrics.MetricCountEvent.log(name, count)
 
     def _start(self):
         self._start_evt = None
@@ -151,6 +285,7 @@ class DBThreadPool(threadpool.ThreadPool):
 
     def _stop(self):
         self._stop_evt = None
+        self.flushStats()
         self.stop()
         self.engine.dispose()
         self.running = False
@@ -172,12 +307,12 @@ class DBThreadPool(threadpool.ThreadPool):
     BACKOFF_MULT = 1.05
     MAX_OPERATIONALERROR_TIME = 3600 * 24  # one day
 
-    def __thd(self, with_engine, callable, args, kwargs):
+    def __thd(self, with_engine, callable, args, kwargs, stats):
         # try to call callable(arg, *args, **kwargs) repeatedly until no
         # OperationalErrors occur, where arg is either the engine (with_engine)
         # or a connection (not with_engine)
         backoff = self.BACKOFF_START
-        start = time.time()
+        start = stats.started = time.time()
         while True:
             if with_engine:
                 arg = self.engine
@@ -186,6 +321,8 @@ class DBThreadPool(threadpool.ThreadPool):
 
             if self.__broken_sqlite:  # see bug #1810
                 arg.execute("select * from sqlite_master")
+            # for the statement listeners installed by setReadPool
+            self._local.stats = stats
             try:
                 try:
                     rv = callable(arg, *args, **kwargs)
@@ -205,6 +342,7 @@ class DBThreadPool(threadpool.ThreadPool):
 
                         metrics.MetricCountEvent.log(
                             "DBThreadPool.retry-on-OperationalError")
+                        stats.retries += 1
                         log.msg("automatically retrying query after "
                                 "OperationalError (%ss sleep)" % backoff)
 
@@ -217,18 +355,99 @@ class DBThreadPool(threadpool.ThreadPool):
                     else:
                         raise
             finally:
+                self._local.stats = None
                 if not with_engine:
                     arg.close()
+                stats.finished = time.time()
             break
+        if isinstance(rv, (list, tuple, dict, set)):
+            stats.rows = len(rv)
         return rv
 
     def do(self, callable, *args, **kwargs):
-        return threads.deferToThreadPool(reactor, self,
-                                         self.__thd, False, callable, args, kwargs)
+        return self._do(False, callable, args, kwargs, sys._getframe(1))
 
     def do_with_engine(self, callable, *args, **kwargs):
-        return threads.deferToThreadPool(reactor, self,
-                                         self.__thd, True, callable, args, kwargs)
+        return self._do(True, callable, args, kwargs, sys._getframe(1))
+
+    def doRead(self, callable, *args, **kwargs):
+        """
+        Like L{do}, but for a C{callable} that only reads, and can tolerate
+        the lag of the read pool, if one is set with L{setReadPool}.
+        """
+        frame = sys._getframe(1)
+        if self.read_pool is None:
+            return self._do(False, callable, args, kwargs, frame)
+
+        d = self.read_pool._do(False, callable, args, kwargs, frame)
+
+        @d.addErrback
+        def fenced(f):
+            f.trap(_ReadFenced)
+            metrics.MetricCountEvent.log(self.name + '.fencedReads', 1)
+            return self._do(False, callable, args, kwargs, frame)
+        return d
+
+    def setReadPool(self, read_pool, read_lag=1):
+        """
+        Send calls made with L{doRead} to C{read_pool}.  So that reads see
+        this master's own writes, a call is run in this pool instead if it
+        queries a table that a call in this pool wrote less than C{read_lag}
+        seconds ago.
+        """
+        self.read_pool = read_pool
+        self.read_lag = read_lag
+        sa.event.listen(self.engine, 'after_cursor_execute',
+                        self._thdNoteWrite)
+        sa.event.listen(read_pool.engine, 'before_cursor_execute',
+                        self._thdCheckRead)
+
+    def _thdNoteWrite(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        # remember the tables written by the call running in this thread;
+        # they are fenced from the read pool once the call finishes
+        stats = self._local.stats
+        if stats is None:
+            return
+        query = context.compiled.statement if context.compiled else None
+        if isinstance(query, sa.sql.expression.UpdateBase):
+            table = query.table.name
+        elif isinstance(query, sa.sql.expression.Select):
+            return
+        elif statement.lstrip()[:6].lower() == 'select':
+            return
+        else:
+            table = _ALL_TABLES
+        if stats.wrote is None:
+            stats.wrote = set()
+        stats.wrote.add(table)
+
+    def _thdCheckRead(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        # abandon a call in the read pool if this query reads a table that
+        # was written too recently; doRead runs it again in this pool
+        if self.read_pool._local.stats is None:
+            return
+        query = context.compiled.statement if context.compiled else None
+        lastWrite = self._lastWrite
+        if isinstance(query, sa.sql.expression.Select):
+            tables = [t.name for t in sql_util.find_tables(query)]
+            tables.append(_ALL_TABLES)
+        else:
+            # a textual query could read anything
+            tables = lastWrite.keys()
+        since = time.time() - self.read_lag
+        for table in tables:
+            if lastWrite.get(table, 0) > since:
+                raise _ReadFenced()
+
+    def _do(self, with_engine, callable, args, kwargs, frame):
+        stats = _CallStats(_callerName(frame))
+        d = threads.deferToThreadPool(reactor, self, self.__thd,
+                                      with_engine, callable, args, kwargs,
+                                      stats)
+        d.addBoth(self._recordStats, stats)
+        return d
 
     def detect_bug1810(self):
         # detect buggy SQLite implementations; call only for a known-sqlite
@@ -94,7 +94,7 @@ class SourceStampsConnectorComponent(base.DBConnectorComponent):
             ssdict = self._rowToSsdict_thd(conn, row)
             res.close()
             return ssdict
-        return self.db.pool.do(thd)
+        return self.db.pool.doRead(thd)
 
     def getSourceStampsForBuild(self, buildid):
         assert buildid > 0
@@ -121,7 +121,7 @@ class SourceStampsConnectorComponent(base.DBConnectorComponent):
             return [self._rowToSsdict_thd(conn, row)
                     for row in res.fetchall()]
 
-        return self.db.pool.do(thd)
+        return self.db.pool.doRead(thd)
 
     def getSourceStamps(self):
         def thd(conn):
@@ -130,7 +130,7 @@ class SourceStampsConnectorComponent(base.DBConnectorComponent):
             res = conn.execute(q)
             return [self._rowToSsdict_thd(conn, row)
                     for row in res.fetchall()]
-        return self.db.pool.do(thd)
+        return self.db.pool.doRead(thd)
 
     def _rowToSsdict_thd(self, conn, row):
         ssid = row.id
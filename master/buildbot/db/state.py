@@ -52,10 +52,13 @@ class StateConnectorComponent(base.DBConnectorComponent):
         self.checkLength(objects_tbl.c.class_name, class_name)
 
         def select():
-            q = sa.select([objects_tbl.c.id],
-                          whereclause=((objects_tbl.c.name == name)
-                                       & (objects_tbl.c.class_name == class_name)))
-            res = conn.execute(q)
+            q = self.statement('getObjectId', lambda: sa.select(
+                [objects_tbl.c.id],
+                whereclause=((objects_tbl.c.name == sa.bindparam('b_name'))
+                             & (objects_tbl.c.class_name ==
+                                sa.bindparam('b_class_name')))))
+            res = self.thdExecute(conn, q, b_name=name,
+                                  b_class_name=class_name)
             row = res.fetchone()
             res.close()
             if not row:
@@ -63,9 +66,8 @@ class StateConnectorComponent(base.DBConnectorComponent):
             return row.id
 
         def insert():
-            res = conn.execute(objects_tbl.insert(),
-                               name=name,
-                               class_name=class_name)
+            q = self.statement('addObject', objects_tbl.insert)
+            res = self.thdExecute(conn, q, name=name, class_name=class_name)
             return res.inserted_primary_key[0]
 
         # we want to try selecting, then inserting, but if the insert fails
@@ -97,10 +99,12 @@ class StateConnectorComponent(base.DBConnectorComponent):
     def thdGetState(self, conn, objectid, name, default=Thunk):
         object_state_tbl = self.db.model.object_state
 
-        q = sa.select([object_state_tbl.c.value_json],
-                      whereclause=((object_state_tbl.c.objectid == objectid)
-                                   & (object_state_tbl.c.name == name)))
-        res = conn.execute(q)
+        q = self.statement('getState', lambda: sa.select(
+            [object_state_tbl.c.value_json],
+            whereclause=((object_state_tbl.c.objectid ==
+                          sa.bindparam('b_objectid'))
+                         & (object_state_tbl.c.name == sa.bindparam('b_name')))))
+        res = self.thdExecute(conn, q, b_objectid=objectid, b_name=name)
         row = res.fetchone()
         res.close()
 
@@ -131,19 +135,23 @@ class StateConnectorComponent(base.DBConnectorComponent):
         self.checkLength(object_state_tbl.c.name, name)
 
         def update():
-            q = object_state_tbl.update(
-                whereclause=((object_state_tbl.c.objectid == objectid)
-                             & (object_state_tbl.c.name == name)))
-            res = conn.execute(q, value_json=value_json)
+            q = self.statement('setState', lambda: object_state_tbl.update(
+                whereclause=((object_state_tbl.c.objectid ==
+                              sa.bindparam('b_objectid'))
+                             & (object_state_tbl.c.name ==
+                                sa.bindparam('b_name')))))
+            res = self.thdExecute(conn, q, b_objectid=objectid, b_name=name,
+                                  value_json=value_json)
 
             # check whether that worked
             return res.rowcount > 0
 
         def insert():
-            conn.execute(object_state_tbl.insert(),
-                         objectid=objectid,
-                         name=name,
-                         value_json=value_json)
+            q = self.statement('addState', object_state_tbl.insert)
+            self.thdExecute(conn, q,
+                            objectid=objectid,
+                            name=name,
+                            value_json=value_json)
 
         # try updating; if that fails, try inserting; if that fails, then
         # we raced with another instance to insert, so let that instance
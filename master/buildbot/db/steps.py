@@ -29,21 +29,28 @@ class StepsConnectorComponent(base.DBConnectorComponent):
     def getStep(self, stepid=None, buildid=None, number=None, name=None):
         tbl = self.db.model.steps
         if stepid is not None:
-            wc = (tbl.c.id == stepid)
+            key = 'getStep'
+            params = dict(b_id=stepid)
+            wc = (tbl.c.id == sa.bindparam('b_id'))
         else:
             if buildid is None:
                 return defer.fail(RuntimeError('must supply either stepid or buildid'))
             if number is not None:
-                wc = (tbl.c.number == number)
+                key = 'getStepByNumber'
+                params = dict(b_number=number)
+                wc = (tbl.c.number == sa.bindparam('b_number'))
             elif name is not None:
-                wc = (tbl.c.name == name)
+                key = 'getStepByName'
+                params = dict(b_name=name)
+                wc = (tbl.c.name == sa.bindparam('b_name'))
             else:
                 return defer.fail(RuntimeError('must supply either number or name'))
-            wc = wc & (tbl.c.buildid == buildid)
+            params['b_buildid'] = buildid
+            wc = wc & (tbl.c.buildid == sa.bindparam('b_buildid'))
 
         def thd(conn):
-            q = self.db.model.steps.select(whereclause=wc)
-            res = conn.execute(q)
+            q = self.statement(key, lambda: tbl.select(whereclause=wc))
+            res = self.thdExecute(conn, q, **params)
             row = res.fetchone()
 
             rv = None
@@ -51,7 +58,7 @@ class StepsConnectorComponent(base.DBConnectorComponent):
                 rv = self._stepdictFromRow(row)
             res.close()
             return rv
-        return self.db.pool.do(thd)
+        return self.db.pool.doRead(thd)
 
     def getSteps(self, buildid):
         def thd(conn):
@@ -61,14 +68,16 @@ class StepsConnectorComponent(base.DBConnectorComponent):
             q = q.order_by(tbl.c.number)
             res = conn.execute(q)
             return [self._stepdictFromRow(row) for row in res.fetchall()]
-        return self.db.pool.do(thd)
+        return self.db.pool.doRead(thd)
 
     def addStep(self, buildid, name, state_string):
         def thd(conn):
             tbl = self.db.model.steps
             # get the highest current number
-            r = conn.execute(sa.select([sa.func.max(tbl.c.number)],
-                                       whereclause=(tbl.c.buildid == buildid)))
+            q = self.statement('getMaxStepNumber', lambda: sa.select(
+                [sa.func.max(tbl.c.number)],
+                whereclause=(tbl.c.buildid == sa.bindparam('b_buildid'))))
+            r = self.thdExecute(conn, q, b_buildid=buildid)
             number = r.scalar()
             number = 0 if number is None else number + 1
 
@@ -80,7 +89,8 @@ class StepsConnectorComponent(base.DBConnectorComponent):
                               state_string=state_string,
                               urls_json='[]', name=name)
             try:
-                r = conn.execute(self.db.model.steps.insert(), insert_row)
+                r = self.thdExecute(conn, self.statement('addStep', tbl.insert),
+                                    insert_row)
                 got_id = r.inserted_primary_key[0]
             except (sa.exc.IntegrityError, sa.exc.ProgrammingError):
                 got_id = None
@@ -111,16 +121,14 @@ class StepsConnectorComponent(base.DBConnectorComponent):
         started_at = _reactor.seconds()
 
         def thd(conn):
-            tbl = self.db.model.steps
-            q = tbl.update(whereclause=(tbl.c.id == stepid))
-            conn.execute(q, started_at=started_at)
+            self.thdExecute(conn, self._updateStepStatement(),
+                            b_id=stepid, started_at=started_at)
         return self.db.pool.do(thd)
 
     def setStepStateString(self, stepid, state_string):
         def thd(conn):
-            tbl = self.db.model.steps
-            q = tbl.update(whereclause=(tbl.c.id == stepid))
-            conn.execute(q, state_string=state_string)
+            self.thdExecute(conn, self._updateStepStatement(),
+                            b_id=stepid, state_string=state_string)
         return self.db.pool.do(thd)
 
     def addURL(self, stepid, name, url, _racehook=None):
@@ -155,14 +163,19 @@ class StepsConnectorComponent(base.DBConnectorComponent):
 
     def finishStep(self, stepid, results, hidden, _reactor=reactor):
         def thd(conn):
-            tbl = self.db.model.steps
-            q = tbl.update(whereclause=(tbl.c.id == stepid))
-            conn.execute(q,
-                         complete_at=_reactor.seconds(),
-                         results=results,
-                         hidden=1 if hidden else 0)
+            self.thdExecute(conn, self._updateStepStatement(),
+                            b_id=stepid,
+                            complete_at=_reactor.seconds(),
+                            results=results,
+                            hidden=1 if hidden else 0)
         return self.db.pool.do(thd)
 
+    def _updateStepStatement(self):
+        # the columns to set are given when this is executed
+        tbl = self.db.model.steps
+        return self.statement('updateStep', lambda: tbl.update(
+            whereclause=(tbl.c.id == sa.bindparam('b_id'))))
+
     def _stepdictFromRow(self, row):
         def mkdt(epoch):
             if epoch:
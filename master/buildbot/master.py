@@ -45,6 +45,7 @@ from buildbot.mq import connector as mqconnector
 from buildbot.process import cache
 from buildbot.process import debug
 from buildbot.process import metrics
+from buildbot.process import remotetransfer
 from buildbot.process.botmaster import BotMaster
 from buildbot.process.builder import BuilderControl
 from buildbot.process.users.manager import UserManagerManager
@@ -147,6 +148,9 @@ class BuildMaster(service.ReconfigurableServiceMixin, service.AsyncMultiService)
         self.botmaster = BotMaster(self)
         self.botmaster.setServiceParent(self)
 
+        self.transfers = remotetransfer.TransferThreadPool()
+        self.transfers.setServiceParent(self)
+
         self.scheduler_manager = SchedulerManager(self)
         self.scheduler_manager.setServiceParent(self)
 
@@ -383,6 +387,12 @@ class BuildMaster(service.ReconfigurableServiceMixin, service.AsyncMultiService)
             raise config.ConfigErrors([
                 "Cannot change c['mq']['type'] after the master has started",
             ])
+        for key in 'broker', 'listen':
+            if self.config.mq.get(key) != new_config.mq.get(key):
+                raise config.ConfigErrors([
+                    "Cannot change c['mq']['%s'] after the master has started"
+                    % (key,),
+                ])
 
         return service.ReconfigurableServiceMixin.reconfigServiceWithBuildbotConfig(self,
                                                                                     new_config)
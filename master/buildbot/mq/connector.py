@@ -24,6 +24,10 @@ class MQConnector(service.ReconfigurableServiceMixin, service.AsyncMultiService)
             'class': "buildbot.mq.simple.SimpleMQ",
             'keys': set(['debug']),
         },
+        'tcp': {
+            'class': "buildbot.mq.tcp.TcpMQ",
+            'keys': set(['debug', 'broker', 'listen']),
+        },
     }
 
     def __init__(self, master):
@@ -0,0 +1,89 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from contextlib import contextmanager
+
+from buildbot.process import metrics
+from buildbot.util import json
+from buildbot.util import toJson
+
+
+class MessageEncoder(object):
+
+    """
+    Encode MQ messages as JSON for delivery to web clients.
+
+    The MQ wraps the delivery of each message to its matching consumers in
+    L{delivery}.  Within a delivery, the message is serialized by the first
+    consumer that asks for it, and the same bytes are returned to every
+    other consumer.  Any other message, and any message outside of a
+    delivery, is encoded afresh.
+
+    At the end of each delivery that was encoded, the time spent encoding
+    and the number of clients the message was delivered to are reported as
+    metrics.
+    """
+
+    def __init__(self):
+        # the message being delivered, and its encoding once there is one
+        self.message = None
+        self.encoded = None
+        self.deliveries = 0
+
+    @contextmanager
+    def delivery(self, key, data):
+        """
+        Context manager bracketing the delivery of DATA, a message with
+        routing key KEY.  Deliveries may nest, if a consumer produces a
+        message while handling one.
+        """
+        outer = self.message, self.encoded, self.deliveries
+        # the caller holds references to KEY and DATA until the delivery is
+        # done, so their ids cannot be reused meanwhile
+        self.message = (id(key), id(data))
+        self.encoded, self.deliveries = None, 0
+        try:
+            yield
+        finally:
+            self.flushMetrics()
+            self.message, self.encoded, self.deliveries = outer
+
+    def encode(self, key, data):
+        """
+        Return the JSON encoding of DATA, a message with routing key KEY.
+        """
+        delivered = self.message == (id(key), id(data))
+        if delivered and self.encoded is not None:
+            self.deliveries += 1
+            return self.encoded
+
+        timer = metrics.Timer('MessageEncoder.encode()')
+        timer.start()
+        encoded = json.dumps(data, default=toJson, separators=(',', ':'))
+        timer.stop()
+        if delivered:
+            self.encoded = encoded
+            self.deliveries = 1
+        return encoded
+
+    def flushMetrics(self):
+        if self.deliveries:
+            metrics.MetricCountEvent.log('MessageEncoder.deliveries',
+                                         self.deliveries)
+            metrics.MetricCountEvent.log('MessageEncoder.messages', 1)
+        self.deliveries = 0
+
+# the encoder shared by all web clients
+encoder = MessageEncoder()
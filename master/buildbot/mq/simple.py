@@ -16,6 +16,7 @@
 import pprint
 
 from buildbot.mq import base
+from buildbot.mq import fanout
 from buildbot.util import service
 from buildbot.util import tuplematch
 from twisted.internet import defer
@@ -26,7 +27,7 @@ class SimpleMQ(service.ReconfigurableServiceMixin, base.MQBase):
 
     def __init__(self, master):
         base.MQBase.__init__(self, master)
-        self.qrefs = []
+        self.qrefs = tuplematch.TupleTrie()
         self.persistent_qrefs = {}
         self.debug = False
 
@@ -38,8 +39,8 @@ class SimpleMQ(service.ReconfigurableServiceMixin, base.MQBase):
     def produce(self, routingKey, data):
         if self.debug:
             log.msg("MSG: %s\n%s" % (routingKey, pprint.pformat(data)))
-        for qref in self.qrefs:
-            if tuplematch.matchTuple(routingKey, qref.filter):
+        with fanout.encoder.delivery(routingKey, data):
+            for qref in self.qrefs.match(routingKey):
                 qref.invoke(routingKey, data)
 
     def startConsuming(self, callback, filter, persistent_name=None):
@@ -49,29 +50,27 @@ class SimpleMQ(service.ReconfigurableServiceMixin, base.MQBase):
                 qref.startConsuming(callback)
             else:
                 qref = PersistentQueueRef(self, callback, filter)
-                self.qrefs.append(qref)
+                qref.seq = self.qrefs.add(filter, qref)
                 self.persistent_qrefs[persistent_name] = qref
         else:
             qref = QueueRef(self, callback, filter)
-            self.qrefs.append(qref)
+            qref.seq = self.qrefs.add(filter, qref)
         return defer.succeed(qref)
 
 
 class QueueRef(base.QueueRef):
 
-    __slots__ = ['mq', 'filter']
+    __slots__ = ['mq', 'filter', 'seq']
 
     def __init__(self, mq, callback, filter):
         base.QueueRef.__init__(self, callback)
         self.mq = mq
         self.filter = filter
+        self.seq = None
 
     def stopConsuming(self):
         self.callback = None
-        try:
-            self.mq.qrefs.remove(self)
-        except ValueError:
-            pass
+        self.mq.qrefs.remove(self.filter, self.seq)
 
 
 class PersistentQueueRef(QueueRef):
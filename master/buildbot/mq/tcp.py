@@ -0,0 +1,404 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+"""
+A network MQ implementation for multi-master setups.
+
+Every master runs a L{TcpMQ}, which delivers messages to its own consumers
+exactly like L{buildbot.mq.simple.SimpleMQ} does, and also publishes them to a
+broker over a small framed-JSON protocol.  The broker forwards each message
+to the other masters that have a matching consumer.  The broker can run
+inside one of the masters (the C{listen} key) or on its own.
+
+Frames are JSON lists, each sent as a 32-bit length-prefixed string:
+
+ - C{["sub", subid, filter, persistent_name]} (master to broker)
+ - C{["unsub", subid]} (master to broker)
+ - C{["pub", [[routingKey, data], ..]]} (master to broker)
+ - C{["msg", [[routingKey, data, [subid, ..]], ..]]} (broker to master)
+
+Publishes are batched for one reactor turn and are never acknowledged, so a
+master can have any number of batches in flight.
+"""
+
+import pprint
+
+from buildbot.mq import fanout
+from buildbot.mq import simple
+from buildbot.util import json
+from buildbot.util import toJson
+from buildbot.util import tuplematch
+from twisted.internet import defer
+from twisted.internet import endpoints
+from twisted.internet import protocol
+from twisted.internet import reactor
+from twisted.protocols import basic
+from twisted.python import log
+
+# largest number of messages sent in a single publish frame
+MAX_BATCH = 1000
+
+# most messages kept by a master while it is not connected to the broker, and
+# by the broker for each persistent queue that no master holds; messages past
+# this limit are dropped, and the number dropped is logged
+MAX_BACKLOG = 100000
+
+# reconnection delays, in seconds
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 60
+
+
+def _encode(obj):
+    return json.dumps(obj, default=toJson, separators=(',', ':'))
+
+
+class FrameProtocol(basic.Int32StringReceiver):
+
+    MAX_LENGTH = 64 * 1024 * 1024
+
+    def sendFrame(self, frame):
+        self.sendString(frame)
+
+    def stringReceived(self, string):
+        try:
+            frame = json.loads(string)
+            handler = getattr(self, 'frame_' + str(frame[0]))
+        except Exception:
+            log.err(None, 'invalid MQ frame received; dropping connection')
+            self.transport.loseConnection()
+            return
+        handler(*frame[1:])
+
+    def lengthLimitExceeded(self, length):
+        log.msg('MQ frame of %d bytes is too long; dropping connection'
+                % (length,))
+        self.transport.loseConnection()
+
+
+# broker
+
+class _PersistentQueue(object):
+
+    __slots__ = ['name', 'filter', 'holders', 'backlog', 'dropped']
+
+    def __init__(self, name, filter):
+        self.name = name
+        self.filter = filter
+        # (connection, subid) pairs; the first one gets the messages
+        self.holders = []
+        # messages that arrived while nobody was holding the queue, up to
+        # MAX_BACKLOG of them, and the number dropped after that
+        self.backlog = []
+        self.dropped = 0
+
+
+class BrokerProtocol(FrameProtocol):
+
+    def connectionMade(self):
+        self.subs = tuplematch.TupleTrie()
+        self.subSeqs = {}
+        self.persistentNames = {}
+        self.factory.connections.append(self)
+
+    def connectionLost(self, reason):
+        self.factory.connections.remove(self)
+        for name in self.persistentNames.values():
+            self.factory.releasePersistent(self, name)
+
+    def frame_sub(self, subid, filter, persistent_name=None):
+        filter = tuple(filter)
+        if persistent_name:
+            self.persistentNames[subid] = persistent_name
+            self.factory.holdPersistent(self, subid, filter, persistent_name)
+        else:
+            self.subSeqs[subid] = (filter, self.subs.add(filter, subid))
+
+    def frame_unsub(self, subid):
+        if subid in self.persistentNames:
+            self.factory.releasePersistent(self,
+                                           self.persistentNames.pop(subid))
+        elif subid in self.subSeqs:
+            filter, seq = self.subSeqs.pop(subid)
+            self.subs.remove(filter, seq)
+
+    def frame_pub(self, messages):
+        self.factory.route(self, messages)
+
+
+class MQBroker(protocol.ServerFactory):
+
+    """
+    Routes messages between the connected masters.
+
+    A non-persistent consumer receives every matching message published by
+    another master while it is subscribed.  A persistent queue is shared by
+    every master consuming with the same C{persistent_name}: each message is
+    delivered to only one of them, and messages are kept by the broker while
+    no master holds the queue, matching L{buildbot.mq.simple.PersistentQueueRef}.
+    """
+
+    protocol = BrokerProtocol
+
+    def __init__(self):
+        self.connections = []
+        self.persistent = {}
+        self.persistentTrie = tuplematch.TupleTrie()
+
+    def holdPersistent(self, conn, subid, filter, name):
+        pq = self.persistent.get(name)
+        if pq is None:
+            pq = self.persistent[name] = _PersistentQueue(name, filter)
+            self.persistentTrie.add(filter, pq)
+        pq.holders.append((conn, subid))
+        if pq.dropped:
+            log.msg("dropped %d messages for MQ queue %r while no master "
+                    "was consuming from it" % (pq.dropped, name))
+            pq.dropped = 0
+        if pq.backlog:
+            backlog, pq.backlog = pq.backlog, []
+            conn.sendFrame(_encode(
+                ['msg', [[key, data, [subid]] for key, data in backlog]]))
+
+    def releasePersistent(self, conn, name):
+        pq = self.persistent.get(name)
+        if pq is not None:
+            pq.holders = [h for h in pq.holders if h[0] is not conn]
+
+    def route(self, origin, messages):
+        outgoing = {}
+        for key, data in messages:
+            key = tuple(key)
+            for conn in self.connections:
+                if conn is origin:
+                    continue
+                subids = conn.subs.match(key)
+                if subids:
+                    outgoing.setdefault(conn, []).append([key, data, subids])
+            for pq in self.persistentTrie.match(key):
+                # the producing master has already delivered the message to
+                # its own consumer of this queue
+                if any(h[0] is origin for h in pq.holders):
+                    continue
+                if not pq.holders:
+                    if len(pq.backlog) < MAX_BACKLOG:
+                        pq.backlog.append((key, data))
+                    else:
+                        if not pq.dropped:
+                            log.msg("MQ queue %r has %d messages waiting; "
+                                    "dropping new messages" % (pq.name,
+                                                               MAX_BACKLOG))
+                        pq.dropped += 1
+                    continue
+                conn, subid = pq.holders[0]
+                msgs = outgoing.setdefault(conn, [])
+                if msgs and msgs[-1][0] is key:
+                    msgs[-1][2].append(subid)
+                else:
+                    msgs.append([key, data, [subid]])
+        for conn, msgs in outgoing.iteritems():
+            conn.sendFrame(_encode(['msg', msgs]))
+
+
+# client
+
+class ClientProtocol(FrameProtocol):
+
+    def connectionMade(self):
+        self.factory.mq._connected(self)
+
+    def connectionLost(self, reason):
+        self.factory.mq._disconnected(self)
+
+    def frame_msg(self, messages):
+        self.factory.mq._deliver(messages)
+
+
+class ClientFactory(protocol.Factory):
+
+    protocol = ClientProtocol
+
+    def __init__(self, mq):
+        self.mq = mq
+
+
+class TcpMQ(simple.SimpleMQ):
+
+    _reactor = reactor  # for tests
+
+    def __init__(self, master):
+        simple.SimpleMQ.__init__(self, master)
+        self.broker = None
+        self.listen = None
+        self.subscriptions = {}
+        self.protocol = None
+        self.brokerPort = None
+        self._nextSubid = 1
+        self._outgoing = []
+        self._dropped = 0
+        self._flushTimer = None
+        self._connectTimer = None
+        self._reconnectDelay = RECONNECT_DELAY
+
+    def reconfigServiceWithBuildbotConfig(self, new_config):
+        # the broker addresses only take effect when the master starts; the
+        # master refuses to reconfigure with different ones
+        if not self.running:
+            self.broker = new_config.mq.get('broker')
+            self.listen = new_config.mq.get('listen')
+        return simple.SimpleMQ.reconfigServiceWithBuildbotConfig(self,
+                                                                 new_config)
+
+    @defer.inlineCallbacks
+    def startService(self):
+        simple.SimpleMQ.startService(self)
+        if self.listen:
+            ep = endpoints.serverFromString(self._reactor, self.listen)
+            self.brokerPort = yield ep.listen(MQBroker())
+        if self.broker:
+            self._connect()
+
+    def stopService(self):
+        simple.SimpleMQ.stopService(self)
+        if self._connectTimer:
+            self._connectTimer.cancel()
+            self._connectTimer = None
+        if self._flushTimer:
+            self._flushTimer.cancel()
+            self._flushTimer = None
+        self._flush()
+        if self.protocol:
+            self.protocol.transport.loseConnection()
+        if self.brokerPort:
+            port, self.brokerPort = self.brokerPort, None
+            return defer.maybeDeferred(port.stopListening)
+
+    def produce(self, routingKey, data):
+        simple.SimpleMQ.produce(self, routingKey, data)
+        if not self.protocol and len(self._outgoing) >= MAX_BACKLOG:
+            if not self._dropped:
+                log.msg("%d messages are waiting for the MQ broker; dropping "
+                        "new messages" % (MAX_BACKLOG,))
+            self._dropped += 1
+            return
+        # encode now, as the caller is free to modify data once we return
+        self._outgoing.append(_encode([routingKey, data]))
+        if len(self._outgoing) >= MAX_BATCH:
+            self._flush()
+        elif not self._flushTimer:
+            self._flushTimer = self._reactor.callLater(0, self._flush)
+
+    def startConsuming(self, callback, filter, persistent_name=None):
+        if persistent_name:
+            if persistent_name in self.persistent_qrefs:
+                qref = self.persistent_qrefs[persistent_name]
+                qref.startConsuming(callback)
+                return defer.succeed(qref)
+            qref = PersistentQueueRef(self, callback, filter)
+            self.persistent_qrefs[persistent_name] = qref
+        else:
+            qref = QueueRef(self, callback, filter)
+        qref.seq = self.qrefs.add(filter, qref)
+        qref.subid = self._nextSubid
+        self._nextSubid += 1
+        qref.persistent_name = persistent_name
+        self.subscriptions[qref.subid] = qref
+        self._sendSubscribe(qref)
+        return defer.succeed(qref)
+
+    def _sendSubscribe(self, qref):
+        if self.protocol:
+            self.protocol.sendFrame(_encode(
+                ['sub', qref.subid, qref.filter, qref.persistent_name]))
+
+    def _unsubscribe(self, qref):
+        if self.subscriptions.pop(qref.subid, None) and self.protocol:
+            self.protocol.sendFrame(_encode(['unsub', qref.subid]))
+
+    def _flush(self):
+        self._flushTimer = None
+        if not self.protocol:
+            # keep the messages until we are connected
+            return
+        while self._outgoing:
+            batch = self._outgoing[:MAX_BATCH]
+            del self._outgoing[:MAX_BATCH]
+            self.protocol.sendFrame('["pub",[%s]]' % (','.join(batch),))
+
+    def _deliver(self, messages):
+        for routingKey, data, subids in messages:
+            routingKey = tuple(routingKey)
+            if self.debug:
+                log.msg("REMOTE MSG: %s\n%s"
+                        % (routingKey, pprint.pformat(data)))
+            with fanout.encoder.delivery(routingKey, data):
+                for subid in subids:
+                    qref = self.subscriptions.get(subid)
+                    if qref:
+                        qref.invoke(routingKey, data)
+
+    def _connect(self):
+        self._connectTimer = None
+        ep = endpoints.clientFromString(self._reactor, self.broker)
+        d = ep.connect(ClientFactory(self))
+
+        @d.addErrback
+        def failed(f):
+            log.msg("could not connect to MQ broker at %s: %s"
+                    % (self.broker, f.getErrorMessage()))
+            self._scheduleReconnect()
+
+    def _scheduleReconnect(self):
+        if not self.running or self._connectTimer:
+            return
+        self._connectTimer = self._reactor.callLater(self._reconnectDelay,
+                                                     self._connect)
+        self._reconnectDelay = min(self._reconnectDelay * 2,
+                                   MAX_RECONNECT_DELAY)
+
+    def _connected(self, proto):
+        log.msg("connected to MQ broker")
+        self.protocol = proto
+        self._reconnectDelay = RECONNECT_DELAY
+        for subid in sorted(self.subscriptions):
+            self._sendSubscribe(self.subscriptions[subid])
+        self._flush()
+        if self._dropped:
+            log.msg("dropped %d messages while not connected to the MQ broker"
+                    % (self._dropped,))
+            self._dropped = 0
+
+    def _disconnected(self, proto):
+        if proto is not self.protocol:
+            return
+        log.msg("lost connection to MQ broker")
+        self.protocol = None
+        self._scheduleReconnect()
+
+
+class QueueRef(simple.QueueRef):
+
+    __slots__ = ['subid', 'persistent_name']
+
+    def stopConsuming(self):
+        simple.QueueRef.stopConsuming(self)
+        self.mq._unsubscribe(self)
+
+
+class PersistentQueueRef(simple.PersistentQueueRef):
+
+    __slots__ = ['subid', 'persistent_name']
+
+    # stopConsuming keeps the broker subscription, so that messages continue
+    # to be queued locally, as they are in SimpleMQ
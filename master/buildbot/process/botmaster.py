@@ -142,7 +142,9 @@ class BotMaster(service.ReconfigurableServiceMixin, service.AsyncMultiService):
                     buildername = builder.name
                     break
             if buildername:
-                self.maybeStartBuildsForBuilder(buildername)
+                # the distributor's index of unclaimed requests has seen this
+                # message too, so it need not be re-read from the database
+                self.brd.maybeStartBuildsOn([buildername], refresh=False)
 
         # consume both 'new' and 'unclaimed' build requests
         startConsuming = self.master.mq.startConsuming
@@ -15,7 +15,9 @@
 
 
 from buildbot.data import resultspec
+from buildbot.locks import LockAccess
 from buildbot.process import metrics
+from buildbot.process.builder import Builder
 from buildbot.process.buildrequest import BuildRequest
 from buildbot.util import ascii2unicode
 from buildbot.util import epoch2datetime
@@ -45,6 +47,10 @@ class BuildChooserBase(object):
     # chooseNextBuild() that delegates out to two other functions:
     #   * bc.popNextBuild() - get the next (slave, breq) pair
 
+    # the distributor's UnclaimedBuildRequests index, if any; without it, the
+    # unclaimed requests are fetched from the data API
+    unclaimedBuildRequests = None
+
     def __init__(self, bldr, master):
         self.bldr = bldr
         self.master = master
@@ -76,9 +82,15 @@ class BuildChooserBase(object):
         # exists, this function does nothing. If a refetch is desired, set
         # the self.unclaimedBrdicts to None before calling."""
         if self.unclaimedBrdicts is None:
+            builderid = yield self.bldr.getBuilderId()
+            if self.unclaimedBuildRequests is not None:
+                # the distributor's index is already sorted by submitted_at
+                self.unclaimedBrdicts = yield \
+                    self.unclaimedBuildRequests.getUnclaimedBrdicts(builderid)
+                defer.returnValue(self.unclaimedBrdicts)
             # TODO: use order of the DATA API
             brdicts = yield self.master.data.get(('builders',
-                                                  (yield self.bldr.getBuilderId()),
+                                                  builderid,
                                                   'buildrequests'),
                                                  [resultspec.Filter('claimed',
                                                                     'eq',
@@ -287,6 +299,149 @@ class BasicBuildChooser(BuildChooserBase):
         return self.bldr.canStartBuild(slave, breq)
 
 
+class UnclaimedBuildRequests(object):
+
+    """
+    An index of the unclaimed build requests of each builder, in the data API
+    format, kept up to date from buildrequest messages so that build choosers
+    do not need to query the database each time they are created.
+
+    The requests for a builder are loaded from the database the first time
+    they are needed, and again after L{invalidate} is called.  They are also
+    reloaded when next needed once they are C{reconcileInterval} seconds old,
+    to catch any changes that were not announced over the MQ.
+
+    With an MQ that is local to the master, such as the default, requests
+    made by other masters are not announced, so the distributor invalidates
+    a builder whenever it is asked to start builds for any reason other than
+    a buildrequest message, such as a slave attaching or a build finishing.
+    """
+
+    reconcileInterval = 300
+
+    _reactor = reactor  # for tests
+
+    def __init__(self, master):
+        self.master = master
+        # builderid -> {brid: brdict}
+        self.brdicts = {}
+        # builderid -> brdicts sorted by submitted_at, or missing if stale
+        self._sorted = {}
+        # builderid -> time the requests were loaded
+        self._loadedAt = {}
+        # builderid -> (messages received while loading, waiting Deferreds)
+        self._loading = {}
+        self._consumer = None
+
+    @defer.inlineCallbacks
+    def start(self):
+        self._consumer = yield self.master.mq.startConsuming(
+            self._onMessage, ('buildrequests', None, None))
+
+    def stop(self):
+        if self._consumer:
+            self._consumer.stopConsuming()
+            self._consumer = None
+        self.invalidate()
+
+    def invalidate(self, builderid=None):
+        """
+        Forget the requests of the given builder, or of all builders, so that
+        they are loaded from the database when next needed.
+        """
+        if builderid is None:
+            self.brdicts.clear()
+            self._sorted.clear()
+            self._loadedAt.clear()
+        else:
+            self.brdicts.pop(builderid, None)
+            self._sorted.pop(builderid, None)
+            self._loadedAt.pop(builderid, None)
+
+    def removeBuildRequests(self, builderid, brids):
+        """
+        Remove the given requests, which this master has just claimed, without
+        waiting for the corresponding messages.
+        """
+        brdicts = self.brdicts.get(builderid)
+        if brdicts is None:
+            return
+        for brid in brids:
+            brdicts.pop(brid, None)
+        self._sorted.pop(builderid, None)
+
+    def getUnclaimedBrdicts(self, builderid):
+        """
+        Get the unclaimed requests for the given builder, oldest first.
+
+        @returns: list of brdicts, via Deferred; the caller may modify the
+        list, but not the dictionaries in it
+        """
+        if builderid in self.brdicts:
+            age = self._reactor.seconds() - self._loadedAt[builderid]
+            if age < self.reconcileInterval:
+                return defer.succeed(list(self._getSorted(builderid)))
+            self.invalidate(builderid)
+
+        d = defer.Deferred()
+        if builderid in self._loading:
+            self._loading[builderid][1].append(d)
+            return d
+        self._loading[builderid] = ([], [d])
+        self._load(builderid)
+        return d
+
+    def _getSorted(self, builderid):
+        if builderid not in self._sorted:
+            self._sorted[builderid] = sorted(
+                self.brdicts[builderid].itervalues(),
+                key=lambda brd: brd['submitted_at'])
+        return self._sorted[builderid]
+
+    @defer.inlineCallbacks
+    def _load(self, builderid):
+        loadedAt = self._reactor.seconds()
+        try:
+            brdicts = yield self.master.data.get(
+                ('builders', builderid, 'buildrequests'),
+                [resultspec.Filter('claimed', 'eq', [False])])
+        except Exception:
+            f = Failure()
+            messages, waiters = self._loading.pop(builderid)
+            for d in waiters:
+                d.errback(f)
+            return
+
+        messages, waiters = self._loading.pop(builderid)
+        self.brdicts[builderid] = dict((brd['buildrequestid'], brd)
+                                       for brd in brdicts)
+        self._sorted.pop(builderid, None)
+        self._loadedAt[builderid] = loadedAt
+        # apply any changes announced while the query was running
+        for msg in messages:
+            self._update(msg)
+        for d in waiters:
+            d.callback(list(self._getSorted(builderid)))
+
+    def _onMessage(self, key, msg):
+        builderid = msg['builderid']
+        if builderid in self._loading:
+            self._loading[builderid][0].append(msg)
+        elif builderid in self.brdicts:
+            self._update(msg)
+
+    def _update(self, msg):
+        builderid = msg['builderid']
+        brdicts = self.brdicts[builderid]
+        brid = msg['buildrequestid']
+        if msg['claimed'] or msg['complete']:
+            if brdicts.pop(brid, None) is None:
+                return
+        else:
+            brdicts[brid] = msg
+        self._sorted.pop(builderid, None)
+
+
 class BuildRequestDistributor(service.AsyncService):
 
     """
@@ -301,6 +456,7 @@ class BuildRequestDistributor(service.AsyncService):
     """
 
     BuildChooser = BasicBuildChooser
+    _reactor = reactor  # for tests
 
     def __init__(self, botmaster):
         self.botmaster = botmaster
@@ -310,20 +466,43 @@ class BuildRequestDistributor(service.AsyncService):
         self.pending_builders_lock = defer.DeferredLock()
 
         # sorted list of names of builders that need their maybeStartBuild
-        # method invoked.
+        # method invoked, and the time at which each was added to it
         self._pending_builders = []
-        self.activity_lock = defer.DeferredLock()
+        self._pendingSince = {}
+
+        # names of the builders being worked on, mapped to their conflict
+        # keys (see _getConflictKeys)
+        self._activeBuilders = {}
+        self._activityWorkers = 0
+        self._activityWaiters = []
+        self._activityTimer = None
         self.active = False
 
         self._pendingMSBOCalls = []
 
+        self.unclaimedBuildRequests = UnclaimedBuildRequests(self.master)
+        # names of builders whose unclaimed requests must be re-read from the
+        # database before they are next worked on
+        self._refreshBuilders = set()
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield self.unclaimedBuildRequests.start()
+        yield service.AsyncService.startService(self)
+
     @defer.inlineCallbacks
     def stopService(self):
         # Lots of stuff happens asynchronously here, so we need to let it all
-        # quiesce.  First, let the parent stopService succeed between
-        # activities; then the loop will stop calling itself, since
-        # self.running is false.
-        yield self.activity_lock.run(service.AsyncService.stopService, self)
+        # quiesce.  First, stop the parent service, so that the activity
+        # workers will not pick up any more builders since self.running is
+        # false, and then wait for the workers to finish the builders they are
+        # already working on.
+        yield service.AsyncService.stopService(self)
+        if self.active:
+            d = defer.Deferred()
+            self._activityWaiters.append(d)
+            yield d
+        self.unclaimedBuildRequests.stop()
 
         # now let any outstanding calls to maybeStartBuildsOn to finish, so
         # they don't get interrupted in mid-stride.  This tends to be
@@ -332,7 +511,7 @@ class BuildRequestDistributor(service.AsyncService):
         if self._pendingMSBOCalls:
             yield defer.DeferredList(self._pendingMSBOCalls)
 
-    def maybeStartBuildsOn(self, new_builders):
+    def maybeStartBuildsOn(self, new_builders, refresh=True):
         """
         Try to start any builds that can be started right now.  This function
         returns immediately, and promises to trigger those builders
@@ -340,9 +519,16 @@ class BuildRequestDistributor(service.AsyncService):
 
         @param new_builders: names of new builders that should be given the
         opportunity to check for new requests.
+
+        @param refresh: if false, the caller is reacting to a buildrequest
+        message, which the index of unclaimed requests has already seen;
+        otherwise the requests of these builders are re-read from the
+        database, to see those made by other masters.
         """
         if not self.running:
             return
+        if refresh:
+            self._refreshBuilders.update(new_builders)
 
         d = self._maybeStartBuildsOn(new_builders)
         self._pendingMSBOCalls.append(d)
@@ -368,16 +554,18 @@ class BuildRequestDistributor(service.AsyncService):
                 # re-fetch existing_pending, in case it has changed
                 # while acquiring the lock
                 existing_pending = set(self._pending_builders)
+                now = self._reactor.seconds()
 
                 # then sort the new, expanded set of builders
                 self._pending_builders = \
                     yield self._sortBuilders(
                         list(existing_pending | new_builders))
+                self._pendingSince = dict(
+                    (name, self._pendingSince.get(name, now))
+                    for name in self._pending_builders)
 
-                # start the activity loop, if we aren't already
-                # working on that.
-                if not self.active:
-                    self._activityLoop()
+                # start the activity loop, or more workers for it
+                self._activityLoop()
             except Exception:
                 log.err(Failure(),
                         "while attempting to start builds on %s" % self.name)
@@ -389,33 +577,43 @@ class BuildRequestDistributor(service.AsyncService):
     def _defaultSorter(self, master, builders):
         timer = metrics.Timer("BuildRequestDistributor._defaultSorter()")
         timer.start()
-        # perform an asynchronous schwarzian transform, transforming None
-        # into sys.maxint so that it sorts to the end
-
-        def xform(bldr):
-            d = defer.maybeDeferred(lambda:
-                                    bldr.getOldestRequestTime())
-            d.addCallback(lambda time:
-                          (((time is None) and None or time), bldr))
-            return d
-        xformed = yield defer.gatherResults(
-            [xform(bldr) for bldr in builders])
-
-        # sort the transformed list synchronously, comparing None to the end of
-        # the list
-        def nonecmp(a, b):
-            if a[0] is None:
-                return 1
-            if b[0] is None:
-                return -1
-            return cmp(a, b)
-        xformed.sort(cmp=nonecmp)
+        # get the oldest unclaimed request time for all builders in a single
+        # query, rather than one query per builder
+        oldestRequestTimes = yield \
+            master.db.buildrequests.getOldestUnclaimedRequestTimes()
+        builderids = yield defer.gatherResults(
+            [defer.maybeDeferred(bldr.getBuilderId) for bldr in builders])
+
+        # builders that override getOldestRequestTime still decide it for
+        # themselves
+        def oldestRequestTime(builderid, bldr):
+            if self._overridesOldestRequestTime(bldr):
+                return defer.maybeDeferred(bldr.getOldestRequestTime)
+            return defer.succeed(oldestRequestTimes.get(builderid))
+        times = yield defer.gatherResults(
+            [oldestRequestTime(builderid, bldr)
+             for builderid, bldr in zip(builderids, builders)])
+
+        # sort builders by that time, with builders that have no unclaimed
+        # requests at the end of the list
+        def key(xf):
+            time = xf[0]
+            return (time is None, time)
+        xformed = zip(times, builders)
+        xformed.sort(key=key)
 
         # and reverse the transform
         rv = [xf[1] for xf in xformed]
         timer.stop()
         defer.returnValue(rv)
 
+    @staticmethod
+    def _overridesOldestRequestTime(bldr):
+        method = getattr(type(bldr), 'getOldestRequestTime', None)
+        return (method is not None and
+                getattr(method, 'im_func', method) is not
+                Builder.getOldestRequestTime.im_func)
+
     @defer.inlineCallbacks
     def _sortBuilders(self, buildernames):
         timer = metrics.Timer("BuildRequestDistributor._sortBuilders()")
@@ -445,46 +643,113 @@ class BuildRequestDistributor(service.AsyncService):
         timer.stop()
         defer.returnValue(rv)
 
-    @defer.inlineCallbacks
     def _activityLoop(self):
-        self.active = True
-
-        timer = metrics.Timer('BuildRequestDistributor._activityLoop()')
-        timer.start()
-
-        while True:
-            yield self.activity_lock.acquire()
-
-            # lock pending_builders, pop an element from it, and release
-            yield self.pending_builders_lock.acquire()
-
-            # bail out if we shouldn't keep looping
-            if not self.running or not self._pending_builders:
-                self.pending_builders_lock.release()
-                self.activity_lock.release()
-                break
+        # start a worker for each pending builder, up to the configured
+        # concurrency; when nothing is active, always start one, so that the
+        # loop goes quiet even if there is nothing to do
+        limit = self.master.config.buildStartConcurrency
+        count = min(limit - self._activityWorkers,
+                    max(len(self._pending_builders), 1))
+        for _ in range(count):
+            if not self.active:
+                self.active = True
+                self._activityTimer = metrics.Timer(
+                    'BuildRequestDistributor._activityLoop()')
+                self._activityTimer.start()
+            self._activityWorkers += 1
+            self._activityWorker()
 
-            bldr_name = self._pending_builders.pop(0)
-            self.pending_builders_lock.release()
-
-            # get the actual builder object
-            bldr = self.botmaster.builders.get(bldr_name)
-            try:
-                if bldr:
-                    yield self._maybeStartBuildsOnBuilder(bldr)
-            except Exception:
-                log.err(Failure(),
-                        "from maybeStartBuild for builder '%s'" % (bldr_name,))
-
-            self.activity_lock.release()
+    @defer.inlineCallbacks
+    def _activityWorker(self):
+        try:
+            while True:
+                # lock pending_builders, pop an element from it, and release
+                yield self.pending_builders_lock.acquire()
+                try:
+                    # bail out if we shouldn't keep looping
+                    if not self.running:
+                        break
+                    bldr_name = self._popPendingBuilder()
+                    if bldr_name is None:
+                        break
+                finally:
+                    self.pending_builders_lock.release()
+
+                # get the actual builder object
+                bldr = self.botmaster.builders.get(bldr_name)
+                try:
+                    if bldr:
+                        yield self._maybeStartBuildsOnBuilder(bldr)
+                except Exception:
+                    log.err(Failure(),
+                            "from maybeStartBuild for builder '%s'" % (bldr_name,))
+                finally:
+                    del self._activeBuilders[bldr_name]
+
+                # pending builders that conflicted with this one can run now,
+                # so make sure there are enough workers for them
+                self._activityLoop()
+        except Exception:
+            log.err(Failure(), "from the BuildRequestDistributor activity loop")
+        finally:
+            # otherwise the loop would never go quiet, and the concurrency
+            # it has left would shrink
+            self._activityWorkers -= 1
 
-        timer.stop()
+        if self._activityWorkers:
+            return
 
+        self._activityTimer.stop()
         self.active = False
+        waiters, self._activityWaiters = self._activityWaiters, []
+        for d in waiters:
+            d.callback(None)
         self._quiet()
 
+    def _popPendingBuilder(self):
+        # pop the first pending builder that does not conflict with any of the
+        # active builders, or return None if there is no such builder
+        held = set()
+        for keys in self._activeBuilders.itervalues():
+            held.update(keys)
+
+        for i, bldr_name in enumerate(self._pending_builders):
+            keys = self._getConflictKeys(bldr_name)
+            if keys & held:
+                continue
+            del self._pending_builders[i]
+            self._activeBuilders[bldr_name] = keys
+
+            since = self._pendingSince.pop(bldr_name, None)
+            if since is not None:
+                metrics.MetricTimeEvent.log(
+                    'BuildRequestDistributor.queueWait.%s' % (bldr_name,),
+                    self._reactor.seconds() - since)
+            return bldr_name
+
+    def _getConflictKeys(self, bldr_name):
+        # builders that share a slave or a lock must not be worked on at the
+        # same time, since their canStartBuild checks and the builds they
+        # start affect each other; neither must two invocations for the same
+        # builder
+        keys = set([('builder', bldr_name)])
+        bldr = self.botmaster.builders.get(bldr_name)
+        if bldr and bldr.config:
+            for slavename in bldr.config.slavenames:
+                keys.add(('slave', slavename))
+            for lock in bldr.config.locks:
+                if isinstance(lock, LockAccess):
+                    lock = lock.lockid
+                keys.add(('lock', lock.name))
+        return keys
+
     @defer.inlineCallbacks
     def _maybeStartBuildsOnBuilder(self, bldr, _reactor=reactor):
+        if bldr.name in self._refreshBuilders:
+            self._refreshBuilders.discard(bldr.name)
+            builderid = yield bldr.getBuilderId()
+            self.unclaimedBuildRequests.invalidate(builderid)
+
         # create a chooser to give us our next builds
         # this object is temporary and will go away when we're done
         bc = self.createBuildChooser(bldr, self.master)
@@ -498,52 +763,47 @@ class BuildRequestDistributor(service.AsyncService):
             brids = [br.id for br in breqs]
             claimed_at_epoch = _reactor.seconds()
             claimed_at = epoch2datetime(claimed_at_epoch)
+            builderid = yield bldr.getBuilderId()
             if not (yield self.master.data.updates.claimBuildRequests(
                     brids, claimed_at=claimed_at)):
-                # some brids were already claimed, so start over
+                # some brids were already claimed, so the index is out of
+                # date; start over
+                self.unclaimedBuildRequests.invalidate(builderid)
                 bc = self.createBuildChooser(bldr, self.master)
                 continue
+            self.unclaimedBuildRequests.removeBuildRequests(builderid, brids)
 
             # the claim was successful, so publish a message for each brid
-            for brid in brids:
-                # TODO: inefficient..
-                brdict = yield self.master.db.buildrequests.getBuildRequest(brid)
-                key = ('buildsets', str(brdict['buildsetid']),
-                       'builders', str(-1),
-                       'buildrequests', str(brdict['buildrequestid']), 'claimed')
-                msg = dict(
-                    bsid=brdict['buildsetid'],
-                    brid=brdict['buildrequestid'],
-                    buildername=brdict['buildername'],
-                    builderid=-1,
-                    # TODO:
-                    # claimed_at=claimed_at_epoch,
-                    # masterid=masterid)
-                )
-                self.master.mq.produce(key, msg)
+            self._produceBrMessages(breqs, 'claimed')
 
             buildStarted = yield bldr.maybeStartBuild(slave, breqs)
             if not buildStarted:
                 yield self.master.data.updates.unclaimBuildRequests(brids)
-
-                for breq in breqs:
-                    bsid = breq.bsid
-                    buildername = ascii2unicode(breq.buildername)
-                    brid = breq.id
-                    key = ('buildsets', str(brdict['buildsetid']),
-                           'builders', str(-1),
-                           'buildrequests', str(brdict['buildrequestid']), 'unclaimed')
-                    msg = dict(brid=brid, bsid=bsid, buildername=buildername,
-                               builderid=-1)
-                    self.master.mq.produce(key, msg)
+                self.unclaimedBuildRequests.invalidate(builderid)
+                self._produceBrMessages(breqs, 'unclaimed')
 
                 # and try starting builds again.  If we still have a working slave,
                 # then this may re-claim the same buildrequests
                 self.botmaster.maybeStartBuildsForBuilder(self.name)
 
+    def _produceBrMessages(self, breqs, event):
+        # all of the information is in the BuildRequest objects, so this does
+        # not need to query the database
+        for breq in breqs:
+            key = ('buildsets', str(breq.bsid),
+                   'builders', str(-1),
+                   'buildrequests', str(breq.id), event)
+            msg = dict(bsid=breq.bsid, brid=breq.id,
+                       buildername=ascii2unicode(breq.buildername),
+                       builderid=-1)
+            self.master.mq.produce(key, msg)
+
     def createBuildChooser(self, bldr, master):
-        # just instantiate the build chooser requested
-        return self.BuildChooser(bldr, master)
+        # just instantiate the build chooser requested, and give it the index
+        # of unclaimed build requests
+        bc = self.BuildChooser(bldr, master)
+        bc.unclaimedBuildRequests = self.unclaimedBuildRequests
+        return bc
 
     def _quiet(self):
         # shim for tests
@@ -18,6 +18,7 @@ import re
 from buildbot import util
 from buildbot.util import lineboundaries
 from twisted.internet import defer
+from twisted.python import failure
 from twisted.python import log
 
 
@@ -35,6 +36,8 @@ class Log(object):
         self.finished = False
         self.finishWaiters = []
         self.lock = defer.DeferredLock()
+        self.pendingLines = []
+        self.pendingWaiters = []
         self.decoder = decoder
 
     @staticmethod
@@ -64,15 +67,36 @@ class Log(object):
 
     # adding lines
 
-    @defer.inlineCallbacks
     def addRawLines(self, lines):
         # used by subclasses to add lines that are already appropriately
-        # formatted for the log type, and newline-terminated
+        # formatted for the log type, and newline-terminated.  Lines added
+        # while another append is in progress are coalesced into a single
+        # append once it completes, and the result of that append is given
+        # to each of their callers.
         assert lines[-1] == '\n'
         assert not self.finished
-        yield self.lock.acquire()
-        yield self.master.data.updates.appendLog(self.logid, lines)
-        yield self.lock.release()
+        d = defer.Deferred()
+        self.pendingLines.append(lines)
+        self.pendingWaiters.append(d)
+        self.lock.run(self._appendPendingLines)
+        return d
+
+    @defer.inlineCallbacks
+    def _appendPendingLines(self):
+        # an earlier call may have already appended the lines
+        if not self.pendingLines:
+            return
+        lines, self.pendingLines = u''.join(self.pendingLines), []
+        waiters, self.pendingWaiters = self.pendingWaiters, []
+        try:
+            yield self.master.data.updates.appendLog(self.logid, lines)
+        except Exception:
+            f = failure.Failure()
+            for d in waiters:
+                d.errback(f)
+        else:
+            for d in waiters:
+                d.callback(None)
 
     # completion
 
@@ -91,6 +115,8 @@ class Log(object):
     def finish(self):
         assert not self.finished
         self.finished = True
+        # wait for any appends in progress
+        yield self.lock.run(lambda: None)
         yield self.master.data.updates.finishLog(self.logid)
 
         # notify subscribers *after* finishing the log
@@ -44,6 +44,7 @@ from twisted.internet.task import LoopingCall
 from twisted.python import log
 
 import gc
+import math
 import os
 import sys
 # Make use of the resource module if we can
@@ -75,6 +76,14 @@ class MetricTimeEvent(MetricEvent):
         self.timer = timer
         self.elapsed = elapsed
 
+
+class MetricHistogramEvent(MetricEvent):
+
+    # value is a single value, or a Histogram of values gathered by the caller
+    def __init__(self, histogram, value):
+        self.histogram = histogram
+        self.value = value
+
 ALARM_OK, ALARM_WARN, ALARM_CRIT = range(3)
 ALARM_TEXT = ["OK", "WARN", "CRIT"]
 
@@ -267,6 +276,102 @@ class MetricTimeHandler(MetricHandler):
         return dict(timers=retval)
 
 
+class Histogram(object):
+
+    """
+    A histogram of non-negative values, in buckets whose upper bounds are
+    powers of two.  Percentiles are estimated as the upper bound of the bucket
+    that contains them.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = defaultdict(int)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if value > 0:
+            # the exponent of the smallest power of two >= value
+            mantissa, exponent = math.frexp(value)
+            if mantissa == 0.5:
+                exponent -= 1
+            self.buckets[exponent] += 1
+        else:
+            self.buckets[None] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        for bucket, count in other.buckets.iteritems():
+            self.buckets[bucket] += count
+
+    @property
+    def mean(self):
+        if not self.count:
+            return 0
+        return float(self.total) / self.count
+
+    def percentile(self, pct):
+        if not self.count:
+            return 0
+        wanted = self.count * pct / 100.0
+        seen = 0
+        # None (the bucket for zero) sorts before all of the exponents
+        for exponent in sorted(self.buckets):
+            seen += self.buckets[exponent]
+            if seen >= wanted:
+                if exponent is None:
+                    return 0
+                return min(2.0 ** exponent, self.max)
+        return self.max
+
+    def asDict(self):
+        return dict(count=self.count, mean=self.mean, max=self.max,
+                    p50=self.percentile(50), p90=self.percentile(90),
+                    p99=self.percentile(99))
+
+
+class MetricHistogramHandler(MetricHandler):
+    _histograms = None
+
+    def reset(self):
+        self._histograms = defaultdict(Histogram)
+
+    def handle(self, eventDict, metric):
+        if isinstance(metric.value, Histogram):
+            self._histograms[metric.histogram].merge(metric.value)
+        else:
+            self._histograms[metric.histogram].add(metric.value)
+
+    def keys(self):
+        return self._histograms.keys()
+
+    def get(self, histogram):
+        return self._histograms[histogram]
+
+    def report(self):
+        retval = []
+        for histogram in sorted(self.keys()):
+            h = self.get(histogram)
+            retval.append("Histogram %s: count %i, mean %.3g, p50 %.3g, "
+                          "p90 %.3g, p99 %.3g, max %.3g"
+                          % (histogram, h.count, h.mean, h.percentile(50),
+                             h.percentile(90), h.percentile(99), h.max))
+        return "\n".join(retval)
+
+    def asDict(self):
+        retval = {}
+        for histogram in sorted(self.keys()):
+            retval[histogram] = self.get(histogram).asDict()
+        return dict(histograms=retval)
+
+
 class MetricAlarmHandler(MetricHandler):
     _alarms = None
 
@@ -391,6 +496,8 @@ class MetricLogObserver(util_service.ReconfigurableServiceMixin,
         self.registerHandler(MetricCountEvent, MetricCountHandler(self))
         self.registerHandler(MetricTimeEvent, MetricTimeHandler(self))
         self.registerHandler(MetricAlarmEvent, MetricAlarmHandler(self))
+        self.registerHandler(MetricHistogramEvent,
+                             MetricHistogramHandler(self))
 
         self.getHandler(MetricCountEvent).addWatcher(
             AttachedSlavesWatcher(self))
@@ -13,6 +13,8 @@
 #
 # Copyright Buildbot Team Members
 
+import zlib
+
 from buildbot import util
 from buildbot.buildslave.protocols import base
 from buildbot.process import metrics
@@ -65,6 +67,7 @@ class RemoteCommand(base.RemoteCommandImpl):
         self.builder_name = None
         self.commandID = None
         self.deferred = None
+        self.decompressor = None
         # a lock to make sure that only one log-handling method runs at a time.
         # This is really only a problem with old-style steps, which do not
         # wait for the Deferred from one method before invoking the next.
@@ -182,6 +185,8 @@ class RemoteCommand(base.RemoteCommandImpl):
         for (update, num) in updates:
             # log.msg("update[%d]:" % num)
             try:
+                if 'zlib' in update:
+                    update = self._decompressUpdate(update)
                 if self.active and not self.ignore_updates:
                     self.remoteUpdate(update)
             except Exception:
@@ -193,6 +198,22 @@ class RemoteCommand(base.RemoteCommandImpl):
                 max_updatenum = num
         return max_updatenum
 
+    def _decompressUpdate(self, update):
+        # slaves that batch their updates compress the larger strings in
+        # them with one zlib stream per command; 'zlib' lists the compressed
+        # keys in stream order, and every update must be decompressed, even
+        # an ignored one, to keep the stream in step
+        if self.decompressor is None:
+            self.decompressor = zlib.decompressobj()
+        update = update.copy()
+        for key in update.pop('zlib'):
+            if key == 'log':
+                logname, data = update[key]
+                update[key] = (logname, self.decompressor.decompress(data))
+            else:
+                update[key] = self.decompressor.decompress(update[key])
+        return update
+
     def remote_complete(self, failure=None):
         """
         Called by the slave's L{buildbot.slave.bot.SlaveBuilder} to
@@ -13,9 +13,14 @@
 #
 # Copyright Buildbot Team Members
 
+import bz2
+import hashlib
 import os
+import re
+import shutil
 import tarfile
 import tempfile
+import zlib
 try:
     from cStringIO import StringIO
     assert StringIO
@@ -24,19 +29,217 @@ except ImportError:
 
 
 from buildbot.buildslave.protocols import base
+from buildbot.util import service
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import threads
+from twisted.python import failure
+from twisted.python import threadpool
 
 """
 module for regrouping all FileWriterImpl and FileReaderImpl away from steps
 """
 
 
+class TransferThreadPool(service.AsyncService):
+
+    """
+    The master service owning the thread pool shared by all transfers,
+    available as C{master.transfers}.  The pool runs while the service does.
+    """
+
+    name = 'transfers'
+    maxthreads = 4
+
+    def __init__(self):
+        self.pool = threadpool.ThreadPool(minthreads=0,
+                                          maxthreads=self.maxthreads,
+                                          name='TransferThreadPool')
+
+    def startService(self):
+        self.pool.start()
+        return service.AsyncService.startService(self)
+
+    def stopService(self):
+        # this waits for the running operations to finish
+        self.pool.stop()
+        return service.AsyncService.stopService(self)
+
+
+class AsyncFileIO(object):
+
+    """
+    Runs the file operations of one transfer in the given thread pool, or
+    the reactor's if there is none, so that the reactor does not wait for
+    the disk.  The operations run one at a
+    time, in the order they were requested; those queued while others run are
+    run together, to save switching threads for each.
+
+    Writes are acknowledged at once while fewer than C{maxPending} operations
+    are queued, and only once they are done otherwise, which bounds the data
+    held in the queue.  If an operation fails, the operations queued after it
+    are dropped and every later call fails with the same failure, except for
+    the cleanup given to L{cancel}.
+    """
+
+    maxPending = 8
+
+    def __init__(self, pool=None):
+        self.pool = pool
+        self.queue = []
+        self.busy = False
+        self.failure = None
+
+    def call(self, fn, *args):
+        """
+        Run C{fn(*args)} in a thread once the queued operations are done.
+
+        @returns: Deferred firing with its result
+        """
+        d = defer.Deferred()
+        self._enqueue(fn, args, d)
+        return d
+
+    def write(self, fn, *args):
+        """
+        Like L{call}, but return None at once if the queue has room.  A failure
+        of the operation is then returned by the next call.
+        """
+        if self.failure is None and len(self.queue) < self.maxPending:
+            self._enqueue(fn, args, None)
+            return None
+        return self.call(fn, *args)
+
+    def cancel(self, fn, *args):
+        """
+        Drop the queued operations, and run the cleanup C{fn(*args)} once the
+        running one, if any, is done.
+
+        @returns: Deferred firing with its result
+        """
+        queue, self.queue = self.queue, []
+        for _, _, d, _ in queue:
+            if d is not None:
+                d.errback(defer.CancelledError())
+        d = defer.Deferred()
+        self.queue.append((fn, args, d, True))
+        if not self.busy:
+            self._runNext()
+        return d
+
+    def _enqueue(self, fn, args, d):
+        self.queue.append((fn, args, d, False))
+        if not self.busy:
+            self._runNext()
+
+    def _runNext(self):
+        if not self.queue:
+            self.busy = False
+            return
+        self.busy = True
+        batch, self.queue = self.queue, []
+        pool = self.pool or reactor.getThreadPool()
+        d = threads.deferToThreadPool(reactor, pool, self._thdRun, batch)
+        d.addCallback(self._done, batch)
+
+    def _thdRun(self, batch):
+        results = []
+        failed = self.failure
+        for fn, args, _, always in batch:
+            if failed is not None and not always:
+                results.append(failed)
+                continue
+            try:
+                results.append(fn(*args))
+            except Exception:
+                failed = failure.Failure()
+                results.append(failed)
+        return results
+
+    def _done(self, results, batch):
+        for res, (_, _, d, _) in zip(results, batch):
+            if isinstance(res, failure.Failure) and self.failure is None:
+                self.failure = res
+            # if nobody is waiting for a failed write, the next call reports
+            # it
+            if d is not None:
+                d.callback(res)
+        self._runNext()
+
+
+class ContentStore(object):
+
+    """
+    A directory of files named by the sha256 digest of their contents, from
+    which uploaded files can be created rather than transferred again.  Files
+    are copied into and out of the store, never linked, so that the mode,
+    times and contents of an uploaded file can be changed without changing
+    the store or the other uploads of the same contents.  Its methods block,
+    so are called in the transfer thread pool.
+    """
+
+    # digests come from the slave, so anything else, which might name a file
+    # outside the store, is refused
+    digestRe = re.compile(r'[0-9a-f]{64}\Z')
+
+    def __init__(self, basedir):
+        self.basedir = os.path.abspath(basedir)
+
+    def path(self, digest):
+        if not isinstance(digest, str) or not self.digestRe.match(digest):
+            raise ValueError("invalid digest %r" % (digest,))
+        return os.path.join(self.basedir, digest[:2], digest[2:])
+
+    def has(self, digest):
+        return os.path.isfile(self.path(digest))
+
+    def add(self, filename, digest):
+        """
+        Add C{filename}, whose contents have the given digest, to the store.
+        """
+        path = self.path(digest)
+        if os.path.exists(path):
+            return
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # another upload may have made it meanwhile
+                if not os.path.isdir(dirname):
+                    raise
+        self._copy(filename, path)
+
+    def materialize(self, digest, filename):
+        """
+        Create C{filename} with the contents stored for the given digest.
+
+        @returns: the size of the file
+        """
+        path = self.path(digest)
+        if os.path.lexists(filename):
+            os.unlink(filename)
+        self._copy(path, filename)
+        return os.path.getsize(path)
+
+    def _copy(self, src, dest):
+        # copy to a temporary file, so that dest appears complete or not at all
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(dest))
+        with os.fdopen(fd, 'wb') as f:
+            with open(src, 'rb') as srcf:
+                shutil.copyfileobj(srcf, f)
+        if os.path.exists(dest):
+            os.unlink(dest)
+        os.rename(tmpname, dest)
+
+
 class FileWriter(base.FileWriterImpl):
 
     """
     Helper class that acts as a file-object with write access
     """
 
-    def __init__(self, destfile, maxsize, mode):
+    def __init__(self, destfile, maxsize, mode, store=None, pool=None):
         # Create missing directories.
         destfile = os.path.abspath(destfile)
         dirname = os.path.dirname(destfile)
@@ -48,6 +251,24 @@ class FileWriter(base.FileWriterImpl):
         fd, self.tmpname = tempfile.mkstemp(dir=dirname)
         self.fp = os.fdopen(fd, 'wb')
         self.remaining = maxsize
+        self.io = AsyncFileIO(pool)
+        self.store = store
+        self.hasher = hashlib.sha256() if store is not None else None
+        self.cached = None
+        self.saved = 0
+
+    def remote_cached(self, digests):
+        """
+        Called from remote slave with the digest of the file, before sending
+        it; if this returns the digest, the file is taken from the content
+        store rather than sent.
+
+        @type  digests: C{list}
+        @param digests: a list of one hex sha256 digest
+
+        @return: Deferred firing with the list of those digests in the store
+        """
+        return self.io.call(self._thdCached, digests)
 
     def remote_write(self, data):
         """
@@ -60,29 +281,53 @@ class FileWriter(base.FileWriterImpl):
         if self.remaining is not None:
             if len(data) > self.remaining:
                 data = data[:self.remaining]
-            self.fp.write(data)
             self.remaining = self.remaining - len(data)
-        else:
-            self.fp.write(data)
+        return self.io.write(self._thdWrite, data)
 
     def remote_utime(self, accessed_modified):
-        os.utime(self.destfile, accessed_modified)
+        return self.io.call(os.utime, self.destfile, accessed_modified)
 
     def remote_close(self):
         """
         Called by remote slave to state that no more data will be transfered
         """
+        return self.io.call(self._thdClose)
+
+    def _thdCached(self, digests):
+        if self.store is None:
+            return []
+        found = [digest for digest in digests if self.store.has(digest)]
+        if found:
+            self.cached = found[0]
+        return found
+
+    def _thdWrite(self, data):
+        self.fp.write(data)
+        if self.hasher is not None:
+            self.hasher.update(data)
+
+    def _thdClose(self):
         self.fp.close()
         self.fp = None
-        # on windows, os.rename does not automatically unlink, so do it manually
-        if os.path.exists(self.destfile):
-            os.unlink(self.destfile)
-        os.rename(self.tmpname, self.destfile)
+        if self.cached is not None:
+            os.unlink(self.tmpname)
+            self.saved = self.store.materialize(self.cached, self.destfile)
+        else:
+            # on windows, os.rename does not automatically unlink, so do it
+            # manually
+            if os.path.exists(self.destfile):
+                os.unlink(self.destfile)
+            os.rename(self.tmpname, self.destfile)
         self.tmpname = None
         if self.mode is not None:
             os.chmod(self.destfile, self.mode)
+        if self.hasher is not None and self.cached is None:
+            self.store.add(self.destfile, self.hasher.hexdigest())
 
     def cancel(self):
+        return self.io.cancel(self._thdCancel)
+
+    def _thdCancel(self):
         # unclean shutdown, the file is probably truncated, so delete it
         # altogether rather than deliver a corrupted file
         fp = getattr(self, "fp", None)
@@ -94,42 +339,263 @@ class FileWriter(base.FileWriterImpl):
                 os.unlink(self.tmpname)
 
 
-class DirectoryWriter(FileWriter):
+class DirectoryWriter(base.FileWriterImpl):
 
     """
-    A DirectoryWriter is implemented as a FileWriter, with an added post-processing
-    step to unpack the archive, once the transfer has completed.
+    A DirectoryWriter unpacks a tar archive into a directory as the archive
+    arrives, rather than storing it and unpacking it at the end, so neither
+    the whole archive nor a file of it is ever held on the master.
+
+    With a content store, every file unpacked is added to the store, and a
+    file whose member has a C{BUILDBOT.cached} pax header, giving its digest,
+    is taken from the store instead; such members have no data.
     """
 
-    def __init__(self, destroot, maxsize, compress, mode):
+    # types of member whose data is the name, link name or pax header of the
+    # next member
+    extendedTypes = (tarfile.GNUTYPE_LONGNAME, tarfile.GNUTYPE_LONGLINK,
+                     tarfile.XHDTYPE, tarfile.XGLTYPE)
+
+    def __init__(self, destroot, maxsize, compress, mode, store=None,
+                 pool=None):
         self.destroot = destroot
+        self.remaining = maxsize
         self.compress = compress
+        # mode was the mode of the temporary archive, of which there is none
+        self.mode = mode
+
+        if compress == 'bz2':
+            self.decompressor = bz2.BZ2Decompressor()
+        elif compress == 'gz':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self.decompressor = None
+
+        self.header = ''        # the part of a header received so far
+        self.member = None      # the member whose data is arriving
+        self.datasize = 0       # bytes of its data still to come
+        self.padsize = 0        # bytes of padding after that
+        self.fp = None          # the file being written for it
+        self.extended = []      # its data, if it is an extended header
+        self.pending = {}       # extended header fields for the next member
+        self.directories = []   # directories, to set their modes at the end
+        self.started = self.ended = False
+        self.io = AsyncFileIO(pool)
+        self.store = store
+        self.hasher = None      # the digest of the file being written
+        self.saved = 0
+
+    def remote_cached(self, digests):
+        """
+        Called from remote slave with the digests of the files to send,
+        before sending them; the files whose digests this returns are sent
+        as members naming their digest, without data.
+
+        @type  digests: C{list}
+        @param digests: hex sha256 digests
 
-        self.fd, self.tarname = tempfile.mkstemp()
-        os.close(self.fd)
+        @return: Deferred firing with the list of those digests in the store
+        """
+        return self.io.call(self._thdCached, digests)
 
-        FileWriter.__init__(self, self.tarname, maxsize, mode)
+    def remote_write(self, data):
+        """
+        Called from remote slave to unpack L{data} within boundaries of
+        L{maxsize}
+
+        @type  data: C{string}
+        @param data: String of data to write
+        """
+        if self.remaining is not None:
+            data = data[:self.remaining]
+            self.remaining -= len(data)
+        return self.io.write(self._thdWrite, data)
+
+    def remote_close(self):
+        # the archive is unpacked as it arrives, and finished by remote_unpack
+        pass
 
     def remote_unpack(self):
         """
         Called by remote slave to state that no more data will be transfered
         """
-        # Make sure remote_close is called, otherwise atomic rename wont happen
-        self.remote_close()
+        return self.io.call(self._thdUnpack)
 
-        # Map configured compression to a TarFile setting
-        if self.compress == 'bz2':
-            mode = 'r|bz2'
-        elif self.compress == 'gz':
-            mode = 'r|gz'
+    def cancel(self):
+        return self.io.cancel(self._thdCancel)
+
+    def _thdCached(self, digests):
+        if self.store is None:
+            return []
+        return [digest for digest in digests if self.store.has(digest)]
+
+    def _thdWrite(self, data):
+        if self.decompressor is not None:
+            data = self.decompressor.decompress(data)
+        self._unpack(data)
+
+    def _thdUnpack(self):
+        if self.decompressor is not None and hasattr(self.decompressor,
+                                                     'flush'):
+            self._unpack(self.decompressor.flush())
+        if not self.started:
+            raise tarfile.ReadError("empty file")
+        if self.header or self.member is not None:
+            self._thdCancel()
+            raise tarfile.ReadError("unexpected end of data")
+
+        # set directory modes and times last, as extractall does, so that
+        # files could be written to read-only directories
+        self.directories.sort(reverse=True)
+        for path, tarinfo in self.directories:
+            self._setAttributes(path, tarinfo)
+        self.directories = []
+
+    def _thdCancel(self):
+        # unclean shutdown, the file being unpacked is probably truncated, so
+        # delete it; the files that were unpacked completely are kept
+        if self.fp is not None:
+            self.fp.close()
+            os.unlink(self.fp.name)
+            self.fp = None
+        self.member = None
+        self.hasher = None
+
+    def _unpack(self, data):
+        while data and not self.ended:
+            if self.datasize:
+                chunk, data = data[:self.datasize], data[self.datasize:]
+                self.datasize -= len(chunk)
+                if self.fp is not None:
+                    self.fp.write(chunk)
+                    if self.hasher is not None:
+                        self.hasher.update(chunk)
+                elif self.member.type in self.extendedTypes:
+                    self.extended.append(chunk)
+                if not self.datasize:
+                    self._endMember()
+            elif self.padsize:
+                skip = min(self.padsize, len(data))
+                data = data[skip:]
+                self.padsize -= skip
+            else:
+                need = tarfile.BLOCKSIZE - len(self.header)
+                self.header += data[:need]
+                data = data[need:]
+                if len(self.header) == tarfile.BLOCKSIZE:
+                    header, self.header = self.header, ''
+                    self._startMember(header)
+
+    def _startMember(self, header):
+        self.started = True
+        try:
+            tarinfo = tarfile.TarInfo.frombuf(header)
+        except tarfile.EOFHeaderError:
+            # the zero blocks at the end of the archive
+            self.ended = True
+            return
+
+        pending = {}
+        if tarinfo.type not in self.extendedTypes:
+            # apply any GNU long names or pax header fields
+            pending, self.pending = self.pending, {}
+            if 'path' in pending:
+                tarinfo.name = pending['path']
+                if tarinfo.isdir():
+                    tarinfo.name = tarinfo.name.rstrip('/')
+            if 'linkpath' in pending:
+                tarinfo.linkname = pending['linkpath']
+            if 'size' in pending:
+                tarinfo.size = int(pending['size'])
+            if 'mtime' in pending:
+                tarinfo.mtime = float(pending['mtime'])
+
+        # TarFile expects data after all but these types of member
+        if (tarinfo.isreg() or tarinfo.type in self.extendedTypes or
+                tarinfo.type not in tarfile.SUPPORTED_TYPES):
+            self.datasize = tarinfo.size
         else:
-            mode = 'r'
+            self.datasize = 0
+        self.padsize = -self.datasize % tarfile.BLOCKSIZE
+        self.member = tarinfo
+
+        path = os.path.join(self.destroot, tarinfo.name)
+        path = path.rstrip('/').replace('/', os.sep)
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
 
-        # Unpack archive and clean up after self
-        archive = tarfile.open(name=self.tarname, mode=mode)
-        archive.extractall(path=self.destroot)
-        archive.close()
-        os.remove(self.tarname)
+        if tarinfo.isreg() and 'BUILDBOT.cached' in pending:
+            if self.store is None:
+                raise tarfile.ReadError("%s was sent as cached, but there is "
+                                        "no content store" % tarinfo.name)
+            self.saved += self.store.materialize(pending['BUILDBOT.cached'],
+                                                 path)
+            self._setAttributes(path, tarinfo)
+        elif tarinfo.isreg():
+            # replace rather than overwrite an existing file, which may be
+            # linked elsewhere
+            if os.path.lexists(path):
+                os.unlink(path)
+            self.fp = open(path, 'wb')
+            if self.store is not None:
+                self.hasher = hashlib.sha256()
+        elif tarinfo.isdir():
+            if not os.path.exists(path):
+                os.mkdir(path, 0700)
+            self.directories.append((path, tarinfo))
+        elif tarinfo.issym():
+            if os.path.lexists(path):
+                os.unlink(path)
+            os.symlink(tarinfo.linkname, path)
+        elif tarinfo.islnk():
+            if os.path.lexists(path):
+                os.unlink(path)
+            os.link(os.path.join(self.destroot, tarinfo.linkname), path)
+            self._setAttributes(path, tarinfo)
+
+        if not self.datasize:
+            self._endMember()
+
+    def _endMember(self):
+        tarinfo, self.member = self.member, None
+        if self.fp is not None:
+            self.fp.close()
+            self._setAttributes(self.fp.name, tarinfo)
+            if self.hasher is not None:
+                self.store.add(self.fp.name, self.hasher.hexdigest())
+                self.hasher = None
+            self.fp = None
+        elif tarinfo.type in (tarfile.GNUTYPE_LONGNAME,
+                              tarfile.GNUTYPE_LONGLINK):
+            name = tarfile.nts(''.join(self.extended))
+            if tarinfo.type == tarfile.GNUTYPE_LONGNAME:
+                self.pending['path'] = name
+            else:
+                self.pending['linkpath'] = name
+        elif tarinfo.type == tarfile.XHDTYPE:
+            self.pending.update(self._parsePax(''.join(self.extended)))
+        self.extended = []
+
+    def _parsePax(self, buf):
+        # records are "<length> <keyword>=<value>\n"
+        fields = {}
+        pos = 0
+        while pos < len(buf):
+            length, rest = buf[pos:].split(' ', 1)
+            record = rest[:int(length) - len(length) - 2]
+            keyword, value = record.split('=', 1)
+            fields[keyword] = value
+            pos += int(length)
+        return fields
+
+    def _setAttributes(self, path, tarinfo):
+        # as with TarFile.extractall, failing to set these is not an error
+        try:
+            os.chmod(path, tarinfo.mode)
+            os.utime(path, (tarinfo.mtime, tarinfo.mtime))
+        except EnvironmentError:
+            pass
 
 
 class FileReader(base.FileReaderImpl):
@@ -138,8 +604,9 @@ class FileReader(base.FileReaderImpl):
     Helper class that acts as a file-object with read access
     """
 
-    def __init__(self, fp):
+    def __init__(self, fp, pool=None):
         self.fp = fp
+        self.io = AsyncFileIO(pool)
 
     def remote_read(self, maxlength):
         """
@@ -154,16 +621,15 @@ class FileReader(base.FileReaderImpl):
         if self.fp is None:
             return ''
 
-        data = self.fp.read(maxlength)
-        return data
+        return self.io.call(self.fp.read, maxlength)
 
     def remote_close(self):
         """
         Called by remote slave to state that no more data will be transfered
         """
         if self.fp is not None:
-            self.fp.close()
-            self.fp = None
+            fp, self.fp = self.fp, None
+            return self.io.call(fp.close)
 
 
 class StringFileWriter(base.FileWriterImpl):
@@ -196,3 +662,13 @@ class StringFileReader(FileReader):
 
     def __init__(self, s):
         FileReader.__init__(self, StringIO(s))
+
+    # the data is in memory, so there is no need for a thread
+
+    def remote_read(self, maxlength):
+        if self.fp is None:
+            return ''
+        return self.fp.read(maxlength)
+
+    def remote_close(self):
+        self.fp = None
@@ -49,9 +49,43 @@ class _TransferBuildStep(BuildStep):
     haltOnFailure = True
     flunkOnFailure = True
 
-    def __init__(self, workdir=None, **buildstep_kwargs):
+    # the content store directory, for steps that upload
+    casdir = None
+
+    def __init__(self, workdir=None, window=1, maxblocksize=None,
+                 **buildstep_kwargs):
         BuildStep.__init__(self, **buildstep_kwargs)
         self.workdir = workdir
+        if not isinstance(window, int) or window < 1:
+            config.error('window must be a positive integer')
+        self.window = window
+        if not isinstance(maxblocksize, (int, type(None))):
+            config.error('maxblocksize must be an integer or None')
+        self.maxblocksize = maxblocksize
+
+    def addWindowArgs(self, command, args):
+        # slaves older than 2.17 transfer one block at a time, whatever the
+        # master asks for, so only tell newer slaves about the window
+        if self.window == 1 and self.maxblocksize is None:
+            return
+        if self.slaveVersionIsOlderThan(command, "2.17"):
+            log.msg("slave does not support pipelined transfers; "
+                    "sending one block at a time")
+            return
+        args['window'] = self.window
+        if self.maxblocksize is not None:
+            args['maxblocksize'] = self.maxblocksize
+
+    def getContentStore(self, command):
+        # slaves older than 2.18 cannot send digests before the data, so
+        # they always send everything
+        if self.casdir is None:
+            return None
+        if self.slaveVersionIsOlderThan(command, "2.18"):
+            log.msg("slave does not support content-addressed uploads; "
+                    "sending all files")
+            return None
+        return remotetransfer.ContentStore(os.path.expanduser(self.casdir))
 
     def runTransferCommand(self, cmd, writer=None):
         # Run a transfer step, add a callback to extract the command status,
@@ -61,14 +95,22 @@ class _TransferBuildStep(BuildStep):
 
         @d.addCallback
         def checkResult(_):
+            if getattr(writer, 'store', None) is not None:
+                self.setStatistic('bytes_saved',
+                                  self.getStatistic('bytes_saved', 0) +
+                                  writer.saved)
             if cmd.didFail():
-                writer.cancel()
-            return FAILURE if cmd.didFail() else SUCCESS
+                cancelled = defer.maybeDeferred(writer.cancel)
+                cancelled.addCallback(lambda _: FAILURE)
+                return cancelled
+            return SUCCESS
 
         @d.addErrback
         def cancel(res):
             if writer:
-                writer.cancel()
+                cancelled = defer.maybeDeferred(writer.cancel)
+                cancelled.addBoth(lambda _: res)
+                return cancelled
             return res
 
         return d
@@ -84,11 +126,11 @@ class FileUpload(_TransferBuildStep):
 
     name = 'upload'
 
-    renderables = ['slavesrc', 'masterdest', 'url']
+    renderables = ['slavesrc', 'masterdest', 'url', 'casdir']
 
     def __init__(self, slavesrc, masterdest,
                  workdir=None, maxsize=None, blocksize=16 * 1024, mode=None,
-                 keepstamp=False, url=None,
+                 keepstamp=False, url=None, casdir=None,
                  **buildstep_kwargs):
         _TransferBuildStep.__init__(self, workdir=workdir, **buildstep_kwargs)
 
@@ -102,6 +144,7 @@ class FileUpload(_TransferBuildStep):
         self.mode = mode
         self.keepstamp = keepstamp
         self.url = url
+        self.casdir = casdir
 
     def start(self):
         self.checkSlaveHasCommand("uploadFile")
@@ -121,7 +164,10 @@ class FileUpload(_TransferBuildStep):
             self.addURL(os.path.basename(masterdest), self.url)
 
         # we use maxsize to limit the amount of data on both sides
-        fileWriter = remotetransfer.FileWriter(masterdest, self.maxsize, self.mode)
+        store = self.getContentStore('uploadFile')
+        fileWriter = remotetransfer.FileWriter(masterdest, self.maxsize,
+                                               self.mode, store,
+                                               self.master.transfers.pool)
 
         if self.keepstamp and self.slaveVersionIsOlderThan("uploadFile", "2.13"):
             m = ("This buildslave (%s) does not support preserving timestamps. "
@@ -137,6 +183,9 @@ class FileUpload(_TransferBuildStep):
             'blocksize': self.blocksize,
             'keepstamp': self.keepstamp,
         }
+        self.addWindowArgs('uploadFile', args)
+        if store is not None:
+            args['cas'] = True
 
         cmd = makeStatusRemoteCommand(self, 'uploadFile', args)
         d = self.runTransferCommand(cmd, fileWriter)
@@ -147,11 +196,11 @@ class DirectoryUpload(_TransferBuildStep):
 
     name = 'upload'
 
-    renderables = ['slavesrc', 'masterdest', 'url']
+    renderables = ['slavesrc', 'masterdest', 'url', 'casdir']
 
     def __init__(self, slavesrc, masterdest,
                  workdir=None, maxsize=None, blocksize=16 * 1024,
-                 compress=None, url=None, **buildstep_kwargs):
+                 compress=None, url=None, casdir=None, **buildstep_kwargs):
         _TransferBuildStep.__init__(self, workdir=workdir, **buildstep_kwargs)
 
         self.slavesrc = slavesrc
@@ -163,6 +212,7 @@ class DirectoryUpload(_TransferBuildStep):
                 "'compress' must be one of None, 'gz', or 'bz2'")
         self.compress = compress
         self.url = url
+        self.casdir = casdir
 
     def start(self):
         self.checkSlaveHasCommand("uploadDirectory")
@@ -182,7 +232,10 @@ class DirectoryUpload(_TransferBuildStep):
             self.addURL(os.path.basename(masterdest), self.url)
 
         # we use maxsize to limit the amount of data on both sides
-        dirWriter = remotetransfer.DirectoryWriter(masterdest, self.maxsize, self.compress, 0600)
+        store = self.getContentStore('uploadDirectory')
+        dirWriter = remotetransfer.DirectoryWriter(masterdest, self.maxsize,
+                                                   self.compress, 0600, store,
+                                                   self.master.transfers.pool)
 
         # default arguments
         args = {
@@ -193,6 +246,9 @@ class DirectoryUpload(_TransferBuildStep):
             'blocksize': self.blocksize,
             'compress': self.compress
         }
+        self.addWindowArgs('uploadDirectory', args)
+        if store is not None:
+            args['cas'] = True
 
         cmd = makeStatusRemoteCommand(self, 'uploadDirectory', args)
         d = self.runTransferCommand(cmd, dirWriter)
@@ -203,11 +259,12 @@ class MultipleFileUpload(_TransferBuildStep):
 
     name = 'upload'
 
-    renderables = ['slavesrcs', 'masterdest', 'url']
+    renderables = ['slavesrcs', 'masterdest', 'url', 'casdir']
 
     def __init__(self, slavesrcs, masterdest,
                  workdir=None, maxsize=None, blocksize=16 * 1024,
-                 mode=None, compress=None, keepstamp=False, url=None, **buildstep_kwargs):
+                 mode=None, compress=None, keepstamp=False, url=None,
+                 casdir=None, **buildstep_kwargs):
         _TransferBuildStep.__init__(self, workdir=workdir, **buildstep_kwargs)
 
         self.slavesrcs = slavesrcs
@@ -224,9 +281,13 @@ class MultipleFileUpload(_TransferBuildStep):
         self.compress = compress
         self.keepstamp = keepstamp
         self.url = url
+        self.casdir = casdir
 
     def uploadFile(self, source, masterdest):
-        fileWriter = remotetransfer.FileWriter(masterdest, self.maxsize, self.mode)
+        store = self.getContentStore('uploadFile')
+        fileWriter = remotetransfer.FileWriter(masterdest, self.maxsize,
+                                               self.mode, store,
+                                               self.master.transfers.pool)
 
         args = {
             'slavesrc': source,
@@ -236,12 +297,18 @@ class MultipleFileUpload(_TransferBuildStep):
             'blocksize': self.blocksize,
             'keepstamp': self.keepstamp,
         }
+        self.addWindowArgs('uploadFile', args)
+        if store is not None:
+            args['cas'] = True
 
         cmd = makeStatusRemoteCommand(self, 'uploadFile', args)
         return self.runTransferCommand(cmd, fileWriter)
 
     def uploadDirectory(self, source, masterdest):
-        dirWriter = remotetransfer.DirectoryWriter(masterdest, self.maxsize, self.compress, 0600)
+        store = self.getContentStore('uploadDirectory')
+        dirWriter = remotetransfer.DirectoryWriter(masterdest, self.maxsize,
+                                                   self.compress, 0600, store,
+                                                   self.master.transfers.pool)
 
         args = {
             'slavesrc': source,
@@ -251,6 +318,9 @@ class MultipleFileUpload(_TransferBuildStep):
             'blocksize': self.blocksize,
             'compress': self.compress
         }
+        self.addWindowArgs('uploadDirectory', args)
+        if store is not None:
+            args['cas'] = True
 
         cmd = makeStatusRemoteCommand(self, 'uploadDirectory', args)
         return self.runTransferCommand(cmd, dirWriter)
@@ -379,7 +449,7 @@ class FileDownload(_TransferBuildStep):
             # maybeDeferred, just re-raise the exception here.
             eventually(BuildStep.finished, self, FAILURE)
             return
-        fileReader = remotetransfer.FileReader(fp)
+        fileReader = remotetransfer.FileReader(fp, self.master.transfers.pool)
 
         # default arguments
         args = {
@@ -390,6 +460,7 @@ class FileDownload(_TransferBuildStep):
             'workdir': self.workdir,
             'mode': self.mode,
         }
+        self.addWindowArgs('downloadFile', args)
 
         cmd = makeStatusRemoteCommand(self, 'downloadFile', args)
         d = self.runTransferCommand(cmd)
@@ -440,6 +511,7 @@ class StringDownload(_TransferBuildStep):
             'workdir': self.workdir,
             'mode': self.mode,
         }
+        self.addWindowArgs('downloadFile', args)
 
         cmd = makeStatusRemoteCommand(self, 'downloadFile', args)
         d = self.runTransferCommand(cmd)
@@ -820,13 +820,16 @@ class FakeChangesComponent(FakeDBComponent):
             ch_uids = []
         return defer.succeed(ch_uids)
 
-    def getRecentChanges(self, count):
-        ids = sorted(self.changes.keys())
+    def getRecentChanges(self, count, before=None):
+        ids = sorted(id for id in self.changes
+                     if before is None or id < before)
         chdicts = [self._chdict(self.changes[id]) for id in ids[-count:]]
         return defer.succeed(chdicts)
 
-    def getChanges(self):
-        chdicts = [self._chdict(v) for v in self.changes.values()]
+    def getChanges(self, after=None, limit=None):
+        ids = sorted(id for id in self.changes
+                     if after is None or id > after)
+        chdicts = [self._chdict(self.changes[id]) for id in ids[:limit]]
         return defer.succeed(chdicts)
 
     def getChangesCount(self):
@@ -1612,11 +1615,14 @@ class FakeBuildRequestsComponent(FakeDBComponent):
 
     @defer.inlineCallbacks
     def getBuildRequests(self, builderid=None, complete=None, claimed=None,
-                         bsid=None, branch=None, repository=None):
+                         bsid=None, branch=None, repository=None,
+                         resultSpec=None, brids=None):
         rv = []
         for br in self.reqs.itervalues():
             if builderid and br.builderid != builderid:
                 continue
+            if brids is not None and br.id not in brids:
+                continue
             if complete is not None:
                 if complete and not br.complete:
                     continue
@@ -1661,6 +1667,17 @@ class FakeBuildRequestsComponent(FakeDBComponent):
             rv.append(self._brdictFromRow(br))
         defer.returnValue(rv)
 
+    def getOldestUnclaimedRequestTimes(self):
+        rv = {}
+        for br in self.reqs.itervalues():
+            if br.complete or br.id in self.claims:
+                continue
+            if br.builderid not in rv or br.submitted_at < rv[br.builderid]:
+                rv[br.builderid] = br.submitted_at
+        return defer.succeed(dict((builderid, _mkdt(submitted_at))
+                                  for builderid, submitted_at
+                                  in rv.iteritems()))
+
     def claimBuildRequests(self, brids, claimed_at=None, _reactor=reactor):
         for brid in brids:
             if brid not in self.reqs or brid in self.claims:
@@ -1794,7 +1811,8 @@ class FakeBuildsComponent(FakeDBComponent):
                 return defer.succeed(self._row2dict(row))
         return defer.succeed(None)
 
-    def getBuilds(self, builderid=None, buildrequestid=None, complete=None):
+    def getBuilds(self, builderid=None, buildrequestid=None, complete=None,
+                  resultSpec=None):
         ret = []
         for (id, row) in self.builds.items():
             if builderid is not None and row['builderid'] != builderid:
@@ -2074,7 +2092,7 @@ class FakeLogsComponent(FakeDBComponent):
         return defer.succeed(None)
 
     def compressLog(self, logid):
-        return defer.succeed(None)
+        return defer.succeed(0)
 
 
 class FakeUsersComponent(FakeDBComponent):
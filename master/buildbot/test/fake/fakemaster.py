@@ -51,6 +51,9 @@ class FakeCache(object):
     def put(self, key, val):
         pass
 
+    def peek(self, key):
+        return None
+
 
 class FakeCaches(object):
 
@@ -141,6 +144,11 @@ class FakeLogRotation(object):
     maxRotatedFiles = 42
 
 
+class FakeTransfers(object):
+    # transfers run in the reactor's thread pool
+    pool = None
+
+
 class FakeMaster(object):
 
     """
@@ -164,6 +172,7 @@ class FakeMaster(object):
         self.masterid = master_id
         self.buildslaves = bslavemanager.FakeBuildslaveManager(self)
         self.log_rotation = FakeLogRotation()
+        self.transfers = FakeTransfers()
 
     def getObjectId(self):
         return defer.succeed(self._master_id)
@@ -194,6 +194,24 @@ class TestConnection(unittest.TestCase):
         self.assertIsInstance(callargs[1], pb.RemoteCommand)
         self.assertEqual(callargs[1].impl, RCInstance)
 
+    def test_remoteStartCommand_batchUpdates(self):
+        ret_val = {'builder': mock.Mock()}
+        self.mind.callRemote.return_value = defer.succeed(ret_val)
+        conn = pb.Connection(self.master, self.buildslave, self.mind)
+        conn.info = {'slave_commands': {'shell': '2.19', 'old': '2.18',
+                                        'newer': '2.100', 'beta': '2.19b1'}}
+        conn.remoteSetBuilderList(['builder'])
+
+        for command, expected in [('shell', {'batchUpdates': True}),
+                                  ('old', {}),
+                                  ('newer', {'batchUpdates': True}),
+                                  ('beta', {'batchUpdates': True}),
+                                  ('unknown', {})]:
+            conn.remoteStartCommand(base.RemoteCommandImpl(), 'builder',
+                                    None, command, {})
+            callargs = ret_val['builder'].callRemote.call_args[0]
+            self.assertEqual(callargs[4], expected)
+
     def test_doKeepalive(self):
         conn = pb.Connection(self.master, self.buildslave, self.mind)
         conn.doKeepalive()
@@ -54,6 +54,7 @@ global_defaults = dict(
     properties=properties.Properties(),
     collapseRequests=None,
     prioritizeBuilders=None,
+    buildStartConcurrency=1,
     protocols={},
     multiMaster=False,
     manhole=None,
@@ -453,7 +454,12 @@ class MasterConfig_loaders(ConfigErrorsMixin, unittest.TestCase):
     def test_load_global_logCompressionMethod_invalid(self):
         self.cfg.load_global(self.filename,
                              dict(logCompressionMethod='foo'))
-        self.assertConfigError(self.errors, "must be 'bz2' or 'gz'")
+        self.assertConfigError(self.errors,
+                               "must be 'raw', 'bz2', 'gz' or 'lz4'")
+
+    def test_load_global_logCompressionMethod_raw(self):
+        self.do_test_load_global(dict(logCompressionMethod='raw'),
+                                 logCompressionMethod='raw')
 
     def test_load_global_codebaseGenerator(self):
         func = lambda _: "dummy"
@@ -512,6 +518,15 @@ class MasterConfig_loaders(ConfigErrorsMixin, unittest.TestCase):
                              dict(prioritizeBuilders='yes'))
         self.assertConfigError(self.errors, "must be a callable")
 
+    def test_load_global_buildStartConcurrency(self):
+        self.do_test_load_global(dict(buildStartConcurrency=4),
+                                 buildStartConcurrency=4)
+
+    def test_load_global_buildStartConcurrency_invalid(self):
+        self.cfg.load_global(self.filename,
+                             dict(buildStartConcurrency=0))
+        self.assertConfigError(self.errors, "must be a positive integer")
+
     def test_load_global_slavePortnum_int(self):
         self.do_test_load_global(dict(slavePortnum=123),
                                  protocols={'pb': {'port': 'tcp:123'}})
@@ -586,6 +601,85 @@ class MasterConfig_loaders(ConfigErrorsMixin, unittest.TestCase):
                          dict(db=dict(db_url='abcd', db_poll_interval=10)))
         self.assertResults(db=dict(db_url='abcd'))
 
+    def test_load_db_log_flush(self):
+        self.cfg.load_db(self.filename,
+                         dict(db=dict(db_url='abcd', log_flush_interval=0.5,
+                                      log_flush_size=65536)))
+        self.assertResults(db=dict(db_url='abcd', log_flush_interval=0.5,
+                                   log_flush_size=65536))
+
+    def test_load_db_log_flush_invalid(self):
+        self.cfg.load_db(self.filename,
+                         dict(db=dict(db_url='abcd', log_flush_interval='x')))
+        self.assertConfigError(self.errors,
+                               "c['db']['log_flush_interval'] must be")
+
+    def test_load_db_pool_size(self):
+        self.cfg.load_db(self.filename,
+                         dict(db=dict(db_url='abcd', pool_size=2,
+                                      pool_max_size=8)))
+        self.assertResults(db=dict(db_url='abcd', pool_size=2,
+                                   pool_max_size=8))
+
+    def test_load_db_pool_size_invalid(self):
+        self.cfg.load_db(self.filename,
+                         dict(db=dict(db_url='abcd', pool_size=0)))
+        self.assertConfigError(self.errors,
+                               "c['db']['pool_size'] must be")
+
+    def test_load_db_pool_max_size_too_small(self):
+        self.cfg.load_db(self.filename,
+                         dict(db=dict(db_url='abcd', pool_size=4,
+                                      pool_max_size=2)))
+        self.assertConfigError(self.errors,
+                               "c['db']['pool_max_size'] must not be less")
+
+    def test_load_db_read_db_url(self):
+        self.cfg.load_db(self.filename,
+                         dict(db=dict(db_url='abcd', read_db_url='efgh',
+                                      read_lag=0)))
+        self.assertResults(db=dict(db_url='abcd', read_db_url='efgh',
+                                   read_lag=0))
+
+    def test_load_db_read_db_url_invalid(self):
+        self.cfg.load_db(self.filename,
+                         dict(db=dict(db_url='abcd', read_db_url=3)))
+        self.assertConfigError(self.errors,
+                               "c['db']['read_db_url'] must be a string")
+
+    def test_load_db_retention(self):
+        self.cfg.load_db(self.filename,
+                         dict(db=dict(db_url='abcd', build_horizon=100,
+                                      log_horizon=20, buildset_max_age=3600.5)))
+        self.assertResults(db=dict(db_url='abcd', build_horizon=100,
+                                   log_horizon=20, buildset_max_age=3600.5))
+
+    def test_load_db_build_horizon_invalid(self):
+        self.cfg.load_db(self.filename,
+                         dict(db=dict(db_url='abcd', build_horizon=0)))
+        self.assertConfigError(self.errors,
+                               "c['db']['build_horizon'] must be a positive "
+                               "integer")
+
+    def test_load_db_buildset_max_age_invalid(self):
+        self.cfg.load_db(self.filename,
+                         dict(db=dict(db_url='abcd', buildset_max_age='1d')))
+        self.assertConfigError(self.errors,
+                               "c['db']['buildset_max_age'] must be a "
+                               "non-negative number")
+
+    def test_load_db_prune_batch_size(self):
+        self.cfg.load_db(self.filename,
+                         dict(db=dict(db_url='abcd', prune_batch_size=50)))
+        self.assertResults(db=dict(db_url='abcd', prune_batch_size=50))
+
+    def test_load_db_prune_batch_size_invalid(self):
+        self.cfg.load_db(self.filename,
+                         dict(db=dict(db_url='abcd', prune_batch_size=0)))
+        self.assertConfigError(self.errors,
+                               "c['db']['prune_batch_size'] must be a "
+                               "positive integer")
+
     def test_load_db_unk_keys(self):
         self.cfg.load_db(self.filename,
                          dict(db=dict(db_url='abcd', db_poll_interval=10, bar='bar')))
@@ -609,6 +703,17 @@ class MasterConfig_loaders(ConfigErrorsMixin, unittest.TestCase):
                          dict(mq=dict(bar='bar')))
         self.assertConfigError(self.errors, "unrecognized keys in")
 
+    def test_load_mq_tcp(self):
+        self.cfg.load_mq(self.filename,
+                         dict(mq=dict(type='tcp', listen='tcp:9988',
+                                      broker='tcp:host=localhost:port=9988')))
+        self.assertResults(mq=dict(type='tcp', listen='tcp:9988',
+                                   broker='tcp:host=localhost:port=9988'))
+
+    def test_load_mq_tcp_no_broker(self):
+        self.cfg.load_mq(self.filename, dict(mq=dict(type='tcp')))
+        self.assertConfigError(self.errors, "c['mq']['broker'] is required")
+
     def test_load_metrics_defaults(self):
         self.cfg.load_metrics(self.filename, {})
         self.assertResults(metrics=None)
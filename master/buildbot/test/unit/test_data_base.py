@@ -128,3 +128,12 @@ class ListResult(unittest.TestCase):
         self.assertEqual(lr3, list)
         lr4 = base.ListResult([1, 2, 3], total=4)
         self.assertNotEqual(lr4, list)
+
+    def test_fromDbResult(self):
+        lr = base.ListResult([1, 2, 3], offset=10, total=20, limit=3)
+        self.assertEqual(base.ListResult.fromDbResult(lr, [4, 5, 6]),
+                         base.ListResult([4, 5, 6], offset=10, total=20,
+                                         limit=3))
+
+    def test_fromDbResult_list(self):
+        self.assertEqual(base.ListResult.fromDbResult([1, 2], [3, 4]), [3, 4])
@@ -146,7 +146,8 @@ class TestBuildRequestsEndpoint(endpoint.EndpointMixin, unittest.TestCase):
             builderid=None,
             bsid=None,
             complete=None,
-            claimed=None)
+            claimed=None,
+            resultSpec=mock.ANY)
 
     @defer.inlineCallbacks
     def testGetFilters(self):
@@ -164,7 +165,8 @@ class TestBuildRequestsEndpoint(endpoint.EndpointMixin, unittest.TestCase):
             builderid=None,
             bsid=55,
             complete=False,
-            claimed=True)
+            claimed=True,
+            resultSpec=mock.ANY)
 
     @defer.inlineCallbacks
     def testGetClaimedByMasterIdFilters(self):
@@ -180,7 +182,8 @@ class TestBuildRequestsEndpoint(endpoint.EndpointMixin, unittest.TestCase):
             builderid=None,
             bsid=None,
             complete=None,
-            claimed=fakedb.FakeBuildRequestsComponent.MASTER_ID)
+            claimed=fakedb.FakeBuildRequestsComponent.MASTER_ID,
+            resultSpec=mock.ANY)
 
 
 class TestBuildRequest(interfaces.InterfaceTests, unittest.TestCase):
@@ -252,6 +255,31 @@ class TestBuildRequest(interfaces.InterfaceTests, unittest.TestCase):
                                      expectedRes=True,
                                      expectedException=None)
 
+    @defer.inlineCallbacks
+    def testClaimBuildRequestsQueries(self):
+        self.master.db.insertTestData([
+            fakedb.Builder(id=77, name='bbb'),
+            fakedb.Buildset(id=8822),
+            fakedb.BuildRequest(id=44, buildsetid=8822, builderid=77),
+            fakedb.BuildRequest(id=45, buildsetid=8822, builderid=77),
+            fakedb.BuildRequest(id=46, buildsetid=8822, builderid=77),
+        ])
+        db = self.master.db.buildrequests
+        for meth in 'getBuildRequest', 'getBuildRequests':
+            self.patch(db, meth, mock.Mock(wraps=getattr(db, meth)))
+        res = yield self.rtype.claimBuildRequests([44, 45, 46],
+                                                  claimed_at=self.CLAIMED_AT)
+        self.assertTrue(res)
+        # the claim messages are generated from a single query
+        self.assertFalse(db.getBuildRequest.called)
+        db.getBuildRequests.assert_called_once_with(brids=[44, 45, 46])
+        self.assertEqual(
+            [(key, msg['claimed']) for key, msg in
+             self.master.mq.productions
+             if key[0] == 'buildrequests'],
+            [(('buildrequests', str(brid), 'claimed'), True)
+             for brid in (44, 45, 46)])
+
     @defer.inlineCallbacks
     def testClaimBuildRequestsNoBrids(self):
         claimBuildRequestsMock = mock.Mock(return_value=defer.succeed(None))
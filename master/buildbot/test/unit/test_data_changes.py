@@ -16,6 +16,7 @@
 import mock
 
 from buildbot.data import changes
+from buildbot.data import resultspec
 from buildbot.process.users import users
 from buildbot.test.fake import fakedb
 from buildbot.test.fake import fakemaster
@@ -94,6 +95,22 @@ class ChangesEndpoint(endpoint.EndpointMixin, unittest.TestCase):
             self.assertEqual(changes[1]['changeid'], 14)
         return d
 
+    @defer.inlineCallbacks
+    def test_get_recent(self):
+        resultSpec = resultspec.ResultSpec(order=['-changeid'], limit=1)
+        changes = yield self.callGet(('changes',), resultSpec=resultSpec)
+        self.assertEqual([ch['changeid'] for ch in changes], [14])
+        self.assertEqual((changes.offset, changes.total, changes.limit),
+                         (0, 2, 1))
+        self.assertEqual((resultSpec.order, resultSpec.limit), (None, None))
+
+    @defer.inlineCallbacks
+    def test_get_first(self):
+        resultSpec = resultspec.ResultSpec(limit=1)
+        changes = yield self.callGet(('changes',), resultSpec=resultSpec)
+        self.assertEqual([ch['changeid'] for ch in changes], [13])
+        self.assertEqual(resultSpec.apply(changes).total, 2)
+
     def test_startConsuming(self):
         return self.callStartConsuming({}, {},
                                        expected_filter=('changes',
@@ -15,6 +15,7 @@
 
 import datetime
 import random
+import sqlalchemy as sa
 
 from buildbot.data import base
 from buildbot.data import resultspec
@@ -136,6 +137,54 @@ class ResultSpec(unittest.TestCase):
             resultspec.ResultSpec(order=['-ln', '-fn']).apply(data),
             exp)
 
+    def test_apply_ordering_mixed_directions(self):
+        data = mklist(('a', 'b', 'c'),
+                      *[(random.choice([None, 1, 2]),
+                         random.choice([None, 'x', 'y']),
+                         i) for i in range(200)])
+
+        def cmpFunc(x, y):
+            return (resultspec.nonecmp(x['a'], y['a']) or
+                    resultspec.nonecmp(y['b'], x['b']) or
+                    resultspec.nonecmp(x['c'], y['c']))
+        exp = sorted(data, cmp=cmpFunc)
+        self.assertEqual(
+            resultspec.ResultSpec(order=['a', '-b', 'c']).apply(data),
+            base.ListResult(exp, total=200))
+        self.assertEqual(
+            resultspec.ResultSpec(order=['a', '-b', 'c'], offset=20,
+                                  limit=10).apply(data),
+            base.ListResult(exp[20:30], offset=20, total=200, limit=10))
+
+    def test_apply_ordering_limit(self):
+        data = mklist(('a', 'b'),
+                      *[(random.choice([None, 1, 2, 3]), i)
+                        for i in range(200)])
+        for order in ['a'], ['-a'], ['a', 'b'], ['-a', '-b']:
+            desc = order[0][0] == '-'
+            fields = [k.lstrip('-') for k in order]
+            # items with equal keys stay in their original order
+            exp = sorted(data, reverse=desc,
+                         key=lambda d: [(d[k] is not None, d[k])
+                                        for k in fields])
+            self.assertEqual(
+                resultspec.ResultSpec(order=order, offset=5,
+                                      limit=10).apply(data),
+                base.ListResult(exp[5:15], offset=5, total=200, limit=10))
+
+    def test_apply_fields_after_filter_and_order(self):
+        data = mklist(('a', 'b', 'c'), (1, 2, 3), (4, 5, 6), (7, 8, 9))
+        f = resultspec.Filter('a', 'gt', [1])
+        self.assertEqual(
+            resultspec.ResultSpec(fields=['a', 'b'], filters=[f],
+                                  order=['-a']).apply(data),
+            base.ListResult(mklist(('a', 'b'), (7, 8), (4, 5)), total=2))
+
+    def test_apply_does_not_modify_data(self):
+        data = mklist('x', 3, 1, 2)
+        resultspec.ResultSpec(order=['x']).apply(data)
+        self.assertEqual(data, mklist('x', 3, 1, 2))
+
     def test_apply_filter(self):
         data = mklist('name', 'albert', 'bruce', 'cedric', 'dwayne')
         f = resultspec.Filter(field='name', op='gt', values=['bruce'])
@@ -263,6 +312,137 @@ class ResultSpec(unittest.TestCase):
         self.assertEqual(rs.fields, ['foo', 'bar'])
 
 
+class SQLResultSpec(unittest.TestCase):
+
+    rows = [(1, 10, u'a'), (2, None, u'b'), (3, 30, u'c'), (4, 10, u'd'),
+            (5, None, u'e'), (6, 20, u'f')]
+
+    def setUp(self):
+        self.engine = sa.create_engine('sqlite://')
+        metadata = sa.MetaData()
+        self.tbl = sa.Table('items', metadata,
+                            sa.Column('id', sa.Integer, primary_key=True),
+                            sa.Column('num', sa.Integer),
+                            sa.Column('name', sa.Text, nullable=False))
+        metadata.create_all(self.engine)
+        self.engine.execute(self.tbl.insert(),
+                            [dict(id=id, num=num, name=name)
+                             for id, num, name in self.rows])
+        self.data = [dict(itemid=id, num=num, name=name)
+                     for id, num, name in self.rows]
+
+    def dictFromRow(self, row):
+        return dict(itemid=row.id, num=row.num, name=row.name)
+
+    def execute(self, rs, mapping=None):
+        if mapping is None:
+            mapping = {'itemid': 'items.id', 'num': 'items.num',
+                       'name': 'items.name'}
+        rs.fieldMapping = mapping
+        conn = self.engine.connect()
+        try:
+            rv = rs.thd_execute(conn, self.tbl.select(), self.dictFromRow)
+        finally:
+            conn.close()
+        return rs.apply(rv)
+
+    def assertSameAsPython(self, **kwargs):
+        exp = resultspec.ResultSpec(**kwargs).apply(self.data)
+        rs = resultspec.ResultSpec(**kwargs)
+        got = self.execute(rs)
+        self.assertEqual((got, got.offset, got.total, got.limit),
+                         (exp, exp.offset, exp.total, exp.limit))
+        return rs
+
+    def test_filters(self):
+        for op in resultspec.Filter.singular_operators:
+            for value in 10, 20, None, u'c':
+                fld = 'name' if isinstance(value, unicode) else 'num'
+                rs = self.assertSameAsPython(
+                    filters=[resultspec.Filter(fld, op, [value])],
+                    order=['itemid'])
+                # only eq and ne can compare with NULL in SQL
+                applied = value is not None or op in ('eq', 'ne')
+                self.assertEqual(rs.filters == [], applied)
+
+    def test_filters_plural(self):
+        for op in resultspec.Filter.plural_operators:
+            for values in [10, 30], [None, 20]:
+                self.assertSameAsPython(
+                    filters=[resultspec.Filter('num', op, values)],
+                    order=['itemid'])
+
+    def test_order(self):
+        for order in ['num', 'itemid'], ['-num', 'itemid'], ['-name']:
+            rs = self.assertSameAsPython(order=order)
+            self.assertEqual(rs.order, None)
+
+    def test_pagination(self):
+        rs = resultspec.ResultSpec(order=['-num', 'itemid'], offset=1,
+                                   limit=3)
+        rv = self.execute(rs)
+        self.assertEqual(rv, base.ListResult(
+            [self.data[i] for i in (5, 0, 3)], offset=1, total=6, limit=3))
+        self.assertEqual((rs.offset, rs.limit), (None, None))
+
+    def test_pagination_filtered(self):
+        for offset, limit in (0, 2), (2, None), (None, 1), (5, 5):
+            self.assertSameAsPython(
+                filters=[resultspec.Filter('num', 'ne', [30])],
+                order=['num', 'itemid'], offset=offset, limit=limit)
+
+    def test_execute_retried(self):
+        # the DB thread pool calls thd_execute again when the query fails
+        rs = resultspec.ResultSpec(
+            filters=[resultspec.Filter('num', 'ne', [30])],
+            order=['-num', 'itemid'], offset=1, limit=2)
+        rs.fieldMapping = {'itemid': 'items.id', 'num': 'items.num'}
+        conn = self.engine.connect()
+        real_execute = conn.execute
+        calls = []
+
+        def execute(query):
+            calls.append(query)
+            if len(calls) == 1:
+                raise sa.exc.OperationalError('q', {},
+                                              Exception('database is locked'))
+            return real_execute(query)
+        self.patch(conn, 'execute', execute)
+        try:
+            self.assertRaises(sa.exc.OperationalError,
+                              rs.thd_execute, conn, self.tbl.select(),
+                              self.dictFromRow)
+            rv = rs.thd_execute(conn, self.tbl.select(), self.dictFromRow)
+        finally:
+            conn.close()
+        exp = resultspec.ResultSpec(
+            filters=[resultspec.Filter('num', 'ne', [30])],
+            order=['-num', 'itemid'], offset=1, limit=2).apply(self.data)
+        got = rs.apply(rv)
+        self.assertEqual((got, got.offset, got.total, got.limit),
+                         (exp, exp.offset, exp.total, exp.limit))
+        self.assertEqual((rs.filters, rs.order, rs.offset, rs.limit),
+                         ([], None, None, None))
+
+    def test_unmapped_filter_applied_in_python(self):
+        rs = resultspec.ResultSpec(
+            filters=[resultspec.Filter('num', 'gt', [10]),
+                     resultspec.Filter('name', 'ne', [u'c'])],
+            order=['itemid'], limit=1)
+        rv = self.execute(rs, mapping={'itemid': 'items.id',
+                                       'num': 'items.num'})
+        self.assertEqual(rv, base.ListResult([self.data[5]], offset=None,
+                                             total=1, limit=1))
+        # the unmapped filter, and everything after it, was left for apply
+        self.assertEqual([f.field for f in rs.filters], ['name'])
+        self.assertEqual((rs.order, rs.limit), (['itemid'], 1))
+
+    def test_unmapped_order_applied_in_python(self):
+        rs = resultspec.ResultSpec(order=['name'], limit=2)
+        self.execute(rs, mapping={'itemid': 'items.id'})
+        self.assertEqual((rs.order, rs.limit), (['name'], 2))
+
+
 class NoneCmp(unittest.TestCase):
 
     def test_nonecmp(self):
@@ -52,6 +52,34 @@ class TestBase(unittest.TestCase):
         # run that again since the method gets stubbed out
         self.comp.checkLength(self.tbl.c.str32, "long string" * 5)
 
+    def test_doBatch(self):
+        self.assertEqual(list(self.comp.doBatch(xrange(7), batch_n=3)),
+                         [[0, 1, 2], [3, 4, 5], [6]])
+
+    def test_doBatch_empty(self):
+        self.assertEqual(list(self.comp.doBatch([])), [])
+
+    def test_statement(self):
+        build = mock.Mock(return_value=self.tbl.select())
+        stmt = self.comp.statement('sel', build)
+        self.assertIdentical(self.comp.statement('sel', build), stmt)
+        self.assertEqual(build.call_count, 1)
+
+    def test_thdExecute_compiles_once(self):
+        engine = sa.create_engine('sqlite://')
+        self.tbl.metadata.create_all(bind=engine)
+        conn = engine.connect()
+        q = self.comp.statement('sel', lambda: self.tbl.select(
+            whereclause=(self.tbl.c.str32 == sa.bindparam('b_str32'))))
+        self.comp.thdExecute(conn, self.tbl.insert(),
+                             [dict(str32='a'), dict(str32='b')])
+        for value in 'ab':
+            res = self.comp.thdExecute(conn, q, b_str32=value)
+            self.assertEqual([row.str32 for row in res], [value])
+        # the select has been compiled just once
+        self.assertEqual(len([key for key in self.comp._compiledCache
+                              if key[1] is q]), 1)
+
     def _sha1(self, s):
         return hashlib.sha1(s).hexdigest()
 
@@ -144,6 +144,45 @@ class Tests(interfaces.InterfaceTests):
             claimed=False,
             expected=[52])
 
+    def test_getOldestUnclaimedRequestTimes(self):
+        d = self.insertTestData([
+            # builder 1: oldest unclaimed is 61
+            fakedb.BuildRequest(id=60, buildsetid=self.BSID,
+                                builderid=self.BLDRID1,
+                                submitted_at=self.SUBMITTED_AT_EPOCH + 20),
+            fakedb.BuildRequest(id=61, buildsetid=self.BSID,
+                                builderid=self.BLDRID1,
+                                submitted_at=self.SUBMITTED_AT_EPOCH),
+            # 62: older, but claimed
+            fakedb.BuildRequest(id=62, buildsetid=self.BSID,
+                                builderid=self.BLDRID1,
+                                submitted_at=self.SUBMITTED_AT_EPOCH - 10),
+            fakedb.BuildRequestClaim(brid=62, masterid=self.OTHER_MASTER_ID,
+                                     claimed_at=self.CLAIMED_AT_EPOCH),
+            # 63: older, but complete
+            fakedb.BuildRequest(id=63, buildsetid=self.BSID,
+                                builderid=self.BLDRID1, complete=1,
+                                submitted_at=self.SUBMITTED_AT_EPOCH - 20),
+            # builder 2: only 64
+            fakedb.BuildRequest(id=64, buildsetid=self.BSID,
+                                builderid=self.BLDRID2,
+                                submitted_at=self.SUBMITTED_AT_EPOCH + 30),
+            # builder 3: no unclaimed requests
+            fakedb.BuildRequest(id=65, buildsetid=self.BSID,
+                                builderid=self.BLDRID3, complete=1,
+                                submitted_at=self.SUBMITTED_AT_EPOCH),
+        ])
+        d.addCallback(lambda _:
+                      self.db.buildrequests.getOldestUnclaimedRequestTimes())
+
+        @d.addCallback
+        def check(times):
+            self.assertEqual(times, {
+                self.BLDRID1: self.SUBMITTED_AT,
+                self.BLDRID2: epoch2datetime(self.SUBMITTED_AT_EPOCH + 30),
+            })
+        return d
+
     def do_test_getBuildRequests_buildername_arg(self, **kwargs):
         expected = kwargs.pop('expected')
         d = self.insertTestData([
@@ -227,6 +266,41 @@ class Tests(interfaces.InterfaceTests):
                              sorted([70, 72]))
         return d
 
+    def test_getBuildRequests_brids_arg(self):
+        d = self.insertTestData([
+            fakedb.BuildRequest(id=70, buildsetid=self.BSID,
+                                builderid=self.BLDRID1),
+            fakedb.BuildRequest(id=71, buildsetid=self.BSID,
+                                builderid=self.BLDRID2),
+            fakedb.BuildRequest(id=72, buildsetid=self.BSID,
+                                builderid=self.BLDRID1),
+        ])
+        d.addCallback(lambda _:
+                      self.db.buildrequests.getBuildRequests(
+                          brids=[70, 72, 99]))
+
+        @d.addCallback
+        def check(brlist):
+            self.assertEqual(sorted([br['buildrequestid'] for br in brlist]),
+                             [70, 72])
+        return d
+
+    def test_getBuildRequests_brids_arg_stress(self):
+        # more brids than fit in a single query
+        d = self.insertTestData([
+            fakedb.BuildRequest(id=id, buildsetid=self.BSID,
+                                builderid=self.BLDRID1)
+            for id in range(1000, 1250)])
+        d.addCallback(lambda _:
+                      self.db.buildrequests.getBuildRequests(
+                          brids=range(1000, 1250, 2), claimed=False))
+
+        @d.addCallback
+        def check(brlist):
+            self.assertEqual(sorted([br['buildrequestid'] for br in brlist]),
+                             range(1000, 1250, 2))
+        return d
+
     def test_getBuildRequests_combo(self):
         d = self.insertTestData([
             # 44: everything we want
@@ -13,7 +13,10 @@
 #
 # Copyright Buildbot Team Members
 
+from buildbot.data import base
+from buildbot.data import resultspec
 from buildbot.db import builds
+from buildbot.db import logs
 from buildbot.test.fake import fakedb
 from buildbot.test.fake import fakemaster
 from buildbot.test.util import connector_component
@@ -90,7 +93,8 @@ class Tests(interfaces.InterfaceTests):
 
     def test_signature_getBuilds(self):
         @self.assertArgSpecMatches(self.db.builds.getBuilds)
-        def getBuilds(self, builderid=None, buildrequestid=None, complete=None):
+        def getBuilds(self, builderid=None, buildrequestid=None, complete=None,
+                      resultSpec=None):
             pass
 
     def test_signature_addBuild(self):
@@ -180,6 +184,24 @@ class Tests(interfaces.InterfaceTests):
         self.assertEqual(sorted(bdicts, key=lambda bd: bd['id']),
                          [self.threeBdicts[52]])
 
+    def makeResultSpec(self, **kwargs):
+        rs = resultspec.ResultSpec(**kwargs)
+        # the db dicts use 'id' rather than 'buildid'
+        rs.fieldMapping = {'id': 'builds.id', 'number': 'builds.number',
+                           'results': 'builds.results'}
+        return rs
+
+    @defer.inlineCallbacks
+    def test_getBuilds_resultSpec(self):
+        yield self.insertTestData(self.backgroundData + self.threeBuilds)
+        rs = self.makeResultSpec(
+            filters=[resultspec.Filter('results', 'ne', [0])],
+            order=['-number'], offset=1, limit=1)
+        bdicts = yield self.db.builds.getBuilds(builderid=77, resultSpec=rs)
+        self.assertEqual(rs.apply(bdicts),
+                         base.ListResult([self.threeBdicts[50]], offset=1,
+                                         total=2, limit=1))
+
     @defer.inlineCallbacks
     def test_addBuild_first(self):
         clock = task.Clock()
@@ -281,6 +303,18 @@ class Tests(interfaces.InterfaceTests):
 
 class RealTests(Tests):
 
+    @defer.inlineCallbacks
+    def test_getBuilds_resultSpec_in_sql(self):
+        yield self.insertTestData(self.backgroundData + self.threeBuilds)
+        rs = self.makeResultSpec(order=['-number'], limit=2)
+        bdicts = yield self.db.builds.getBuilds(resultSpec=rs)
+        self.assertEqual(bdicts,
+                         base.ListResult([self.threeBdicts[52],
+                                          self.threeBdicts[51]],
+                                         offset=None, total=3, limit=2))
+        # everything was applied by the query
+        self.assertEqual((rs.filters, rs.order, rs.limit), ([], None, None))
+
     @defer.inlineCallbacks
     def test_addBuild_existing_race(self):
         clock = task.Clock()
@@ -311,6 +345,58 @@ class RealTests(Tests):
                                  'complete_at': None, 'state_string': u'test test2',
                                  'results': None})
 
+    @defer.inlineCallbacks
+    def test_pruneBuilds(self):
+        rows = self.backgroundData + [
+            fakedb.Build(id=50, buildrequestid=42, number=5, masterid=88,
+                         builderid=77, buildslaveid=13, started_at=TIME1),
+            fakedb.Buildset(id=21, parent_buildid=60),
+        ]
+        for i in range(4):
+            rows.extend([
+                fakedb.Build(id=60 + i, buildrequestid=40, number=1 + i,
+                             masterid=88, builderid=77, buildslaveid=13,
+                             started_at=TIME1, complete_at=TIME2, results=0),
+                fakedb.BuildProperty(buildid=60 + i),
+                fakedb.Step(id=70 + i, buildid=60 + i),
+                fakedb.Log(id=80 + i, stepid=70 + i, num_lines=2),
+                fakedb.LogChunk(logid=80 + i, first_line=0, last_line=1,
+                                content='line\nline'),
+            ])
+        yield self.insertTestData(rows)
+
+        pruned = yield self.db.builds.pruneBuilds(2, batch_n=1)
+        self.assertEqual(pruned, {
+            'rows': {'builds': 2, 'build_properties': 2, 'steps': 2,
+                     'logs': 2, 'logchunks': 2},
+            'bytes': {'logchunks': 18},
+        })
+
+        # the latest two finished builds, and the unfinished one, remain
+        bdicts = yield self.db.builds.getBuilds(builderid=77)
+        self.assertEqual(sorted(b['id'] for b in bdicts), [50, 62, 63])
+
+        def thd(conn):
+            model = self.db.model
+            return (
+                [r.buildid for r in conn.execute(
+                    model.build_properties.select())],
+                [r.id for r in conn.execute(model.steps.select())],
+                [r.id for r in conn.execute(model.logs.select())],
+                [r.logid for r in conn.execute(model.logchunks.select())],
+                [r.parent_buildid for r in conn.execute(
+                    model.buildsets.select(model.buildsets.c.id == 21))])
+        remaining = yield self.db.pool.do(thd)
+        self.assertEqual([sorted(ids) for ids in remaining],
+                         [[62, 63], [72, 73], [82, 83], [82, 83], [None]])
+
+    @defer.inlineCallbacks
+    def test_pruneBuilds_no_horizon(self):
+        yield self.insertTestData(self.backgroundData + self.threeBuilds)
+        yield self.db.builds.pruneBuilds(None)
+        bdicts = yield self.db.builds.getBuilds()
+        self.assertEqual(len(bdicts), 3)
+
 
 class TestFakeDB(unittest.TestCase, Tests):
 
@@ -328,11 +414,13 @@ class TestRealDB(unittest.TestCase,
     def setUp(self):
         d = self.setUpConnectorComponent(
             table_names=['builds', 'builders', 'masters', 'buildrequests',
-                         'buildsets', 'buildslaves', 'build_properties'])
+                         'buildsets', 'buildslaves', 'build_properties',
+                         'steps', 'logs', 'logchunks'])
 
         @d.addCallback
         def finish_setup(_):
             self.db.builds = builds.BuildsConnectorComponent(self.db)
+            self.db.logs = logs.LogsConnectorComponent(self.db)
         return d
 
     def tearDown(self):
@@ -15,6 +15,7 @@
 
 import datetime
 import mock
+import sqlalchemy as sa
 
 from buildbot.db import buildsets
 from buildbot.test.fake import fakedb
@@ -546,6 +547,68 @@ class RealTests(Tests):
         d.addCallback(check)
         return d
 
+    @defer.inlineCallbacks
+    def test_addBuildset_many_builders(self):
+        # an existing buildset's build requests must not be mistaken for the
+        # new buildset's
+        yield self.db.buildsets.addBuildset(sourcestamps=[234],
+                                            reason='earlier', properties={},
+                                            builderids=range(1, 11),
+                                            waited_for=False)
+        bsid, brids = yield self.db.buildsets.addBuildset(
+            sourcestamps=[234], reason='because', properties={},
+            builderids=range(1, 601), waited_for=False)
+
+        def thd(conn):
+            br_tbl = self.db.model.buildrequests
+            r = conn.execute(sa.select([br_tbl.c.id, br_tbl.c.builderid],
+                                       br_tbl.c.buildsetid == bsid))
+            return dict((builderid, brid) for brid, builderid in r)
+        self.assertEqual(brids, (yield self.db.pool.do(thd)))
+        self.assertEqual(sorted(brids), range(1, 601))
+
+    @defer.inlineCallbacks
+    def test_pruneBuildsets(self):
+        old = self.now - 7200
+        yield self.insertTestData([
+            fakedb.Master(id=88),
+            fakedb.Buildslave(id=13, name='sl'),
+            # old and complete, so pruned
+            fakedb.Buildset(id=30, complete=1, complete_at=old),
+            fakedb.BuildsetProperty(buildsetid=30),
+            fakedb.BuildsetSourceStamp(buildsetid=30, sourcestampid=234),
+            fakedb.BuildRequest(id=300, buildsetid=30, builderid=1,
+                                complete=1),
+            fakedb.BuildRequestClaim(brid=300, masterid=88, claimed_at=old),
+            # old and complete, but with a build
+            fakedb.Buildset(id=31, complete=1, complete_at=old),
+            fakedb.BuildRequest(id=310, buildsetid=31, builderid=1,
+                                complete=1),
+            fakedb.Build(id=50, buildrequestid=310, number=1, masterid=88,
+                         builderid=1, buildslaveid=13),
+            # recent
+            fakedb.Buildset(id=32, complete=1, complete_at=self.now - 60),
+            # incomplete
+            fakedb.Buildset(id=33, complete=0),
+        ])
+        pruned = yield self.db.buildsets.pruneBuildsets(3600,
+                                                        _reactor=self.clock)
+        self.assertEqual(pruned, {
+            'rows': {'buildsets': 1, 'buildset_properties': 1,
+                     'buildset_sourcestamps': 1, 'buildrequests': 1,
+                     'buildrequest_claims': 1},
+            'bytes': {},
+        })
+        bsdicts = yield self.db.buildsets.getBuildsets()
+        self.assertEqual(sorted(bs['bsid'] for bs in bsdicts), [31, 32, 33])
+
+        def thd(conn):
+            model = self.db.model
+            return ([r.id for r in conn.execute(model.buildrequests.select())],
+                    [r.brid for r in conn.execute(
+                        model.buildrequest_claims.select())])
+        self.assertEqual((yield self.db.pool.do(thd)), ([310], []))
+
 
 class TestFakeDB(unittest.TestCase, Tests):
 
@@ -572,7 +635,8 @@ class TestRealDB(unittest.TestCase,
         d = self.setUpConnectorComponent(
             table_names=['patches', 'buildsets', 'buildset_properties',
                          'objects', 'buildrequests', 'sourcestamps',
-                         'buildset_sourcestamps', 'builders'])
+                         'buildset_sourcestamps', 'builders', 'builds',
+                         'buildrequest_claims', 'masters', 'buildslaves'])
 
         @d.addCallback
         def finish_setup(_):
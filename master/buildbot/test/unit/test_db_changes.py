@@ -18,6 +18,7 @@ import sqlalchemy as sa
 from buildbot.db import builds
 from buildbot.db import changes
 from buildbot.db import sourcestamps
+from buildbot.process import cache
 from buildbot.test.fake import fakedb
 from buildbot.test.fake import fakemaster
 from buildbot.test.util import connector_component
@@ -275,12 +276,12 @@ class Tests(interfaces.InterfaceTests):
 
     def test_signature_getRecentChanges(self):
         @self.assertArgSpecMatches(self.db.changes.getRecentChanges)
-        def getRecentChanges(self, count):
+        def getRecentChanges(self, count, before=None):
             pass
 
     def test_signature_getChanges(self):
         @self.assertArgSpecMatches(self.db.changes.getChanges)
-        def getChanges(self):
+        def getChanges(self, after=None, limit=None):
             pass
 
     def insert7Changes(self):
@@ -304,6 +305,22 @@ class Tests(interfaces.InterfaceTests):
         d.addCallback(check)
         return d
 
+    @defer.inlineCallbacks
+    def test_getRecentChanges_before(self):
+        yield self.insert7Changes()
+        changes = yield self.db.changes.getRecentChanges(3, before=12)
+        self.assertEqual([c['changeid'] for c in changes], [9, 10, 11])
+
+    @defer.inlineCallbacks
+    def test_getChanges_after_limit(self):
+        yield self.insert7Changes()
+        changes = yield self.db.changes.getChanges()
+        self.assertEqual([c['changeid'] for c in changes], range(8, 15))
+        changes = yield self.db.changes.getChanges(after=9, limit=3)
+        self.assertEqual([c['changeid'] for c in changes], [10, 11, 12])
+        changes = yield self.db.changes.getChanges(after=12, limit=3)
+        self.assertEqual([c['changeid'] for c in changes], [13, 14])
+
     def test_getChangesCount(self):
         d = self.insert7Changes()
         d.addCallback(lambda _:
@@ -417,6 +434,37 @@ class RealTests(Tests):
 
     # tests that only "real" implementations will pass
 
+    @defer.inlineCallbacks
+    def test_getRecentChanges_bulk(self):
+        # use a real cache, big enough for all of the changes
+        self.db.master.caches = cache.CacheManager()
+        self.db.master.caches.config = {'chdicts': 10}
+        self.db.changes = changes.ChangesConnectorComponent(self.db)
+        yield self.insert7Changes()
+        statements = []
+        sa.event.listen(self.db_engine, 'before_cursor_execute',
+                        lambda *args: statements.append(args[2]))
+
+        # the number of queries does not depend on the number of changes
+        chdicts = yield self.db.changes.getRecentChanges(2)
+        self.assertEqual([c['changeid'] for c in chdicts], [13, 14])
+        n = len(statements)
+        del statements[:]
+        chdicts = yield self.db.changes.getRecentChanges(7, before=13)
+        self.assertEqual([c['changeid'] for c in chdicts], range(8, 13))
+        self.assertEqual(len(statements), n)
+
+        # and the results are cached, so getChange does not query them again,
+        # and neither does getChanges
+        del statements[:]
+        chdict = yield self.db.changes.getChange(13)
+        self.assertEqual(chdict['files'],
+                         ['master/README.txt', 'slave/README.txt'])
+        self.assertEqual(chdict['properties'], {'notest': ('no', 'Change')})
+        chdicts = yield self.db.changes.getChanges()
+        self.assertEqual([c['changeid'] for c in chdicts], range(8, 15))
+        self.assertEqual(len(statements), 1)
+
     def test_addChange(self):
         clock = task.Clock()
         clock.advance(SOMETIME)
@@ -19,6 +19,7 @@ import os
 from buildbot import config
 from buildbot.db import connector
 from buildbot.db import exceptions
+from buildbot.process import metrics
 from buildbot.test.fake import fakemaster
 from buildbot.test.util import db
 from twisted.internet import defer
@@ -82,6 +83,52 @@ class DBConnector(db.RealDatabaseMixin, unittest.TestCase):
             self.assertTrue(self.db.changes.pruneChanges.called)
         return d
 
+    @defer.inlineCallbacks
+    def test_doCleanup_prune(self):
+        yield self.startService()
+        self.master.config.db.update(build_horizon=10, buildset_max_age=60,
+                                     prune_batch_size=20)
+        self.db.builds.pruneBuilds = mock.Mock(return_value=defer.succeed(
+            dict(rows={'builds': 3, 'steps': 0}, bytes={'logchunks': 100})))
+        self.db.logs.pruneLogs = mock.Mock()
+        self.db.buildsets.pruneBuildsets = mock.Mock(
+            return_value=defer.fail(RuntimeError('oops')))
+        counts = []
+        self.patch(metrics.MetricCountEvent, 'log',
+                   staticmethod(lambda name, count: counts.append((name,
+                                                                   count))))
+        yield self.db._doCleanup()
+
+        self.db.builds.pruneBuilds.assert_called_with(10, batch_n=20)
+        self.assertFalse(self.db.logs.pruneLogs.called)
+        self.db.buildsets.pruneBuildsets.assert_called_with(60, batch_n=20)
+        self.assertEqual(counts, [('DBJanitor.rows.builds', 3),
+                                  ('DBJanitor.bytes.logchunks', 100)])
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+
+    @defer.inlineCallbacks
+    def test_doCleanup_prune_not_configured(self):
+        yield self.startService()
+        # the status horizons do not delete anything from the database
+        self.master.config.buildHorizon = 10
+        self.master.config.logHorizon = 5
+        self.db.builds.pruneBuilds = mock.Mock()
+        self.db.logs.pruneLogs = mock.Mock()
+        self.db.buildsets.pruneBuildsets = mock.Mock()
+        yield self.db._doCleanup()
+        self.assertFalse(self.db.builds.pruneBuilds.called)
+        self.assertFalse(self.db.logs.pruneLogs.called)
+        self.assertFalse(self.db.buildsets.pruneBuildsets.called)
+
+    @defer.inlineCallbacks
+    def test_stopService_flushes_appends(self):
+        yield self.startService()
+        self.db.logs.flushPendingAppends = mock.Mock(
+            return_value=defer.succeed(None))
+        yield self.db.stopService()
+        self.db.logs.flushPendingAppends.assert_called_with()
+        self.assertFalse(self.db.cleanup_timer.running)
+
     def test_setup_check_version_bad(self):
         d = self.startService(check_version=True)
         return self.assertFailure(d, exceptions.DatabaseNotReadyError)
@@ -89,3 +136,17 @@ class DBConnector(db.RealDatabaseMixin, unittest.TestCase):
     def test_setup_check_version_good(self):
         self.db.model.is_current = lambda: defer.succeed(True)
         return self.startService(check_version=True)
+
+    @defer.inlineCallbacks
+    def test_setup_read_db_url(self):
+        self.master.config.db['read_db_url'] = self.db_url
+        yield self.startService()
+        self.assertNotIdentical(self.db.pool.read_pool, None)
+        self.assertIdentical(self.db.pool.read_pool.engine,
+                             self.db._read_engine)
+        self.assertEqual(self.db.pool.read_lag, 1)
+
+    @defer.inlineCallbacks
+    def test_setup_no_read_db_url(self):
+        yield self.startService()
+        self.assertIdentical(self.db.pool.read_pool, None)
@@ -14,6 +14,7 @@
 # Copyright Buildbot Team Members
 
 import base64
+import struct
 import textwrap
 
 from buildbot.db import logs
@@ -23,6 +24,7 @@ from buildbot.test.util import connector_component
 from buildbot.test.util import interfaces
 from buildbot.test.util import validation
 from twisted.internet import defer
+from twisted.internet import task
 from twisted.trial import unittest
 
 
@@ -267,6 +269,34 @@ class Tests(interfaces.InterfaceTests):
             'type': u's',
         })
 
+    @defer.inlineCallbacks
+    def test_appendLog_concurrent(self):
+        yield self.insertTestData(self.backgroundData + self.testLogLines)
+        logid = yield self.db.logs.addLog(
+            stepid=102, name=u'another', slug=u'another', type=u's')
+        res = yield defer.gatherResults([
+            self.db.logs.appendLog(201, u'abc\n'),
+            self.db.logs.appendLog(logid, u'xyz\n'),
+            self.db.logs.appendLog(201, u'def\nghi\n'),
+            self.db.logs.appendLog(logid, u'XYZ\n'),
+        ])
+        self.assertEqual(res, [(7, 7), (0, 0), (8, 9), (1, 1)])
+        self.assertEqual((yield self.db.logs.getLogLines(201, 6, 9)),
+                         u"yet another line\nabc\ndef\nghi\n")
+        self.assertEqual((yield self.db.logs.getLogLines(logid, 0, 1)),
+                         u"xyz\nXYZ\n")
+        self.assertEqual((yield self.db.logs.getLog(logid))['num_lines'], 2)
+
+    @defer.inlineCallbacks
+    def test_finishLog_after_appendLog(self):
+        yield self.insertTestData(self.backgroundData + self.testLogLines)
+        # finishing must not overtake an append that is still pending
+        d = self.db.logs.appendLog(201, u'abc\n')
+        yield self.db.logs.finishLog(201)
+        self.assertEqual((yield d), (7, 7))
+        self.assertEqual((yield self.db.logs.getLogLines(201, 7, 7)),
+                         u"abc\n")
+
     @defer.inlineCallbacks
     def test_compressLog(self):
         yield self.insertTestData(self.backgroundData + self.testLogLines)
@@ -318,6 +348,78 @@ class RealTests(Tests):
             'content': 'abc\ndef\nghi\njkl',
             'compressed': 0})
 
+    @defer.inlineCallbacks
+    def test_appendLog_coalesced_db(self):
+        yield self.insertTestData(self.backgroundData + self.testLogLines)
+        yield defer.gatherResults([
+            self.db.logs.appendLog(201, u'abc\n'),
+            self.db.logs.appendLog(201, u'def\n'),
+            self.db.logs.appendLog(201, u'ghi\njkl\n'),
+        ])
+        rows = yield self.getLogChunkRows(201)
+        self.assertEqual(rows[-1], {
+            'logid': 201,
+            'first_line': 7,
+            'last_line': 10,
+            'content': 'abc\ndef\nghi\njkl',
+            'compressed': 0})
+        # the line count is now kept in memory
+        self.assertEqual(self.db.logs._numLines, {201: 11})
+
+    @defer.inlineCallbacks
+    def test_appendLog_flush_interval(self):
+        self.db.logs._reactor = clock = task.Clock()
+        self.db.master.config.db['log_flush_interval'] = 5
+        self.db.master.config.db['log_flush_size'] = 10
+        yield self.insertTestData(self.backgroundData + self.testLogLines)
+        d1 = self.db.logs.appendLog(201, u'abc\n')
+        clock.advance(4)
+        self.assertFalse(d1.called)
+        clock.advance(1)
+        self.assertEqual((yield d1), (7, 7))
+        # exceeding the size limit flushes right away
+        self.assertEqual((yield self.db.logs.appendLog(201, u'x' * 10 + '\n')),
+                         (8, 8))
+
+    @defer.inlineCallbacks
+    def test_appendLog_waiter_during_flush(self):
+        self.db.logs._reactor = clock = task.Clock()
+        self.db.master.config.db['log_flush_interval'] = 5
+        yield self.insertTestData(self.backgroundData + self.testLogLines)
+        # hold up the first flush, so the next append queues behind it
+        real_do = self.db.pool.do
+        blocked = defer.Deferred()
+
+        @defer.inlineCallbacks
+        def do(*args, **kwargs):
+            yield blocked
+            res = yield real_do(*args, **kwargs)
+            defer.returnValue(res)
+        self.patch(self.db.pool, 'do', do)
+        d1 = self.db.logs.appendLog(201, u'abc\n')
+        self.db.logs._flushAppends()
+        d2 = self.db.logs.appendLog(201, u'def\n')
+        waited = self.db.logs.flushPendingAppends()
+        self.patch(self.db.pool, 'do', real_do)
+        blocked.callback(None)
+        # the second append is written as soon as the first flush completes,
+        # without waiting for the flush interval
+        self.assertEqual((yield d1), (7, 7))
+        self.assertEqual((yield d2), (8, 8))
+        yield waited
+        self.assertFalse(clock.getDelayedCalls())
+
+    @defer.inlineCallbacks
+    def test_flushPendingAppends(self):
+        self.db.logs._reactor = task.Clock()
+        self.db.master.config.db['log_flush_interval'] = 5
+        yield self.insertTestData(self.backgroundData + self.testLogLines)
+        d = self.db.logs.appendLog(201, u'abc\n')
+        yield self.db.logs.flushPendingAppends()
+        self.assertTrue(d.called)
+        line = yield self.db.logs.getLogLines(201, 7, 7)
+        self.assertEqual(line, u'abc\n')
+
     @defer.inlineCallbacks
     def test_addLogLines_huge_lines(self):
         yield self.insertTestData(self.backgroundData + self.testLogLines)
@@ -337,8 +439,130 @@ class RealTests(Tests):
         self.assertEqual(len(chunk), 65534)
         chunk.decode('utf-8')
 
-    # TODO: test compressing with >64k
-    # TODO: test compressing compressed size >64k
+    def getLogChunkRows(self, logid):
+        def thd(conn):
+            tbl = self.db.model.logchunks
+            q = tbl.select(whereclause=tbl.c.logid == logid)
+            q = q.order_by(tbl.c.first_line)
+            return [dict(row) for row in conn.execute(q).fetchall()]
+        return self.db.pool.do(thd)
+
+    @defer.inlineCallbacks
+    def test_compressLog_raw_merges_chunks(self):
+        self.db.master.config.logCompressionMethod = 'raw'
+        yield self.insertTestData(self.backgroundData + self.testLogLines)
+        saved = yield self.db.logs.compressLog(201)
+        # the newlines joining the chunks cost three bytes
+        self.assertEqual(saved, -3)
+        rows = yield self.getLogChunkRows(201)
+        self.assertEqual([(r['first_line'], r['last_line'], r['compressed'])
+                          for r in rows], [(0, 6, 0)])
+        yield self.checkTestLogLines()
+
+    @defer.inlineCallbacks
+    def do_test_compressLog(self, method, first_compressed, compressed):
+        self.db.master.config.logCompressionMethod = method
+        yield self.insertTestData(self.backgroundData + self.testLogLines)
+        yield self.db.logs.appendLog(201, u'abc\n' * 20000)  # 80k
+        saved = yield self.db.logs.compressLog(201)
+        self.assertTrue(saved > 70000)
+        rows = yield self.getLogChunkRows(201)
+        self.assertEqual([(r['first_line'], r['last_line'], r['compressed'])
+                          for r in rows],
+                         [(0, 6, first_compressed), (7, 16390, compressed),
+                          (16391, 20006, compressed)])
+
+        # log lines should still be readable just the same
+        lines = yield self.db.logs.getLogLines(201, 4, 8)
+        self.assertEqual(lines, u'line 2**2\nanother line\n'
+                         u'yet another line\nabc\nabc\n')
+        lines = yield self.db.logs.getLogLines(201, 7, 50000)
+        self.assertEqual(lines, u'abc\n' * 20000)
+
+        # and already-compressed chunks are left alone
+        self.assertEqual((yield self.db.logs.compressLog(201)), 0)
+
+    def test_compressLog_gz(self):
+        # even the small chunks compress a little with gzip
+        return self.do_test_compressLog('gz', 1, 1)
+
+    def test_compressLog_bz2(self):
+        return self.do_test_compressLog('bz2', 0, 2)
+
+    def test_compressLog_lz4(self):
+        return self.do_test_compressLog('lz4', 3, 3)
+    if logs.lz4 is None:
+        test_compressLog_lz4.skip = "lz4 not installed"
+
+    def test_lz4_loads_old_format(self):
+        # chunks written with the lz4.dumps of older lz4 releases
+        data = 'abc\n' * 1000
+        old = (struct.pack('<I', len(data)) +
+               logs.lz4.block.compress(data, store_size=False))
+        self.assertEqual(logs._lz4_loads(old), data)
+    if logs.lz4 is None:
+        test_lz4_loads_old_format.skip = "lz4 not installed"
+
+    @defer.inlineCallbacks
+    def test_getLogLines_compressed_cached(self):
+        self.db.master.config.logCompressionMethod = 'gz'
+        yield self.insertTestData(self.backgroundData + self.testLogLines)
+        yield self.db.logs.appendLog(201, u'abc\n' * 1000)
+        yield self.db.logs.compressLog(201)
+        cache = self.db.logs.decompressedChunks
+        self.assertEqual((yield self.db.logs.getLogLines(201, 7, 7)), u'abc\n')
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        self.assertEqual((yield self.db.logs.getLogLines(201, 8, 9)),
+                         u'abc\nabc\n')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    @defer.inlineCallbacks
+    def test_pruneLogs(self):
+        yield self.insertTestData(self.backgroundData + self.testLogLines + [
+            # two finished builds, older than the running build 30
+            fakedb.Build(id=31, buildrequestid=41, number=5, masterid=88,
+                         builderid=88, buildslaveid=47, complete_at=1000),
+            fakedb.Step(id=103, buildid=31, number=1, name='one'),
+            fakedb.Log(id=202, stepid=103, name=u'old', slug=u'old',
+                       complete=1, num_lines=3),
+            fakedb.LogChunk(logid=202, first_line=0, last_line=1,
+                            content='abc\ndef'),
+            fakedb.LogChunk(logid=202, first_line=2, last_line=2,
+                            content='ghi'),
+            fakedb.Build(id=32, buildrequestid=41, number=6, masterid=88,
+                         builderid=88, buildslaveid=47, complete_at=2000),
+            fakedb.Step(id=104, buildid=32, number=1, name='one'),
+            fakedb.Log(id=203, stepid=104, name=u'new', slug=u'new',
+                       complete=1, num_lines=1),
+            fakedb.LogChunk(logid=203, first_line=0, last_line=0,
+                            content='jkl'),
+        ])
+
+        # keep the logs of the latest finished build only
+        pruned = yield self.db.logs.pruneLogs(1)
+        self.assertEqual(pruned, {'rows': {'logchunks': 2},
+                                  'bytes': {'logchunks': 10}})
+
+        # the old log remains, but with no lines
+        logdict = yield self.db.logs.getLog(202)
+        self.assertEqual(logdict['num_lines'], 0)
+        self.assertEqual((yield self.db.logs.getLogLines(202, 0, 2)), u'')
+        self.assertEqual((yield self.db.logs.getLogLines(203, 0, 0)),
+                         u'jkl\n')
+        self.assertEqual((yield self.db.logs.getLogLines(201, 5, 5)),
+                         u'another line\n')
+
+        # and pruning again finds nothing more to do
+        pruned = yield self.db.logs.pruneLogs(1)
+        self.assertEqual(pruned['rows'], {'logchunks': 0})
+
+    def test_DecompressedChunkCache(self):
+        cache = logs.DecompressedChunkCache(2)
+        cache.put(1, 'one')
+        cache.put(2, 'two')
+        cache.put(3, 'three')
+        self.assertEqual([cache.get(k) for k in (1, 2, 3)],
+                         [None, 'two', 'three'])
 
 
 class TestFakeDB(unittest.TestCase, Tests):
@@ -18,6 +18,7 @@ import sqlalchemy as sa
 import time
 
 from buildbot.db import pool
+from buildbot.process import metrics
 from buildbot.test.util import db
 from twisted.internet import defer
 from twisted.internet import reactor
@@ -97,6 +98,244 @@ class Basic(unittest.TestCase):
         return d
 
 
+class Instrumentation(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = sa.create_engine('sqlite://')
+        self.engine.optimal_thread_pool_size = 1
+        self.pool = pool.DBThreadPool(self.engine)
+        # log the statistics after every call
+        self.pool.STATS_INTERVAL = 0
+        self.histograms = []
+        self.patch(metrics.MetricHistogramEvent, 'log',
+                   staticmethod(lambda histogram, value:
+                                self.histograms.append((histogram, value))))
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    @defer.inlineCallbacks
+    def test_do_stats(self):
+        def thd(conn):
+            return [1, 2, 3]
+        res = yield self.pool.do(thd)
+        self.assertEqual(res, [1, 2, 3])
+        # the stats are named after the method that called do
+        self.assertEqual(sorted(h for h, v in self.histograms), [
+            'DBThreadPool.execute.test_db_pool.test_do_stats',
+            'DBThreadPool.queueWait.test_db_pool.test_do_stats',
+            'DBThreadPool.rows.test_db_pool.test_do_stats',
+        ])
+        rows = dict(self.histograms)[
+            'DBThreadPool.rows.test_db_pool.test_do_stats']
+        self.assertEqual((rows.count, rows.max), (1, 3))
+
+    @defer.inlineCallbacks
+    def test_do_stats_interval(self):
+        self.pool.STATS_INTERVAL = 3600
+
+        def thd(conn):
+            return [1, 2, 3]
+        yield self.pool.do(thd)
+        yield self.pool.do(thd)
+        self.assertEqual(self.histograms, [])
+
+        # the statistics are gathered until the next flush
+        self.pool.flushStats()
+        execute = dict(self.histograms)[
+            'DBThreadPool.execute.test_db_pool.test_do_stats_interval']
+        self.assertEqual(execute.count, 2)
+
+    @defer.inlineCallbacks
+    def test_do_with_engine_stats_scalar(self):
+        def thd(engine):
+            return 7
+        yield self.pool.do_with_engine(thd)
+        # a scalar result is not counted as rows
+        self.assertEqual(sorted(h for h, v in self.histograms), [
+            'DBThreadPool.execute.test_db_pool.'
+            'test_do_with_engine_stats_scalar',
+            'DBThreadPool.queueWait.test_db_pool.'
+            'test_do_with_engine_stats_scalar',
+        ])
+
+    def test_do_exception_stats(self):
+        def thd(conn):
+            raise RuntimeError("oh noes")
+        d = self.pool.do(thd)
+
+        @d.addErrback
+        def check(f):
+            f.trap(RuntimeError)
+            self.assertEqual(len(self.histograms), 2)
+        return d
+
+
+class PoolSize(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = sa.create_engine('sqlite://')
+        self.engine.optimal_thread_pool_size = 10
+
+    def makePool(self, **kwargs):
+        p = pool.DBThreadPool(self.engine, **kwargs)
+
+        @self.addCleanup
+        def cleanup():
+            # the pool starts when the reactor does, which may not have
+            # happened yet
+            if p._start_evt:
+                reactor.removeSystemEventTrigger(p._start_evt)
+            else:
+                p.shutdown()
+        return p
+
+    def test_default(self):
+        p = self.makePool()
+        self.assertEqual((p.max, p.pool_size, p.pool_max_size), (10, 10, 10))
+
+    def test_configured(self):
+        p = self.makePool(pool_size=3)
+        self.assertEqual((p.max, p.pool_size, p.pool_max_size), (3, 3, 3))
+
+    def test_limited_by_engine(self):
+        p = self.makePool(pool_size=30, pool_max_size=40)
+        self.assertEqual((p.max, p.pool_size, p.pool_max_size),
+                         (10, 10, 10))
+
+    def test_setPoolSize(self):
+        p = self.makePool(pool_size=3)
+        p.setPoolSize(4, 6)
+        self.assertEqual((p.max, p.pool_size, p.pool_max_size), (4, 4, 6))
+
+    def test_adaptive(self):
+        p = self.makePool(pool_size=2, pool_max_size=4)
+        self.assertEqual(p.max, 2)
+        now = p._lastSaturated
+
+        # grows by one thread for each long wait, up to pool_max_size
+        for i in range(3):
+            p._adapt(p.GROW_WAIT * 2, now + i)
+        self.assertEqual(p.max, 4)
+
+        # does not shrink while there have been recent long waits
+        p._adapt(0, now + 10)
+        self.assertEqual(p.max, 4)
+
+        # and then shrinks by one thread each SHRINK_AFTER seconds, down to
+        # pool_size
+        for i in range(1, 4):
+            p._adapt(0, now + 2 + i * (p.SHRINK_AFTER + 1))
+        self.assertEqual(p.max, 2)
+
+    def test_not_adaptive(self):
+        p = self.makePool(pool_size=2)
+        stats = pool._CallStats('x')
+        stats.queued -= 10
+        p._recordStats(None, stats)
+        self.assertEqual(p.max, 2)
+
+
+class ReadPool(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        metadata = sa.MetaData()
+        self.builds = sa.Table('builds', metadata,
+                               sa.Column('id', sa.Integer))
+        self.logs = sa.Table('logs', metadata, sa.Column('id', sa.Integer))
+
+        @defer.inlineCallbacks
+        def makePool(name):
+            engine = sa.create_engine('sqlite://')
+            engine.optimal_thread_pool_size = 1
+            engine.name_for_test = name
+            p = pool.DBThreadPool(engine)
+            self.addCleanup(p.shutdown)
+            yield p.do_with_engine(metadata.create_all)
+            defer.returnValue(p)
+        self.pool = yield makePool('primary')
+        self.pool.setReadPool((yield makePool('read')), read_lag=3600)
+
+    def which(self, conn):
+        return conn.engine.name_for_test
+
+    def readBuilds(self, conn):
+        conn.execute(sa.select([self.builds.c.id]))
+        return conn.engine.name_for_test
+
+    def readLogs(self, conn):
+        conn.execute(sa.select([self.logs.c.id]))
+        return conn.engine.name_for_test
+
+    def writeBuilds(self, conn):
+        conn.execute(self.builds.insert(), dict(id=1))
+
+    @defer.inlineCallbacks
+    def test_doRead(self):
+        self.assertEqual((yield self.pool.doRead(self.readBuilds)), 'read')
+
+    @defer.inlineCallbacks
+    def test_doRead_no_read_pool(self):
+        self.pool.read_pool = None
+        self.assertEqual((yield self.pool.doRead(self.readBuilds)),
+                         'primary')
+
+    @defer.inlineCallbacks
+    def test_do(self):
+        self.assertEqual((yield self.pool.do(self.which)), 'primary')
+
+    @defer.inlineCallbacks
+    def test_do_with_engine(self):
+        self.assertEqual(
+            (yield self.pool.do_with_engine(lambda e: e.name_for_test)),
+            'primary')
+
+    @defer.inlineCallbacks
+    def test_doRead_after_write(self):
+        yield self.pool.do(self.writeBuilds)
+        # reads of the table written see the write ..
+        self.assertEqual((yield self.pool.doRead(self.readBuilds)),
+                         'primary')
+        # .. while reads of other tables still use the read pool
+        self.assertEqual((yield self.pool.doRead(self.readLogs)), 'read')
+
+    @defer.inlineCallbacks
+    def test_doRead_after_read_lag(self):
+        self.pool.read_lag = 0
+        yield self.pool.do(self.writeBuilds)
+        self.assertEqual((yield self.pool.doRead(self.readBuilds)), 'read')
+
+    @defer.inlineCallbacks
+    def test_doRead_after_do_that_reads(self):
+        yield self.pool.do(self.readBuilds)
+        self.assertEqual((yield self.pool.doRead(self.readBuilds)), 'read')
+
+    @defer.inlineCallbacks
+    def test_doRead_after_textual_write(self):
+        def thd(conn):
+            conn.execute("insert into logs (id) values (1)")
+        yield self.pool.do(thd)
+        # the tables of a textual statement are unknown, so all are fenced
+        self.assertEqual((yield self.pool.doRead(self.readBuilds)),
+                         'primary')
+
+    @defer.inlineCallbacks
+    def test_textual_doRead_after_write(self):
+        def thd(conn):
+            conn.execute("select id from logs")
+            return conn.engine.name_for_test
+        yield self.pool.do(self.writeBuilds)
+        # a textual query may read any table
+        self.assertEqual((yield self.pool.doRead(thd)), 'primary')
+
+    @defer.inlineCallbacks
+    def test_doRead_error(self):
+        def fail(conn):
+            raise RuntimeError('oh noes')
+        yield self.assertFailure(self.pool.doRead(fail), RuntimeError)
+
+
 class Stress(unittest.TestCase):
 
     def setUp(self):
@@ -264,3 +264,15 @@ class StartupAndReconfig(dirs.DirsMixin, logging.LoggingMixin, unittest.TestCase
 
         self.assertRaises(config.ConfigErrors, lambda:
                           self.master.reconfigServiceWithBuildbotConfig(new))
+
+    @defer.inlineCallbacks
+    def test_reconfigService_mq_broker_changed(self):
+        old = self.master.config = config.MasterConfig()
+        old.mq.update(type='tcp', broker='tcp:host=a:port=1')
+        yield self.master.reconfigServiceWithBuildbotConfig(old)
+
+        new = config.MasterConfig()
+        new.mq.update(type='tcp', broker='tcp:host=b:port=1')
+
+        self.assertRaises(config.ConfigErrors, lambda:
+                          self.master.reconfigServiceWithBuildbotConfig(new))
@@ -16,6 +16,7 @@
 import mock
 
 from buildbot.mq import simple
+from buildbot.mq import tcp
 from buildbot.test.fake import fakemaster
 from buildbot.test.util import interfaces
 from buildbot.test.util import tuplematching
@@ -129,3 +130,12 @@ class TestSimpleMQ(unittest.TestCase, RealTests):
     def setUp(self):
         self.master = fakemaster.make_master()
         self.mq = simple.SimpleMQ(self.master)
+
+
+class TestTcpMQ(unittest.TestCase, RealTests):
+
+    # without a broker, TcpMQ must behave exactly like SimpleMQ
+
+    def setUp(self):
+        self.master = fakemaster.make_master()
+        self.mq = tcp.TcpMQ(self.master)
@@ -0,0 +1,128 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import mock
+
+from buildbot.mq import fanout
+from buildbot.mq import simple
+from buildbot.util import json
+from twisted.internet import defer
+from twisted.trial import unittest
+
+
+class MessageEncoder(unittest.TestCase):
+
+    def setUp(self):
+        self.encoder = fanout.MessageEncoder()
+        self.counts = []
+        self.patch(fanout.metrics.MetricCountEvent, 'log',
+                   staticmethod(lambda counter, count:
+                                self.counts.append((counter, count))))
+
+    def test_encode(self):
+        key, data = ('builds', '1', 'new'), dict(buildid=1, number=3)
+        self.assertEqual(json.loads(self.encoder.encode(key, data)), data)
+
+    def test_encode_once(self):
+        key, data = ('builds', '1', 'new'), dict(buildid=1)
+        with mock.patch.object(fanout.json, 'dumps',
+                               side_effect=json.dumps) as dumps:
+            with self.encoder.delivery(key, data):
+                first = self.encoder.encode(key, data)
+                for _ in range(10):
+                    self.assertIdentical(self.encoder.encode(key, data),
+                                         first)
+            self.assertEqual(dumps.call_count, 1)
+
+            # the same objects, delivered again, are encoded again
+            data['buildid'] = 2
+            with self.encoder.delivery(key, data):
+                self.assertEqual(json.loads(self.encoder.encode(key, data)),
+                                 dict(buildid=2))
+            self.assertEqual(dumps.call_count, 2)
+
+    def test_encode_outside_delivery(self):
+        key, data = ('builds', '1', 'new'), dict(buildid=1)
+        self.encoder.encode(key, data)
+        data['buildid'] = 2
+        self.assertEqual(json.loads(self.encoder.encode(key, data)),
+                         dict(buildid=2))
+        self.assertEqual(self.counts, [])
+
+    def test_other_message_during_delivery(self):
+        key, data = ('builds', '1', 'new'), dict(buildid=1)
+        other = ('builds', '2', 'new'), dict(buildid=2)
+        with self.encoder.delivery(key, data):
+            first = self.encoder.encode(key, data)
+            self.assertEqual(self.encoder.encode(*other), '{"buildid":2}')
+            self.assertEqual(self.encoder.encode(key, dict(buildid=3)),
+                             '{"buildid":3}')
+            self.assertIdentical(self.encoder.encode(key, data), first)
+        self.assertEqual(self.counts, [('MessageEncoder.deliveries', 2),
+                                       ('MessageEncoder.messages', 1)])
+
+    def test_nested_delivery(self):
+        key, data = ('builds', '1', 'new'), dict(buildid=1)
+        inner = ('builds', '2', 'new'), dict(buildid=2)
+        with self.encoder.delivery(key, data):
+            outer = self.encoder.encode(key, data)
+            with self.encoder.delivery(*inner):
+                self.assertEqual(self.encoder.encode(*inner),
+                                 '{"buildid":2}')
+                self.encoder.encode(*inner)
+            self.assertIdentical(self.encoder.encode(key, data), outer)
+        self.assertEqual(self.counts, [('MessageEncoder.deliveries', 2),
+                                       ('MessageEncoder.messages', 1),
+                                       ('MessageEncoder.deliveries', 2),
+                                       ('MessageEncoder.messages', 1)])
+
+    def test_metrics(self):
+        key, data = ('builds', '1', 'new'), dict(buildid=1)
+        with self.encoder.delivery(key, data):
+            for _ in range(3):
+                self.encoder.encode(key, data)
+            self.assertEqual(self.counts, [])
+        # flushed as soon as the delivery is done
+        self.assertEqual(self.counts, [('MessageEncoder.deliveries', 3),
+                                       ('MessageEncoder.messages', 1)])
+
+    def test_metrics_no_consumers(self):
+        with self.encoder.delivery(('builds', '1', 'new'), dict(buildid=1)):
+            pass
+        self.assertEqual(self.counts, [])
+
+
+class Delivery(unittest.TestCase):
+
+    def setUp(self):
+        self.mq = simple.SimpleMQ(mock.Mock(name='master'))
+
+    @defer.inlineCallbacks
+    def test_produce_encodes_once(self):
+        got = []
+
+        def callback(key, data):
+            got.append(fanout.encoder.encode(key, data))
+        for _ in range(3):
+            yield self.mq.startConsuming(callback, ('builds', None, None))
+        data = dict(buildid=1)
+        with mock.patch.object(fanout.json, 'dumps',
+                               side_effect=json.dumps) as dumps:
+            self.mq.produce(('builds', '1', 'new'), data)
+            self.assertEqual(dumps.call_count, 1)
+            data['buildid'] = 2
+            self.mq.produce(('builds', '1', 'new'), data)
+            self.assertEqual(dumps.call_count, 2)
+        self.assertEqual(got, ['{"buildid":1}'] * 3 + ['{"buildid":2}'] * 3)
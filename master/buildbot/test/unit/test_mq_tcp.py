@@ -0,0 +1,233 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import mock
+
+from buildbot.mq import tcp
+from buildbot.test.fake import fakemaster
+from twisted.internet import defer
+from twisted.internet import task
+from twisted.test import iosim
+from twisted.trial import unittest
+
+
+class TcpMQ(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = tcp.MQBroker()
+        self.clock = task.Clock()
+        self.pumps = {}
+
+    def makeMQ(self, connect=True):
+        mq = tcp.TcpMQ(fakemaster.make_master())
+        mq._reactor = self.clock
+        if connect:
+            self.connect(mq)
+        return mq
+
+    def connect(self, mq):
+        server = self.broker.buildProtocol(None)
+        client = tcp.ClientFactory(mq).buildProtocol(None)
+        self.pumps[mq] = iosim.connect(server, iosim.makeFakeServer(server),
+                                       client, iosim.makeFakeClient(client))
+
+    def disconnect(self, mq):
+        pump = self.pumps.pop(mq)
+        pump.client.transport.loseConnection()
+        pump.flush()
+
+    def deliver(self):
+        for _ in range(2):
+            self.clock.advance(0)
+            for pump in self.pumps.values():
+                pump.flush()
+
+    @defer.inlineCallbacks
+    def test_remote_delivery(self):
+        mq1, mq2 = self.makeMQ(), self.makeMQ()
+        cb = mock.Mock()
+        yield mq2.startConsuming(cb, ('a', None))
+        self.deliver()
+        mq1.produce(('a', 'b'), dict(x=1))
+        mq1.produce(('c', 'd'), dict(x=2))
+        self.deliver()
+        cb.assert_called_once_with(('a', 'b'), dict(x=1))
+
+    @defer.inlineCallbacks
+    def test_local_delivery_not_echoed(self):
+        mq1, mq2 = self.makeMQ(), self.makeMQ()
+        cb1, cb2 = mock.Mock(), mock.Mock()
+        yield mq1.startConsuming(cb1, ('a',))
+        yield mq2.startConsuming(cb2, ('a',))
+        self.deliver()
+        mq1.produce(('a',), dict(x=1))
+        # local consumers are invoked immediately
+        cb1.assert_called_once_with(('a',), dict(x=1))
+        self.assertFalse(cb2.called)
+        self.deliver()
+        cb1.assert_called_once_with(('a',), dict(x=1))
+        cb2.assert_called_once_with(('a',), dict(x=1))
+
+    @defer.inlineCallbacks
+    def test_publishes_batched(self):
+        mq1, mq2 = self.makeMQ(), self.makeMQ()
+        yield mq2.startConsuming(mock.Mock(), ('a',))
+        self.deliver()
+        route = mock.Mock(wraps=self.broker.route)
+        self.patch(self.broker, 'route', route)
+        for i in range(3):
+            mq1.produce(('a',), dict(i=i))
+        self.deliver()
+        self.assertEqual(route.call_count, 1)
+        self.assertEqual(len(route.call_args[0][1]), 3)
+
+    @defer.inlineCallbacks
+    def test_publishes_max_batch(self):
+        self.patch(tcp, 'MAX_BATCH', 2)
+        mq1, mq2 = self.makeMQ(), self.makeMQ()
+        cb = mock.Mock()
+        yield mq2.startConsuming(cb, ('a',))
+        self.deliver()
+        for i in range(5):
+            mq1.produce(('a',), dict(i=i))
+        # two full batches are sent without waiting for the reactor
+        self.pumps[mq1].flush()
+        self.pumps[mq2].flush()
+        self.assertEqual([c[0][1]['i'] for c in cb.call_args_list], [0, 1, 2, 3])
+        self.deliver()
+        self.assertEqual(cb.call_count, 5)
+
+    @defer.inlineCallbacks
+    def test_stopConsuming(self):
+        mq1, mq2 = self.makeMQ(), self.makeMQ()
+        cb = mock.Mock()
+        qref = yield mq2.startConsuming(cb, ('a',))
+        self.deliver()
+        qref.stopConsuming()
+        self.deliver()
+        mq1.produce(('a',), dict(x=1))
+        self.deliver()
+        self.assertFalse(cb.called)
+        self.assertEqual(self.broker.connections[1].subSeqs, {})
+
+    @defer.inlineCallbacks
+    def test_produce_while_disconnected(self):
+        mq1, mq2 = self.makeMQ(connect=False), self.makeMQ()
+        cb = mock.Mock()
+        yield mq2.startConsuming(cb, ('a',))
+        mq1.produce(('a',), dict(x=1))
+        self.deliver()
+        self.assertFalse(cb.called)
+        self.connect(mq1)
+        self.deliver()
+        cb.assert_called_once_with(('a',), dict(x=1))
+
+    @defer.inlineCallbacks
+    def test_produce_while_disconnected_limit(self):
+        self.patch(tcp, 'MAX_BACKLOG', 2)
+        mq1, mq2 = self.makeMQ(connect=False), self.makeMQ()
+        cb = mock.Mock()
+        yield mq2.startConsuming(cb, ('a',))
+        for i in range(4):
+            mq1.produce(('a',), dict(i=i))
+        self.deliver()
+        self.assertEqual(mq1._dropped, 2)
+        self.connect(mq1)
+        self.deliver()
+        self.assertEqual(cb.call_args_list,
+                         [mock.call(('a',), dict(i=0)),
+                          mock.call(('a',), dict(i=1))])
+        self.assertEqual(mq1._dropped, 0)
+
+    @defer.inlineCallbacks
+    def test_subscriptions_resent_on_reconnect(self):
+        mq1, mq2 = self.makeMQ(), self.makeMQ()
+        cb = mock.Mock()
+        yield mq2.startConsuming(cb, ('a',))
+        self.deliver()
+        self.disconnect(mq2)
+        self.connect(mq2)
+        mq1.produce(('a',), dict(x=1))
+        self.deliver()
+        cb.assert_called_once_with(('a',), dict(x=1))
+
+    @defer.inlineCallbacks
+    def test_persistent_delivered_once(self):
+        mq1, mq2, mq3 = self.makeMQ(), self.makeMQ(), self.makeMQ()
+        cb1, cb2 = mock.Mock(), mock.Mock()
+        yield mq1.startConsuming(cb1, ('a',), persistent_name='P')
+        yield mq2.startConsuming(cb2, ('a',), persistent_name='P')
+        self.deliver()
+        mq3.produce(('a',), dict(x=1))
+        self.deliver()
+        self.assertEqual(cb1.call_args_list + cb2.call_args_list,
+                         [mock.call(('a',), dict(x=1))])
+
+    @defer.inlineCallbacks
+    def test_persistent_backlog_at_broker(self):
+        mq1, mq2 = self.makeMQ(), self.makeMQ()
+        cb = mock.Mock()
+        yield mq2.startConsuming(cb, ('a',), persistent_name='P')
+        self.deliver()
+        self.disconnect(mq2)
+        mq1.produce(('a',), dict(x=1))
+        mq1.produce(('a',), dict(x=2))
+        self.deliver()
+        self.assertFalse(cb.called)
+        self.connect(mq2)
+        self.deliver()
+        self.assertEqual(cb.call_args_list,
+                         [mock.call(('a',), dict(x=1)),
+                          mock.call(('a',), dict(x=2))])
+
+    @defer.inlineCallbacks
+    def test_persistent_backlog_limit(self):
+        self.patch(tcp, 'MAX_BACKLOG', 2)
+        mq1, mq2 = self.makeMQ(), self.makeMQ()
+        cb = mock.Mock()
+        yield mq2.startConsuming(cb, ('a',), persistent_name='P')
+        self.deliver()
+        self.disconnect(mq2)
+        for i in range(4):
+            mq1.produce(('a',), dict(i=i))
+        self.deliver()
+        self.assertEqual(self.broker.persistent['P'].dropped, 2)
+        self.connect(mq2)
+        self.deliver()
+        self.assertEqual(cb.call_args_list,
+                         [mock.call(('a',), dict(i=0)),
+                          mock.call(('a',), dict(i=1))])
+        self.assertEqual(self.broker.persistent['P'].dropped, 0)
+
+    @defer.inlineCallbacks
+    def test_persistent_stopped_locally(self):
+        mq1, mq2 = self.makeMQ(), self.makeMQ()
+        cb = mock.Mock()
+        qref = yield mq2.startConsuming(cb, ('a',), persistent_name='P')
+        self.deliver()
+        qref.stopConsuming()
+        mq1.produce(('a',), dict(x=1))
+        self.deliver()
+        self.assertFalse(cb.called)
+        yield mq2.startConsuming(cb, ('a',), persistent_name='P')
+        cb.assert_called_once_with(('a',), dict(x=1))
+
+    def test_invalid_frame(self):
+        mq1 = self.makeMQ()
+        pump = self.pumps[mq1]
+        pump.client.sendString('{"not a list"')
+        pump.flush()
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual(self.broker.connections, [])
@@ -181,6 +181,23 @@ class TestBotMaster(unittest.TestCase):
         self.botmaster.getBuildersForSlave.assert_called_once_with('centos')
         brd.maybeStartBuildsOn.assert_called_once_with(['frank', 'larry'])
 
+    @defer.inlineCallbacks
+    def test_buildRequestAdded(self):
+        brd = self.botmaster.brd = mock.Mock()
+        bldr = mock.Mock()
+        bldr.name = 'frank'
+        bldr.getBuilderId.return_value = defer.succeed(13)
+        self.botmaster.builders = {'frank': bldr}
+
+        # the message validator still expects the old buildrequest messages
+        self.master.mq.verifyMessages = False
+        yield self.master.mq.callConsumer(
+            ('buildrequests', '10', 'new'), dict(builderid=13))
+
+        # the index of unclaimed requests has seen the message as well
+        brd.maybeStartBuildsOn.assert_called_once_with(['frank'],
+                                                       refresh=False)
+
     def test_maybeStartBuildsForAll(self):
         brd = self.botmaster.brd = mock.Mock()
         self.botmaster.builderNames = ['frank', 'larry']
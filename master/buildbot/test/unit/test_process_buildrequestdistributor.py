@@ -15,14 +15,18 @@
 
 import mock
 
+from buildbot import locks
 from buildbot.db import buildrequests
+from buildbot.process import builder
 from buildbot.process import buildrequestdistributor
+from buildbot.process.buildrequest import BuildRequest
 from buildbot.test.fake import fakedb
 from buildbot.test.fake import fakemaster
 from buildbot.util import epoch2datetime
 from buildbot.util.eventual import fireEventually
 from twisted.internet import defer
 from twisted.internet import reactor
+from twisted.internet import task
 from twisted.python import failure
 from twisted.trial import unittest
 
@@ -132,6 +136,8 @@ class TestBRDBase(unittest.TestCase):
         bldr.getBuilderId = lambda: (builderid)
         bldr.config.nextSlave = None
         bldr.config.nextBuild = None
+        bldr.config.slavenames = []
+        bldr.config.locks = []
 
         def canStartBuild(*args):
             can = bldr.config.canStartBuild
@@ -158,8 +164,9 @@ class Test(TestBRDBase):
         # check that the BRD didnt end with a stuck lock or in the 'active' state (which would mean
         # it ended without unwinding correctly)
         self.assertEqual(self.brd.pending_builders_lock.locked, False)
-        self.assertEqual(self.brd.activity_lock.locked, False)
         self.assertEqual(self.brd.active, False)
+        self.assertEqual(self.brd._activityWorkers, 0)
+        self.assertEqual(self.brd._activeBuilders, {})
 
     def useMock_maybeStartBuildsOnBuilder(self):
         # sets up a mock "maybeStartBuildsOnBuilder" so we can track
@@ -238,6 +245,34 @@ class Test(TestBRDBase):
         self.quiet_deferred.addCallback(check)
         return self.quiet_deferred
 
+    @defer.inlineCallbacks
+    def test_maybeStartBuildsOn_worker_exception(self):
+        self.useMock_maybeStartBuildsOnBuilder()
+        yield self.addBuilders(['bldr1', 'bldr2'])
+        popPendingBuilder = self.brd._popPendingBuilder
+        calls = []
+
+        def _popPendingBuilder():
+            calls.append(None)
+            if len(calls) == 1:
+                raise RuntimeError('oh noes')
+            return popPendingBuilder()
+        self.brd._popPendingBuilder = _popPendingBuilder
+
+        self.brd.maybeStartBuildsOn(['bldr1'])
+        yield self.quiet_deferred
+        self.assertEqual(1, len(self.flushLoggedErrors(RuntimeError)))
+        self.checkAllCleanedUp()
+
+        # and the loop still starts builds afterwards, including for the
+        # builder that was left pending
+        self.quiet_deferred = defer.Deferred()
+        self.brd.maybeStartBuildsOn(['bldr2'])
+        yield self.quiet_deferred
+        self.assertEqual(self.maybeStartBuildsOnBuilder_calls,
+                         ['bldr1', 'bldr2'])
+        self.checkAllCleanedUp()
+
     def test_maybeStartBuildsOn_collapsing(self):
         self.useMock_maybeStartBuildsOnBuilder()
         self.addBuilders(['bldr1', 'bldr2', 'bldr3'])
@@ -271,47 +306,202 @@ class Test(TestBRDBase):
         self.quiet_deferred.addCallback(check)
         return self.quiet_deferred
 
+    def useControlled_maybeStartBuildsOnBuilder(self):
+        # sets up a mock "maybeStartBuildsOnBuilder" that does not finish
+        # until the test calls finishBuilder
+        self.maybeStartBuildsOnBuilder_calls = []
+        self.running_builders = {}
+
+        def maybeStartBuildsOnBuilder(bldr):
+            self.assertNotIn(bldr.name, self.running_builders)
+            self.maybeStartBuildsOnBuilder_calls.append(bldr.name)
+            d = self.running_builders[bldr.name] = defer.Deferred()
+            return d
+        self.brd._maybeStartBuildsOnBuilder = maybeStartBuildsOnBuilder
+
+    def finishBuilder(self, name):
+        self.running_builders.pop(name).callback(None)
+
+    @defer.inlineCallbacks
+    def test_maybeStartBuildsOn_concurrent(self):
+        self.master.config.buildStartConcurrency = 2
+        self.useControlled_maybeStartBuildsOnBuilder()
+        yield self.addBuilders(['bldr1', 'bldr2', 'bldr3'])
+        self.brd.maybeStartBuildsOn(['bldr1', 'bldr2', 'bldr3'])
+
+        # only two builders are worked on at a time
+        self.assertEqual(sorted(self.running_builders), ['bldr1', 'bldr2'])
+        self.finishBuilder('bldr2')
+        self.assertEqual(sorted(self.running_builders), ['bldr1', 'bldr3'])
+        self.finishBuilder('bldr1')
+        self.finishBuilder('bldr3')
+
+        yield self.quiet_deferred
+        self.checkAllCleanedUp()
+
+    @defer.inlineCallbacks
+    def test_maybeStartBuildsOn_concurrent_conflicts(self):
+        self.master.config.buildStartConcurrency = 4
+        self.useControlled_maybeStartBuildsOnBuilder()
+        yield self.addBuilders(['bldr1', 'bldr2', 'bldr3', 'bldr4'])
+        lock = locks.MasterLock('lock')
+        self.builders['bldr1'].config.slavenames = ['slave1']
+        self.builders['bldr2'].config.slavenames = ['slave2', 'slave1']
+        self.builders['bldr3'].config.locks = [lock.access('counting')]
+        self.builders['bldr4'].config.locks = [lock]
+        self.brd.maybeStartBuildsOn(['bldr1', 'bldr2', 'bldr3', 'bldr4'])
+
+        # bldr2 shares a slave with bldr1, and bldr4 a lock with bldr3
+        self.assertEqual(sorted(self.running_builders), ['bldr1', 'bldr3'])
+        self.finishBuilder('bldr3')
+        self.assertEqual(sorted(self.running_builders), ['bldr1', 'bldr4'])
+        self.finishBuilder('bldr1')
+        self.assertEqual(sorted(self.running_builders), ['bldr2', 'bldr4'])
+        self.finishBuilder('bldr2')
+        self.finishBuilder('bldr4')
+
+        yield self.quiet_deferred
+        self.checkAllCleanedUp()
+
+    @defer.inlineCallbacks
+    def test_maybeStartBuildsOn_concurrent_same_builder(self):
+        self.master.config.buildStartConcurrency = 2
+        self.useControlled_maybeStartBuildsOnBuilder()
+        yield self.addBuilders(['bldr1'])
+        self.brd.maybeStartBuildsOn(['bldr1'])
+        self.brd.maybeStartBuildsOn(['bldr1'])
+
+        # the second invocation waits for the first to finish
+        self.assertEqual(self.maybeStartBuildsOnBuilder_calls, ['bldr1'])
+        self.finishBuilder('bldr1')
+        self.assertEqual(self.maybeStartBuildsOnBuilder_calls,
+                         ['bldr1', 'bldr1'])
+        self.finishBuilder('bldr1')
+
+        yield self.quiet_deferred
+        self.checkAllCleanedUp()
+
+    @defer.inlineCallbacks
+    def test_maybeStartBuildsOn_queueWait_metrics(self):
+        clock = task.Clock()
+        self.brd._reactor = clock
+        logged = []
+        self.patch(buildrequestdistributor.metrics.MetricTimeEvent, 'log',
+                   staticmethod(lambda timer, elapsed:
+                                logged.append((timer, elapsed))))
+        self.useControlled_maybeStartBuildsOnBuilder()
+        yield self.addBuilders(['bldr1', 'bldr2'])
+        self.brd.maybeStartBuildsOn(['bldr1', 'bldr2'])
+        clock.advance(5)
+        self.finishBuilder('bldr1')
+        self.finishBuilder('bldr2')
+
+        yield self.quiet_deferred
+        logged = [(timer, elapsed) for timer, elapsed in logged
+                  if 'queueWait' in timer]
+        self.assertEqual(logged, [
+            ('BuildRequestDistributor.queueWait.bldr1', 0),
+            ('BuildRequestDistributor.queueWait.bldr2', 5),
+        ])
+
+    @defer.inlineCallbacks
+    def test_stopService_waits_for_workers(self):
+        self.master.config.buildStartConcurrency = 2
+        self.useControlled_maybeStartBuildsOnBuilder()
+        yield self.addBuilders(['bldr1', 'bldr2', 'bldr3'])
+        self.brd.maybeStartBuildsOn(['bldr1', 'bldr2', 'bldr3'])
+
+        d = self.brd.stopService()
+        self.assertFalse(d.called)
+        self.finishBuilder('bldr1')
+        self.assertFalse(d.called)
+        self.finishBuilder('bldr2')
+        yield d
+
+        # bldr3 was never worked on, since the service stopped first
+        self.assertEqual(sorted(self.maybeStartBuildsOnBuilder_calls),
+                         ['bldr1', 'bldr2'])
+        self.checkAllCleanedUp()
+
+    @defer.inlineCallbacks
     def do_test_sortBuilders(self, prioritizeBuilders, oldestRequestTimes,
-                             expected, returnDeferred=False):
+                             expected):
         self.useMock_maybeStartBuildsOnBuilder()
-        self.addBuilders(oldestRequestTimes.keys())
+        yield self.addBuilders(oldestRequestTimes.keys())
         self.master.config.prioritizeBuilders = prioritizeBuilders
 
-        def mklambda(t):  # work around variable-binding issues
-            if returnDeferred:
-                return lambda: defer.succeed(t)
-            else:
-                return lambda: t
-
+        rows = self.base_rows[:]
         for n, t in oldestRequestTimes.iteritems():
-            if t is not None:
-                t = epoch2datetime(t)
-            self.builders[n].getOldestRequestTime = mklambda(t)
+            if t is None:
+                continue
+            builderid = self.builders[n].getBuilderId()
+            rows.extend([
+                fakedb.BuildRequest(buildsetid=11, builderid=builderid,
+                                    submitted_at=t),
+                fakedb.BuildRequest(buildsetid=11, builderid=builderid,
+                                    submitted_at=t + 10),
+                # older, but claimed or complete, so not considered
+                fakedb.BuildRequest(id=1000 + t, buildsetid=11,
+                                    builderid=builderid, submitted_at=t - 500),
+                fakedb.BuildRequestClaim(brid=1000 + t, masterid=1,
+                                         claimed_at=t),
+                fakedb.BuildRequest(buildsetid=11, builderid=builderid,
+                                    submitted_at=t - 600, complete=1),
+            ])
+        yield self.master.db.insertTestData(rows)
 
-        d = self.brd._sortBuilders(oldestRequestTimes.keys())
+        result = yield self.brd._sortBuilders(oldestRequestTimes.keys())
+        self.assertEqual(result, expected)
+        self.checkAllCleanedUp()
 
-        def check(result):
-            self.assertEqual(result, expected)
-            self.checkAllCleanedUp()
-        d.addCallback(check)
-        return d
-
-    def test_sortBuilders_default_sync(self):
+    def test_sortBuilders_default(self):
         return self.do_test_sortBuilders(None,  # use the default sort
                                          dict(bldr1=777, bldr2=999, bldr3=888),
                                          ['bldr1', 'bldr3', 'bldr2'])
 
-    def test_sortBuilders_default_asyn(self):
-        return self.do_test_sortBuilders(None,  # use the default sort
-                                         dict(bldr1=777, bldr2=999, bldr3=888),
-                                         ['bldr1', 'bldr3', 'bldr2'],
-                                         returnDeferred=True)
-
     def test_sortBuilders_default_None(self):
         return self.do_test_sortBuilders(None,  # use the default sort
                                          dict(bldr1=777, bldr2=None, bldr3=888),
                                          ['bldr1', 'bldr3', 'bldr2'])
 
+    @defer.inlineCallbacks
+    def test_sortBuilders_default_single_query(self):
+        getOldest = mock.Mock(return_value=defer.succeed({}))
+        self.patch(self.master.db.buildrequests,
+                   'getOldestUnclaimedRequestTimes', getOldest)
+        yield self.do_test_sortBuilders(None,
+                                        dict(bldr1=None, bldr2=None),
+                                        ['bldr1', 'bldr2'])
+        getOldest.assert_called_once_with()
+
+    @defer.inlineCallbacks
+    def test_sortBuilders_default_overridden(self):
+        class CustomBuilder(builder.Builder):
+
+            def __init__(self, name, oldest):
+                self.name = name
+                self.oldest = oldest
+
+            def getBuilderId(self):
+                return 1000
+
+            def getOldestRequestTime(self):
+                return defer.succeed(self.oldest)
+        yield self.addBuilders(['bldr1'])
+        yield self.master.db.insertTestData(self.base_rows + [
+            fakedb.BuildRequest(buildsetid=11, builderid=77,
+                                submitted_at=800),
+        ])
+        self.builders['bldr1'].getBuilderId = lambda: 77
+        custom = [CustomBuilder('custom1', epoch2datetime(700)),
+                  CustomBuilder('custom2', None),
+                  CustomBuilder('custom3', epoch2datetime(900))]
+
+        result = yield self.brd._defaultSorter(
+            self.master, [self.builders['bldr1']] + custom)
+        self.assertEqual([b.name for b in result],
+                         ['custom1', 'bldr1', 'custom3', 'custom2'])
+
     def test_sortBuilders_custom(self):
         def prioritizeBuilders(master, builders):
             self.assertIdentical(master, self.master)
@@ -782,6 +972,92 @@ class TestMaybeStartBuilds(TestBRDBase):
         yield self.do_test_maybeStartBuildsOnBuilder(rows=rows,
                                                      exp_claims=[11], exp_builds=[('test-slave1', [11])])
 
+    @defer.inlineCallbacks
+    def test_claim_queries(self):
+        # a chooser that returns several collapsed requests at once
+        self.addSlaves({'test-slave1': 1})
+        rows = self.base_rows + [
+            fakedb.BuildRequest(id=id, buildsetid=11, builderid=77)
+            for id in (10, 11, 12)]
+        yield self.master.db.insertTestData(rows)
+        brdicts = yield self.master.db.buildrequests.getBuildRequests()
+        breqs = yield defer.gatherResults([
+            BuildRequest.fromBrdict(self.master, brdict)
+            for brdict in brdicts])
+        bc = mock.Mock(name='buildChooser')
+        bc.chooseNextBuild.side_effect = [
+            defer.succeed((self.bldr.slaves[0], breqs)),
+            defer.succeed((None, None))]
+        self.brd.createBuildChooser = lambda bldr, master: bc
+
+        db = self.master.db.buildrequests
+        for meth in 'getBuildRequest', 'getBuildRequests':
+            self.patch(db, meth, mock.Mock(wraps=getattr(db, meth)))
+        yield self.brd._maybeStartBuildsOnBuilder(self.bldr)
+
+        self.assertMyClaims([10, 11, 12])
+        # the claimed messages are produced without any further queries
+        self.assertFalse(db.getBuildRequest.called)
+        self.assertFalse(db.getBuildRequests.called)
+        self.assertEqual(
+            sorted(key for key, msg in self.master.mq.productions),
+            [('buildsets', '11', 'builders', '-1', 'buildrequests', str(id),
+              'claimed') for id in (10, 11, 12)])
+
+    @defer.inlineCallbacks
+    def test_unclaimed_requests_indexed(self):
+        self.addSlaves({'test-slave1': 1})
+        rows = self.base_rows + [
+            fakedb.BuildRequest(id=10, buildsetid=11, builderid=77,
+                                submitted_at=130000),
+            fakedb.BuildRequest(id=11, buildsetid=11, builderid=77,
+                                submitted_at=135000),
+        ]
+        yield self.do_test_maybeStartBuildsOnBuilder(
+            rows=rows, exp_claims=[10], exp_builds=[('test-slave1', [10])])
+
+        # the second pass gets the unclaimed requests from the index, without
+        # querying the data API again
+        dataGet = mock.Mock(wraps=self.master.data.get)
+        self.patch(self.master.data, 'get', dataGet)
+        self.startedBuilds = []
+        yield self.brd._maybeStartBuildsOnBuilder(self.bldr)
+        self.assertMyClaims([10, 11])
+        self.assertBuildsStarted([('test-slave1', [11])])
+        self.assertNotIn(mock.call(('builders', 77, 'buildrequests'),
+                                   mock.ANY),
+                         dataGet.call_args_list)
+
+    @defer.inlineCallbacks
+    def test_unclaimed_requests_refreshed(self):
+        self.addSlaves({'test-slave1': 1})
+        rows = self.base_rows + [
+            fakedb.BuildRequest(id=10, buildsetid=11, builderid=77,
+                                submitted_at=130000),
+        ]
+        yield self.do_test_maybeStartBuildsOnBuilder(
+            rows=rows, exp_claims=[10], exp_builds=[('test-slave1', [10])])
+
+        # another master adds a request, which this master's MQ does not
+        # announce
+        yield self.master.db.insertTestData([
+            fakedb.BuildRequest(id=11, buildsetid=11, builderid=77,
+                                submitted_at=135000),
+        ])
+        self.startedBuilds = []
+
+        # a buildrequest message does not re-read the database ..
+        self.brd.maybeStartBuildsOn(['A'], refresh=False)
+        yield self.quiet_deferred
+        self.assertBuildsStarted([])
+
+        # .. but anything else, such as a slave attaching, does
+        self.quiet_deferred = defer.Deferred()
+        self.brd.maybeStartBuildsOn(['A'])
+        yield self.quiet_deferred
+        self.assertMyClaims([10, 11])
+        self.assertBuildsStarted([('test-slave1', [11])])
+
     # nextSlave
     @defer.inlineCallbacks
     def do_test_nextSlave(self, nextSlave, exp_choice=None):
@@ -879,3 +1155,131 @@ class TestMaybeStartBuilds(TestBRDBase):
         result = self.do_test_nextBuild(nextBuild)
         self.assertEqual(1, len(self.flushLoggedErrors(RuntimeError)))
         return result
+
+
+class TestUnclaimedBuildRequests(unittest.TestCase):
+
+    def setUp(self):
+        self.master = fakemaster.make_master(testcase=self, wantData=True)
+        # the message validator still expects the old buildrequest messages
+        self.master.mq.verifyMessages = False
+        self.clock = task.Clock()
+        self.index = buildrequestdistributor.UnclaimedBuildRequests(
+            self.master)
+        self.index._reactor = self.clock
+        self.index.start()
+        self.addCleanup(self.index.stop)
+        self.dataGet = mock.Mock(wraps=self.master.data.get)
+        self.patch(self.master.data, 'get', self.dataGet)
+        return self.master.db.insertTestData([
+            fakedb.SourceStamp(id=21),
+            fakedb.Builder(id=77, name='A'),
+            fakedb.Builder(id=78, name='B'),
+            fakedb.Buildset(id=11, reason='because'),
+            fakedb.BuildsetSourceStamp(sourcestampid=21, buildsetid=11),
+            fakedb.BuildRequest(id=10, buildsetid=11, builderid=77,
+                                submitted_at=130000),
+            fakedb.BuildRequest(id=11, buildsetid=11, builderid=77,
+                                submitted_at=120000),
+            fakedb.BuildRequest(id=12, buildsetid=11, builderid=78,
+                                submitted_at=110000),
+        ])
+
+    def send(self, brid, event, builderid=77, submitted_at=140000,
+             claimed=False, complete=False):
+        msg = dict(buildrequestid=brid, buildsetid=11, builderid=builderid,
+                   priority=0, claimed=claimed,
+                   claimed_at=epoch2datetime(150000) if claimed else None,
+                   claimed_by_masterid=1 if claimed else None,
+                   complete=complete, results=0 if complete else -1,
+                   submitted_at=epoch2datetime(submitted_at),
+                   complete_at=epoch2datetime(160000) if complete else None,
+                   waited_for=False)
+        self.master.mq.callConsumer(('buildrequests', str(brid), event), msg)
+
+    @defer.inlineCallbacks
+    def assertUnclaimed(self, builderid, exp):
+        brdicts = yield self.index.getUnclaimedBrdicts(builderid)
+        self.assertEqual([brd['buildrequestid'] for brd in brdicts], exp)
+
+    @defer.inlineCallbacks
+    def test_loaded_once(self):
+        yield self.assertUnclaimed(77, [11, 10])
+        yield self.assertUnclaimed(77, [11, 10])
+        yield self.assertUnclaimed(78, [12])
+        self.assertEqual(self.dataGet.call_count, 2)
+
+    @defer.inlineCallbacks
+    def test_messages(self):
+        yield self.assertUnclaimed(77, [11, 10])
+        self.send(13, 'new', submitted_at=125000)
+        yield self.assertUnclaimed(77, [11, 13, 10])
+        self.send(11, 'claimed', submitted_at=120000, claimed=True)
+        yield self.assertUnclaimed(77, [13, 10])
+        self.send(11, 'unclaimed', submitted_at=120000)
+        yield self.assertUnclaimed(77, [11, 13, 10])
+        self.send(10, 'complete', submitted_at=130000, complete=True)
+        yield self.assertUnclaimed(77, [11, 13])
+        self.assertEqual(self.dataGet.call_count, 1)
+
+    @defer.inlineCallbacks
+    def test_messages_for_unloaded_builder(self):
+        self.send(14, 'new', builderid=78)
+        yield self.assertUnclaimed(78, [12])
+
+    @defer.inlineCallbacks
+    def test_messages_while_loading(self):
+        loaded = defer.Deferred()
+        self.dataGet.side_effect = lambda *args: loaded
+        d1 = self.index.getUnclaimedBrdicts(77)
+        d2 = self.index.getUnclaimedBrdicts(77)
+        self.send(13, 'new', submitted_at=125000)
+        self.send(11, 'claimed', submitted_at=120000, claimed=True)
+        # the load started before the claim, so it still sees 11
+        loaded.callback([dict(buildrequestid=10, builderid=77,
+                              submitted_at=epoch2datetime(130000)),
+                         dict(buildrequestid=11, builderid=77,
+                              submitted_at=epoch2datetime(120000))])
+        for d in d1, d2:
+            brdicts = yield d
+            self.assertEqual([brd['buildrequestid'] for brd in brdicts],
+                             [13, 10])
+        self.assertEqual(self.dataGet.call_count, 1)
+
+    @defer.inlineCallbacks
+    def test_load_fails(self):
+        self.dataGet.side_effect = lambda *args: defer.fail(RuntimeError())
+        yield self.assertFailure(self.index.getUnclaimedBrdicts(77),
+                                 RuntimeError)
+        # and the next call tries again
+        self.dataGet.side_effect = None
+        yield self.assertUnclaimed(77, [11, 10])
+
+    @defer.inlineCallbacks
+    def test_removeBuildRequests(self):
+        yield self.assertUnclaimed(77, [11, 10])
+        self.index.removeBuildRequests(77, [11])
+        yield self.assertUnclaimed(77, [10])
+        # not loaded yet, so nothing to do
+        self.index.removeBuildRequests(78, [12])
+        yield self.assertUnclaimed(78, [12])
+
+    @defer.inlineCallbacks
+    def test_invalidate(self):
+        yield self.assertUnclaimed(77, [11, 10])
+        yield self.master.db.insertTestData([
+            fakedb.BuildRequest(id=13, buildsetid=11, builderid=77,
+                                submitted_at=100000),
+        ])
+        yield self.assertUnclaimed(77, [11, 10])
+        self.index.invalidate(77)
+        yield self.assertUnclaimed(77, [13, 11, 10])
+
+    @defer.inlineCallbacks
+    def test_reconcile(self):
+        yield self.assertUnclaimed(77, [11, 10])
+        yield self.assertUnclaimed(78, [12])
+        self.clock.advance(self.index.reconcileInterval)
+        yield self.assertUnclaimed(77, [11, 10])
+        yield self.assertUnclaimed(78, [12])
+        self.assertEqual(self.dataGet.call_count, 4)
@@ -76,6 +76,58 @@ class Tests(unittest.TestCase):
             'name': u'testlog',
         })
 
+    @defer.inlineCallbacks
+    def test_updates_coalesced(self):
+        l = yield self.makeLog('t')
+        appendLog = self.master.data.updates.appendLog
+        firstAppend = defer.Deferred()
+        calls = []
+
+        def slowAppendLog(logid, content):
+            calls.append(content)
+            if len(calls) == 1:
+                firstAppend.addCallback(lambda _: appendLog(logid, content))
+                return firstAppend
+            return appendLog(logid, content)
+        self.patch(self.master.data.updates, 'appendLog', slowAppendLog)
+
+        l.addContent(u'one\n')
+        l.addContent(u'two\n')
+        l.addContent(u'three\n')
+        self.assertEqual(calls, [u'one\n'])
+        d = l.finish()
+        firstAppend.callback(None)
+        yield d
+
+        # lines that arrived during the first append were sent at once
+        self.assertEqual(calls, [u'one\n', u'two\nthree\n'])
+        self.assertEqual(self.master.data.updates.logs[l.logid]['content'],
+                         [u'one\n', u'two\nthree\n'])
+        self.assertTrue(self.master.data.updates.logs[l.logid]['finished'])
+
+    @defer.inlineCallbacks
+    def test_updates_coalesced_failure(self):
+        l = yield self.makeLog('t')
+        firstAppend = defer.Deferred()
+        calls = []
+
+        def failingAppendLog(logid, content):
+            calls.append(content)
+            if len(calls) == 1:
+                return firstAppend
+            return defer.fail(RuntimeError('oh noes'))
+        self.patch(self.master.data.updates, 'appendLog', failingAppendLog)
+
+        d1 = l.addRawLines(u'one\n')
+        d2 = l.addRawLines(u'two\n')
+        d3 = l.addRawLines(u'three\n')
+        firstAppend.callback(None)
+        yield d1
+        # both callers whose lines were coalesced see the failure
+        yield self.assertFailure(d2, RuntimeError)
+        yield self.assertFailure(d3, RuntimeError)
+        self.assertEqual(calls, [u'one\n', u'two\nthree\n'])
+
     @defer.inlineCallbacks
     def test_updates_different_encoding(self):
         l = yield self.makeLog('t', logEncoding='latin-1')
@@ -132,6 +132,46 @@ class TestMetricTimeEvent(TestMetricBase):
         self.assertEquals(report['timers']['foo_time'], sum(data) / float(len(data)))
 
 
+class TestMetricHistogramEvent(TestMetricBase):
+
+    def testManualEvent(self):
+        metrics.MetricHistogramEvent.log('foo_rows', 3)
+        report = self.observer.asDict()
+        self.assertEquals(report['histograms']['foo_rows'],
+                          dict(count=1, mean=3, max=3, p50=3, p90=3, p99=3))
+
+    def testPercentiles(self):
+        for i in range(1, 101):
+            metrics.MetricHistogramEvent.log('foo_rows', i)
+        report = self.observer.asDict()['histograms']['foo_rows']
+        self.assertEquals(report['count'], 100)
+        self.assertEquals(report['mean'], 50.5)
+        self.assertEquals(report['max'], 100)
+        # percentiles are the upper bounds of power-of-two buckets
+        self.assertEquals(report['p50'], 64)
+        self.assertEquals(report['p90'], 100)
+        self.assertEquals(report['p99'], 100)
+
+    def testMergeHistogram(self):
+        h = metrics.Histogram()
+        for value in (1, 2, 3):
+            h.add(value)
+        metrics.MetricHistogramEvent.log('foo_rows', 8)
+        metrics.MetricHistogramEvent.log('foo_rows', h)
+        report = self.observer.asDict()
+        self.assertEquals(report['histograms']['foo_rows'],
+                          dict(count=4, mean=3.5, max=8, p50=2, p90=8, p99=8))
+
+    def testSmallValues(self):
+        for value in (0, 0, 0.0003, 0.002):
+            metrics.MetricHistogramEvent.log('foo_time', value)
+        h = self.observer.getHandler(metrics.MetricHistogramEvent)
+        h = h.get('foo_time')
+        self.assertEquals(h.percentile(50), 0)
+        self.assertEquals(h.percentile(75), 2 ** -11)
+        self.assertEquals(h.percentile(100), 0.002)
+
+
 class TestPeriodicChecks(TestMetricBase):
 
     def testPeriodicCheck(self):
@@ -241,6 +281,16 @@ class TestReports(unittest.TestCase):
         self.assertEquals("Timer time_foo: 1", handler.report())
         self.assertEquals({"timers": {"time_foo": 1}}, handler.asDict())
 
+    def testMetricHistogramReport(self):
+        handler = metrics.MetricHistogramHandler(None)
+        handler.handle({}, metrics.MetricHistogramEvent('rows_foo', 4))
+
+        self.assertEquals("Histogram rows_foo: count 1, mean 4, p50 4, "
+                          "p90 4, p99 4, max 4", handler.report())
+        self.assertEquals({"histograms": {"rows_foo": dict(
+            count=1, mean=4, max=4, p50=4, p90=4, p99=4)}},
+            handler.asDict())
+
     def testMetricAlarmReport(self):
         handler = metrics.MetricAlarmHandler(None)
         handler.handle({}, metrics.MetricAlarmEvent('alarm_foo', msg='Uh oh', level=metrics.ALARM_WARN))
@@ -13,6 +13,9 @@
 #
 # Copyright Buildbot Team Members
 
+import mock
+import zlib
+
 from buildbot.process import remotecommand
 from buildbot.test.fake import logfile
 from buildbot.test.fake import remotecommand as fakeremotecommand
@@ -148,6 +151,34 @@ class TestRunCommand(unittest.TestCase, Tests):
         cmd.addHeader('some header')
         self.failUnlessEqual(log.header, 'some header')
 
+    def test_remote_update_zlib(self):
+        cmd = self.makeRemoteCommand()
+        cmd.buildslave = mock.Mock()
+        cmd.active = True
+        stdio = logfile.FakeLogFile('stdio', 'dummy')
+        log1 = logfile.FakeLogFile('log1', 'dummy')
+        cmd.useLog(stdio)
+        cmd.useLog(log1)
+        compressor = zlib.compressobj()
+
+        def compress(data):
+            return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        cmd.remote_update([
+            [{'stdout': compress('out' * 100), 'zlib': ['stdout']}, 0],
+            [{'stderr': 'err'}, 0],
+            [{'log': ('log1', compress('log' * 100)), 'zlib': ['log']}, 0],
+        ])
+        self.assertEqual(stdio.stdout, 'out' * 100)
+        self.assertEqual(stdio.stderr, 'err')
+        self.assertEqual(log1.stdout, 'log' * 100)
+
+        # an ignored update still advances the stream
+        cmd.ignore_updates = True
+        cmd.remote_update([[{'stdout': compress('out'), 'zlib': ['stdout']}, 0]])
+        cmd.ignore_updates = False
+        cmd.remote_update([[{'stdout': compress('more'), 'zlib': ['stdout']}, 0]])
+        self.assertEqual(stdio.stdout, 'out' * 100 + 'more')
+
 
 class TestFakeRunCommand(unittest.TestCase, Tests):
 
@@ -1,12 +1,139 @@
+import hashlib
 import os
 import stat
+import tarfile
 import tempfile
 
 from buildbot.process import remotetransfer
+from cStringIO import StringIO
 from mock import Mock
+from twisted.internet import defer
+from twisted.python import threadable
 from twisted.trial import unittest
 
 
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class TestContentStore(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = os.path.abspath(self.mktemp())
+        os.makedirs(self.basedir)
+        self.store = remotetransfer.ContentStore(
+            os.path.join(self.basedir, 'cas'))
+        self.filename = os.path.join(self.basedir, 'file')
+        with open(self.filename, 'wb') as f:
+            f.write('contents')
+
+    def test_add_materialize(self):
+        digest = sha256('contents')
+        self.assertFalse(self.store.has(digest))
+        self.store.add(self.filename, digest)
+        self.assertTrue(self.store.has(digest))
+
+        dest = os.path.join(self.basedir, 'dest')
+        with open(dest, 'wb') as f:
+            f.write('old contents')
+        self.assertEqual(self.store.materialize(digest, dest), 8)
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), 'contents')
+
+    def test_copies_are_independent(self):
+        digest = sha256('contents')
+        self.store.add(self.filename, digest)
+        dest = os.path.join(self.basedir, 'dest')
+        self.store.materialize(digest, dest)
+        stored = self.store.path(digest)
+        for name in self.filename, dest:
+            self.assertNotEqual(os.stat(name).st_ino, os.stat(stored).st_ino)
+            os.chmod(name, 0755)
+            with open(name, 'wb') as f:
+                f.write('changed')
+        with open(stored, 'rb') as f:
+            self.assertEqual(f.read(), 'contents')
+        self.assertEqual(stat.S_IMODE(os.stat(stored).st_mode), 0600)
+
+    def test_invalid_digest(self):
+        for digest in ['../../etc/passwd', '/etc/passwd', '..',
+                       sha256('x').upper(), sha256('x') + '\n',
+                       sha256('x')[:-1], unicode(sha256('x')), None]:
+            self.assertRaises(ValueError, self.store.path, digest)
+            self.assertRaises(ValueError, self.store.has, digest)
+            self.assertRaises(ValueError, self.store.materialize, digest,
+                              os.path.join(self.basedir, 'dest'))
+        self.assertFalse(os.path.exists(os.path.join(self.basedir, 'dest')))
+
+
+class TestAsyncFileIO(unittest.TestCase):
+
+    def setUp(self):
+        self.io = remotetransfer.AsyncFileIO()
+        self.calls = []
+
+    def op(self, n, fail=False):
+        self.calls.append((n, threadable.isInIOThread()))
+        if fail:
+            raise RuntimeError('disk full')
+        return n
+
+    @defer.inlineCallbacks
+    def test_call_in_order_in_thread(self):
+        results = yield defer.gatherResults(
+            [self.io.call(self.op, n) for n in range(20)])
+        self.assertEqual(results, range(20))
+        self.assertEqual(self.calls, [(n, False) for n in range(20)])
+
+    @defer.inlineCallbacks
+    def test_write_bounded(self):
+        self.io.maxPending = 3
+        # the first write runs at once, so three more fit in the queue
+        results = [self.io.write(self.op, n) for n in range(6)]
+        self.assertEqual(results[:4], [None] * 4)
+        self.assertIsInstance(results[4], defer.Deferred)
+        self.assertEqual((yield results[5]), 5)
+        self.assertEqual([n for n, _ in self.calls], range(6))
+
+    @defer.inlineCallbacks
+    def test_write_failure_reported_by_next_call(self):
+        self.assertEqual(self.io.write(self.op, 0, True), None)
+        self.io.write(self.op, 1)
+        yield self.assertFailure(self.io.call(self.op, 2), RuntimeError)
+        yield self.assertFailure(self.io.call(self.op, 3), RuntimeError)
+        self.assertEqual([n for n, _ in self.calls], [0])
+
+    @defer.inlineCallbacks
+    def test_cancel(self):
+        d = self.io.call(self.op, 0)
+        queued = self.io.call(self.op, 1)
+        res = yield self.io.cancel(self.op, 'cleanup')
+        self.assertEqual(res, 'cleanup')
+        yield d
+        yield self.assertFailure(queued, defer.CancelledError)
+        self.assertEqual([n for n, _ in self.calls], [0, 'cleanup'])
+
+    @defer.inlineCallbacks
+    def test_cancel_after_failure(self):
+        yield self.assertFailure(self.io.call(self.op, 0, True), RuntimeError)
+        yield self.io.cancel(self.op, 'cleanup')
+        self.assertEqual([n for n, _ in self.calls], [0, 'cleanup'])
+
+
+class TestTransferThreadPool(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def test_pool_runs_with_service(self):
+        svc = remotetransfer.TransferThreadPool()
+        yield svc.startService()
+        self.assertTrue(svc.pool.started)
+        io = remotetransfer.AsyncFileIO(svc.pool)
+        self.assertFalse((yield io.call(threadable.isInIOThread)))
+        yield svc.stopService()
+        self.assertFalse(svc.pool.started)
+        self.assertTrue(svc.pool.joined)
+
+
 # Test buildbot.steps.remotetransfer.FileWriter class.
 class TestFileWriter(unittest.TestCase):
 
@@ -47,3 +174,280 @@ class TestFileWriter(unittest.TestCase):
         mockedMakedirs.assert_called_once_with(absdir)
         mockedMkstemp.assert_called_once_with(dir=absdir)
         mockedFdopen.assert_called_once_with(7, 'wb')
+
+    @defer.inlineCallbacks
+    def test_write_close(self):
+        destfile = os.path.abspath(os.path.join(self.mktemp(), 'file'))
+        writer = remotetransfer.FileWriter(destfile, 10, stat.S_IRUSR)
+        writer.io.maxPending = 1
+        yield writer.remote_write('0123456')
+        yield writer.remote_write('789abc')
+        yield writer.remote_close()
+        with open(destfile) as f:
+            self.assertEqual(f.read(), '0123456789')
+        self.assertEqual(stat.S_IMODE(os.stat(destfile).st_mode),
+                         stat.S_IRUSR)
+
+    @defer.inlineCallbacks
+    def test_cas(self):
+        basedir = os.path.abspath(self.mktemp())
+        store = remotetransfer.ContentStore(os.path.join(basedir, 'cas'))
+        destfile = os.path.join(basedir, 'file')
+
+        # the first upload is added to the store
+        writer = remotetransfer.FileWriter(destfile, None, None, store)
+        cached = yield writer.remote_cached([sha256('data')])
+        self.assertEqual(cached, [])
+        yield writer.remote_write('data')
+        yield writer.remote_close()
+        self.assertEqual(writer.saved, 0)
+        self.assertTrue(store.has(sha256('data')))
+
+        # and the second is taken from it
+        destfile2 = os.path.join(basedir, 'file2')
+        writer = remotetransfer.FileWriter(destfile2, None, None, store)
+        cached = yield writer.remote_cached([sha256('data')])
+        self.assertEqual(cached, [sha256('data')])
+        yield writer.remote_close()
+        self.assertEqual(writer.saved, 4)
+        with open(destfile2) as f:
+            self.assertEqual(f.read(), 'data')
+
+        # a mode given to one upload does not change the others
+        writer = remotetransfer.FileWriter(destfile2, None, 0755, store)
+        yield writer.remote_cached([sha256('data')])
+        yield writer.remote_close()
+        self.assertEqual(stat.S_IMODE(os.stat(destfile2).st_mode), 0755)
+        self.assertEqual(stat.S_IMODE(os.stat(destfile).st_mode), 0600)
+        self.assertEqual(sorted(os.listdir(basedir)),
+                         ['cas', 'file', 'file2'])
+
+    @defer.inlineCallbacks
+    def test_cancel(self):
+        destfile = os.path.abspath(os.path.join(self.mktemp(), 'file'))
+        writer = remotetransfer.FileWriter(destfile, None, None)
+        yield writer.remote_write('data')
+        yield writer.cancel()
+        self.assertEqual(os.listdir(os.path.dirname(destfile)), [])
+
+    @defer.inlineCallbacks
+    def test_cas_invalid_digest(self):
+        basedir = os.path.abspath(self.mktemp())
+        store = remotetransfer.ContentStore(os.path.join(basedir, 'cas'))
+        destfile = os.path.join(basedir, 'file')
+        writer = remotetransfer.FileWriter(destfile, None, None, store)
+        yield self.assertFailure(writer.remote_cached(['../../etc/passwd']),
+                                 ValueError)
+        # the transfer fails rather than creating the file
+        yield self.assertFailure(writer.remote_close(), ValueError)
+        yield writer.cancel()
+        self.assertFalse(os.path.exists(destfile))
+
+
+class TestFileReader(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def test_read(self):
+        filename = self.mktemp()
+        with open(filename, 'wb') as f:
+            f.write('0123456789')
+        reader = remotetransfer.FileReader(open(filename, 'rb'))
+        data = yield defer.gatherResults(
+            [reader.remote_read(4) for _ in range(4)])
+        self.assertEqual(data, ['0123', '4567', '89', ''])
+        fp = reader.fp
+        yield reader.remote_close()
+        self.assertTrue(fp.closed)
+        self.assertEqual(reader.remote_read(4), '')
+
+
+class TestDirectoryWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = os.path.abspath(self.mktemp())
+        self.srcdir = os.path.join(self.basedir, 'src')
+        self.destdir = os.path.join(self.basedir, 'dest')
+        os.makedirs(os.path.join(self.srcdir, 'sub', 'deeper'))
+        os.makedirs(self.destdir)
+        with open(os.path.join(self.srcdir, 'big'), 'wb') as f:
+            f.write(os.urandom(100000))
+        with open(os.path.join(self.srcdir, 'sub', 'empty'), 'wb'):
+            pass
+        with open(os.path.join(self.srcdir, 'sub', 'deeper', 'x' * 150),
+                  'wb') as f:
+            f.write('long name')
+        os.chmod(os.path.join(self.srcdir, 'big'), 0751)
+        if hasattr(os, 'symlink'):
+            os.symlink('big', os.path.join(self.srcdir, 'link'))
+
+    def makeTarball(self, compress=None, format=tarfile.DEFAULT_FORMAT):
+        tarname = os.path.join(self.basedir, 'src.tar')
+        archive = tarfile.open(tarname, 'w:' + (compress or ''),
+                               format=format)
+        archive.add(self.srcdir, '')
+        archive.close()
+        with open(tarname, 'rb') as f:
+            return f.read()
+
+    @defer.inlineCallbacks
+    def feed(self, data, compress=None, chunksize=1001):
+        writer = remotetransfer.DirectoryWriter(self.destdir, None,
+                                                compress, 0600)
+        for i in xrange(0, len(data), chunksize):
+            yield writer.remote_write(data[i:i + chunksize])
+        yield writer.remote_close()
+        defer.returnValue(writer)
+
+    def listTree(self, top):
+        tree = {}
+        for dirpath, dirnames, filenames in os.walk(top):
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                relpath = os.path.relpath(path, top)
+                if os.path.islink(path):
+                    tree[relpath] = ('link', os.readlink(path))
+                elif os.path.isdir(path):
+                    tree[relpath] = ('dir',)
+                else:
+                    with open(path, 'rb') as f:
+                        tree[relpath] = ('file', f.read(),
+                                         stat.S_IMODE(os.stat(path).st_mode))
+        return tree
+
+    @defer.inlineCallbacks
+    def assertUnpacked(self, data, compress=None):
+        mkstemp = Mock()
+        self.patch(tempfile, 'mkstemp', mkstemp)
+        writer = yield self.feed(data, compress)
+        yield writer.remote_unpack()
+        self.assertEqual(self.listTree(self.destdir),
+                         self.listTree(self.srcdir))
+        self.assertFalse(mkstemp.called)
+
+    def test_unpack(self):
+        return self.assertUnpacked(self.makeTarball())
+
+    def test_unpack_gnu(self):
+        return self.assertUnpacked(self.makeTarball(format=tarfile.GNU_FORMAT))
+
+    def test_unpack_pax(self):
+        return self.assertUnpacked(self.makeTarball(format=tarfile.PAX_FORMAT))
+
+    def test_unpack_gz(self):
+        return self.assertUnpacked(self.makeTarball('gz'), 'gz')
+
+    def test_unpack_bz2(self):
+        return self.assertUnpacked(self.makeTarball('bz2'), 'bz2')
+
+    @defer.inlineCallbacks
+    def test_unpack_as_it_arrives(self):
+        data = self.makeTarball()
+        # everything but the end of the archive is unpacked before the
+        # transfer completes
+        end = len(data.rstrip('\0'))
+        writer = yield self.feed(data[:end + -end % tarfile.BLOCKSIZE])
+        yield writer.io.call(lambda: None)
+        self.assertEqual(self.listTree(self.destdir),
+                         self.listTree(self.srcdir))
+
+    @defer.inlineCallbacks
+    def test_truncated(self):
+        data = self.makeTarball()
+        writer = yield self.feed(data[:len(data) // 2])
+        yield self.assertFailure(writer.remote_unpack(), tarfile.ReadError)
+        # the partly written file was removed
+        self.assertFalse(os.path.exists(os.path.join(self.destdir, 'big')))
+
+    @defer.inlineCallbacks
+    def test_empty(self):
+        writer = yield self.feed('')
+        yield self.assertFailure(writer.remote_unpack(), tarfile.ReadError)
+
+    @defer.inlineCallbacks
+    def test_maxsize(self):
+        data = self.makeTarball()
+        writer = remotetransfer.DirectoryWriter(self.destdir, 20000, None,
+                                                0600)
+        yield writer.remote_write(data)
+        yield self.assertFailure(writer.remote_unpack(), tarfile.ReadError)
+
+    @defer.inlineCallbacks
+    def test_cas(self):
+        store = remotetransfer.ContentStore(os.path.join(self.basedir, 'cas'))
+        with open(os.path.join(self.srcdir, 'big'), 'rb') as f:
+            bigdigest = sha256(f.read())
+        longname = os.path.join(self.srcdir, 'sub', 'deeper', 'x' * 150)
+
+        # the first upload adds the files to the store
+        writer = remotetransfer.DirectoryWriter(self.destdir, None, None,
+                                                0600, store)
+        cached = yield writer.remote_cached([bigdigest])
+        self.assertEqual(cached, [])
+        yield writer.remote_write(self.makeTarball())
+        yield writer.remote_unpack()
+        self.assertTrue(store.has(bigdigest))
+        self.assertTrue(store.has(sha256('long name')))
+        self.assertTrue(store.has(sha256('')))
+
+        # and the second takes those it says are cached from the store
+        f = StringIO()
+        archive = tarfile.open(fileobj=f, mode='w')
+        for name, arcname in [(os.path.join(self.srcdir, 'big'), 'big'),
+                              (longname, 'x' * 150)]:
+            with open(name, 'rb') as fp:
+                tarinfo = archive.gettarinfo(name, arcname)
+                tarinfo.size = 0
+                tarinfo.pax_headers = {'BUILDBOT.cached': sha256(fp.read())}
+            f.write(tarinfo.tobuf(tarfile.PAX_FORMAT))
+        archive.close()
+        destdir = os.path.join(self.basedir, 'dest2')
+        writer = remotetransfer.DirectoryWriter(destdir, None, None, 0600,
+                                                store)
+        cached = yield writer.remote_cached([bigdigest, sha256('other')])
+        self.assertEqual(cached, [bigdigest])
+        yield writer.remote_write(f.getvalue())
+        yield writer.remote_unpack()
+        self.assertEqual(writer.saved, 100000 + len('long name'))
+        self.assertEqual(self.listTree(destdir), {
+            'big': self.listTree(self.srcdir)['big'],
+            'x' * 150: ('file', 'long name', 0644)})
+
+    @defer.inlineCallbacks
+    def test_cached_without_store(self):
+        f = StringIO()
+        archive = tarfile.open(fileobj=f, mode='w', format=tarfile.PAX_FORMAT)
+        tarinfo = tarfile.TarInfo('big')
+        tarinfo.pax_headers = {'BUILDBOT.cached': sha256('')}
+        archive.addfile(tarinfo)
+        archive.close()
+        writer = remotetransfer.DirectoryWriter(self.destdir, None, None,
+                                                0600)
+        yield writer.remote_write(f.getvalue())
+        yield self.assertFailure(writer.remote_unpack(), tarfile.ReadError)
+
+    @defer.inlineCallbacks
+    def test_cached_invalid_digest(self):
+        store = remotetransfer.ContentStore(os.path.join(self.basedir, 'cas'))
+        writer = remotetransfer.DirectoryWriter(self.destdir, None, None,
+                                                0600, store)
+        yield self.assertFailure(writer.remote_cached(['../../etc/passwd']),
+                                 ValueError)
+
+        f = StringIO()
+        archive = tarfile.open(fileobj=f, mode='w', format=tarfile.PAX_FORMAT)
+        tarinfo = tarfile.TarInfo('passwd')
+        tarinfo.pax_headers = {'BUILDBOT.cached': '../../../../etc/passwd'}
+        archive.addfile(tarinfo)
+        archive.close()
+        writer = remotetransfer.DirectoryWriter(self.destdir, None, None,
+                                                0600, store)
+        yield writer.remote_write(f.getvalue())
+        yield self.assertFailure(writer.remote_unpack(), ValueError)
+        self.assertFalse(os.path.exists(os.path.join(self.destdir, 'passwd')))
+
+    @defer.inlineCallbacks
+    def test_cancel(self):
+        data = self.makeTarball()
+        writer = yield self.feed(data[:len(data) // 2])
+        yield writer.cancel()
+        self.assertFalse(os.path.exists(os.path.join(self.destdir, 'big')))
@@ -15,12 +15,14 @@
 
 from __future__ import with_statement
 
+import hashlib
 import os
 import shutil
 import stat
 import tarfile
 import tempfile
 
+from twisted.internet import defer
 from twisted.trial import unittest
 
 from mock import Mock
@@ -42,24 +44,39 @@ from cStringIO import StringIO
 
 
 def uploadString(string, timestamp=None):
+    @defer.inlineCallbacks
     def behavior(command):
         writer = command.args['writer']
-        writer.remote_write(string + "\n")
-        writer.remote_close()
+        yield writer.remote_write(string + "\n")
+        yield writer.remote_close()
         if timestamp:
-            writer.remote_utime(timestamp)
+            yield writer.remote_utime(timestamp)
+    return behavior
+
+
+def uploadCachedString(string):
+    # as a slave does with 'cas', ask whether the master has it first
+    @defer.inlineCallbacks
+    def behavior(command):
+        writer = command.args['writer']
+        cached = yield writer.remote_cached(
+            [hashlib.sha256(string).hexdigest()])
+        if not cached:
+            yield writer.remote_write(string)
+        yield writer.remote_close()
     return behavior
 
 
 def uploadTarFile(filename, **members):
+    @defer.inlineCallbacks
     def behavior(command):
         f = StringIO()
         archive = tarfile.TarFile(fileobj=f, name=filename, mode='w')
         for name, content in members.iteritems():
             archive.addfile(tarfile.TarInfo(name), StringIO(content))
         writer = command.args['writer']
-        writer.remote_write(f.getvalue())
-        writer.remote_unpack()
+        yield writer.remote_write(f.getvalue())
+        yield writer.remote_unpack()
     return behavior
 
 
@@ -69,10 +86,11 @@ class UploadError(object):
         self.behavior = behavior
         self.writer = None
 
+    @defer.inlineCallbacks
     def __call__(self, command):
         self.writer = command.args['writer']
         self.writer.cancel = Mock(wraps=self.writer.cancel)
-        self.behavior(command)
+        yield self.behavior(command)
         raise RuntimeError('uh oh')
 
 
@@ -93,6 +111,100 @@ class TestFileUpload(steps.BuildStepMixin, unittest.TestCase):
         self.assertRaises(config.ConfigErrors, lambda:
                           transfer.FileUpload(slavesrc=__file__, masterdest='xyz', mode='g+rwx'))
 
+    def testConstructorWindow(self):
+        self.assertRaises(config.ConfigErrors, lambda:
+                          transfer.FileUpload(slavesrc=__file__, masterdest='xyz', window=0))
+
+    def testWindow(self):
+        self.setupStep(
+            transfer.FileUpload(slavesrc='srcfile', masterdest=self.destfile,
+                                window=8, maxblocksize=256 * 1024))
+
+        self.expectCommands(
+            Expect('uploadFile', dict(
+                slavesrc="srcfile", workdir='wkdir',
+                blocksize=16384, maxsize=None, keepstamp=False,
+                window=8, maxblocksize=256 * 1024,
+                writer=ExpectRemoteRef(remotetransfer.FileWriter)))
+            + Expect.behavior(uploadString("Hello world!"))
+            + 0)
+
+        self.expectOutcome(
+            result=SUCCESS, state_string="uploading srcfile")
+        return self.runStep()
+
+    def testWindowOldSlave(self):
+        self.setupStep(
+            transfer.FileUpload(slavesrc='srcfile', masterdest=self.destfile,
+                                window=8),
+            slave_version={'*': '2.16'})
+
+        self.expectCommands(
+            Expect('uploadFile', dict(
+                slavesrc="srcfile", workdir='wkdir',
+                blocksize=16384, maxsize=None, keepstamp=False,
+                writer=ExpectRemoteRef(remotetransfer.FileWriter)))
+            + Expect.behavior(uploadString("Hello world!"))
+            + 0)
+
+        self.expectOutcome(
+            result=SUCCESS, state_string="uploading srcfile")
+        return self.runStep()
+
+    def testCas(self):
+        casdir = os.path.abspath(self.mktemp())
+        store = remotetransfer.ContentStore(casdir)
+        os.makedirs(casdir)
+        cachedfile = os.path.join(casdir, 'file')
+        with open(cachedfile, 'w') as f:
+            f.write('Hello world!')
+        store.add(cachedfile, hashlib.sha256('Hello world!').hexdigest())
+        self.setupStep(
+            transfer.FileUpload(slavesrc='srcfile', masterdest=self.destfile,
+                                casdir=casdir))
+
+        self.expectCommands(
+            Expect('uploadFile', dict(
+                slavesrc="srcfile", workdir='wkdir',
+                blocksize=16384, maxsize=None, keepstamp=False, cas=True,
+                writer=ExpectRemoteRef(remotetransfer.FileWriter)))
+            + Expect.behavior(uploadCachedString("Hello world!"))
+            + 0)
+
+        self.expectOutcome(
+            result=SUCCESS, state_string="uploading srcfile")
+        d = self.runStep()
+
+        @d.addCallback
+        def check(_):
+            with open(self.destfile) as f:
+                self.assertEqual(f.read(), 'Hello world!')
+            self.assertEqual(self.step.getStatistic('bytes_saved'), 12)
+        return d
+
+    def testCasOldSlave(self):
+        self.setupStep(
+            transfer.FileUpload(slavesrc='srcfile', masterdest=self.destfile,
+                                casdir=self.mktemp()),
+            slave_version={'*': '2.17'})
+
+        self.expectCommands(
+            Expect('uploadFile', dict(
+                slavesrc="srcfile", workdir='wkdir',
+                blocksize=16384, maxsize=None, keepstamp=False,
+                writer=ExpectRemoteRef(remotetransfer.FileWriter)))
+            + Expect.behavior(uploadString("Hello world!"))
+            + 0)
+
+        self.expectOutcome(
+            result=SUCCESS, state_string="uploading srcfile")
+        d = self.runStep()
+
+        @d.addCallback
+        def check(_):
+            self.assertFalse(self.step.hasStatistic('bytes_saved'))
+        return d
+
     def testBasic(self):
         self.setupStep(
             transfer.FileUpload(slavesrc='srcfile', masterdest=self.destfile))
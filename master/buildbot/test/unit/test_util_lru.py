@@ -254,6 +254,14 @@ class LRUCacheTest(unittest.TestCase):
         self.assertEqual(self.lru.get('p'), set(['PPP']))
         self.assertEqual(self.lru.get('q'), set(['new-q']))  # updated
 
+    def test_peek(self):
+        self.assertEqual(self.lru.peek('p'), None)
+        self.assertEqual(self.lru.misses, 1)
+        self.lru.put('p', set(['P2P2']))
+        self.assertEqual(self.lru.peek('p'), set(['P2P2']))
+        self.assertEqual(self.lru.hits, 1)
+        self.assertEqual(self.lru.get('p'), set(['P2P2']))
+
 
 class AsyncLRUCacheTest(unittest.TestCase):
 
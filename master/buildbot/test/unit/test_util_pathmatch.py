@@ -88,3 +88,40 @@ class Matcher(unittest.TestCase):
         self.m[('abc', 'efg')] = 3
         self.assertEqual(self.m[('abc', 'def')], (2, {}))
         self.assertEqual(self.m[('abc', 'efg')], (3, {}))
+
+    def test_literal_preferred(self):
+        self.m[('A', ':a')] = 'var'
+        self.m[('A', 'x')] = 'lit'
+        self.assertEqual(self.m[('A', 'x')], ('lit', {}))
+        self.assertEqual(self.m[('A', 'y')], ('var', dict(a='y')))
+
+    def test_backtracking(self):
+        self.m[('A', 'x', 'B')] = 'lit'
+        self.m[('A', ':a', 'C')] = 'var'
+        self.assertEqual(self.m[('A', 'x', 'C')], ('var', dict(a='x')))
+        self.assertEqual(self.m[('A', 'x', 'B')], ('lit', {}))
+
+    def test_backtracking_typed(self):
+        self.m[('A', 'n:a', 'B')] = 'num'
+        self.m[('A', 'i:b', 'C')] = 'ident'
+        self.assertRaises(KeyError, lambda: self.m[('A', '10', 'C')])
+        self.assertEqual(self.m[('A', 'x', 'C')], ('ident', dict(b='x')))
+
+    def test_shared_prefix(self):
+        self.m[('A', 'n:a', 'B')] = 'B'
+        self.m[('A', 'n:a', 'C')] = 'C'
+        self.assertEqual(self.m[('A', '1', 'C')], ('C', dict(a=1)))
+        self.assertRaises(KeyError, lambda: self.m[('A', '1')])
+
+    def test_compiled_once(self):
+        self.m[('abc', 'def')] = 2
+        compile = self.m._compile
+        calls = []
+
+        def _compile():
+            calls.append(1)
+            compile()
+        self.m._compile = _compile
+        self.m[('abc', 'def')]
+        self.m[('abc', 'def')]
+        self.assertEqual(len(calls), 1)
@@ -28,3 +28,42 @@ class MatchTuple(tuplematching.TupleMatchingMixin, unittest.TestCase):
                          % (routingKey,
                             'should match' if shouldMatch else "shouldn't match",
                             filter))
+
+
+class TupleTrie(tuplematching.TupleMatchingMixin, unittest.TestCase):
+
+    # called by the TupleMatchingMixin methods
+
+    def do_test_match(self, routingKey, shouldMatch, filter):
+        trie = tuplematch.TupleTrie()
+        trie.add(filter, 'x')
+        self.assertEqual(trie.match(routingKey), ['x'] if shouldMatch else [])
+
+    def test_match_order(self):
+        trie = tuplematch.TupleTrie()
+        trie.add(('a', None, 'c'), 1)
+        trie.add(('a', 'b', 'c'), 2)
+        trie.add(('a', None, None), 3)
+        trie.add(('a', 'b', 'c'), 4)
+        trie.add(('a', 'b', 'x'), 5)
+        trie.add(('a', 'b'), 6)
+        self.assertEqual(trie.match(('a', 'b', 'c')), [1, 2, 3, 4])
+        self.assertEqual(trie.match(('a', 'z', 'c')), [1, 3])
+        self.assertEqual(trie.match(('b', 'b', 'c')), [])
+        self.assertEqual(trie.values(), [1, 2, 3, 4, 5, 6])
+
+    def test_remove(self):
+        trie = tuplematch.TupleTrie()
+        one = trie.add(('a', None), 1)
+        two = trie.add(('a', 'b'), 2)
+        trie.remove(('a', 'b'), two)
+        self.assertEqual(trie.match(('a', 'b')), [1])
+        # removing twice, or with the wrong filter, does nothing
+        trie.remove(('a', 'b'), two)
+        trie.remove(('a', 'b'), one)
+        trie.remove(('x', 'y', 'z'), one)
+        self.assertEqual(trie.match(('a', 'b')), [1])
+        trie.remove(('a', None), one)
+        self.assertEqual(trie.match(('a', 'b')), [])
+        # and the empty nodes are pruned
+        self.assertEqual(trie.roots, {})
@@ -0,0 +1,137 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import datetime
+import mock
+
+from buildbot.test.util import www
+from buildbot.util import json
+from buildbot.util import toJson
+from buildbot.www import jsonstream
+from twisted.internet import task
+from twisted.trial import unittest
+
+ITEMS = [
+    dict(id=1, name=u'one', tags=[u'a', u'b'], props={u'x': [1, u'y']}),
+    dict(id=2, name=u'tw\xf6', tags=[], props={}),
+    dict(id=3, name=None, when=datetime.datetime(2015, 9, 1, 12, 0)),
+]
+
+
+class Encoders(unittest.TestCase):
+
+    def check(self, typeName, items, meta, compact):
+        got = ''.join(jsonstream.encodeResponse(typeName, iter(items), meta,
+                                                compact=compact))
+        obj = {typeName: items, 'meta': meta}
+        if compact:
+            exp = json.dumps(obj, default=toJson, sort_keys=True,
+                             separators=(',', ':'))
+        else:
+            exp = json.dumps(obj, default=toJson, sort_keys=True, indent=2,
+                             separators=(',', ': '))
+        self.assertEqual(got, exp)
+
+    def test_compact(self):
+        self.check('things', ITEMS, dict(total=3), compact=True)
+
+    def test_pretty(self):
+        self.check('things', ITEMS, dict(total=3), compact=False)
+
+    def test_empty(self):
+        self.check('things', [], {}, compact=True)
+        self.check('things', [], {}, compact=False)
+
+    def test_typeName_after_meta(self):
+        # keys are sorted, so 'steps' comes after 'meta'
+        self.check('steps', ITEMS, dict(total=3), compact=False)
+
+    def test_ndjson(self):
+        got = ''.join(jsonstream.encodeNdjson(iter(ITEMS)))
+        lines = got.split('\n')
+        self.assertEqual(lines[-1], '')
+        self.assertEqual([json.loads(l) for l in lines[:-1]],
+                         json.loads(json.dumps(ITEMS, default=toJson)))
+
+    def test_lazy(self):
+        consumed = []
+
+        def items():
+            for i in range(3):
+                consumed.append(i)
+                yield dict(id=i)
+        pieces = jsonstream.encodeResponse('things', items(), {}, True)
+        while next(pieces) != '{"id":0}':
+            pass
+        self.assertEqual(consumed, [0])
+
+
+class JsonStreamProducer(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(jsonstream, 'CHUNK_SIZE', 10)
+        self.request = www.FakeRequest('/')
+        self.steps = []
+        self.producer = jsonstream.JsonStreamProducer(
+            self.request, ('x' * 5 for _ in range(5)))
+        self.producer._cooperate = self.cooperate
+
+    def cooperate(self, iterator):
+        # run the task one step at a time, under the test's control
+        self.cooperator = task.Cooperator(
+            terminationPredicateFactory=lambda: lambda: True,
+            scheduler=self.schedule,
+            started=True)
+        return self.cooperator.cooperate(iterator)
+
+    def schedule(self, step):
+        self.steps.append(step)
+        return mock.Mock(name='delayedCall',
+                         cancel=lambda: self.steps.remove(step))
+
+    def runSteps(self, n):
+        for _ in range(n):
+            if self.steps:
+                self.steps.pop(0)()
+
+    def test_writes_chunks(self):
+        d = self.producer.start()
+        self.assertIdentical(self.request.producer, self.producer)
+        self.runSteps(10)
+        self.assertEqual(self.request.written, 'x' * 25)
+        self.assertIdentical(self.request.producer, None)
+        self.assertEqual(self.successResultOf(d), True)
+
+    def test_pause_resume(self):
+        d = self.producer.start()
+        self.runSteps(1)
+        written = self.request.written
+        self.producer.pauseProducing()
+        self.runSteps(10)
+        self.assertEqual(self.request.written, written)
+        self.assertNoResult(d)
+        self.producer.resumeProducing()
+        self.runSteps(10)
+        self.assertEqual(self.request.written, 'x' * 25)
+        self.assertEqual(self.successResultOf(d), True)
+
+    def test_stop(self):
+        d = self.producer.start()
+        self.runSteps(1)
+        self.producer.stopProducing()
+        self.runSteps(10)
+        self.assertTrue(len(self.request.written) < 25)
+        self.assertIdentical(self.request.producer, None)
+        self.assertEqual(self.successResultOf(d), False)
@@ -481,6 +481,18 @@ class V2RootResource_REST(www.WwwTestMixin, unittest.TestCase):
                                item=endpoint.testData[13],
                                contentType='application/json; charset=utf-8')
 
+    @defer.inlineCallbacks
+    def test_api_collection_ndjson(self):
+        yield self.render_resource(self.rsrc, '/test?order=id&limit=3',
+                                   accept='application/x-ndjson')
+        self.assertEqual(self.request.headers['content-type'],
+                         ['application/x-ndjson; charset=utf-8'])
+        lines = self.request.written.split('\n')
+        self.assertEqual(lines[-1], '')
+        ids = sorted(endpoint.testData)[:3]
+        self.assertEqual([json.loads(l) for l in lines[:-1]],
+                         [endpoint.testData[id] for id in ids])
+
     @defer.inlineCallbacks
     def test_api_fails(self):
         yield self.render_resource(self.rsrc, '/test/fail')
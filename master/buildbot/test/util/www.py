@@ -38,6 +38,7 @@ class FakeRequest(object):
     redirected_to = None
     rendered_resource = None
     failure = None
+    producer = None
     method = 'GET'
     path = '/req.path'
     responseCode = 200
@@ -61,6 +62,12 @@ class FakeRequest(object):
     def write(self, data):
         self.written = self.written + data
 
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
     def redirect(self, url):
         self.redirected_to = url
 
@@ -69,6 +69,13 @@ class LRUCache(object):
 
         return result
 
+    def peek(self, key):
+        try:
+            return self._get_hit(key)
+        except KeyError:
+            self.misses += 1
+            return None
+
     def keys(self):
         return self.cache.keys()
 
@@ -24,6 +24,19 @@ def ident(x):
     raise TypeError
 
 
+class _Node(object):
+
+    __slots__ = ['literals', 'captures', 'value', 'hasValue']
+
+    def __init__(self):
+        # path element -> _Node
+        self.literals = {}
+        # (type_flag, type_fn, arg_name, _Node), in Matcher.capture_order
+        self.captures = []
+        self.value = None
+        self.hasValue = False
+
+
 class Matcher(object):
 
     def __init__(self):
@@ -41,42 +54,74 @@ class Matcher(object):
     path_elt_re = re.compile('^(.?):([a-z0-9_.]+)$')
     type_fns = dict(n=int, i=ident)
 
+    # order in which captures are tried; untyped captures match anything
+    capture_order = ['n', 'i', '']
+
     def __getitem__(self, path):
         if self._dirty:
             self._compile()
 
-        patterns = self._by_length.get(len(path), {})
-        for pattern in patterns:
-            kwargs = {}
-            for pattern_elt, path_elt in zip(pattern, path):
-                mo = self.path_elt_re.match(pattern_elt)
-                if mo:
-                    type_flag, arg_name = mo.groups()
-                    if type_flag:
-                        try:
-                            type_fn = self.type_fns[type_flag]
-                        except Exception:
-                            assert type_flag in self.type_fns, \
-                                "no such type flag %s" % type_flag
-                        try:
-                            path_elt = type_fn(path_elt)
-                        except Exception:
-                            break
-                    kwargs[arg_name] = path_elt
-                else:
-                    if pattern_elt != path_elt:
-                        break
-            else:
-                # complete match
-                return patterns[pattern], kwargs
-        else:
+        kwargs = {}
+        node = self._match(self._root, path, 0, kwargs)
+        if node is None:
             raise KeyError('No match for %r' % (path,))
+        return node.value, kwargs
+
+    def _match(self, node, path, i, kwargs):
+        # descend from node to the node matching path[i:], filling in kwargs;
+        # literal elements are preferred to captures, and the next alternative
+        # is only tried if the rest of the path does not match
+        if i == len(path):
+            return node if node.hasValue else None
+        path_elt = path[i]
+        child = node.literals.get(path_elt)
+        if child is not None:
+            found = self._match(child, path, i + 1, kwargs)
+            if found is not None:
+                return found
+        for _, type_fn, arg_name, child in node.captures:
+            if type_fn:
+                try:
+                    value = type_fn(path_elt)
+                except Exception:
+                    continue
+            else:
+                value = path_elt
+            found = self._match(child, path, i + 1, kwargs)
+            if found is not None:
+                kwargs[arg_name] = value
+                return found
+        return None
 
     def iterPatterns(self):
         return self._patterns.iteritems()
 
     def _compile(self):
-        self._by_length = {}
-        for k, v in self.iterPatterns():
-            l = len(k)
-            self._by_length.setdefault(l, {})[k] = v
+        self._root = _Node()
+        for pattern, value in self.iterPatterns():
+            node = self._root
+            for pattern_elt in pattern:
+                mo = self.path_elt_re.match(pattern_elt)
+                if not mo:
+                    child = node.literals.get(pattern_elt)
+                    if child is None:
+                        child = node.literals[pattern_elt] = _Node()
+                    node = child
+                    continue
+                type_flag, arg_name = mo.groups()
+                assert not type_flag or type_flag in self.type_fns, \
+                    "no such type flag %s" % type_flag
+                for flag, _, name, child in node.captures:
+                    if flag == type_flag and name == arg_name:
+                        break
+                else:
+                    child = _Node()
+                    node.captures.append((type_flag,
+                                          self.type_fns.get(type_flag),
+                                          arg_name, child))
+                    node.captures.sort(
+                        key=lambda c: self.capture_order.index(c[0]))
+                node = child
+            node.value = value
+            node.hasValue = True
+        self._dirty = False
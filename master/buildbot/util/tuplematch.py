@@ -23,3 +23,112 @@ def matchTuple(routingKey, filter):
         if f is not None and f != k:
             return False
     return True
+
+
+class _TrieNode(object):
+
+    __slots__ = ['children', 'values']
+
+    def __init__(self):
+        # children, keyed by filter element, with None for the wildcard
+        self.children = {}
+        # values whose filter ends at this node, keyed by sequence number
+        self.values = {}
+
+
+class TupleTrie(object):
+
+    """
+    An index of values by filter, for finding every value whose filter
+    matches a given routing key, as L{matchTuple} would.  Filters are
+    stored in a trie per tuple length, so a lookup only visits nodes for
+    the literal elements of the routing key and for wildcards, and its cost
+    does not depend on the number of non-matching filters.
+
+    Matching values are returned in the order they were added.
+    """
+
+    def __init__(self):
+        self.roots = {}
+        self.nextSeq = itertools.count()
+
+    def add(self, filter, value):
+        """
+        Add VALUE under FILTER, returning a handle for L{remove}.
+        """
+        try:
+            node = self.roots[len(filter)]
+        except KeyError:
+            node = self.roots[len(filter)] = _TrieNode()
+        for elt in filter:
+            try:
+                node = node.children[elt]
+            except KeyError:
+                child = node.children[elt] = _TrieNode()
+                node = child
+        seq = self.nextSeq.next()
+        node.values[seq] = value
+        return seq
+
+    def remove(self, filter, seq):
+        """
+        Remove the value added under FILTER with handle SEQ, if it is still
+        present, pruning any nodes left empty.
+        """
+        node = self.roots.get(len(filter))
+        path = []
+        for elt in filter:
+            if node is None:
+                return
+            path.append((node, elt))
+            node = node.children.get(elt)
+        if node is None or node.values.pop(seq, None) is None:
+            return
+        while path and not node.values and not node.children:
+            node, elt = path.pop()
+            del node.children[elt]
+        if not node.values and not node.children:
+            del self.roots[len(filter)]
+
+    def match(self, routingKey):
+        """
+        Return a list of the values whose filters match ROUTINGKEY.
+        """
+        node = self.roots.get(len(routingKey))
+        if node is None:
+            return []
+        nodes = [node]
+        for elt in routingKey:
+            nextNodes = []
+            for node in nodes:
+                child = node.children.get(elt)
+                if child is not None:
+                    nextNodes.append(child)
+                if elt is not None:
+                    child = node.children.get(None)
+                    if child is not None:
+                        nextNodes.append(child)
+            if not nextNodes:
+                return []
+            nodes = nextNodes
+        if len(nodes) == 1:
+            values = nodes[0].values
+            return [values[seq] for seq in sorted(values)]
+        matches = []
+        for node in nodes:
+            matches.extend(node.values.iteritems())
+        matches.sort()
+        return [value for _, value in matches]
+
+    def values(self):
+        """
+        Return a list of all values, in the order they were added.
+        """
+        matches = []
+        stack = self.roots.values()
+        while stack:
+            node = stack.pop()
+            matches.extend(node.values.iteritems())
+            stack.extend(node.children.itervalues())
+        matches.sort()
+        return [value for _, value in matches]
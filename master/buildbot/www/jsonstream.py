@@ -0,0 +1,156 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+"""
+Incremental JSON encoding for REST responses.
+
+The encoders here yield the JSON text of a response piece by piece, encoding
+one item of the collection at a time, and L{JsonStreamProducer} writes those
+pieces to a request as the client reads them.
+"""
+
+from buildbot.util import json
+from buildbot.util import toJson
+from twisted.internet import interfaces
+from twisted.internet import task
+from zope.interface import implements
+
+# pieces are gathered into writes of about this many bytes
+CHUNK_SIZE = 16 * 1024
+
+
+# encoders are reused for every item, rather than being set up by each call to
+# json.dumps
+_compactEncoder = json.JSONEncoder(default=toJson, sort_keys=True,
+                                   separators=(',', ':'))
+_indentedEncoder = json.JSONEncoder(default=toJson, sort_keys=True, indent=2,
+                                    separators=(',', ': '))
+
+
+def _dumps(obj, compact):
+    if compact:
+        return _compactEncoder.encode(obj)
+    return _indentedEncoder.encode(obj)
+
+
+def encodeResponse(typeName, items, meta, compact):
+    """
+    Yield the JSON encoding of C{{typeName: items, 'meta': meta}}, with the
+    same content as C{json.dumps(.., sort_keys=True)}, and indented unless
+    C{compact} is true.
+    """
+    if compact:
+        nl, indent, colon = '', '', ':'
+    else:
+        nl, indent, colon = '\n', '  ', ': '
+
+    yield '{' + nl
+    for i, key in enumerate(sorted([typeName, 'meta'])):
+        if i:
+            yield ',' + nl
+        yield indent + json.dumps(key) + colon
+        if key == 'meta':
+            yield _dumps(meta, compact).replace('\n', '\n' + indent)
+            continue
+        yield '['
+        itemIndent = indent * 2
+        sep = nl
+        for item in items:
+            yield sep + itemIndent + \
+                _dumps(item, compact).replace('\n', '\n' + itemIndent)
+            sep = ',' + nl
+        if sep != nl:
+            yield nl + indent
+        yield ']'
+    yield nl + '}'
+
+
+def encodeNdjson(items):
+    """
+    Yield the newline-delimited JSON encoding of C{items}: each item, encoded
+    compactly, on its own line.
+    """
+    for item in items:
+        yield _dumps(item, True) + '\n'
+
+
+def _chunks(pieces, size):
+    buf, buflen = [], 0
+    for piece in pieces:
+        buf.append(piece)
+        buflen += len(piece)
+        if buflen >= size:
+            yield ''.join(buf)
+            buf, buflen = [], 0
+    if buf:
+        yield ''.join(buf)
+
+
+class JsonStreamProducer(object):
+
+    """
+    Write the strings from C{pieces} to C{request}, gathered into chunks of
+    about L{CHUNK_SIZE} bytes.  Encoding is done cooperatively, a few chunks
+    per reactor iteration, and pauses whenever the client is not keeping up.
+    """
+
+    implements(interfaces.IPushProducer)
+
+    _cooperate = staticmethod(task.cooperate)  # for tests
+
+    def __init__(self, request, pieces):
+        self.request = request
+        self.pieces = pieces
+        self._task = None
+
+    def start(self):
+        """
+        Start writing; returns a Deferred that fires with True when all the
+        pieces have been written, or with False if the client disconnected
+        first.
+        """
+        self.request.registerProducer(self, True)
+        self._task = self._cooperate(self._write())
+        d = self._task.whenDone()
+
+        @d.addBoth
+        def unregister(res):
+            self.request.unregisterProducer()
+            return res
+
+        @d.addCallback
+        def done(_):
+            return True
+
+        @d.addErrback
+        def stopped(f):
+            # the client went away before the response was complete
+            f.trap(task.TaskStopped)
+            return False
+        return d
+
+    def _write(self):
+        for chunk in _chunks(self.pieces, CHUNK_SIZE):
+            self.request.write(chunk)
+            yield None
+
+    def pauseProducing(self):
+        self._task.pause()
+
+    def resumeProducing(self):
+        self._task.resume()
+
+    def stopProducing(self):
+        self._task.stop()
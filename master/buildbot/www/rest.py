@@ -25,6 +25,7 @@ from buildbot.data import exceptions
 from buildbot.data import resultspec
 from buildbot.util import json
 from buildbot.util import toJson
+from buildbot.www import jsonstream
 from buildbot.www import resource
 from contextlib import contextmanager
 from twisted.internet import defer
@@ -347,21 +348,25 @@ class V2RootResource(resource.Resource):
                 data = [data]
 
             typeName = ep.rtype.plural
-            data = {
-                typeName: data,
-                'meta': meta
-            }
 
             # set up the content type and formatting options; if the request
             # accepts text/html or text/plain, the JSON will be rendered in a
-            # readable, multiline format.
+            # readable, multiline format.  Clients asking for NDJSON get one
+            # compact JSON object per line, and no metadata.
 
-            if 'application/json' in (request.getHeader('accept') or ''):
-                compact = True
+            accept = request.getHeader('accept') or ''
+            if 'application/x-ndjson' in accept:
+                pieces = jsonstream.encodeNdjson(data)
+                request.setHeader("content-type",
+                                  'application/x-ndjson; charset=utf-8')
+            elif 'application/json' in accept:
+                pieces = jsonstream.encodeResponse(typeName, data, meta,
+                                                   compact=True)
                 request.setHeader("content-type",
                                   'application/json; charset=utf-8')
             else:
-                compact = False
+                pieces = jsonstream.encodeResponse(typeName, data, meta,
+                                                   compact=False)
                 request.setHeader("content-type",
                                   'text/plain; charset=utf-8')
 
@@ -373,18 +378,14 @@ class V2RootResource(resource.Resource):
                                   expires.strftime("%a, %d %b %Y %H:%M:%S GMT"))
                 request.setHeader("Pragma", "no-cache")
 
-            # filter out blanks if necessary and render the data
-            if compact:
-                data = json.dumps(data, default=toJson,
-                                  sort_keys=True, separators=(',', ':'))
-            else:
-                data = json.dumps(data, default=toJson,
-                                  sort_keys=True, indent=2)
-
+            # render the data; the body is encoded an item at a time, and
+            # written as the client reads it, rather than building the whole
+            # response in memory first
             if request.method == "HEAD":
-                request.setHeader("content-length", len(data))
+                request.setHeader("content-length",
+                                  sum(len(p) for p in pieces))
             else:
-                request.write(data)
+                yield jsonstream.JsonStreamProducer(request, pieces).start()
 
     def reconfigResource(self, new_config):
         # buildbotURL may contain reverse proxy path, Origin header is just scheme + host + port
@@ -16,8 +16,8 @@
 import uuid
 
 from buildbot.data.exceptions import InvalidPathError
+from buildbot.mq import fanout
 from buildbot.util import json
-from buildbot.util import toJson
 from twisted.python import log
 from twisted.web import resource
 from twisted.web import server
@@ -39,10 +39,10 @@ class Consumer(object):
 
     def onMessage(self, event, data):
         request = self.request
-        msg = dict(key=event, message=data)
-        request.write("event: " + "event" + "\n")
-        request.write("data: " + json.dumps(msg, default=toJson) + "\n")
-        request.write("\n")
+        # the message itself is encoded only once for all clients
+        msg = '{"key":%s,"message":%s}' % (
+            json.dumps(event), fanout.encoder.encode(event, data))
+        request.write("event: event\ndata: " + msg + "\n\n")
 
     def registerQref(self, path, qref):
         self.qrefs[path] = qref
@@ -13,6 +13,7 @@
 #
 # Copyright  Team Members
 
+from buildbot.mq import fanout
 from buildbot.util import json
 from buildbot.util import toJson
 from twisted.internet import defer
@@ -79,8 +80,11 @@ class WsProtocol(WebSocketServerProtocol):
             return
 
         def callback(key, message):
-            # protocol is deliberatly concise in size
-            return self.sendJsonMessage(k="/".join(key), m=message)
+            # protocol is deliberatly concise in size; the message itself is
+            # encoded only once for all clients
+            return self.sendMessage('{"k":%s,"m":%s}' % (
+                json.dumps("/".join(key)),
+                fanout.encoder.encode(key, message)))
 
         qref = yield self.master.mq.startConsuming(callback, self.parsePath(path))
 
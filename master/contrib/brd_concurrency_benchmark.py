@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+# usage: python brd_concurrency_benchmark.py [num_builders] [delay_ms]
+#
+# Times how long the BuildRequestDistributor takes to work through a set of
+# independent builders, each of which takes delay_ms to decide whether it can
+# start a build (as a slow canStartBuild or latent slave would), with several
+# values of c['buildStartConcurrency'].
+
+import sys
+import time
+
+import mock
+
+from buildbot.process import buildrequestdistributor
+from buildbot.test.fake import fakemaster
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+
+
+def makeBuilder(name):
+    bldr = mock.Mock(name=name)
+    bldr.name = name
+    bldr.config.slavenames = ['slave-%s' % name]
+    bldr.config.locks = []
+    return bldr
+
+
+@defer.inlineCallbacks
+def timeConcurrency(concurrency, num_builders, delay):
+    master = fakemaster.make_master()
+    master.mq = mock.Mock(name='mq')
+    master.mq.startConsuming.return_value = defer.succeed(mock.Mock())
+    master.config.buildStartConcurrency = concurrency
+    master.config.prioritizeBuilders = \
+        lambda master, builders: sorted(builders, key=lambda b: b.name)
+    botmaster = mock.Mock(name='botmaster')
+    botmaster.master = master
+    botmaster.builders = dict(('b%03d' % i, makeBuilder('b%03d' % i))
+                              for i in range(num_builders))
+
+    brd = buildrequestdistributor.BuildRequestDistributor(botmaster)
+    brd._maybeStartBuildsOnBuilder = \
+        lambda bldr: task.deferLater(reactor, delay, lambda: None)
+    done = defer.Deferred()
+    brd._quiet = lambda: done.callback(None)
+    yield brd.startService()
+
+    start = time.time()
+    brd.maybeStartBuildsOn(botmaster.builders.keys())
+    yield done
+    elapsed = time.time() - start
+    yield brd.stopService()
+    print "concurrency %2d: %8.1fms" % (concurrency, elapsed * 1000)
+
+
+@defer.inlineCallbacks
+def main(num_builders, delay):
+    print "%d builders, %.0fms per builder" % (num_builders, delay * 1000)
+    for concurrency in (1, 2, 4, 8, 16):
+        yield timeConcurrency(concurrency, num_builders, delay)
+
+
+if __name__ == '__main__':
+    num_builders = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    delay = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.05
+    d = main(num_builders, delay)
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
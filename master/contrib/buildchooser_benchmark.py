@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# usage: python buildchooser_benchmark.py [num_requests]
+#
+# Times how long a new build chooser takes to get the list of unclaimed build
+# requests for a builder with a deep queue, in an in-memory sqlite database:
+# once by querying the data API, as choosers without an index do, and once
+# from a warm UnclaimedBuildRequests index.
+
+import sys
+import time
+
+from buildbot.data import connector as dataconnector
+from buildbot.db import connector
+from buildbot.db import enginestrategy
+from buildbot.db import pool
+from buildbot.process import buildrequestdistributor
+from buildbot.test.fake import fakemaster
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+class FakeBuilder(object):
+
+    class config(object):
+        nextSlave = None
+        nextBuild = None
+
+    def getBuilderId(self):
+        return defer.succeed(1)
+
+    def getAvailableSlaves(self):
+        return []
+
+
+def thdPopulate(conn, model, num_requests):
+    conn.execute(model.builders.insert(),
+                 dict(id=1, name='builder', name_hash='b'))
+    conn.execute(model.sourcestamps.insert(),
+                 dict(id=1, ss_hash='x', branch='master', revision='abcd',
+                      repository='repo', codebase='', project='',
+                      created_at=0))
+    conn.execute(model.buildsets.insert(),
+                 dict(id=1, reason='because', submitted_at=0, complete=0,
+                      results=-1))
+    conn.execute(model.buildset_sourcestamps.insert(),
+                 dict(buildsetid=1, sourcestampid=1))
+    conn.execute(model.buildrequests.insert(),
+                 [dict(id=i, buildsetid=1, builderid=1, priority=0,
+                       complete=0, results=-1, submitted_at=1400000000 + i,
+                       complete_at=None, waited_for=0)
+                  for i in xrange(1, num_requests + 1)])
+
+
+@defer.inlineCallbacks
+def timeFetch(name, master, bldr, index, repeat=5):
+    best = None
+    for _ in range(repeat):
+        bc = buildrequestdistributor.BasicBuildChooser(bldr, master)
+        bc.unclaimedBuildRequests = index
+        start = time.time()
+        yield bc._fetchUnclaimedBrdicts()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print "%-10s %8.2fms" % (name, best * 1000)
+
+
+@defer.inlineCallbacks
+def main(num_requests):
+    master = fakemaster.make_master()
+    master.db = db = connector.DBConnector(master, '.')
+    db._engine = enginestrategy.create_engine('sqlite://', basedir='.')
+    db.pool = pool.DBThreadPool(db._engine)
+    yield db.pool.do(lambda conn: db.model.metadata.create_all(bind=conn))
+    yield db.pool.do(thdPopulate, db.model, num_requests)
+    master.data = dataconnector.DataConnector(master)
+
+    bldr = FakeBuilder()
+    index = buildrequestdistributor.UnclaimedBuildRequests(master)
+    yield index.getUnclaimedBrdicts(1)
+
+    print "%d unclaimed build requests" % (num_requests,)
+    yield timeFetch('data API', master, bldr, None)
+    yield timeFetch('index', master, bldr, index)
+    db.pool.shutdown()
+
+
+if __name__ == '__main__':
+    num_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    d = main(num_requests)
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
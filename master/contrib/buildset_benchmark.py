@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# usage: python buildset_benchmark.py [num_builders] [db_url]
+#
+# Times the database side of a build forced on every builder: adding a
+# buildset with a build request for each builder, then claiming, unclaiming,
+# reclaiming and completing those requests.  The default database is a
+# temporary sqlite file.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from buildbot.db import connector
+from buildbot.db import enginestrategy
+from buildbot.db import pool
+from buildbot.test.fake import fakemaster
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+def thdPopulate(conn, model, num_builders):
+    conn.execute(model.builders.insert(),
+                 [dict(id=i, name='builder%d' % i, name_hash='b%d' % i)
+                  for i in xrange(1, num_builders + 1)])
+    conn.execute(model.sourcestamps.insert(),
+                 dict(id=1, ss_hash='x', branch='master', revision='abcd',
+                      repository='repo', codebase='', project='',
+                      created_at=0))
+
+
+@defer.inlineCallbacks
+def timeIt(name, fn, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        yield fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print "%-20s %8.1fms" % (name, best * 1000)
+
+
+@defer.inlineCallbacks
+def main(num_builders, db_url):
+    master = fakemaster.make_master()
+    master.masterid = 1
+    master.db = db = connector.DBConnector(master, '.')
+    db._engine = enginestrategy.create_engine(db_url, basedir='.')
+    db.pool = pool.DBThreadPool(db._engine)
+    yield db.pool.do(lambda conn: db.model.metadata.create_all(bind=conn))
+    yield db.pool.do(thdPopulate, db.model, num_builders)
+    builderids = range(1, num_builders + 1)
+
+    print "%d builders" % (num_builders,)
+    brids = []
+
+    @defer.inlineCallbacks
+    def addBuildset():
+        bsid, bsbrids = yield db.buildsets.addBuildset(
+            sourcestamps=[1], reason='force', properties={},
+            builderids=builderids, waited_for=False)
+        brids[:] = bsbrids.values()
+    yield timeIt('addBuildset', addBuildset)
+
+    @defer.inlineCallbacks
+    def claimUnclaim():
+        yield db.buildrequests.claimBuildRequests(brids)
+        yield db.buildrequests.reclaimBuildRequests(brids)
+        yield db.buildrequests.unclaimBuildRequests(brids)
+    yield timeIt('claim/reclaim/unclaim', claimUnclaim)
+
+    yield timeIt('completeBuildRequests', lambda:
+                 db.buildrequests.completeBuildRequests(brids, 0),
+                 repeat=1)
+    db.pool.shutdown()
+
+
+if __name__ == '__main__':
+    num_builders = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    tmpdir = None
+    if len(sys.argv) > 2:
+        db_url = sys.argv[2]
+    else:
+        tmpdir = tempfile.mkdtemp()
+        db_url = 'sqlite:///' + os.path.join(tmpdir, 'state.sqlite')
+    d = main(num_builders, db_url)
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+    if tmpdir:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+# usage: PYTHONPATH=.:../slave python cas_upload_benchmark.py [num_files] [file_kb]
+#
+# Uploads a directory of num_files files of file_kb each from a slave
+# directory upload command straight into a master DirectoryWriter, with and
+# without a content store, three times: into an empty store, unchanged, and
+# with a tenth of the files changed.  Prints the bytes sent and the time taken
+# for each upload.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from buildbot.process import remotetransfer
+from buildslave.commands import transfer
+from buildslave.test.fake.remote import FakeRemote
+from buildslave.test.fake.slavebuilder import FakeSlaveBuilder
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+class CountingWriter(object):
+
+    # passes calls on to a DirectoryWriter, counting the bytes written
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.sent = 0
+
+    def remote_write(self, data):
+        self.sent += len(data)
+        return self.writer.remote_write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+
+@defer.inlineCallbacks
+def upload(basedir, cas, run):
+    store = None
+    if cas:
+        store = remotetransfer.ContentStore(os.path.join(basedir, 'cas'))
+    destdir = os.path.join(basedir, 'dest', '%s-%d' % (cas, run))
+    writer = CountingWriter(remotetransfer.DirectoryWriter(
+        destdir, None, None, 0600, store))
+    builder = FakeSlaveBuilder(basedir=basedir)
+    args = dict(workdir='.', slavesrc='src', writer=FakeRemote(writer),
+                maxsize=None, blocksize=64 * 1024, compress=None,
+                window=8, maxblocksize=1024 * 1024)
+    if cas:
+        args['cas'] = True
+    cmd = transfer.SlaveDirectoryUploadCommand(builder, 'upload', args)
+    start = time.time()
+    yield cmd.doStart()
+    elapsed = time.time() - start
+    srcdir = os.path.join(basedir, 'src')
+    for name in os.listdir(srcdir):
+        with open(os.path.join(srcdir, name), 'rb') as src:
+            with open(os.path.join(destdir, name), 'rb') as dest:
+                assert src.read() == dest.read(), name
+    print "%-16s %-12s %8.1fMB sent %8.1fMB saved %8.1fms" % (
+        'content store' if cas else 'no store', ['empty', 'unchanged',
+                                                 '10% changed'][run],
+        writer.sent / 1024. / 1024, writer.writer.saved / 1024. / 1024,
+        elapsed * 1000)
+
+
+@defer.inlineCallbacks
+def main(num_files, file_kb, basedir):
+    srcdir = os.path.join(basedir, 'src')
+    os.makedirs(srcdir)
+
+    def writeFiles(count):
+        for i in xrange(count):
+            with open(os.path.join(srcdir, 'file%d' % i), 'wb') as f:
+                f.write(os.urandom(file_kb * 1024))
+
+    print "%d files of %dKB" % (num_files, file_kb)
+    writeFiles(num_files)
+    for cas in (False, True):
+        for run in range(3):
+            if run == 2:
+                writeFiles(num_files // 10)
+            yield upload(basedir, cas, run)
+
+
+if __name__ == '__main__':
+    num_files = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    file_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    basedir = tempfile.mkdtemp()
+    d = main(num_files, file_kb, basedir)
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+    shutil.rmtree(basedir)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+# usage: python changes_benchmark.py [num_changes] [db_url]
+#
+# Times loading changes from the database, each with a few files and
+# properties: the most recent 50 with getRecentChanges, and all of them with
+# getChanges.  The chdicts cache is empty for each run.  The default database
+# is a temporary sqlite file.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from buildbot.db import connector
+from buildbot.db import enginestrategy
+from buildbot.db import pool
+from buildbot.test.fake import fakemaster
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+def thdPopulate(conn, model, num_changes):
+    conn.execute(model.sourcestamps.insert(),
+                 dict(id=1, ss_hash='x', branch='master', revision='abcd',
+                      repository='repo', codebase='', project='',
+                      created_at=0))
+    changeids = range(1, num_changes + 1)
+    conn.execute(model.changes.insert(),
+                 [dict(changeid=i, author='me', comments='change %d' % i,
+                       branch='master', revision='%040x' % i, revlink='',
+                       when_timestamp=i, category=None, repository='repo',
+                       codebase='', project='', sourcestampid=1)
+                  for i in changeids])
+    conn.execute(model.change_files.insert(),
+                 [dict(changeid=i, filename='file%d.c' % j)
+                  for i in changeids for j in range(3)])
+    conn.execute(model.change_properties.insert(),
+                 [dict(changeid=i, property_name='prop%d' % j,
+                       property_value='["value", "Change"]')
+                  for i in changeids for j in range(2)])
+
+
+@defer.inlineCallbacks
+def timeIt(name, fn, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        yield fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print "%-20s %8.1fms" % (name, best * 1000)
+
+
+@defer.inlineCallbacks
+def main(num_changes, db_url):
+    # the fake master's caches do not cache anything
+    master = fakemaster.make_master()
+    master.db = db = connector.DBConnector(master, '.')
+    db._engine = enginestrategy.create_engine(db_url, basedir='.')
+    db.pool = pool.DBThreadPool(db._engine)
+    yield db.pool.do(lambda conn: db.model.metadata.create_all(bind=conn))
+    yield db.pool.do(thdPopulate, db.model, num_changes)
+
+    print "%d changes" % (num_changes,)
+    yield timeIt('getRecentChanges(50)', lambda:
+                 db.changes.getRecentChanges(50))
+    yield timeIt('getChanges()', db.changes.getChanges, repeat=3)
+    db.pool.shutdown()
+
+
+if __name__ == '__main__':
+    num_changes = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    tmpdir = None
+    if len(sys.argv) > 2:
+        db_url = sys.argv[2]
+    else:
+        tmpdir = tempfile.mkdtemp()
+        db_url = 'sqlite:///' + os.path.join(tmpdir, 'state.sqlite')
+    d = main(num_changes, db_url)
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+    if tmpdir:
+        shutil.rmtree(tmpdir)
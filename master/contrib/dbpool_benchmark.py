@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# usage: python dbpool_benchmark.py [num_calls] [concurrency]
+#
+# Runs num_calls short queries through a DBThreadPool on a temporary sqlite
+# file, concurrency at a time, with and without the per-callable metrics,
+# and prints the time per call and the resulting DBThreadPool histograms.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from buildbot.db import enginestrategy
+from buildbot.db import pool
+from buildbot.process import metrics
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+
+
+def query(conn):
+    return conn.execute("SELECT 1").fetchall()
+
+
+@defer.inlineCallbacks
+def runCalls(dbpool, num_calls, concurrency):
+    def calls():
+        for _ in xrange(num_calls):
+            yield dbpool.do(query)
+    work = calls()
+    start = time.time()
+    yield defer.DeferredList([task.cooperate(work).whenDone()
+                              for _ in range(concurrency)])
+    defer.returnValue(time.time() - start)
+
+
+@defer.inlineCallbacks
+def main(num_calls, concurrency, db_url):
+    engine = enginestrategy.create_engine(db_url, basedir='.')
+    dbpool = pool.DBThreadPool(engine, pool_size=2, pool_max_size=8)
+    observer = metrics.MetricLogObserver()
+    observer.enable()
+
+    # warm up, and let the adaptive pool grow
+    yield runCalls(dbpool, 500, concurrency)
+    elapsed = yield runCalls(dbpool, num_calls, concurrency)
+    print "with metrics:    %6.1fus per call (%d threads)" % (
+        elapsed / num_calls * 1e6, dbpool.max)
+
+    recordStats = dbpool._recordStats
+    dbpool._recordStats = lambda res, stats: res
+    elapsed = yield runCalls(dbpool, num_calls, concurrency)
+    print "without metrics: %6.1fus per call" % (elapsed / num_calls * 1e6,)
+    dbpool._recordStats = recordStats
+
+    dbpool.flushStats()
+    print observer.getHandler(metrics.MetricHistogramEvent).report()
+    observer.disable()
+    dbpool.shutdown()
+
+
+if __name__ == '__main__':
+    num_calls = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    tmpdir = tempfile.mkdtemp()
+    db_url = 'sqlite:///' + os.path.join(tmpdir, 'state.sqlite')
+    d = main(num_calls, concurrency, db_url)
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# usage: python logcompression_benchmark.py [num_lines] [db_url]
+#
+# Writes a log of num_lines lines of compiler-like output, in chunks of 100
+# lines as appends would, and compacts it with compressLog using each
+# c['logCompressionMethod'] (lz4 only if it is installed).  For each method
+# it prints the bytes stored and saved, the time compressLog took, and the
+# latency of reading random 100-line windows with getLogLines, with the
+# decompressed chunk cache cleared before each read.  The default database
+# is a temporary sqlite file.
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from buildbot.db import connector
+from buildbot.db import enginestrategy
+from buildbot.db import logs
+from buildbot.db import pool
+from buildbot.process import metrics
+from buildbot.test.fake import fakemaster
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+def makeLines(num_lines):
+    rnd = random.Random(0)
+    lines = []
+    for _ in xrange(num_lines):
+        n = rnd.randint(0, 500)
+        if rnd.random() < 0.9:
+            lines.append('gcc -c -O2 -Wall -Iinclude src/mod%d/file%d.c '
+                         '-o build/mod%d/file%d.o' % (n % 20, n, n % 20, n))
+        else:
+            lines.append("src/mod%d/file%d.c:%d:5: warning: unused variable "
+                         "'tmp%d' [-Wunused-variable]"
+                         % (n % 20, n, rnd.randint(1, 2000), n))
+    return lines
+
+
+def thdPopulate(conn, model, lines):
+    conn.execute(model.logchunks.delete())
+    conn.execute(model.logs.delete())
+    conn.execute(model.logs.insert(),
+                 dict(id=1, name='stdio', slug='stdio', stepid=1, complete=1,
+                      num_lines=len(lines), type='s'))
+    conn.execute(model.logchunks.insert(),
+                 [dict(logid=1, first_line=i, last_line=i + 99,
+                       content='\n'.join(lines[i:i + 100]), compressed=0)
+                  for i in xrange(0, len(lines), 100)])
+
+
+def thdStoredBytes(conn, model):
+    tbl = model.logchunks
+    return sum(len(row.content) for row in conn.execute(
+        tbl.select(whereclause=tbl.c.logid == 1)))
+
+
+@defer.inlineCallbacks
+def timeMethod(db, method, lines, reads=200):
+    yield db.pool.do(thdPopulate, db.model, lines)
+    raw = yield db.pool.do(thdStoredBytes, db.model)
+    db.master.config.logCompressionMethod = method
+    start = time.time()
+    yield db.logs.compressLog(1)
+    compress_time = time.time() - start
+    stored = yield db.pool.do(thdStoredBytes, db.model)
+
+    rnd = random.Random(1)
+    latency = metrics.Histogram()
+    for _ in xrange(reads):
+        first = rnd.randint(0, len(lines) - 100)
+        db.logs.decompressedChunks = logs.DecompressedChunkCache(
+            db.logs.DECOMPRESSED_CACHE_SIZE)
+        start = time.time()
+        yield db.logs.getLogLines(1, first, first + 99)
+        latency.add(time.time() - start)
+    stats = latency.asDict()
+    print "%-4s %6.1fMB stored, %7dKB saved, compress %5.2fs, " \
+        "read mean %5.2fms, p90 %5.2fms" % (
+            method, stored / 1e6, (raw - stored) / 1000, compress_time,
+            stats['mean'] * 1000, stats['p90'] * 1000)
+
+
+@defer.inlineCallbacks
+def main(num_lines, db_url):
+    master = fakemaster.make_master()
+    master.db = db = connector.DBConnector(master, '.')
+    db._engine = enginestrategy.create_engine(db_url, basedir='.')
+    db.pool = pool.DBThreadPool(db._engine)
+    yield db.pool.do(lambda conn: db.model.metadata.create_all(bind=conn))
+    lines = makeLines(num_lines)
+    print "%d lines, %.1fMB" % (num_lines,
+                                sum(len(l) + 1 for l in lines) / 1e6)
+    methods = ['raw', 'gz', 'bz2']
+    if logs.lz4 is not None:
+        methods.append('lz4')
+    for method in methods:
+        yield timeMethod(db, method, lines)
+    db.pool.shutdown()
+
+
+if __name__ == '__main__':
+    num_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    tmpdir = None
+    if len(sys.argv) > 2:
+        db_url = sys.argv[2]
+    else:
+        tmpdir = tempfile.mkdtemp()
+        db_url = 'sqlite:///' + os.path.join(tmpdir, 'state.sqlite')
+    d = main(num_lines, db_url)
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+    if tmpdir:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+# usage: python loglines_benchmark.py [num_lines] [method] [db_url]
+#
+# Writes a log of num_lines lines, compacts it with compressLog using the
+# given c['logCompressionMethod'] (default 'gz'), and reads random 100-line
+# windows of it with getLogLines.  It prints the latency of those reads, and
+# how long trimming the chunks to the requested lines takes, both as
+# getLogLines does it, by splitting the chunk, and as it would take with a
+# precomputed index of the offset of each line in the chunk.  The default
+# database is a temporary sqlite file.
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from buildbot.db import connector
+from buildbot.db import enginestrategy
+from buildbot.db import pool
+from buildbot.process import metrics
+from buildbot.test.fake import fakemaster
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+def thdPopulate(conn, model, num_lines):
+    line = 'gcc -c -O2 -Wall -Iinclude src/mod%d/file%d.c -o build/file%d.o'
+    conn.execute(model.logs.insert(),
+                 dict(id=1, name='stdio', slug='stdio', stepid=1, complete=1,
+                      num_lines=num_lines, type='s'))
+    conn.execute(model.logchunks.insert(),
+                 [dict(logid=1, first_line=i, last_line=i + 99,
+                       content='\n'.join(line % (j % 20, j, j)
+                                         for j in xrange(i, i + 100)),
+                       compressed=0)
+                  for i in xrange(0, num_lines, 100)])
+
+
+def thdGetChunks(conn, model, logs):
+    tbl = model.logchunks
+    return [(row.first_line, row.last_line,
+             logs._thdChunkContent(1, row))
+            for row in conn.execute(tbl.select(whereclause=tbl.c.logid == 1))]
+
+
+def trimSplit(content, first, last, first_line, last_line):
+    if first < first_line:
+        content = content.split('\n', first_line - first)[-1]
+    if last > last_line:
+        content = content.rsplit('\n', last - last_line)[0]
+    return content
+
+
+def trimIndex(content, offsets, first, last, first_line, last_line):
+    start = offsets[max(first_line - first, 0)]
+    end = offsets[min(last_line, last) - first + 1] - 1
+    return content[start:end]
+
+
+def timeTrim(chunks, windows):
+    # time each way of trimming the chunks that cover each window
+    index = dict((first, [0] + [i + 1 for i, c in enumerate(content)
+                                if c == '\n'] + [len(content) + 1])
+                 for first, _, content in chunks)
+    covering = [[(first, last, content) for first, last, content in chunks
+                 if first <= last_line and last >= first_line]
+                for first_line, last_line in windows]
+    for (first_line, last_line), chunks in zip(windows, covering):
+        for first, last, content in chunks:
+            assert (trimSplit(content, first, last, first_line, last_line) ==
+                    trimIndex(content, index[first], first, last,
+                              first_line, last_line))
+    results = []
+    for trim in 'split', 'index':
+        start = time.time()
+        for (first_line, last_line), chunks in zip(windows, covering):
+            for first, last, content in chunks:
+                if trim == 'split':
+                    trimSplit(content, first, last, first_line, last_line)
+                else:
+                    trimIndex(content, index[first], first, last,
+                              first_line, last_line)
+        results.append((time.time() - start) / len(windows))
+    return results
+
+
+@defer.inlineCallbacks
+def main(num_lines, method, db_url, reads=1000):
+    master = fakemaster.make_master()
+    master.db = db = connector.DBConnector(master, '.')
+    db._engine = enginestrategy.create_engine(db_url, basedir='.')
+    db.pool = pool.DBThreadPool(db._engine)
+    yield db.pool.do(lambda conn: db.model.metadata.create_all(bind=conn))
+    yield db.pool.do(thdPopulate, db.model, num_lines)
+    master.config.logCompressionMethod = method
+    yield db.logs.compressLog(1)
+    chunks = yield db.pool.do(thdGetChunks, db.model, db.logs)
+    print "%d lines in %d chunks, compressed with %s" % (
+        num_lines, len(chunks), method)
+
+    rnd = random.Random(0)
+    windows = []
+    for _ in xrange(reads):
+        first = rnd.randint(0, num_lines - 100)
+        windows.append((first, first + 99))
+    latency = metrics.Histogram()
+    for first_line, last_line in windows:
+        start = time.time()
+        lines = yield db.logs.getLogLines(1, first_line, last_line)
+        latency.add(time.time() - start)
+        assert lines.count('\n') == 100
+    stats = latency.asDict()
+    split, index = timeTrim(chunks, windows)
+    print "getLogLines: mean %6.3fms, p90 %6.3fms" % (
+        stats['mean'] * 1000, stats['p90'] * 1000)
+    print "trimming:    split %6.3fms, offset index %6.3fms" % (
+        split * 1000, index * 1000)
+    db.pool.shutdown()
+
+
+if __name__ == '__main__':
+    num_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    method = sys.argv[2] if len(sys.argv) > 2 else 'gz'
+    tmpdir = None
+    if len(sys.argv) > 3:
+        db_url = sys.argv[3]
+    else:
+        tmpdir = tempfile.mkdtemp()
+        db_url = 'sqlite:///' + os.path.join(tmpdir, 'state.sqlite')
+    d = main(num_lines, method, db_url)
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+    if tmpdir:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# usage: python mq_benchmark.py [num_messages]
+#
+# Measures the throughput of the 'tcp' MQ implementation: a broker and two
+# TcpMQ instances, standing in for two masters, run in this process and talk
+# over loopback TCP.  One of them produces messages as fast as it can, and the
+# other one consumes them.
+
+import sys
+import time
+
+from buildbot.mq import tcp
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+
+
+class FakeConfig(object):
+
+    def __init__(self, **mq):
+        self.mq = mq
+
+
+@defer.inlineCallbacks
+def startMQ(**mq):
+    m = tcp.TcpMQ(None)
+    yield m.reconfigServiceWithBuildbotConfig(FakeConfig(**mq))
+    yield m.startService()
+    defer.returnValue(m)
+
+
+@defer.inlineCallbacks
+def main(num_messages):
+    producer = yield startMQ(listen='tcp:0:interface=127.0.0.1')
+    broker = 'tcp:host=127.0.0.1:port=%d' % producer.brokerPort.getHost().port
+    producer.broker = broker
+    producer._connect()
+    consumer = yield startMQ(broker=broker)
+
+    done = defer.Deferred()
+    received = [0]
+
+    def cb(key, msg):
+        received[0] += 1
+        if received[0] == num_messages:
+            done.callback(None)
+    yield consumer.startConsuming(cb, ('builds', None, 'new'))
+
+    # wait for both masters to be connected and subscribed
+    while not (producer.protocol and consumer.protocol):
+        yield task.deferLater(reactor, 0.01, lambda: None)
+    yield task.deferLater(reactor, 0.1, lambda: None)
+
+    msg = dict(buildid=1, number=1, builderid=1, buildrequestid=1,
+               buildslaveid=1, masterid=1, started_at=1440000000,
+               complete=False, state_string=u'starting', results=None)
+    start = time.time()
+    for i in xrange(num_messages):
+        msg['buildid'] = i
+        producer.produce(('builds', str(i), 'new'), msg)
+        if i % 1000 == 999:
+            # give the reactor a chance to send and receive
+            yield task.deferLater(reactor, 0, lambda: None)
+    yield done
+    elapsed = time.time() - start
+
+    print "%d messages in %.2fs: %d messages/s" % (
+        num_messages, elapsed, num_messages / elapsed)
+    yield consumer.stopService()
+    yield producer.stopService()
+
+
+if __name__ == '__main__':
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    d = main(num_messages)
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+# usage: python mq_dispatch_benchmark.py [num_subscriptions] [rate] [duration]
+#
+# Subscribes num_subscriptions consumers to a SimpleMQ, with a mix of the
+# filters the web UI uses (per-build, per-step and per-log, plus a few
+# wildcards), and produces build, step, log and build request messages at
+# `rate` messages per second for `duration` seconds.  This is done once with
+# the linear scan over every subscription that SimpleMQ.produce used to do,
+# and once with its routing-key trie.  For each, it prints the time taken to
+# dispatch each message, the share of the reactor's time that took, and the
+# rate of messages actually produced.
+
+import random
+import sys
+import time
+
+from buildbot.mq import simple
+from buildbot.process import metrics
+from buildbot.util import tuplematch
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+
+
+class LinearMQ(simple.SimpleMQ):
+
+    # SimpleMQ, dispatching as it did before the trie
+
+    def produce(self, routingKey, data):
+        for qref in self.linear:
+            if tuplematch.matchTuple(routingKey, qref.filter):
+                qref.invoke(routingKey, data)
+
+
+def makeFilters(num_subscriptions, num_builds):
+    rnd = random.Random(0)
+    filters = []
+    for i in xrange(num_subscriptions):
+        kind = rnd.random()
+        if kind < 0.01:
+            filters.append(rnd.choice([('builds', None, None),
+                                       ('buildrequests', None, None, None),
+                                       ('steps', None, None)]))
+        elif kind < 0.4:
+            filters.append(('builds', str(rnd.randrange(num_builds)), None))
+        elif kind < 0.7:
+            filters.append(('steps', str(rnd.randrange(num_builds * 10)),
+                            None))
+        else:
+            filters.append(('logs', str(rnd.randrange(num_builds * 20)),
+                            'append'))
+    return filters
+
+
+def makeKeys(count, num_builds):
+    rnd = random.Random(1)
+    keys = []
+    for i in xrange(count):
+        kind = rnd.random()
+        if kind < 0.6:
+            keys.append(('logs', str(rnd.randrange(num_builds * 20)),
+                         'append'))
+        elif kind < 0.8:
+            keys.append(('steps', str(rnd.randrange(num_builds * 10)),
+                         rnd.choice(['started', 'finished'])))
+        elif kind < 0.95:
+            keys.append(('builds', str(rnd.randrange(num_builds)),
+                         rnd.choice(['new', 'finished'])))
+        else:
+            keys.append(('buildrequests', '1', str(rnd.randrange(100)),
+                         'claimed'))
+    return keys
+
+
+@defer.inlineCallbacks
+def timeDispatch(mq, filters, keys, rate, duration):
+    delivered = [0]
+
+    def callback(key, data):
+        delivered[0] += 1
+    for filter in filters:
+        yield mq.startConsuming(callback, filter)
+    mq.linear = mq.qrefs.values()
+
+    # produce in batches of 10 messages, each when it is due
+    latency = metrics.Histogram()
+    busy = [0.0]
+    keys = iter(keys)
+    data = dict(buildid=1, number=1, complete=False)
+
+    def produce():
+        for _ in xrange(10):
+            start = time.time()
+            mq.produce(keys.next(), data)
+            elapsed = time.time() - start
+            latency.add(elapsed)
+            busy[0] += elapsed
+    start = time.time()
+    loop = task.LoopingCall(produce)
+    d = loop.start(10.0 / rate)
+    reactor.callLater(duration, loop.stop)
+    yield d
+    elapsed = time.time() - start
+    defer.returnValue((latency.asDict(), busy[0] / elapsed,
+                       latency.count / elapsed, delivered[0]))
+
+
+@defer.inlineCallbacks
+def main(num_subscriptions, rate, duration, num_builds=2000):
+    filters = makeFilters(num_subscriptions, num_builds)
+    keys = makeKeys(int(rate * duration * 2), num_builds)
+    print "%d subscriptions, %d messages/s for %ds" % (
+        num_subscriptions, rate, duration)
+    for name, cls in ('linear', LinearMQ), ('trie', simple.SimpleMQ):
+        stats, busy, achieved, delivered = yield timeDispatch(
+            cls(None), filters, keys, rate, duration)
+        print "%-6s dispatch mean %8.1fus, p90 %8.1fus, reactor %5.1f%% " \
+            "busy, %6.0f messages/s, %d deliveries" % (
+                name, stats['mean'] * 1e6, stats['p90'] * 1e6, busy * 100,
+                achieved, delivered)
+
+
+if __name__ == '__main__':
+    num_subscriptions = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rate = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    duration = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    d = main(num_subscriptions, rate, duration)
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
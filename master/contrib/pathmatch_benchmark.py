@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+# usage: python pathmatch_benchmark.py [iterations]
+#
+# Times DataConnector.getEndpoint for a concrete path matching each of the
+# registered endpoint path patterns.
+
+import sys
+import time
+
+from buildbot.data import connector
+from buildbot.util import pathmatch
+
+SAMPLE_VALUES = {'n': '17', 'i': 'sample_name', '': 'sample'}
+
+
+def samplePath(pattern):
+    path = []
+    for elt in pattern:
+        mo = pathmatch.Matcher.path_elt_re.match(elt)
+        path.append(SAMPLE_VALUES[mo.group(1)] if mo else elt)
+    return tuple(path)
+
+
+def main(iterations):
+    data = connector.DataConnector(None)
+    paths = [samplePath(pattern)
+             for pattern, _ in data.matcher.iterPatterns()]
+    # compile the matcher before starting the clock
+    data.getEndpoint(paths[0])
+
+    start = time.time()
+    for _ in xrange(iterations):
+        for path in paths:
+            data.getEndpoint(path)
+    elapsed = time.time() - start
+    lookups = iterations * len(paths)
+    print "%d patterns, %d lookups in %.2fs: %.1fus per lookup" % (
+        len(paths), lookups, elapsed, elapsed / lookups * 1e6)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
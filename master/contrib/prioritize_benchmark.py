@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+# usage: python prioritize_benchmark.py [num_builders [num_requests]]
+#
+# Times one pass of the BuildRequestDistributor's default builder sort over an
+# in-memory sqlite database with the given number of builders and build
+# requests, about a fifth of which are claimed or complete.  For comparison,
+# it also times a sort based on Builder.getOldestRequestTime, which issues one
+# query per builder.
+
+import random
+import sys
+import time
+
+from buildbot.data import connector as dataconnector
+from buildbot.db import connector
+from buildbot.db import enginestrategy
+from buildbot.db import pool
+from buildbot.process import builder
+from buildbot.process import buildrequestdistributor
+from buildbot.test.fake import fakemaster
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+class FakeBuilder(object):
+
+    getOldestRequestTime = builder.Builder.__dict__['getOldestRequestTime']
+
+    def __init__(self, master, builderid):
+        self.master = master
+        self.name = 'builder%d' % builderid
+        self.builderid = builderid
+
+    def getBuilderId(self):
+        return defer.succeed(self.builderid)
+
+
+@defer.inlineCallbacks
+def perBuilderSorter(master, builders):
+    times = yield defer.gatherResults(
+        [b.getOldestRequestTime() for b in builders])
+    xformed = sorted(zip(times, builders),
+                     key=lambda xf: (xf[0] is None, xf[0]))
+    defer.returnValue([xf[1] for xf in xformed])
+
+
+def thdPopulate(conn, model, num_builders, num_requests):
+    rnd = random.Random(0)
+    conn.execute(model.masters.insert(),
+                 dict(id=1, name='master', name_hash='m', active=1,
+                      last_active=0))
+    conn.execute(model.builders.insert(),
+                 [dict(id=i, name='builder%d' % i, name_hash='%d' % i)
+                  for i in xrange(1, num_builders + 1)])
+    conn.execute(model.sourcestamps.insert(),
+                 dict(id=1, ss_hash='x', branch='master', revision='abcd',
+                      repository='repo', codebase='', project='',
+                      created_at=0))
+    conn.execute(model.buildsets.insert(),
+                 dict(id=1, reason='because', submitted_at=0, complete=0,
+                      results=-1))
+    conn.execute(model.buildset_sourcestamps.insert(),
+                 dict(buildsetid=1, sourcestampid=1))
+    reqs, claims = [], []
+    for i in xrange(1, num_requests + 1):
+        complete = rnd.random() < 0.1
+        reqs.append(dict(id=i, buildsetid=1,
+                         builderid=rnd.randint(1, num_builders),
+                         priority=0, complete=complete, results=-1,
+                         submitted_at=1400000000 + rnd.randint(0, 10 ** 6),
+                         complete_at=None, waited_for=0))
+        if not complete and rnd.random() < 0.1:
+            claims.append(dict(brid=i, masterid=1, claimed_at=1400000000))
+    conn.execute(model.buildrequests.insert(), reqs)
+    conn.execute(model.buildrequest_claims.insert(), claims)
+
+
+@defer.inlineCallbacks
+def timeSort(name, sorter, master, builders, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        yield sorter(master, builders)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print "%-16s %8.1fms" % (name, best * 1000)
+
+
+@defer.inlineCallbacks
+def main(num_builders, num_requests):
+    master = fakemaster.make_master()
+    master.db = db = connector.DBConnector(master, '.')
+    db._engine = enginestrategy.create_engine('sqlite://', basedir='.')
+    db.pool = pool.DBThreadPool(db._engine)
+    yield db.pool.do(lambda conn: db.model.metadata.create_all(bind=conn))
+    yield db.pool.do(thdPopulate, db.model, num_builders, num_requests)
+    master.data = dataconnector.DataConnector(master)
+
+    builders = [FakeBuilder(master, i) for i in xrange(1, num_builders + 1)]
+    brd = buildrequestdistributor.BuildRequestDistributor(master.botmaster)
+
+    print "%d builders, %d build requests" % (num_builders, num_requests)
+    yield timeSort('per-builder', perBuilderSorter, master, builders)
+    yield timeSort('_defaultSorter', brd._defaultSorter, master, builders)
+    db.pool.shutdown()
+
+
+if __name__ == '__main__':
+    num_builders = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    num_requests = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+    d = main(num_builders, num_requests)
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
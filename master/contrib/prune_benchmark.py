@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+# usage: python prune_benchmark.py [num_builds] [db_url]
+#
+# Fills a database with num_builds finished builds, each with a few steps,
+# logs and log chunks, and then prunes all but 10 of them with several
+# values of c['db']['prune_batch_size'], reporting the time taken, the rows
+# and bytes reclaimed, and the worst latency of a query made while the
+# pruning runs.  The default database is a temporary sqlite file.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from buildbot.db import connector
+from buildbot.db import enginestrategy
+from buildbot.db import pool
+from buildbot.test.fake import fakemaster
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+def thdPopulate(conn, model, num_builds):
+    conn.execute(model.builds.delete())
+    conn.execute(model.steps.delete())
+    conn.execute(model.logs.delete())
+    conn.execute(model.logchunks.delete())
+    conn.execute(model.build_properties.delete())
+    content = '\n'.join(['compiling something or other'] * 100)
+    builds, props, steps, logs, chunks = [], [], [], [], []
+    for buildid in xrange(1, num_builds + 1):
+        builds.append(dict(id=buildid, number=buildid, builderid=1,
+                           buildrequestid=1, buildslaveid=1, masterid=1,
+                           started_at=0, complete_at=1, results=0,
+                           state_string='done'))
+        props.append(dict(buildid=buildid, name='got_revision',
+                          value='"abcd"', source='Build'))
+        for i in range(5):
+            stepid = buildid * 5 + i
+            steps.append(dict(id=stepid, number=i, name='step%d' % i,
+                              buildid=buildid, complete_at=1,
+                              state_string='done', urls_json='[]'))
+            logs.append(dict(id=stepid, name='stdio', slug='stdio',
+                             stepid=stepid, complete=1, num_lines=1000,
+                             type='s'))
+            for j in range(10):
+                chunks.append(dict(logid=stepid, first_line=j * 100,
+                                   last_line=j * 100 + 99, content=content,
+                                   compressed=0))
+    for tbl, rows in [(model.builds, builds), (model.build_properties, props),
+                      (model.steps, steps), (model.logs, logs),
+                      (model.logchunks, chunks)]:
+        conn.execute(tbl.insert(), rows)
+
+
+@defer.inlineCallbacks
+def timePrune(db, num_builds, batch_n):
+    yield db.pool.do(thdPopulate, db.model, num_builds)
+    stopping = []
+    latencies = []
+
+    @defer.inlineCallbacks
+    def reader():
+        while not stopping:
+            start = time.time()
+            yield db.builds.getBuild(num_builds)
+            latencies.append(time.time() - start)
+
+    d = reader()
+    start = time.time()
+    pruned = yield db.builds.pruneBuilds(10, batch_n=batch_n)
+    elapsed = time.time() - start
+    stopping.append(True)
+    yield d
+    print "batch %6d: %6.1fs, %7d rows, %5.1fMB, worst query %7.1fms" % (
+        batch_n, elapsed, sum(pruned['rows'].values()),
+        pruned['bytes']['logchunks'] / 1e6, max(latencies) * 1000)
+
+
+@defer.inlineCallbacks
+def main(num_builds, db_url):
+    master = fakemaster.make_master()
+    master.masterid = 1
+    master.db = db = connector.DBConnector(master, '.')
+    db._engine = enginestrategy.create_engine(db_url, basedir='.')
+    db.pool = pool.DBThreadPool(db._engine)
+    yield db.pool.do(lambda conn: db.model.metadata.create_all(bind=conn))
+    print "%d builds, 5 steps each, 10 log chunks per step" % (num_builds,)
+    for batch_n in (50, 500, num_builds):
+        yield timePrune(db, num_builds, batch_n)
+    db.pool.shutdown()
+
+
+if __name__ == '__main__':
+    num_builds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    tmpdir = None
+    if len(sys.argv) > 2:
+        db_url = sys.argv[2]
+    else:
+        tmpdir = tempfile.mkdtemp()
+        db_url = 'sqlite:///' + os.path.join(tmpdir, 'state.sqlite')
+    d = main(num_builds, db_url)
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+    if tmpdir:
+        shutil.rmtree(tmpdir)
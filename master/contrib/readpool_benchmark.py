@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# usage: python readpool_benchmark.py [num_builds] [readers] [pool_size] [db_url]
+#
+# Times claiming and unclaiming a build request while `readers` clients keep
+# listing num_builds builds and a running build keeps appending to its log,
+# first with every query on one database pool and then with
+# c['db']['read_db_url'] pointing a second pool at the same database.  The
+# default database is a temporary sqlite file.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from buildbot.db import connector
+from buildbot.db import enginestrategy
+from buildbot.db import pool
+from buildbot.process import metrics
+from buildbot.test.fake import fakemaster
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+def thdPopulate(conn, model, num_builds):
+    conn.execute(model.buildrequests.insert(),
+                 dict(id=1, buildsetid=1, builderid=1, submitted_at=0))
+    conn.execute(model.builds.insert(),
+                 [dict(id=i, number=i, builderid=1, buildrequestid=1,
+                       buildslaveid=1, masterid=1, started_at=i,
+                       state_string='building')
+                  for i in xrange(1, num_builds + 1)])
+    conn.execute(model.logs.insert(),
+                 dict(id=1, name='stdio', slug='stdio', stepid=1, complete=0,
+                      num_lines=0, type='s'))
+
+
+def thdAppend(conn, model, line):
+    conn.execute(model.logchunks.insert(),
+                 dict(logid=1, first_line=line, last_line=line,
+                      content='gcc -c -O2 src/file%d.c' % line, compressed=0))
+
+
+@defer.inlineCallbacks
+def timeClaims(db, readers, duration=3):
+    stopping = []
+    reads = []
+
+    @defer.inlineCallbacks
+    def reader():
+        while not stopping:
+            yield db.builds.getBuilds()
+            reads.append(None)
+
+    @defer.inlineCallbacks
+    def appender():
+        line = 0
+        while not stopping:
+            yield db.pool.do(thdAppend, db.model, line)
+            line += 1
+
+    readers = [reader() for _ in range(readers)] + [appender()]
+    latency = metrics.Histogram()
+    end = time.time() + duration
+    while time.time() < end:
+        start = time.time()
+        yield db.buildrequests.claimBuildRequests([1])
+        yield db.buildrequests.unclaimBuildRequests([1])
+        latency.add(time.time() - start)
+    stopping.append(True)
+    yield defer.DeferredList(readers)
+    defer.returnValue((latency, len(reads)))
+
+
+@defer.inlineCallbacks
+def main(num_builds, readers, pool_size, db_url):
+    master = fakemaster.make_master()
+    master.masterid = 1
+    master.db = db = connector.DBConnector(master, '.')
+    db._engine = enginestrategy.create_engine(db_url, basedir='.')
+    db.pool = pool.DBThreadPool(db._engine, pool_size=pool_size)
+    yield db.pool.do(lambda conn: db.model.metadata.create_all(bind=conn))
+    yield db.pool.do(thdPopulate, db.model, num_builds)
+    print "%d builds, %d readers, %d threads per pool" % (
+        num_builds, readers, pool_size)
+
+    for read_db_url in (None, db_url):
+        if read_db_url:
+            read_pool = pool.DBThreadPool(
+                enginestrategy.create_engine(read_db_url, basedir='.'),
+                pool_size=pool_size, name='DBReadThreadPool')
+            db.pool.setReadPool(read_pool)
+        latency, reads = yield timeClaims(db, readers)
+        stats = latency.asDict()
+        print "%-14s %5d claims, mean %7.1fms, p90 %7.1fms, max %7.1fms, " \
+            "%d reads" % (
+                'read pool:' if read_db_url else 'single pool:',
+                stats['count'], stats['mean'] * 1000, stats['p90'] * 1000,
+                stats['max'] * 1000, reads)
+    read_pool.shutdown()
+    db.pool.shutdown()
+
+
+if __name__ == '__main__':
+    num_builds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    readers = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    pool_size = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    tmpdir = None
+    if len(sys.argv) > 4:
+        db_url = sys.argv[4]
+    else:
+        tmpdir = tempfile.mkdtemp()
+        db_url = 'sqlite:///' + os.path.join(tmpdir, 'state.sqlite')
+    d = main(num_builds, readers, pool_size, db_url)
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+    if tmpdir:
+        shutil.rmtree(tmpdir)
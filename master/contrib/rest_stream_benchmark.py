@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+# usage: python rest_stream_benchmark.py [num_builds]
+#
+# Compares encoding a large REST collection response in one piece, as
+# json.dumps, with encoding it incrementally through buildbot.www.jsonstream.
+# Each mode runs in a fresh subprocess, and reports the time until the first
+# bytes of the response are ready, the total encoding time, and the peak
+# resident memory of the process.
+
+import datetime
+import resource
+import subprocess
+import sys
+import time
+
+from buildbot.util import json
+from buildbot.util import toJson
+from buildbot.www import jsonstream
+
+MODES = ['buffered', 'streamed', 'ndjson']
+
+
+def makeBuilds(num_builds):
+    epoch = datetime.datetime(2015, 1, 1)
+    return [dict(buildid=i + 1, number=i // 20 + 1, builderid=i % 20,
+                 buildrequestid=i + 1, buildslaveid=i % 50, masterid=1,
+                 started_at=epoch + datetime.timedelta(seconds=i * 60),
+                 complete_at=epoch + datetime.timedelta(seconds=i * 60 + 600),
+                 complete=True, state_string=u'build successful', results=0)
+            for i in xrange(num_builds)]
+
+
+def chunks(mode, builds):
+    meta = dict(total=len(builds))
+    if mode == 'buffered':
+        return [json.dumps(dict(builds=builds, meta=meta), default=toJson,
+                           sort_keys=True, indent=2)]
+    if mode == 'streamed':
+        pieces = jsonstream.encodeResponse('builds', builds, meta,
+                                           compact=False)
+    else:
+        pieces = jsonstream.encodeNdjson(builds)
+    return jsonstream._chunks(pieces, jsonstream.CHUNK_SIZE)
+
+
+def runMode(mode, num_builds):
+    builds = makeBuilds(num_builds)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    ttfb = None
+    size = 0
+    for chunk in chunks(mode, builds):
+        if ttfb is None:
+            ttfb = time.time() - start
+        size += len(chunk)
+    elapsed = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print "%-9s %6.1fMB  first bytes %8.2fms  total %7.0fms  " \
+        "peak RSS +%.1fMB" % (mode, size / 1e6, ttfb * 1000, elapsed * 1000,
+                              (peak - baseline) / 1024.)
+
+
+def main(num_builds):
+    print "%d builds" % (num_builds,)
+    for mode in MODES:
+        subprocess.check_call([sys.executable, __file__, str(num_builds),
+                               mode])
+
+
+if __name__ == '__main__':
+    num_builds = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    if len(sys.argv) > 2:
+        runMode(sys.argv[2], num_builds)
+    else:
+        main(num_builds)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+# usage: python resultspec_benchmark.py [num_builds]
+#
+# Times ResultSpec.apply for the query shapes commonly sent to the REST API,
+# over a collection of synthetic build dictionaries.
+
+import datetime
+import random
+import sys
+import timeit
+
+from buildbot.data import resultspec
+
+Filter = resultspec.Filter
+
+QUERIES = [
+    ('order=-number&limit=20',
+     dict(order=['-number'], limit=20)),
+    ('order=-number&offset=5000&limit=50',
+     dict(order=['-number'], offset=5000, limit=50)),
+    ('builderid=7&order=-number&limit=20',
+     dict(filters=[Filter('builderid', 'eq', [7])], order=['-number'],
+          limit=20)),
+    ('complete=false',
+     dict(filters=[Filter('complete', 'eq', [False])])),
+    ('results__ne=0&order=-complete_at',
+     dict(filters=[Filter('results', 'ne', [0])], order=['-complete_at'])),
+    ('builderid=1&builderid=2&results=2&field=buildid&field=number',
+     dict(filters=[Filter('builderid', 'eq', [1, 2]),
+                   Filter('results', 'eq', [2])],
+          fields=['buildid', 'number', 'builderid', 'results'])),
+    ('order=builderid&order=-number&limit=100',
+     dict(order=['builderid', '-number'], limit=100)),
+    ('order=-started_at',
+     dict(order=['-started_at'])),
+]
+
+
+def makeBuilds(num_builds):
+    rnd = random.Random(0)
+    epoch = datetime.datetime(2015, 1, 1)
+    builds = []
+    for i in xrange(num_builds):
+        complete = rnd.random() < 0.95
+        started_at = epoch + datetime.timedelta(seconds=i * 60)
+        builds.append({
+            'buildid': i + 1,
+            'number': i // 20 + 1,
+            'builderid': i % 20,
+            'buildrequestid': i + 1,
+            'buildslaveid': rnd.randint(1, 50),
+            'masterid': 1,
+            'started_at': started_at,
+            'complete_at': (started_at + datetime.timedelta(seconds=600)
+                            if complete else None),
+            'complete': complete,
+            'state_string': u'finished' if complete else u'building',
+            'results': rnd.choice([0, 0, 0, 1, 2, 4]) if complete else None,
+        })
+    return builds
+
+
+def main(num_builds):
+    builds = makeBuilds(num_builds)
+    print "%d builds" % (num_builds,)
+    for name, kwargs in QUERIES:
+        def run():
+            resultspec.ResultSpec(**kwargs).apply(builds)
+        times = timeit.repeat(run, number=1, repeat=5)
+        print "%8.1fms  %s" % (min(times) * 1000, name)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+# usage: python statement_cache_benchmark.py [num_calls] [db_url]
+#
+# Measures the rate of the database connector's most frequent calls (state,
+# build request, build, step and log lookups and updates), made one at a
+# time so that each pays the full cost of preparing its statement.  The
+# default database is a temporary sqlite file.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from buildbot.db import connector
+from buildbot.db import enginestrategy
+from buildbot.db import pool
+from buildbot.test.fake import fakemaster
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+def thdPopulate(conn, model):
+    conn.execute(model.builders.insert(),
+                 dict(id=1, name='builder', name_hash='b'))
+    conn.execute(model.buildsets.insert(),
+                 dict(id=1, reason='force', submitted_at=0,
+                      complete=0, results=-1))
+    conn.execute(model.sourcestamps.insert(),
+                 dict(id=1, ss_hash='x', branch='master', revision='abcd',
+                      repository='repo', codebase='', project='',
+                      created_at=0))
+    conn.execute(model.buildset_sourcestamps.insert(),
+                 dict(buildsetid=1, sourcestampid=1))
+    conn.execute(model.buildrequests.insert(),
+                 dict(id=1, buildsetid=1, builderid=1, submitted_at=0))
+    conn.execute(model.builds.insert(),
+                 dict(id=1, number=1, builderid=1, buildrequestid=1,
+                      buildslaveid=1, masterid=1, started_at=0,
+                      state_string='building'))
+    conn.execute(model.steps.insert(),
+                 dict(id=1, number=0, name='step', buildid=1,
+                      state_string='running', urls_json='[]'))
+    conn.execute(model.logs.insert(),
+                 dict(id=1, name='stdio', slug='stdio', stepid=1,
+                      complete=0, num_lines=0, type='s'))
+
+
+@defer.inlineCallbacks
+def timeIt(name, fn, num_calls):
+    start = time.time()
+    for i in xrange(num_calls):
+        yield fn(i)
+    elapsed = time.time() - start
+    print "%-20s %8.0f ops/sec" % (name, num_calls / elapsed)
+
+
+@defer.inlineCallbacks
+def main(num_calls, db_url):
+    master = fakemaster.make_master()
+    master.masterid = 1
+    master.db = db = connector.DBConnector(master, '.')
+    db._engine = enginestrategy.create_engine(db_url, basedir='.')
+    db.pool = pool.DBThreadPool(db._engine)
+    yield db.pool.do(lambda conn: db.model.metadata.create_all(bind=conn))
+    yield db.pool.do(thdPopulate, db.model)
+    objectid = yield db.state.getObjectId('bench', 'Benchmark')
+
+    yield timeIt('setState', lambda i:
+                 db.state.setState(objectid, 'x', i), num_calls)
+    yield timeIt('getState', lambda i:
+                 db.state.getState(objectid, 'x'), num_calls)
+    yield timeIt('getBuildRequest', lambda i:
+                 db.buildrequests.getBuildRequest(1), num_calls)
+    yield timeIt('getBuildRequests', lambda i:
+                 db.buildrequests.getBuildRequests(builderid=1,
+                                                   claimed=False),
+                 num_calls)
+    yield timeIt('getBuild', lambda i: db.builds.getBuild(1), num_calls)
+    yield timeIt('setBuildStateString', lambda i:
+                 db.builds.setBuildStateString(1, 'step %d' % i), num_calls)
+    yield timeIt('getStep', lambda i: db.steps.getStep(1), num_calls)
+    yield timeIt('setStepStateString', lambda i:
+                 db.steps.setStepStateString(1, 'line %d' % i), num_calls)
+    yield timeIt('appendLog', lambda i:
+                 db.logs.appendLog(1, u'line %d\n' % i), num_calls)
+    yield timeIt('getLogLines', lambda i:
+                 db.logs.getLogLines(1, i, i), num_calls)
+    db.pool.shutdown()
+
+
+if __name__ == '__main__':
+    num_calls = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    tmpdir = None
+    if len(sys.argv) > 2:
+        db_url = sys.argv[2]
+    else:
+        tmpdir = tempfile.mkdtemp()
+        db_url = 'sqlite:///' + os.path.join(tmpdir, 'state.sqlite')
+    d = main(num_calls, db_url)
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+    if tmpdir:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+# usage: python transfer_latency_benchmark.py [uploads] [size_mb] [basedir]
+#
+# Runs several concurrent uploads into FileWriters, and gzipped directory
+# uploads into DirectoryWriters, delivering a 64k block to each writer on
+# every turn of the reactor as a fast slave connection would, and prints how
+# late a 10ms timer fired meanwhile, as a measure of how responsive the
+# reactor stayed to the web UI and slave keepalives.
+
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+from buildbot.process import remotetransfer
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+
+BLOCKSIZE = 64 * 1024
+INTERVAL = 0.01
+
+
+class LagMonitor(object):
+
+    def __init__(self):
+        self.lags = []
+        self.last = None
+        self.loop = task.LoopingCall(self.tick)
+
+    def tick(self):
+        now = time.time()
+        if self.last is not None:
+            self.lags.append(max(0, now - self.last - INTERVAL))
+        self.last = now
+
+    def start(self):
+        self.loop.start(INTERVAL)
+
+    def stop(self):
+        self.loop.stop()
+        lags = sorted(self.lags) or [0]
+        return (lags[len(lags) // 2] * 1000,
+                lags[len(lags) * 99 // 100] * 1000, lags[-1] * 1000)
+
+
+@defer.inlineCallbacks
+def upload(writer, data, finish):
+    for i in xrange(0, len(data), BLOCKSIZE):
+        yield writer.remote_write(data[i:i + BLOCKSIZE])
+        # let the reactor run, as it would between blocks from the network
+        yield task.deferLater(reactor, 0, lambda: None)
+    yield finish()
+
+
+def makeTarball(basedir, size):
+    srcdir = os.path.join(basedir, 'src')
+    os.makedirs(srcdir)
+    for i in range(size // (1024 * 1024)):
+        with open(os.path.join(srcdir, 'file%d' % i), 'wb') as f:
+            f.write(os.urandom(512 * 1024) + '\0' * (512 * 1024))
+    tarname = os.path.join(basedir, 'src.tar.gz')
+    archive = tarfile.open(tarname, 'w:gz')
+    archive.add(srcdir, '')
+    archive.close()
+    with open(tarname, 'rb') as f:
+        return f.read()
+
+
+@defer.inlineCallbacks
+def timeUploads(name, makeWriter, data, uploads, finish):
+    monitor = LagMonitor()
+    monitor.start()
+    start = time.time()
+    yield defer.gatherResults([upload(w, data, getattr(w, finish))
+                               for w in [makeWriter(i)
+                                         for i in range(uploads)]])
+    elapsed = time.time() - start
+    print ("%-16s %7.1fMB/s  reactor lag median %6.1fms p99 %6.1fms "
+           "max %6.1fms" % ((name, uploads * len(data) / elapsed / 1024 / 1024)
+                            + monitor.stop()))
+
+
+@defer.inlineCallbacks
+def main(uploads, size, basedir):
+    print "%d concurrent uploads of %dMB" % (uploads, size / 1024 / 1024)
+    data = os.urandom(size)
+    yield timeUploads('file upload', lambda i: remotetransfer.FileWriter(
+        os.path.join(basedir, 'file%d' % i), None, None),
+        data, uploads, 'remote_close')
+
+    data = makeTarball(basedir, size)
+    yield timeUploads('directory (gz)', lambda i: remotetransfer.DirectoryWriter(
+        os.path.join(basedir, 'dir%d' % i), None, 'gz', 0600),
+        data, uploads, 'remote_unpack')
+
+
+if __name__ == '__main__':
+    uploads = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    size = int(float(sys.argv[2]) * 1024 * 1024) if len(sys.argv) > 2 \
+        else 64 * 1024 * 1024
+    basedir = tempfile.mkdtemp(dir=sys.argv[3] if len(sys.argv) > 3 else None)
+    d = main(uploads, size, basedir)
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+    shutil.rmtree(basedir)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+# usage: PYTHONPATH=.:../slave python update_benchmark.py [output_mb] [switch]
+#
+# Feeds output_mb of compiler-like build output, interleaved across stdout,
+# stderr and a logfile (switching stream after each line with probability
+# switch), through a slave RunProcess and SlaveBuilder, with and without
+# batched updates.  For each mode it prints the number of update calls, the
+# bytes they take on the wire, the slave CPU time spent producing them, and
+# the master CPU time spent decoding them and handing them to a
+# RemoteCommand, per MB of build output.
+
+import random
+import sys
+import time
+import zlib
+
+from buildbot.process import remotecommand
+from buildslave import base
+from buildslave import runprocess
+from twisted.internet import defer
+from twisted.spread import banana
+from twisted.spread import jelly
+
+
+class FakeRemoteStep(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def callRemote(self, method, updates):
+        self.calls.append(updates)
+        return defer.succeed(0)
+
+
+class FakeLog(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.size = 0
+
+    def getName(self):
+        return self.name
+
+    def addStdout(self, data):
+        self.size += len(data)
+
+    addStderr = addHeader = addStdout
+
+
+class FakeBuildSlave(object):
+
+    def messageReceivedFromSlave(self):
+        pass
+
+
+def makeOutput(output_mb, switch):
+    rnd = random.Random(0)
+    streams = ['stdout', 'stderr', ('log', 'test.log')]
+    stream = 'stdout'
+    lines = []
+    size = 0
+    while size < output_mb * 1024 * 1024:
+        n = rnd.randint(0, 500)
+        if stream == 'stdout':
+            line = 'gcc -c -O2 -Wall -Iinclude src/mod%d/file%d.c -o build/mod%d/file%d.o\n' % (
+                n % 20, n, n % 20, n)
+        elif stream == 'stderr':
+            line = 'src/mod%d/file%d.c:%d:5: warning: unused variable \'tmp%d\' [-Wunused-variable]\n' % (
+                n % 20, n, rnd.randint(1, 2000), n)
+        else:
+            line = 'test_mod%d.TestFile%d.test_case_%d ... ok (%.3fs)\n' % (
+                n % 20, n, rnd.randint(1, 50), rnd.random())
+        lines.append((stream, line))
+        size += len(line)
+        if rnd.random() < switch:
+            stream = rnd.choice(streams)
+    return lines, size
+
+
+def runSlave(lines, batch):
+    sb = base.SlaveBuilderBase('sb')
+    sb.running = True
+    sb.usePTY = False
+    sb.remoteStep = step = FakeRemoteStep()
+    sb.batchUpdates = batch
+    if batch:
+        sb.compressor = zlib.compressobj()
+    rp = runprocess.RunProcess(sb, ['true'], '.', logEnviron=False)
+    rp.sendStatus = sb.sendUpdate
+
+    start = time.clock()
+    for stream, line in lines:
+        rp._addToBuffers(stream, line)
+        # the reactor would send the batch once this read was handled
+        if sb.pendingUpdates:
+            sb.flushUpdates()
+    rp._sendBuffers()
+    sb.flushUpdates()
+    return step.calls, time.clock() - start
+
+
+def runMaster(wire):
+    cmd = remotecommand.RemoteCommand('shell', {})
+    cmd.buildslave = FakeBuildSlave()
+    cmd.active = True
+    for name in 'stdio', 'test.log':
+        cmd.useLog(FakeLog(name))
+
+    start = time.clock()
+    for data in wire:
+        message = jelly.unjelly(banana.decode(data))
+        cmd.remote_update(message[4][0])
+    return time.clock() - start, cmd
+
+
+def main(output_mb, switch):
+    lines, size = makeOutput(output_mb, switch)
+    mb = size / (1024.0 * 1024)
+    print "%.1fMB of output in %d lines, switch %.2f" % (mb, len(lines), switch)
+    for batch in False, True:
+        calls, slave_time = runSlave(lines, batch)
+        # roughly what PB puts on the wire for each call
+        wire = [banana.encode(jelly.jelly(['message', i, 'update', 1,
+                                           (updates,), {}]))
+                for i, updates in enumerate(calls)]
+        wire_bytes = sum(len(data) for data in wire)
+        master_time, cmd = runMaster(wire)
+        received = sum(log_.size for log_ in cmd.logs.values())
+        assert received == size, (received, size)
+        print "%-10s %6d calls %8.1fKB wire/MB  slave %6.1fms/MB  master %6.1fms/MB" % (
+            'batched' if batch else 'unbatched', len(calls),
+            wire_bytes / mb / 1024, slave_time / mb * 1000,
+            master_time / mb * 1000)
+
+
+if __name__ == '__main__':
+    output_mb = float(sys.argv[1]) if len(sys.argv) > 1 else 20
+    switch = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    main(output_mb, switch)
@@ -16,6 +16,7 @@
 import os.path
 import socket
 import sys
+import zlib
 
 from twisted.application import service
 from twisted.internet import defer
@@ -58,9 +59,20 @@ class SlaveBuilderBase(service.Service):
 
     bf = None
 
+    # when the master asks for it, updates are queued and sent in batches of
+    # up to updateBatchSize bytes, and strings of at least compressThreshold
+    # bytes in them are compressed
+    batchUpdates = False
+    updateBatchSize = 128 * 1024
+    compressThreshold = 256
+
     def __init__(self, name):
         # service.Service.__init__(self) # Service has no __init__ method
         self.setName(name)
+        self.pendingUpdates = []
+        self.pendingSize = 0
+        self.flushTimer = None
+        self.compressor = None
 
     def __repr__(self):
         return "<SlaveBuilder '%s' at %d>" % (self.name, id(self))
@@ -84,6 +96,7 @@ class SlaveBuilderBase(service.Service):
         service.Service.stopService(self)
         if self.stopCommandOnShutdown:
             self.stopCommand()
+        self.flushUpdates()
 
     def activity(self):
         bot = self.parent
@@ -108,6 +121,7 @@ class SlaveBuilderBase(service.Service):
     def lostRemoteStep(self, remotestep):
         log.msg("lost remote step")
         self.remoteStep = None
+        self.flushUpdates()
         if self.stopCommandOnShutdown:
             self.stopCommand()
 
@@ -133,6 +147,11 @@ class SlaveBuilderBase(service.Service):
             log.msg("leftover command, dropping it")
             self.stopCommand()
 
+        # newer masters ask for batched, compressed updates; this is not an
+        # argument of the command itself
+        args = args.copy()
+        batchUpdates = args.pop('batchUpdates', False)
+
         try:
             factory = registry.getFactory(command)
         except KeyError:
@@ -140,6 +159,10 @@ class SlaveBuilderBase(service.Service):
         self.command = factory(self, stepId, args)
 
         log.msg(" startCommand:%s [id %s]" % (command, stepId))
+        # anything still queued belongs to the previous step
+        self.flushUpdates()
+        self.batchUpdates = batchUpdates
+        self.compressor = zlib.compressobj() if batchUpdates else None
         self.remoteStep = stepref
         self.remoteStep.notifyOnDisconnect(self.lostRemoteStep)
         d = self.command.doStart()
@@ -186,12 +209,67 @@ class SlaveBuilderBase(service.Service):
         # master still expects to receive. Provide it to avoid significant
         # interoperability issues between new slaves and old masters.
         if self.remoteStep:
+            if self.batchUpdates:
+                self.queueUpdate(data)
+                return
             update = [data, 0]
             updates = [update]
             d = self.remoteStep.callRemote("update", updates)
             d.addCallback(self.ackUpdate)
             d.addErrback(self._ackFailed, "SlaveBuilder.sendUpdate")
 
+    def queueUpdate(self, data):
+        """Add an update to the next batch, compressing its larger strings.
+        The batch is sent once the reactor has nothing else to do, or as soon
+        as it reaches updateBatchSize, so the order of the updates is kept."""
+        data, size = self._compressUpdate(data)
+        self.pendingUpdates.append([data, 0])
+        self.pendingSize += size
+        if self.pendingSize >= self.updateBatchSize:
+            self.flushUpdates()
+        elif self.flushTimer is None:
+            self.flushTimer = reactor.callLater(0, self.flushUpdates)
+
+    def _compressUpdate(self, data):
+        # all of a command's strings go through one zlib stream, so that
+        # later output can refer back to earlier output; the keys under
+        # 'zlib' give the order in which the master must decompress them
+        compressed = []
+        size = 0
+        for key in ('header', 'stdout', 'stderr', 'log'):
+            if key not in data:
+                continue
+            if key == 'log':
+                logname, text = data[key]
+            else:
+                text = data[key]
+            if not isinstance(text, str) or len(text) < self.compressThreshold:
+                size += len(text)
+                continue
+            text = (self.compressor.compress(text) +
+                    self.compressor.flush(zlib.Z_SYNC_FLUSH))
+            size += len(text)
+            if not compressed:
+                data = data.copy()
+            compressed.append(key)
+            data[key] = (logname, text) if key == 'log' else text
+        if compressed:
+            data['zlib'] = compressed
+        return data, size
+
+    def flushUpdates(self):
+        """Send the queued updates to the master in a single call."""
+        if self.flushTimer is not None:
+            if self.flushTimer.active():
+                self.flushTimer.cancel()
+            self.flushTimer = None
+        updates, self.pendingUpdates = self.pendingUpdates, []
+        self.pendingSize = 0
+        if updates and self.remoteStep:
+            d = self.remoteStep.callRemote("update", updates)
+            d.addCallback(self.ackUpdate)
+            d.addErrback(self._ackFailed, "SlaveBuilder.flushUpdates")
+
     def ackUpdate(self, acknum):
         self.activity()  # update the "last activity" timer
 
@@ -219,6 +297,7 @@ class SlaveBuilderBase(service.Service):
             log.msg(" but we weren't running, quitting silently")
             return
         if self.remoteStep:
+            self.flushUpdates()
             self.remoteStep.dontNotifyOnDisconnect(self.lostRemoteStep)
             d = self.remoteStep.callRemote("complete", failure)
             d.addCallback(self.ackComplete)
@@ -37,7 +37,7 @@ from buildslave.interfaces import ISlaveCommand
 # this used to be a CVS $-style "Revision" auto-updated keyword, but since I
 # moved to Darcs as the primary repository, this is updated manually each
 # time this file is changed. The last cvs_ver that was here was 1.51 .
-command_version = "2.16"
+command_version = "2.19"
 
 # version history:
 #  >=1.17: commands are interruptable
@@ -72,6 +72,12 @@ command_version = "2.16"
 #  >= 2.16: 'sigtermTime' option is added to SlaveShellCommand
 #  >= 2.16: runprocess supports obfuscation via tuples (#1748)
 #  >= 2.16: listdir command added to read a directory
+#  >= 2.17: uploadFile, uploadDirectory and downloadFile accept 'window' and
+#           'maxblocksize', to pipeline blocks
+#  >= 2.18: uploadFile and uploadDirectory accept 'cas', to send digests first
+#           and skip the files the master already has
+#  >= 2.19: startCommand accepts 'batchUpdates', to send updates in batches
+#           and compress their larger strings
 
 
 class Command:
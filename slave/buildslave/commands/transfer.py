@@ -13,18 +13,193 @@
 #
 # Copyright Buildbot Team Members
 
+import bz2
+import hashlib
 import os
 import tarfile
-import tempfile
+import zlib
+
+from cStringIO import StringIO
 
 from twisted.internet import defer
+from twisted.internet import threads
+from twisted.python import failure
 from twisted.python import log
 
 from buildslave.commands.base import Command
 
 
+def fileDigest(fp, chunksize=64 * 1024):
+    """
+    Return the hex sha256 digest of the rest of the file C{fp}.
+    """
+    hasher = hashlib.sha256()
+    while True:
+        data = fp.read(chunksize)
+        if not data:
+            return hasher.hexdigest()
+        hasher.update(data)
+
+
+class TarStream(object):
+
+    """
+    A file-like object whose read() returns successive parts of a tar archive
+    of the directory C{path}, optionally compressed with 'gz' or 'bz2'.  The
+    archive is generated as it is read, a file at a time, so only a little
+    more than the requested amount of it is ever held in memory.  The archive
+    is the same as C{tarfile} would write for C{add(path, '')}.
+
+    The files named in C{cached}, a dictionary mapping their names in the
+    archive to their digests, are archived without their data, with a
+    C{BUILDBOT.cached} pax header giving the digest instead.
+    """
+
+    chunksize = 64 * 1024
+
+    def __init__(self, path, compress=None, cached=None):
+        self.path = path
+        self.cached = cached or {}
+        self.buffer = ''
+        self.blocks = self._archive()
+        if compress == 'bz2':
+            self.compressor = bz2.BZ2Compressor()
+        elif compress == 'gz':
+            self.compressor = zlib.compressobj(9, zlib.DEFLATED,
+                                               16 + zlib.MAX_WBITS)
+        else:
+            self.compressor = None
+
+    def read(self, size):
+        while len(self.buffer) < size and self.blocks is not None:
+            try:
+                data = self.blocks.next()
+                if self.compressor is not None:
+                    data = self.compressor.compress(data)
+            except StopIteration:
+                self.blocks = None
+                data = self.compressor.flush() if self.compressor else ''
+            self.buffer += data
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        if self.blocks is not None:
+            self.blocks.close()
+            self.blocks = None
+        self.buffer = ''
+
+    def _archive(self):
+        # this archive is only used for its gettarinfo and format settings;
+        # nothing is written to it
+        archive = tarfile.TarFile(fileobj=StringIO(), mode='w')
+        offset = 0
+        for data in self._members(archive, self.path, ''):
+            offset += len(data)
+            yield data
+
+        # end the archive just as TarFile.close does
+        yield tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+        offset += tarfile.BLOCKSIZE * 2
+        remainder = offset % tarfile.RECORDSIZE
+        if remainder:
+            yield tarfile.NUL * (tarfile.RECORDSIZE - remainder)
+
+    def _members(self, archive, name, arcname):
+        tarinfo = archive.gettarinfo(name, arcname)
+        if tarinfo is None:
+            # sockets and the like are not archived
+            return
+        if tarinfo.isreg() and arcname in self.cached:
+            tarinfo.size = 0
+            tarinfo.pax_headers = {'BUILDBOT.cached': self.cached[arcname]}
+            yield tarinfo.tobuf(tarfile.PAX_FORMAT, archive.encoding,
+                                archive.errors)
+            return
+        yield tarinfo.tobuf(archive.format, archive.encoding, archive.errors)
+
+        if tarinfo.isreg():
+            remaining = tarinfo.size
+            with open(name, 'rb') as f:
+                while remaining:
+                    data = f.read(min(remaining, self.chunksize))
+                    if not data:
+                        raise IOError("end of file reached")
+                    remaining -= len(data)
+                    yield data
+            remainder = tarinfo.size % tarfile.BLOCKSIZE
+            if remainder:
+                yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+
+        elif tarinfo.isdir():
+            for f in os.listdir(name):
+                for data in self._members(archive, os.path.join(name, f),
+                                          os.path.join(arcname, f)):
+                    yield data
+
+
 class TransferCommand(Command):
 
+    # number of blocks to keep in flight, and the size the blocks may grow
+    # to; masters that do not know about pipelining send neither, so the
+    # transfer goes one fixed-size block at a time
+    window = 1
+    maxblocksize = None
+
+    def setupWindow(self, args):
+        self.window = args.get('window', 1)
+        self.maxblocksize = max(args.get('maxblocksize') or 0, self.blocksize)
+        self._inflight = 0
+        self._eof = False
+        self._filling = False
+
+    def _loop(self, fire_when_done):
+        """
+        Transfer the file, keeping up to C{self.window} blocks in flight, and
+        fire C{fire_when_done} once the last one is acknowledged.  Each block
+        is started by C{_startBlock}, and the block size doubles with each
+        acknowledged block, up to C{self.maxblocksize}.
+        """
+        self._fire_when_done = fire_when_done
+        self._fillWindow()
+        return None
+
+    def _fillWindow(self):
+        fire_when_done = self._fire_when_done
+        # blocks acknowledged synchronously call back in here, so let the
+        # outermost call do the work, rather than recursing once per block
+        if self._filling or fire_when_done.called:
+            return
+        self._filling = True
+        try:
+            while not self._eof and self._inflight < self.window:
+                d = self._startBlock()
+                if d is None:
+                    break
+                self._inflight += 1
+                d.addCallbacks(self._blockDone, self._blockFailed)
+        except Exception:
+            self._eof = True
+            fire_when_done.errback(failure.Failure())
+            return
+        finally:
+            self._filling = False
+        if not self._inflight and not fire_when_done.called:
+            fire_when_done.callback(None)
+
+    def _blockDone(self, finished):
+        self._inflight -= 1
+        if finished:
+            self._eof = True
+        self.blocksize = min(self.blocksize * 2, self.maxblocksize)
+        self._fillWindow()
+
+    def _blockFailed(self, why):
+        self._inflight -= 1
+        self._eof = True
+        if not self._fire_when_done.called:
+            self._fire_when_done.errback(why)
+
     def finished(self, res):
         if self.debug:
             log.msg('finished: stderr=%r, rc=%r' % (self.stderr, self.rc))
@@ -60,10 +235,18 @@ class SlaveFileUploadCommand(TransferCommand):
         - ['maxsize']:   max size (in bytes) of file to write
         - ['blocksize']: max size for each data block
         - ['keepstamp']: whether to preserve file modified and accessed times
+        - ['window']:    number of blocks to send before waiting for the
+                         first to be acknowledged (default 1)
+        - ['maxblocksize']: size the blocks may grow to (default blocksize)
+        - ['cas']:       whether to send the file's digest first, and skip
+                         sending the file if the master already has it
     """
     debug = False
     requiredArgs = ['workdir', 'slavesrc', 'writer', 'blocksize']
 
+    # number of digests to send to the master in each 'cached' call
+    digestBatchSize = 1000
+
     def setup(self, args):
         self.workdir = args['workdir']
         self.filename = args['slavesrc']
@@ -71,6 +254,8 @@ class SlaveFileUploadCommand(TransferCommand):
         self.remaining = args['maxsize']
         self.blocksize = args['blocksize']
         self.keepstamp = args.get('keepstamp', False)
+        self.cas = args.get('cas', False)
+        self.setupWindow(args)
         self.stderr = None
         self.rc = 0
 
@@ -101,7 +286,12 @@ class SlaveFileUploadCommand(TransferCommand):
         self.sendStatus({'header': "sending %s" % self.path})
 
         d = defer.Deferred()
-        self._reactor.callLater(0, self._loop, d)
+        if self.cas and self.fp is not None:
+            found = self._findCached()
+            found.addCallback(lambda _: self._loop(d))
+            found.addErrback(d.errback)
+        else:
+            self._reactor.callLater(0, self._loop, d)
 
         def _close_ok(res):
             self.fp = None
@@ -130,27 +320,34 @@ class SlaveFileUploadCommand(TransferCommand):
         d.addBoth(self.finished)
         return d
 
-    def _loop(self, fire_when_done):
-        d = defer.maybeDeferred(self._writeBlock)
-
-        def _done(finished):
-            if finished:
-                fire_when_done.callback(None)
-            else:
-                self._loop(fire_when_done)
-
-        def _err(why):
-            fire_when_done.errback(why)
-        d.addCallbacks(_done, _err)
-        return None
+    def _findCached(self):
+        # a file truncated to maxsize is not the file the master may have
+        if self.remaining is not None and \
+                os.path.getsize(self.path) > self.remaining:
+            return defer.succeed(None)
+        d = threads.deferToThread(fileDigest, self.fp)
+
+        @d.addCallback
+        def check(digest):
+            self.fp.seek(0)
+            return self.writer.callRemote('cached', [digest])
+
+        @d.addCallback
+        def skip(cached):
+            if cached:
+                if self.debug:
+                    log.msg("master has '%s' already" % self.path)
+                self.fp.close()
+                self.fp = None
+        return d
 
-    def _writeBlock(self):
+    def _startBlock(self):
         """Write a block of data to the remote writer"""
 
         if self.interrupted or self.fp is None:
             if self.debug:
-                log.msg('SlaveFileUploadCommand._writeBlock(): end')
-            return True
+                log.msg('SlaveFileUploadCommand._startBlock(): end')
+            return None
 
         length = self.blocksize
         if self.remaining is not None and length > self.remaining:
@@ -166,11 +363,12 @@ class SlaveFileUploadCommand(TransferCommand):
             data = self.fp.read(length)
 
         if self.debug:
-            log.msg('SlaveFileUploadCommand._writeBlock(): ' +
+            log.msg('SlaveFileUploadCommand._startBlock(): ' +
                     'allowed=%d readlen=%d' % (length, len(data)))
         if len(data) == 0:
-            log.msg("EOF: callRemote(close)")
-            return True
+            if not self._inflight:
+                log.msg("EOF: callRemote(close)")
+            return None
 
         if self.remaining is not None:
             self.remaining = self.remaining - len(data)
@@ -191,6 +389,8 @@ class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
         self.remaining = args['maxsize']
         self.blocksize = args['blocksize']
         self.compress = args['compress']
+        self.cas = args.get('cas', False)
+        self.setupWindow(args)
         self.stderr = None
         self.rc = 0
 
@@ -204,27 +404,16 @@ class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
         if self.debug:
             log.msg("path: %r" % self.path)
 
-        # Create temporary archive
-        fd, self.tarname = tempfile.mkstemp()
-        fileobj = os.fdopen(fd, 'w')
-        if self.compress == 'bz2':
-            mode = 'w|bz2'
-        elif self.compress == 'gz':
-            mode = 'w|gz'
-        else:
-            mode = 'w'
-        archive = tarfile.open(name=self.tarname, mode=mode, fileobj=fileobj)
-        archive.add(self.path, '')
-        archive.close()
-        fileobj.close()
-
-        # Transfer it
-        self.fp = open(self.tarname, 'rb')
-
+        self.fp = None
         self.sendStatus({'header': "sending %s" % self.path})
 
         d = defer.Deferred()
-        self._reactor.callLater(0, self._loop, d)
+        if self.cas:
+            found = self._findCached()
+            found.addCallback(self._startArchive, d)
+            found.addErrback(d.errback)
+        else:
+            self._startArchive({}, d)
 
         def unpack(res):
             d1 = self.writer.callRemote("unpack")
@@ -239,9 +428,53 @@ class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
         d.addBoth(self.finished)
         return d
 
+    def _startArchive(self, cached, d):
+        # Transfer an archive of the directory, made as it is sent
+        self.fp = TarStream(self.path, self.compress, cached)
+        self._reactor.callLater(0, self._loop, d)
+
+    def _findCached(self):
+        d = threads.deferToThread(self._digestFiles)
+
+        @d.addCallback
+        def ask(digests):
+            # ask the master which of the files it has, a batch at a time
+            cached = {}
+            batches = defer.succeed(None)
+            names = sorted(digests)
+            for i in xrange(0, len(names), self.digestBatchSize):
+                batch = names[i:i + self.digestBatchSize]
+                batches.addCallback(lambda _, batch=batch:
+                                    self.writer.callRemote(
+                                        'cached', [digests[name]
+                                                   for name in batch]))
+
+                @batches.addCallback
+                def found(found, batch=batch):
+                    found = set(found)
+                    for name in batch:
+                        if digests[name] in found:
+                            cached[name] = digests[name]
+            batches.addCallback(lambda _: cached)
+            return batches
+        return d
+
+    def _digestFiles(self):
+        # the digests of the regular files, by their names in the archive
+        digests = {}
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if os.path.islink(path) or not os.path.isfile(path):
+                    continue
+                with open(path, 'rb') as fp:
+                    digests[os.path.relpath(path, self.path)] = \
+                        fileDigest(fp)
+        return digests
+
     def finished(self, res):
-        self.fp.close()
-        os.remove(self.tarname)
+        if self.fp is not None:
+            self.fp.close()
         return TransferCommand.finished(self, res)
 
 
@@ -257,6 +490,9 @@ class SlaveFileDownloadCommand(TransferCommand):
         - ['maxsize']:   max size (in bytes) of file to write
         - ['blocksize']: max size for each data block
         - ['mode']:      access mode for the new file
+        - ['window']:    number of blocks to request before waiting for the
+                         first to arrive (default 1)
+        - ['maxblocksize']: size the blocks may grow to (default blocksize)
     """
     debug = False
     requiredArgs = ['workdir', 'slavedest', 'reader', 'blocksize']
@@ -268,6 +504,8 @@ class SlaveFileDownloadCommand(TransferCommand):
         self.bytes_remaining = args['maxsize']
         self.blocksize = args['blocksize']
         self.mode = args['mode']
+        self.setupWindow(args)
+        self.bytes_requested = 0
         self.stderr = None
         self.rc = 0
 
@@ -318,48 +556,43 @@ class SlaveFileDownloadCommand(TransferCommand):
         d.addBoth(self.finished)
         return d
 
-    def _loop(self, fire_when_done):
-        d = defer.maybeDeferred(self._readBlock)
-
-        def _done(finished):
-            if finished:
-                fire_when_done.callback(None)
-            else:
-                self._loop(fire_when_done)
-
-        def _err(why):
-            fire_when_done.errback(why)
-        d.addCallbacks(_done, _err)
-        return None
-
-    def _readBlock(self):
+    def _startBlock(self):
         """Read a block of data from the remote reader."""
 
         if self.interrupted or self.fp is None:
             if self.debug:
-                log.msg('SlaveFileDownloadCommand._readBlock(): end')
-            return True
+                log.msg('SlaveFileDownloadCommand._startBlock(): end')
+            return None
 
         length = self.blocksize
-        if self.bytes_remaining is not None and length > self.bytes_remaining:
-            length = self.bytes_remaining
+        if self.bytes_remaining is not None:
+            # bytes already asked for will count against bytes_remaining
+            # when they arrive
+            length = min(length, self.bytes_remaining - self.bytes_requested)
 
         if length <= 0:
-            if self.stderr is None:
+            # the limit may yet be met exactly, if the data still in flight
+            # ends the file
+            if self.stderr is None and not self.bytes_requested:
                 self.stderr = "Maximum filesize reached, truncating file '%s'" \
                     % self.path
                 self.rc = 1
-            return True
+            return None
         else:
+            self.bytes_requested += length
             d = self.reader.callRemote('read', length)
-            d.addCallback(self._writeData)
+
+            @d.addCallback
+            def received(data):
+                self.bytes_requested -= length
+                return self._writeData(data)
             return d
 
     def _writeData(self, data):
         if self.debug:
-            log.msg('SlaveFileDownloadCommand._readBlock(): readlen=%d' %
+            log.msg('SlaveFileDownloadCommand._startBlock(): readlen=%d' %
                     len(data))
-        if len(data) == 0:
+        if len(data) == 0 or self._eof:
             return True
 
         if self.bytes_remaining is not None:
@@ -16,6 +16,7 @@
 import mock
 import os
 import shutil
+import zlib
 
 from twisted.internet import defer
 from twisted.internet import reactor
@@ -292,6 +293,41 @@ class TestSlaveBuilder(command.CommandTestMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    @defer.inlineCallbacks
+    def test_startCommand_batchUpdates(self):
+        st = FakeStep()
+        out, log_ = 'hello\n' * 1000, 'log output\n' * 1000
+        self.patch_runprocess(
+            Expect(['echo', 'hello'], os.path.join(self.basedir, 'sb', 'workdir'))
+            + {'hdr': 'headers'} + {'stdout': out} + {'stderr': 'oops\n'}
+            + {'log': ('log1', log_)} + {'stdout': out} + {'rc': 0}
+            + 0,
+        )
+
+        yield self.sb.callRemote("startCommand", FakeRemote(st),
+                                 "13", "shell", dict(
+                                     command=['echo', 'hello'],
+                                     workdir='workdir', batchUpdates=True))
+        yield st.wait_for_finish()
+
+        # everything arrives in one call, in order, followed by the completion
+        self.assertEqual([a[0] for a in st.actions], ['update', 'complete'])
+        updates = [u for u, num in st.actions[0][1]]
+        self.assertTrue(len(updates[1]['stdout']) < len(out) / 10)
+        decompressor = zlib.decompressobj()
+        for update in updates:
+            for key in update.pop('zlib', []):
+                if key == 'log':
+                    logname, data = update[key]
+                    update[key] = (logname, decompressor.decompress(data))
+                else:
+                    update[key] = decompressor.decompress(update[key])
+        self.assertEqual(updates, [
+            {'hdr': 'headers'}, {'stdout': out}, {'stderr': 'oops\n'},
+            {'log': ('log1', log_)}, {'stdout': out}, {'rc': 0},
+            {'elapsed': 1},
+        ])
+
     def test_startCommand_interruptCommand(self):
         # set up a fake step to receive updates
         st = FakeStep()
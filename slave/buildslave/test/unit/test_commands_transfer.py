@@ -14,6 +14,7 @@
 # Copyright Buildbot Team Members
 
 import StringIO
+import hashlib
 import os
 import shutil
 import sys
@@ -49,10 +50,31 @@ class FakeMasterMethods(object):
 
         self.unpack_fail = False
 
+        # digests of the files the master has already
+        self.cached = set()
+
         self.written = False
         self.read = False
         self.data = ''
 
+        # the most delayed writes or reads outstanding at once
+        self.in_flight = self.max_in_flight = 0
+
+    def _delay(self, result):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        d = defer.Deferred()
+
+        def fire():
+            self.in_flight -= 1
+            d.callback(result)
+        reactor.callLater(0.01, fire)
+        return d
+
+    def remote_cached(self, digests):
+        self.add_update('cached %d' % len(digests))
+        return [digest for digest in digests if digest in self.cached]
+
     def remote_write(self, data):
         if self.write_out_of_space_at is not None:
             self.write_out_of_space_at -= len(data)
@@ -69,9 +91,7 @@ class FakeMasterMethods(object):
             self.data += data
 
         if self.delay_write:
-            d = defer.Deferred()
-            reactor.callLater(0.01, d.callback, None)
-            return d
+            return self._delay(None)
 
     def remote_read(self, length):
         if self.count_reads:
@@ -80,14 +100,13 @@ class FakeMasterMethods(object):
             self.add_update('read(s)')
             self.read = True
 
-        if not self.data:
+        # like PB, answer reads in the order they were made, even at EOF
+        if not self.data and not self.delay_read:
             return ''
 
         slice, self.data = self.data[:length], self.data[length:]
         if self.delay_read:
-            d = defer.Deferred()
-            reactor.callLater(0.01, d.callback, slice)
-            return d
+            return self._delay(slice)
         else:
             return slice
 
@@ -173,6 +192,83 @@ class TestUploadFile(CommandTestMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def test_cas_cached(self):
+        self.fakemaster.count_writes = True
+        self.fakemaster.cached.add(
+            hashlib.sha256("this is some data\n" * 10).hexdigest())
+
+        self.make_command(transfer.SlaveFileUploadCommand, dict(
+            workdir='workdir',
+            slavesrc='data',
+            writer=FakeRemote(self.fakemaster),
+            maxsize=1000,
+            blocksize=64,
+            keepstamp=False,
+            cas=True,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertUpdates([
+                {'header': 'sending %s' % self.datafile},
+                'cached 1', 'close',
+                {'rc': 0}
+            ])
+        d.addCallback(check)
+        return d
+
+    def test_cas_not_cached(self):
+        self.fakemaster.count_writes = True
+
+        self.make_command(transfer.SlaveFileUploadCommand, dict(
+            workdir='workdir',
+            slavesrc='data',
+            writer=FakeRemote(self.fakemaster),
+            maxsize=1000,
+            blocksize=64,
+            keepstamp=False,
+            cas=True,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertUpdates([
+                {'header': 'sending %s' % self.datafile},
+                'cached 1', 'write 64', 'write 64', 'write 52', 'close',
+                {'rc': 0}
+            ])
+        d.addCallback(check)
+        return d
+
+    def test_cas_truncated(self):
+        # a file larger than maxsize is sent, truncated, whatever the master
+        # has
+        self.fakemaster.count_writes = True
+
+        self.make_command(transfer.SlaveFileUploadCommand, dict(
+            workdir='workdir',
+            slavesrc='data',
+            writer=FakeRemote(self.fakemaster),
+            maxsize=100,
+            blocksize=64,
+            keepstamp=False,
+            cas=True,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertUpdates([
+                {'header': 'sending %s' % self.datafile},
+                'write 64', 'write 36', 'close',
+                {'rc': 1,
+                 'stderr': "Maximum filesize reached, truncating file '%s'" % self.datafile}
+            ])
+        d.addCallback(check)
+        return d
+
     def test_missing(self):
         self.make_command(transfer.SlaveFileUploadCommand, dict(
             workdir='workdir',
@@ -254,6 +350,66 @@ class TestUploadFile(CommandTestMixin, unittest.TestCase):
         dl.addCallback(check)
         return dl
 
+    def test_pipelined(self):
+        self.fakemaster.count_writes = True    # get actual byte counts
+        self.fakemaster.keep_data = True
+        self.fakemaster.delay_write = True
+
+        self.make_command(transfer.SlaveFileUploadCommand, dict(
+            workdir='workdir',
+            slavesrc='data',
+            writer=FakeRemote(self.fakemaster),
+            maxsize=1000,
+            blocksize=16,
+            keepstamp=False,
+            window=3,
+            maxblocksize=64,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            # three blocks are sent at once, and the blocks grow as they are
+            # acknowledged
+            self.assertUpdates([
+                {'header': 'sending %s' % self.datafile},
+                'write 16', 'write 16', 'write 16', 'write 32', 'write 64',
+                'write 36', 'close',
+                {'rc': 0}
+            ])
+            self.assertEqual(self.fakemaster.max_in_flight, 3)
+            self.assertEqual(self.fakemaster.data,
+                             open(self.datafile, 'rb').read())
+        d.addCallback(check)
+        return d
+
+    def test_pipelined_out_of_space(self):
+        self.fakemaster.write_out_of_space_at = 40
+        self.fakemaster.count_writes = True    # get actual byte counts
+
+        self.make_command(transfer.SlaveFileUploadCommand, dict(
+            workdir='workdir',
+            slavesrc='data',
+            writer=FakeRemote(self.fakemaster),
+            maxsize=1000,
+            blocksize=16,
+            keepstamp=False,
+            window=3,
+            maxblocksize=64,
+        ))
+
+        d = self.run_command()
+        self.assertFailure(d, RuntimeError)
+
+        def check(_):
+            self.assertUpdates([
+                {'header': 'sending %s' % self.datafile},
+                'write 16', 'close',
+                {'rc': 1}
+            ])
+        d.addCallback(check)
+        return d
+
     def test_timestamp(self):
         self.fakemaster.count_writes = True    # get actual byte counts
         timestamp = (os.path.getatime(self.datafile),
@@ -374,10 +530,87 @@ class TestSlaveDirectoryUpload(CommandTestMixin, unittest.TestCase):
 
         return d
 
+    def test_cas(self):
+        self.fakemaster.keep_data = True
+        digest = hashlib.sha256("lots of a" * 100).hexdigest()
+        self.fakemaster.cached.add(digest)
+
+        self.make_command(transfer.SlaveDirectoryUploadCommand, dict(
+            workdir='workdir',
+            slavesrc='data',
+            writer=FakeRemote(self.fakemaster),
+            maxsize=None,
+            blocksize=512,
+            compress=None,
+            cas=True,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertUpdates([
+                {'header': 'sending %s' % self.datadir},
+                'cached 2', 'write(s)', 'unpack',
+                {'rc': 0}
+            ])
+            a = tarfile.open(fileobj=StringIO.StringIO(self.fakemaster.data))
+            aa = a.getmember('aa')
+            self.assertEqual(aa.size, 0)
+            self.assertEqual(aa.pax_headers['BUILDBOT.cached'], digest)
+            self.assertEqual(a.extractfile('bb').read(), "and a little b" * 17)
+        d.addCallback(check)
+        return d
+
     # this is just a subclass of SlaveUpload, so the remaining permutations
     # are already tested
 
 
+class TestTarStream(unittest.TestCase):
+
+    def setUp(self):
+        self.datadir = os.path.abspath('tarstream')
+        if os.path.exists(self.datadir):
+            shutil.rmtree(self.datadir)
+        os.makedirs(os.path.join(self.datadir, 'sub' * 40))
+        open(os.path.join(self.datadir, 'aa'), 'wb').write('a' * 100000)
+        open(os.path.join(self.datadir, 'sub' * 40, 'bb'), 'wb').write('b')
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def readAll(self, stream, size):
+        data = []
+        while True:
+            block = stream.read(size)
+            # no more than a chunk of file data, or the padding at the end,
+            # is generated beyond what was asked for
+            self.assertTrue(len(stream.buffer) <=
+                            size + max(stream.chunksize, tarfile.RECORDSIZE))
+            if not block:
+                break
+            data.append(block)
+        stream.close()
+        return ''.join(data)
+
+    def test_same_as_tarfile(self):
+        f = StringIO.StringIO()
+        archive = tarfile.open(fileobj=f, mode='w')
+        archive.add(self.datadir, '')
+        archive.close()
+
+        stream = transfer.TarStream(self.datadir)
+        stream.chunksize = 1000
+        self.assertEqual(self.readAll(stream, 777), f.getvalue())
+
+    def test_compressed(self):
+        for compress in 'gz', 'bz2':
+            stream = transfer.TarStream(self.datadir, compress)
+            f = StringIO.StringIO(self.readAll(stream, 512))
+            archive = tarfile.open(fileobj=f, mode='r|' + compress)
+            self.assertEqual(sorted(m.name.rstrip('/') for m in archive),
+                             ['', 'aa', 'sub' * 40, 'sub' * 40 + '/bb'])
+
+
 class TestDownloadFile(CommandTestMixin, unittest.TestCase):
 
     def setUp(self):
@@ -425,6 +658,66 @@ class TestDownloadFile(CommandTestMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def test_pipelined(self):
+        self.fakemaster.count_reads = True    # get actual byte counts
+        self.fakemaster.delay_read = True
+        self.fakemaster.data = test_data = '1234' * 50
+
+        self.make_command(transfer.SlaveFileDownloadCommand, dict(
+            workdir='.',
+            slavedest='data',
+            reader=FakeRemote(self.fakemaster),
+            maxsize=None,
+            blocksize=16,
+            mode=None,
+            window=3,
+            maxblocksize=64,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            # the window stays full until the first empty read comes back
+            self.assertUpdates([
+                'read 16', 'read 16', 'read 16', 'read 32', 'read 64',
+                'read 64', 'read 64', 'read 64', 'read 64', 'close',
+                {'rc': 0}
+            ])
+            self.assertEqual(self.fakemaster.max_in_flight, 3)
+            datafile = os.path.join(self.basedir, 'data')
+            self.assertEqual(open(datafile).read(), test_data)
+        d.addCallback(check)
+        return d
+
+    def test_pipelined_truncated(self):
+        self.fakemaster.count_reads = True    # get actual byte counts
+        self.fakemaster.data = test_data = 'tenchars--' * 10
+
+        self.make_command(transfer.SlaveFileDownloadCommand, dict(
+            workdir='.',
+            slavedest='data',
+            reader=FakeRemote(self.fakemaster),
+            maxsize=50,
+            blocksize=16,
+            mode=None,
+            window=4,
+            maxblocksize=64,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertUpdates([
+                'read 16', 'read 32', 'read 2', 'close',
+                {'rc': 1,
+                 'stderr': "Maximum filesize reached, truncating file '%s'"
+                 % os.path.join(self.basedir, '.', 'data')}
+            ])
+            datafile = os.path.join(self.basedir, 'data')
+            self.assertEqual(open(datafile).read(), test_data[:50])
+        d.addCallback(check)
+        return d
+
     def test_mkdir(self):
         self.fakemaster.data = test_data = 'hi'
 
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# usage: python dirupload_benchmark.py [num_files] [file_kb] [compress]
+#
+# Uploads a directory of num_files files of file_kb each with a slave
+# directory upload command, to a writer that discards the data, and prints
+# the time until the first block was sent, the total time, and the temporary
+# disk space in use when the first block was sent.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+from buildslave.commands import transfer
+from buildslave.test.fake.remote import FakeRemote
+from buildslave.test.fake.slavebuilder import FakeSlaveBuilder
+
+
+def diskUsage(path):
+    return sum(os.path.getsize(os.path.join(dirpath, name))
+               for dirpath, _, names in os.walk(path) for name in names)
+
+
+class Writer(object):
+
+    def __init__(self, tmpdir):
+        self.tmpdir = tmpdir
+        self.size = 0
+        self.first = None
+
+    def remote_write(self, data):
+        if self.first is None:
+            self.first = time.time(), diskUsage(self.tmpdir)
+        self.size += len(data)
+
+    def remote_close(self):
+        pass
+
+    def remote_unpack(self):
+        pass
+
+
+@defer.inlineCallbacks
+def main(num_files, file_kb, compress, basedir):
+    srcdir = os.path.join(basedir, 'src')
+    os.makedirs(srcdir)
+    for i in xrange(num_files):
+        with open(os.path.join(srcdir, 'file%d' % i), 'wb') as f:
+            f.write(os.urandom(file_kb * 1024))
+    tempfile.tempdir = os.path.join(basedir, 'tmp')
+    os.makedirs(tempfile.tempdir)
+
+    builder = FakeSlaveBuilder(basedir=basedir)
+    writer = Writer(tempfile.tempdir)
+    cmd = transfer.SlaveDirectoryUploadCommand(builder, 'upload', dict(
+        workdir='.', slavesrc='src', writer=FakeRemote(writer),
+        maxsize=None, blocksize=16 * 1024, compress=compress))
+    start = time.time()
+    yield cmd.doStart()
+    end = time.time()
+
+    print "%d files of %dKB, compress=%s" % (num_files, file_kb, compress)
+    print "first block after %8.1fms" % ((writer.first[0] - start) * 1000,)
+    print "total            %8.1fms" % ((end - start) * 1000,)
+    print "temporary disk   %8.1fMB" % (writer.first[1] / 1024. / 1024,)
+
+
+if __name__ == '__main__':
+    num_files = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    file_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    compress = sys.argv[3] if len(sys.argv) > 3 else None
+    basedir = tempfile.mkdtemp()
+    d = main(num_files, file_kb, compress, basedir)
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+    shutil.rmtree(basedir)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+# usage: python transfer_benchmark.py [size_mb] [rtt_ms]
+#
+# Measures the throughput of file uploads and downloads between a slave
+# transfer command and a PB writer or reader, connected over loopback through
+# a proxy that delays each direction by half of rtt_ms, with several windows
+# and maximum block sizes.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from twisted.internet import defer
+from twisted.internet import protocol
+from twisted.internet import reactor
+from twisted.spread import pb
+
+from buildslave.commands import transfer
+from buildslave.test.fake.slavebuilder import FakeSlaveBuilder
+
+
+class DelayedProxy(protocol.Protocol):
+
+    # one end of a proxied connection; data is passed on to the other end
+    # after a delay, in the order it arrived
+
+    peer = None
+
+    def connectionMade(self):
+        self.pending = []
+
+    def dataReceived(self, data):
+        reactor.callLater(self.factory.delay, self.forward, data)
+
+    def forward(self, data):
+        if self.peer is not None:
+            self.peer.transport.write(data)
+        else:
+            self.pending.append(data)
+
+    def setPeer(self, peer):
+        self.peer = peer
+        for data in self.pending:
+            peer.transport.write(data)
+        self.pending = []
+
+    def connectionLost(self, reason):
+        if self.peer is not None:
+            self.peer.transport.loseConnection()
+
+
+class ProxyFactory(protocol.ServerFactory):
+
+    protocol = DelayedProxy
+
+    def __init__(self, port, delay):
+        self.port = port
+        self.delay = delay
+
+    def buildProtocol(self, addr):
+        p = protocol.ServerFactory.buildProtocol(self, addr)
+        client = protocol.ClientCreator(reactor, DelayedProxy)
+        d = client.connectTCP('127.0.0.1', self.port)
+
+        @d.addCallback
+        def connected(other):
+            other.factory = self
+            other.setPeer(p)
+            p.setPeer(other)
+        return p
+
+
+class Writer(pb.Referenceable):
+
+    def __init__(self):
+        self.size = 0
+
+    def remote_write(self, data):
+        self.size += len(data)
+
+    def remote_close(self):
+        pass
+
+
+class Reader(pb.Referenceable):
+
+    def __init__(self, size):
+        self.remaining = size
+
+    def remote_read(self, length):
+        length = min(length, self.remaining)
+        self.remaining -= length
+        return '\0' * length
+
+    def remote_close(self):
+        pass
+
+
+class Root(pb.Root):
+
+    def __init__(self, size):
+        self.size = size
+
+    def remote_writer(self):
+        return Writer()
+
+    def remote_reader(self):
+        return Reader(self.size)
+
+
+@defer.inlineCallbacks
+def timeTransfer(root, basedir, size, window, maxblocksize):
+    builder = FakeSlaveBuilder(basedir=basedir)
+    args = dict(workdir='.', maxsize=None, blocksize=16 * 1024,
+                window=window, maxblocksize=maxblocksize)
+    result = []
+
+    writer = yield root.callRemote('writer')
+    cmd = transfer.SlaveFileUploadCommand(builder, 'upload', dict(
+        args, slavesrc='data', writer=writer, keepstamp=False))
+    start = time.time()
+    yield cmd.doStart()
+    result.append(size / (time.time() - start) / 1024 / 1024)
+
+    reader = yield root.callRemote('reader')
+    cmd = transfer.SlaveFileDownloadCommand(builder, 'download', dict(
+        args, slavedest='copy', reader=reader, mode=None))
+    start = time.time()
+    yield cmd.doStart()
+    result.append(size / (time.time() - start) / 1024 / 1024)
+    assert os.path.getsize(os.path.join(basedir, 'copy')) == size
+
+    print "window %2d, maxblocksize %6s: upload %7.2fMB/s download %7.2fMB/s" \
+        % ((window, maxblocksize or '-') + tuple(result))
+
+
+@defer.inlineCallbacks
+def main(size, rtt, basedir):
+    with open(os.path.join(basedir, 'data'), 'wb') as f:
+        f.write('\0' * size)
+    server = reactor.listenTCP(0, pb.PBServerFactory(Root(size)),
+                               interface='127.0.0.1')
+    proxy = reactor.listenTCP(0, ProxyFactory(server.getHost().port, rtt / 2),
+                              interface='127.0.0.1')
+    factory = pb.PBClientFactory()
+    reactor.connectTCP('127.0.0.1', proxy.getHost().port, factory)
+    root = yield factory.getRootObject()
+
+    print "%dMB, %.0fms round trip" % (size / 1024 / 1024, rtt * 1000)
+    for window, maxblocksize in [(1, None), (4, None), (4, 256 * 1024),
+                                 (16, 256 * 1024)]:
+        yield timeTransfer(root, basedir, size, window, maxblocksize)
+    factory.disconnect()
+
+
+if __name__ == '__main__':
+    size = int(float(sys.argv[1]) * 1024 * 1024) if len(sys.argv) > 1 \
+        else 4 * 1024 * 1024
+    rtt = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.05
+    basedir = tempfile.mkdtemp()
+    d = main(size, rtt, basedir)
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+    shutil.rmtree(basedir)